@@ -0,0 +1,84 @@
+#! /usr/bin/python3
+
+# Benchmark html_extractor.extract_many (threads) against the
+# process-pool approach used by preprocess_observations_v3.py, over a
+# sample of pages stored in the collection database.
+#
+# usage: bench_extract_many.py DBNAME [N_PAGES [THREAD_COUNTS...]]
+
+import multiprocessing
+import os
+import sys
+import time
+import zlib
+
+import psycopg2
+
+import html_extractor
+
+def load_pages(dbname, n_pages):
+    db = psycopg2.connect(dbname=dbname)
+    cur = db.cursor()
+    cur.execute("SELECT h.content, s.url"
+                "  FROM collection.capture_html_content h"
+                "  JOIN collection.captured_pages c ON c.html_content = h.id"
+                "  JOIN collection.url_strings s ON c.redir_url = s.id"
+                " LIMIT %s", (n_pages,))
+    pages = []
+    for content, url in cur:
+        try:
+            page = zlib.decompress(content)
+        except zlib.error:
+            page = b''
+        pages.append((url, page, "text/html", ""))
+    db.close()
+    return pages
+
+# This is what the process-pool scripts have to do: the worker can't
+# send back the ExtractedContent object itself, so it sends a tuple
+# of its interesting fields.
+def extract_in_process(args):
+    extr = html_extractor.ExtractedContent(*args)
+    return (extr.url, extr.title, extr.text_content, extr.text_pruned,
+            extr.headings, extr.links, extr.resources,
+            extr.dom_stats.to_json(), extr.original)
+
+def report(label, pages, elapsed):
+    nbytes = sum(len(p[1]) for p in pages)
+    sys.stdout.write("{:<16} {:>8.2f}s {:>8.1f} pages/s {:>8.2f} MB/s\n"
+                     .format(label, elapsed, len(pages)/elapsed,
+                             nbytes/elapsed/1e6))
+    sys.stdout.flush()
+
+def main():
+    dbname = sys.argv[1]
+    n_pages = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    ncpu = os.cpu_count() or 1
+    if len(sys.argv) > 3:
+        thread_counts = [int(x) for x in sys.argv[3:]]
+    else:
+        thread_counts = sorted(set([1, 2, 4, ncpu]))
+
+    pages = load_pages(dbname, n_pages)
+    sys.stdout.write("{} pages, {:.1f} MB\n"
+                     .format(len(pages),
+                             sum(len(p[1]) for p in pages)/1e6))
+
+    start = time.monotonic()
+    for args in pages:
+        html_extractor.ExtractedContent(*args)
+    report("serial", pages, time.monotonic() - start)
+
+    with multiprocessing.Pool(ncpu) as pool:
+        start = time.monotonic()
+        for _ in pool.imap_unordered(extract_in_process, pages, 16):
+            pass
+        report("processes x{}".format(ncpu), pages,
+               time.monotonic() - start)
+
+    for n in thread_counts:
+        start = time.monotonic()
+        html_extractor.extract_many(pages, n, return_exceptions=True)
+        report("threads x{}".format(n), pages, time.monotonic() - start)
+
+main()
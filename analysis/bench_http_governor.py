@@ -0,0 +1,119 @@
+#! /usr/bin/python3
+
+# Benchmark http_governor against a simulated service that can handle
+# CAPACITY requests per second.  Requests beyond that are refused with
+# 429 and a Retry-After header, and a few others fail with 503, as
+# the Wayback Machine and Google Translate do.  Each configuration
+# below is run for N_REQUESTS requests, issued by 32 concurrent
+# tasks; the governor's report (rates, retries, latency and
+# throughput histograms) is printed for each.
+#
+# usage: bench_http_governor.py [N_REQUESTS [CAPACITY [URL]]]
+#
+# If URL is given, the requests are instead sent, with aiohttp, to
+# that URL (e.g. a local mock server), and CAPACITY only sets the
+# initial rate.
+
+import asyncio
+import random
+import sys
+import time
+
+import http_governor
+
+CONFIGS = [
+    # name, endpoint parameters
+    ("fixed rate",  dict(increase=0, decrease=1.0, error_decrease=1.0)),
+    ("aimd",        dict()),
+    ("aimd, no retry-after", dict(honor_retry_after=False)),
+]
+
+class SimulatedService:
+    """Token bucket of CAPACITY requests per second; the latency of
+       each request is lognormal around LATENCY seconds."""
+
+    def __init__(self, capacity, latency, error_rate, loop):
+        self.capacity   = capacity
+        self.latency    = latency
+        self.error_rate = error_rate
+        self.loop       = loop
+        self.rng        = random.Random(0)
+        self.tokens     = capacity
+        self.refilled   = loop.time()
+
+    @asyncio.coroutine
+    def handle(self, method, url, kwargs):
+        now = self.loop.time()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.refilled) * self.capacity)
+        self.refilled = now
+        if self.tokens < 1:
+            yield from asyncio.sleep(self.latency / 10, loop=self.loop)
+            return http_governor.Response(
+                429, "Too Many Requests", { "retry-after": "1" }, b"")
+        self.tokens -= 1
+
+        yield from asyncio.sleep(
+            self.rng.lognormvariate(0, 0.5) * self.latency, loop=self.loop)
+        if self.rng.random() < self.error_rate:
+            return http_governor.Response(503, "Service Unavailable", {}, b"")
+        return http_governor.Response(200, "OK", {}, b"x" * 2048)
+
+@asyncio.coroutine
+def client(gov, queue, url):
+    while True:
+        try:
+            queue.get_nowait()
+        except asyncio.QueueEmpty:
+            return
+        resp = yield from gov.request("bench", "GET", url)
+        if resp.status != 200:
+            gov.n_failed += 1
+
+def run_one(loop, n_requests, capacity, url, name, params):
+    if url is None:
+        service = SimulatedService(capacity, 0.05, 0.01, loop)
+        transport = http_governor.StubTransport(service.handle, loop=loop)
+        url = "http://bench.invalid/"
+    else:
+        transport = http_governor.AiohttpTransport(
+            loop=loop, connections_per_host=32)
+
+    gov = http_governor.HTTPGovernor(transport, loop=loop)
+    gov.n_failed = 0
+    # Start out too fast, as a client that doesn't know the capacity would.
+    gov.add_endpoint("bench", rate=capacity * 2, concurrency=32,
+                     max_rate=capacity * 4, timeout=10, **params)
+
+    queue = asyncio.Queue(loop=loop)
+    for i in range(n_requests):
+        queue.put_nowait(i)
+
+    start = time.monotonic()
+    loop.run_until_complete(asyncio.wait(
+        [loop.create_task(client(gov, queue, url)) for _ in range(32)],
+        loop=loop))
+    elapsed = time.monotonic() - start
+
+    sys.stdout.write("== {}: {} requests in {:.2f}s, {:.1f} req/s,"
+                     " {} failed\n"
+                     .format(name, n_requests, elapsed,
+                             n_requests / elapsed, gov.n_failed))
+    gov.report(sys.stdout)
+    transport.close()
+    sys.stdout.write("\n")
+    sys.stdout.flush()
+
+def main():
+    n_requests = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    capacity   = float(sys.argv[2]) if len(sys.argv) > 2 else 100
+    url        = sys.argv[3] if len(sys.argv) > 3 else None
+
+    loop = asyncio.get_event_loop()
+    try:
+        for name, params in CONFIGS:
+            run_one(loop, n_requests, capacity, url, name, params)
+    finally:
+        loop.close()
+
+main()
@@ -0,0 +1,70 @@
+#! /usr/bin/python3
+
+# Benchmark the Stanford segmenters: one pipe round trip per
+# presegmented token (the original approach) against one round trip
+# per document, with and without a pool of segmenter processes.
+#
+# usage: bench_stanford_segmenter.py [REPEAT [POOL_SIZE]]
+#
+# The sample text is fixed, so numbers are comparable across runs.
+# REPEAT (default 200) controls how many copies of the sample make
+# up each "document".
+
+import sys
+import time
+
+import word_seg
+from word_seg import stanford
+
+SAMPLES = {
+    'zh': ("中华人民共和国是位于东亚的社会主义国家，首都为北京。"
+           "全国共划分为二十三个省、五个自治区、四个直辖市和两个特别行政区。"
+           "http://www.example.cn/ 中国是世界上人口最多的国家之一。 "),
+    'ar': ("اللغة العربية هي أكثر اللغات تحدثاً ونطقاً ضمن مجموعة اللغات "
+           "السامية، وإحدى أكثر اللغات انتشاراً في العالم. "
+           "http://www.example.sa/ وللعربية أهمية قصوى لدى المسلمين. "),
+}
+
+CLASSES = {
+    'zh': stanford.ChineseSegmenter,
+    'ar': stanford.ArabicSegmenter,
+}
+
+def run(label, lang, fn, text):
+    start = time.monotonic()
+    n = sum(1 for _ in fn(text))
+    elapsed = time.monotonic() - start
+    sys.stdout.write("{} {:<16} {:>8} tokens {:>8.2f}s {:>10.1f} tokens/s\n"
+                     .format(lang, label, n, elapsed, n/elapsed))
+    sys.stdout.flush()
+    return n
+
+def main():
+    repeat    = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    pool_size = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+
+    segmenter = word_seg.Segmenter()
+    for lang, sample in sorted(SAMPLES.items()):
+        text = sample * repeat
+        cls  = CLASSES[lang]
+
+        single = cls()
+        # Make sure JVM startup is not counted against either method.
+        single.segment_many(["warm"])
+        n_old = run("per-token", lang,
+                    lambda t: segmenter._presegment_internal(
+                        t, single.segment), text)
+        n_new = run("batched", lang,
+                    lambda t: segmenter._presegment_batched(
+                        t, single.segment_many), text)
+
+        pool = stanford.SegmenterPool(cls, pool_size)
+        pool.segment_many(["warm"] * (pool_size * pool.MIN_SHARD))
+        n_pool = run("batched x{}".format(pool_size), lang,
+                     lambda t: segmenter._presegment_batched(
+                         t, pool.segment_many), text)
+
+        if not n_old == n_new == n_pool:
+            sys.stdout.write("{}: token counts differ!\n".format(lang))
+
+main()
@@ -0,0 +1,59 @@
+#! /usr/bin/python3
+
+# Benchmark topic_similarity.TopicSimilarity on synthetic translated
+# texts, in batches of 100 pairs (as TopicAnalyzer sends them), using
+# a thread pool of each of the given sizes.
+#
+# usage: bench_topic_similarity.py [N_PAIRS [THREADS...]]
+
+import concurrent.futures
+import random
+import sys
+import time
+
+import topic_similarity
+
+BATCH = 100
+
+def make_pairs(n, rng):
+    """Successive snapshots of pages, compared pairwise as the history
+       scanner does: each snapshot either repeats the previous one
+       with a few words changed, or is about something else.  Word
+       frequencies are roughly Zipfian."""
+    vocab = ["term{}".format(i) for i in range(50000)]
+    weights = [1/(i+1) for i in range(len(vocab))]
+    pairs = []
+    prev = None
+    for i in range(n):
+        if prev is None or i % 10 == 0 or rng.random() < 0.3:
+            words = rng.choices(vocab, weights, k=rng.randint(50, 2000))
+        else:
+            words = prev[:]
+            for _ in range(len(words) // 20):
+                words[rng.randrange(len(words))] = rng.choice(vocab)
+        if prev is not None and i % 10 != 0:
+            pairs.append(("en," + " ".join(prev), "en," + " ".join(words)))
+        prev = words
+    return pairs
+
+def main():
+    n_pairs = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    threads = [int(x) for x in sys.argv[2:]] or [1, 2, 4]
+    pairs = make_pairs(n_pairs, random.Random(0))
+    batches = [pairs[i:i+BATCH] for i in range(0, n_pairs, BATCH)]
+
+    for n_threads in threads:
+        # Fresh engine each time so the vector cache starts cold.
+        engine = topic_similarity.TopicSimilarity()
+        start = time.monotonic()
+        with concurrent.futures.ThreadPoolExecutor(n_threads) as pool:
+            n_same = sum(sum(r) for r in
+                         pool.map(engine.same_topic_many, batches))
+        elapsed = time.monotonic() - start
+        sys.stdout.write("{:>2} threads: {:>8} pairs {:>8.2f}s"
+                         " {:>10.1f} pairs/s ({} same)\n"
+                         .format(n_threads, n_pairs, elapsed,
+                                 n_pairs/elapsed, n_same))
+        sys.stdout.flush()
+
+main()
@@ -0,0 +1,49 @@
+#! /usr/bin/python3
+
+# Benchmark word_seg startup: the time for a fresh interpreter to
+# import word_seg, construct the Segmenter, and compile the Stanford
+# segmenters' presegmentation regexes, with the character-class cache
+# (see word_seg/charclasses.py) cold and warm.
+#
+# usage: bench_word_seg_startup.py [REPEAT]
+
+import os
+import subprocess
+import sys
+import tempfile
+
+CHILD = r"""
+import time
+t0 = time.monotonic()
+import word_seg
+from word_seg import stanford
+t1 = time.monotonic()
+word_seg.Segmenter()
+t2 = time.monotonic()
+stanford.ArabicSegmenter._get_presegment_re()
+stanford.ChineseSegmenter._get_presegment_re()
+t3 = time.monotonic()
+print(t1-t0, t2-t1, t3-t2)
+"""
+
+def run_child(cache_dir):
+    env = dict(os.environ, WORD_SEG_CACHE_DIR=cache_dir)
+    out = subprocess.check_output(
+        [sys.executable, "-c", CHILD], env=env,
+        cwd=os.path.dirname(os.path.abspath(__file__)))
+    return [float(x) for x in out.split()]
+
+def report(label, times):
+    sys.stdout.write("{:<6} import {:>7.3f}s  Segmenter {:>7.3f}s  "
+                     "stanford regexes {:>7.3f}s  total {:>7.3f}s\n"
+                     .format(label, *times, sum(times)))
+    sys.stdout.flush()
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    with tempfile.TemporaryDirectory() as cache_dir:
+        report("cold", run_child(cache_dir))
+        for _ in range(repeat):
+            report("warm", run_child(cache_dir))
+
+main()
@@ -3,7 +3,11 @@
 # C++-level API, in particular the encoding and language hints and the
 # flags, which are not especially useful in this application.
 
+import os as _os
+from concurrent.futures import ThreadPoolExecutor as _ThreadPoolExecutor
+
 from libcpp cimport bool as bool_t
+from libcpp.vector cimport vector
 
 cimport compact_lang_det
 from compact_lang_det cimport UNKNOWN_ENCODING, UNKNOWN_LANGUAGE, \
@@ -78,7 +82,80 @@ cdef class DetectedLanguages:
         self.scores = scores
         self.chunks = chunks
 
-cpdef detect(text, lang_hint=None, tld_hint=None, want_chunks=False):
+# One detection's worth of ExtDetectLanguageSummary arguments and
+# out-parameters.  (hoo boy, it has a lot of out-parameters, eh?)
+cdef struct _Detection:
+    const char                *text
+    int                        text_len
+    compact_lang_det.Language  chosen
+    compact_lang_det.Language  top3[3]
+    int                        pct3[3]
+    double                     score3[3]
+    int                        text_bytes
+    bool_t                     reliable
+
+cdef int _run_detection(_Detection *d,
+                        const compact_lang_det.CLDHints *hints,
+                        ResultChunkVector *chunks) except -1 nogil:
+    d.chosen = compact_lang_det.ExtDetectLanguageSummary(
+        d.text, d.text_len, True, hints, 0,
+        d.top3, d.pct3, d.score3, chunks,
+        &d.text_bytes, &d.reliable)
+    return 0
+
+cdef bytes _capped_utf8(text, max_bytes):
+    """Encode TEXT as UTF-8, then, if MAX_BYTES is not None, cut it to
+       at most that many bytes, without splitting a character."""
+    cdef bytes u8text = _as_utf8(text)
+    cdef Py_ssize_t n
+    if max_bytes is None or len(u8text) <= max_bytes:
+        return u8text
+    n = max_bytes
+    # Back up over continuation bytes (10xxxxxx) to a character start.
+    while n > 0 and (u8text[n] & 0xC0) == 0x80:
+        n -= 1
+    return u8text[:n]
+
+cdef DetectedLanguages _make_result(text, bytes u8text, _Detection *d,
+                                    ResultChunkVector *raw_chunks):
+    cdef list scores = []
+    # This typecast seems to be required only in -3 mode :-(
+    if d.chosen == <int>UNKNOWN_LANGUAGE or not d.reliable:
+        scores.append(Language(UNKNOWN_LANGUAGE, 0, 0))
+    else:
+        # If chosen isn't UNKNOWN_LANGUAGE, it will be one of the top3.
+        # Sort that to the beginning.
+        if d.chosen == d.top3[0]:   a,b,c = 0,1,2
+        elif d.chosen == d.top3[1]: a,b,c = 1,0,2
+        elif d.chosen == d.top3[2]: a,b,c = 2,0,1
+        else:
+            raise AssertionError("chosen_lang not found in top3")
+
+        assert d.top3[a] != <int>UNKNOWN_LANGUAGE
+        scores.append(Language(d.top3[a], d.score3[a], d.pct3[a]))
+
+        if d.top3[b] != <int>UNKNOWN_LANGUAGE:
+            scores.append(Language(d.top3[b], d.score3[b], d.pct3[b]))
+        if d.top3[c] != <int>UNKNOWN_LANGUAGE:
+            scores.append(Language(d.top3[c], d.score3[c], d.pct3[c]))
+
+    cdef list chunks
+    if raw_chunks is not NULL:
+        chunks = [
+            (Language(<compact_lang_det.Language>x.lang1, -1, -1),
+             u8text[x.offset : (x.offset + x.bytes)].decode('utf-8'))
+            for x in raw_chunks[0]
+        ]
+    else:
+        chunks = []
+
+    return DetectedLanguages(text, scores, chunks)
+
+cpdef detect(text, lang_hint=None, tld_hint=None, want_chunks=False,
+             max_bytes=None):
+    """Detect the language(s) of TEXT.  Returns a DetectedLanguages
+       object.  If MAX_BYTES is not None, only the first MAX_BYTES
+       bytes of the UTF-8 encoding of TEXT are examined."""
     cdef compact_lang_det.CLDHints hints
     if lang_hint is not None:
         # reuse lang_hint as an owning reference to the bytes object
@@ -99,58 +176,90 @@ cpdef detect(text, lang_hint=None, tld_hint=None, want_chunks=False):
     hints.language_hint = UNKNOWN_LANGUAGE
 
     # Must precalculate these before dropping the GIL.
-    cdef bytes u8text = _as_utf8(text)
-    cdef const char *u8text_raw = u8text
-    cdef int u8text_len = len(u8text)
-    cdef bool_t want_chunks_raw = want_chunks
-
-    # hoo boy, ExtDetectLanguageSummary has a lot of out-parameters, eh?
-    cdef compact_lang_det.Language top3[3]
-    cdef int                       pct3[3]
-    cdef double                    score3[3]
-    cdef ResultChunkVector         raw_chunks
-    cdef int                       text_bytes
-    cdef bool_t                    reliable
+    cdef bytes u8text = _capped_utf8(text, max_bytes)
+    cdef _Detection d
+    d.text     = u8text
+    d.text_len = len(u8text)
+
+    cdef ResultChunkVector raw_chunks
+    cdef ResultChunkVector *chunks_p = &raw_chunks if want_chunks else NULL
 
     with nogil:
-        chosen_lang = compact_lang_det.ExtDetectLanguageSummary(
-            u8text_raw, u8text_len, True, &hints, 0,
-            top3, pct3, score3,
-            &raw_chunks if want_chunks_raw else NULL,
-            &text_bytes, &reliable)
+        _run_detection(&d, &hints, chunks_p)
 
-    cdef list scores = []
-    # This typecast seems to be required only in -3 mode :-(
-    if chosen_lang == <int>UNKNOWN_LANGUAGE or not reliable:
-        scores.append(Language(UNKNOWN_LANGUAGE, 0, 0))
-    else:
-        # If chosen_lang isn't UNKNOWN_LANGUAGE, it will be one of the top3.
-        # Sort that to the beginning.
-        if chosen_lang == top3[0]:   a,b,c = 0,1,2
-        elif chosen_lang == top3[1]: a,b,c = 1,0,2
-        elif chosen_lang == top3[2]: a,b,c = 2,0,1
-        else:
-            raise AssertionError("chosen_lang not found in top3")
+    return _make_result(text, u8text, &d, chunks_p)
 
-        assert top3[a] != <int>UNKNOWN_LANGUAGE
-        scores.append(Language(top3[a], score3[a], pct3[a]))
+cdef class _Batch:
+    """Inputs and outputs for detect_many.  Separate threads each run
+       a disjoint range of the detections, without the GIL."""
+    cdef list                      u8texts
+    cdef vector[_Detection]        dets
+    cdef vector[ResultChunkVector] chunks
+    cdef bool_t                    want_chunks
+    cdef compact_lang_det.CLDHints hints
 
-        if top3[b] != <int>UNKNOWN_LANGUAGE:
-            scores.append(Language(top3[b], score3[b], pct3[b]))
-        if top3[c] != <int>UNKNOWN_LANGUAGE:
-            scores.append(Language(top3[c], score3[c], pct3[c]))
+    def __cinit__(self, list u8texts, bint want_chunks):
+        cdef Py_ssize_t i, n = len(u8texts)
+        cdef bytes t
+        self.u8texts     = u8texts
+        self.want_chunks = want_chunks
+        self.dets.resize(n)
+        if want_chunks:
+            self.chunks.resize(n)
+        for i in range(n):
+            t = u8texts[i]
+            self.dets[i].text     = t
+            self.dets[i].text_len = len(t)
 
-    cdef list chunks
-    if want_chunks:
-        chunks = [
-            (Language(<compact_lang_det.Language>x.lang1, -1, -1),
-             u8text[x.offset : (x.offset + x.bytes)].decode('utf-8'))
-            for x in raw_chunks
-        ]
+        self.hints.content_language_hint = NULL
+        self.hints.tld_hint              = NULL
+        self.hints.encoding_hint         = UNKNOWN_ENCODING
+        self.hints.language_hint         = UNKNOWN_LANGUAGE
+
+    def run(self, Py_ssize_t start, Py_ssize_t stop):
+        cdef Py_ssize_t i
+        with nogil:
+            for i in range(start, stop):
+                _run_detection(&self.dets[i], &self.hints,
+                               &self.chunks[i] if self.want_chunks
+                               else NULL)
+
+    cdef DetectedLanguages result(self, Py_ssize_t i, text):
+        return _make_result(text, self.u8texts[i], &self.dets[i],
+                            &self.chunks[i] if self.want_chunks else NULL)
+
+def detect_many(texts, want_chunks=False, n_threads=None, max_bytes=None):
+    """Detect the language(s) of each of TEXTS, using N_THREADS threads
+       (default: one per CPU).  Returns a list of DetectedLanguages
+       objects, in the same order as TEXTS.  WANT_CHUNKS and MAX_BYTES
+       have the same meaning as for detect().
+
+       All of the texts are encoded to UTF-8 up front; the detection
+       itself runs without the GIL, so the threads really do run in
+       parallel.
+    """
+    texts = list(texts)
+    cdef _Batch batch = _Batch([_capped_utf8(t, max_bytes) for t in texts],
+                               want_chunks)
+    cdef Py_ssize_t n = len(texts)
+
+    if n_threads is None:
+        n_threads = _os.cpu_count() or 1
+    n_threads = max(1, min(n_threads, n))
+
+    if n_threads == 1:
+        batch.run(0, n)
     else:
-        chunks = []
+        # Several ranges per thread, so that one range full of long
+        # texts doesn't leave the other threads idle at the end.
+        step = max(1, n // (n_threads * 4))
+        starts = range(0, n, step)
+        stops  = [min(s + step, n) for s in starts]
+        with _ThreadPoolExecutor(n_threads) as pool:
+            for _ in pool.map(batch.run, starts, stops):
+                pass
 
-    return DetectedLanguages(text, scores, chunks)
+    return [batch.result(i, texts[i]) for i in range(n)]
 
 cpdef get_all_languages():
     """Returns a dictionary mapping language codes to language names for
@@ -1,40 +1,160 @@
 #! /usr/bin/python3
 
-import difflib
-import psycopg2
+# Compare the original segmentation of each document
+# (extracted_plaintext.segmented) with its resegmentation
+# (extracted_pt_resegment.segmented; see resegment.py), and report
+# per-language statistics: how many documents were affected, token
+# and boundary precision and recall of the resegmentation relative to
+# the original, and the most common differences.  See seg_diff/compare.py
+# for the definitions.
+#
+# usage: compare_seg.py [options] DBNAME > report
+#
+# With --diffs FILE, a token-level unified diff of each differing
+# document that involves one of the "interesting" languages (or any
+# language, with --all-languages) is written to FILE.
+#
+# Rows are streamed through a server-side cursor and compared in a
+# pool of worker processes.
+
+import argparse
+import multiprocessing
+import os
 import sys
+import time
+
+import psycopg2
+
+from seg_diff import DocComparison, merge_stats
 
 interesting = frozenset(('zh', 'zh-Hant', 'ja', 'vi', 'th',
                          'ar', 'fa', 'ku', 'ps', 'ur'))
-def is_interesting(s, interesting=interesting):
-    for chunk in s:
-        if chunk['l'] in interesting:
-            return True
-    return False
-
-def flatten_segmented(s):
-    rv = []
-    for chunk in s:
-        l = chunk['l']
-        rv.extend("{}  {}\n".format(l, w)
-                  for w in chunk['t'])
-    return rv
-
-def compare_segmented(out, id, p, q):
-    if is_interesting(p) or is_interesting(q):
-        p = flatten_segmented(p)
-        q = flatten_segmented(q)
-        out.writelines(difflib.unified_diff(p, q, str(id), str(id)))
 
-def main():
-    out = sys.stdout
-    db = psycopg2.connect(dbname=sys.argv[1])
-    cur = db.cursor()
+# Each worker's, and the parent's, table of divergent hunks is cut
+# down to this many entries per language when it grows past twice that.
+DIVERGENT_KEEP = 10000
+
+def fmt_interval(interval):
+    m, s = divmod(interval, 60)
+    h, m = divmod(m, 60)
+    return "{}:{:>02}:{:>05.2f}".format(int(h), int(m), s)
+
+def trim_stats(stats):
+    for s in stats.values():
+        if len(s.divergent) > 2 * DIVERGENT_KEEP:
+            s.trim(DIVERGENT_KEEP)
+
+def compare_batch(args):
+    """Worker: compare each (id, p, q) row in ROWS.  Returns the
+       accumulated statistics and the text of the diffs, if wanted."""
+    rows, want_diffs, all_languages = args
+    stats = {}
+    diffs = []
+    for id, p, q in rows:
+        dc = DocComparison(p, q)
+        dc.add_to(stats)
+        if want_diffs and (all_languages or
+                           not interesting.isdisjoint(dc.languages())):
+            diffs.extend(dc.unified_diff(str(id), str(id)))
+    trim_stats(stats)
+    return len(rows), stats, "".join(diffs)
+
+def scan(db, pool, args, diff_out):
+    cur = db.cursor("compare_seg_scan")
+    cur.itersize = args.batch_size
     cur.execute("SELECT p.id, p.segmented, q.segmented"
                 "  FROM extracted_plaintext p, extracted_pt_resegment q"
                 " WHERE p.id = q.id AND p.segmented IS NOT NULL"
                 "   AND p.segmented <> q.segmented")
-    for row in cur:
-        compare_segmented(out, *row)
 
-main()
+    stats = {}
+    n_docs = 0
+    start = time.monotonic()
+    want_diffs = diff_out is not None
+    while True:
+        # Keep every worker busy, but never hold more than a few
+        # batches per worker in memory.
+        block = []
+        for _ in range(args.workers * 4):
+            rows = cur.fetchmany(args.batch_size)
+            if not rows:
+                break
+            block.append((rows, want_diffs, args.all_languages))
+        if not block:
+            break
+
+        for n, bstats, diffs in pool.imap_unordered(compare_batch, block):
+            n_docs += n
+            merge_stats(stats, bstats)
+            if diffs:
+                diff_out.write(diffs)
+        trim_stats(stats)
+        sys.stderr.write("{}: {} documents compared\n"
+                         .format(fmt_interval(time.monotonic() - start),
+                                 n_docs))
+        sys.stderr.flush()
+
+    cur.close()
+    return n_docs, stats
+
+def report(out, n_docs, stats, top):
+    out.write("{} documents with differing segmentations\n\n"
+              .format(n_docs))
+    out.write("{:<8} {:>9} {:>9} {:>7}  {:>6} {:>6}  {:>6} {:>6}\n"
+              .format("lang", "docs", "affected", "%", "tok-P", "tok-R",
+                      "bnd-P", "bnd-R"))
+    order = sorted(stats.items(),
+                   key=lambda kv: (-kv[1].docs_affected, kv[0]))
+    for lang, s in order:
+        out.write("{:<8} {:>9} {:>9} {:>6.1%}  {:>6.3f} {:>6.3f}"
+                  "  {:>6.3f} {:>6.3f}\n"
+                  .format(lang, s.docs, s.docs_affected,
+                          s.docs_affected / s.docs if s.docs else 0,
+                          s.token_precision, s.token_recall,
+                          s.boundary_precision, s.boundary_recall))
+
+    if not top:
+        return
+    for lang, s in order:
+        if not s.divergent:
+            continue
+        out.write("\n{}: most common differences\n".format(lang))
+        for (ph, qh), n in s.divergent.most_common(top):
+            out.write("  {:>8}  {} => {}\n".format(n, ph or "∅", qh or "∅"))
+
+def main():
+    ap = argparse.ArgumentParser(
+        description="Compare original and resegmented word segmentations.")
+    ap.add_argument("dbname")
+    ap.add_argument("--diffs", metavar="FILE",
+                    help="Write per-document token diffs to FILE.")
+    ap.add_argument("--all-languages", action="store_true",
+                    help="Write diffs for all documents, not just those"
+                         " involving the languages of interest.")
+    ap.add_argument("--top", type=int, default=20,
+                    help="Number of differences to list per language"
+                         " (default %(default)s).")
+    ap.add_argument("--workers", type=int, default=os.cpu_count(),
+                    help="Number of worker processes"
+                         " (default: one per CPU).")
+    ap.add_argument("--batch-size", type=int, default=200,
+                    help="Documents per batch (default %(default)s).")
+    args = ap.parse_args()
+
+    diff_out = open(args.diffs, "w") if args.diffs else None
+    try:
+        # Start the workers before connecting, so they don't inherit the
+        # database connection.
+        with multiprocessing.Pool(args.workers) as pool:
+            db = psycopg2.connect(dbname=args.dbname)
+            cur = db.cursor()
+            cur.execute("SET search_path TO analysis, public")
+            n_docs, stats = scan(db, pool, args, diff_out)
+    finally:
+        if diff_out is not None:
+            diff_out.close()
+
+    report(sys.stdout, n_docs, stats, args.top)
+
+if __name__ == '__main__':
+    main()
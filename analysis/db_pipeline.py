@@ -0,0 +1,420 @@
+# Three-stage pipeline for batch jobs over rows of the analysis database.
+#
+# resegment.py, segment_raw_text.py and redetect_langs.py all have the
+# same shape: select the rows that still need processing, push them
+# through some CPU-bound function, and write the results back.  Done
+# one step at a time -- read a batch, process it, write it, repeat --
+# the workers sit idle while each batch is read and written.  Pipeline
+# instead runs
+#
+#     reader thread  -->  worker pool  -->  writer thread
+#
+# with bounded queues between the stages, so that reading, processing
+# and writing all overlap, and memory use stays bounded.
+#
+# The reader fetches rows in id order, a batch at a time, with keyset
+# pagination: no list of ids is built up front, and no cursor is held
+# open across the writer's commits.  The writer loads each batch of
+# results with COPY and commits it.  The selection query is expected
+# to exclude rows that have already been processed, so an interrupted
+# run can simply be restarted.  The progress reports also give the id
+# below which every row has been committed ("resume after"), which
+# can be passed back as start_after to skip rescanning that part of
+# the table.
+
+import collections
+import concurrent.futures
+import io
+import os
+import queue
+import sys
+import threading
+import time
+
+import psycopg2
+
+__all__ = ['Pipeline', 'fmt_interval']
+
+# How often (in seconds) blocked stages check whether another stage
+# has failed.
+_POLL = 0.5
+
+_DONE = object()
+
+def fmt_interval(interval):
+    m, s = divmod(interval, 60)
+    h, m = divmod(m, 60)
+    return "{}:{:>02}:{:>05.2f}".format(int(h), int(m), s)
+
+# COPY's text format.  PostgreSQL does not support NUL in TEXT at all,
+# so it is replaced with U+FFFD.
+_COPY_ESCAPES = str.maketrans({ "\\": "\\\\", "\t": "\\t",
+                                "\n": "\\n",  "\r": "\\r",
+                                "\x00": "\ufffd" })
+
+def _copy_line(row):
+    return "\t".join("\\N" if v is None else str(v).translate(_COPY_ESCAPES)
+                     for v in row) + "\n"
+
+def _process_batch(args):
+    """Worker: apply PROCESS to ROWS, and time it."""
+    process, seq, rows = args
+    start = time.monotonic()
+    results = process(rows)
+    return seq, results, time.monotonic() - start
+
+def _as_future(pool, args):
+    """Run _process_batch(ARGS) on POOL, which may be either a
+       multiprocessing.Pool or a concurrent.futures.Executor (such as
+       extraction_service.ExtractionService), and return a Future."""
+    if hasattr(pool, "apply_async"):
+        fut = concurrent.futures.Future()
+        pool.apply_async(_process_batch, (args,),
+                         callback=fut.set_result,
+                         error_callback=fut.set_exception)
+        return fut
+    return pool.submit(_process_batch, args)
+
+class Pipeline:
+    """Read rows from the database, process them in batches, and write
+       the results back, with all three stages running concurrently.
+
+       Constructor arguments:
+           connect       - Callable returning a new database connection.
+                           The reader and the writer each get their own.
+           select        - Query for the next batch of rows to process.
+                           It must take the parameters %(after)s and
+                           %(limit)s, and return at most LIMIT rows with
+                           id > AFTER, in increasing order of id, which
+                           must be the first column.  Ids are assumed
+                           to be positive.
+           process       - Function applied to each batch (a list of
+                           rows) in the pool.  It must return a list
+                           of rows to be written, and be picklable
+                           (i.e. defined at the top level of a module).
+           copy_to       - Table that the results are COPYed into.
+           columns       - Column names for the COPY (default: all, in
+                           order).
+           count         - Optional query for the number of rows to be
+                           processed, for estimates of time remaining.
+           prepare       - Optional function applied to each batch in
+                           the reader thread, before it goes to the pool.
+                           Useful for work that releases the GIL.
+           session_setup - Statements to execute on both connections
+                           when they are opened (e.g. SET search_path).
+           writer_setup  - Statements to execute on the writer's
+                           connection when it is opened (e.g. to create
+                           a temporary table for copy_to).
+           finish        - Statements to execute after each COPY, in the
+                           same transaction (e.g. UPDATE ... FROM the
+                           temporary table).
+           batch_size    - Rows per batch.
+           max_in_flight - Maximum number of batches read but not yet
+                           written (default: twice the number of CPUs).
+           start_after   - Begin with the first row whose id is greater
+                           than this.
+           report_interval - Seconds between progress reports.
+           stage_report  - Optional callable returning extra text for
+                           the progress reports (e.g. the pool's
+                           stage_report method).
+           log           - File to write progress reports to.
+
+       If a whole batch cannot be written, it is written one row at a
+       time instead, and rows that still fail are reported and skipped.
+    """
+
+    def __init__(self, connect, select, process, copy_to, *,
+                 columns=None, count=None, prepare=None,
+                 session_setup=(), writer_setup=(), finish=(),
+                 batch_size=1000, max_in_flight=None, start_after=0,
+                 report_interval=60, stage_report=None, log=sys.stdout):
+
+        if max_in_flight is None:
+            max_in_flight = 2 * (os.cpu_count() or 1)
+
+        self.connect         = connect
+        self.select          = select
+        self.process         = process
+        self.count           = count
+        self.prepare         = prepare
+        self.session_setup   = tuple(session_setup)
+        self.writer_setup    = tuple(writer_setup)
+        self.finish          = tuple(finish)
+        self.batch_size      = batch_size
+        self.max_in_flight   = max_in_flight
+        self.start_after     = start_after
+        self.report_interval = report_interval
+        self.stage_report    = stage_report
+        self.log             = log
+
+        self._copy_sql = "COPY {}{} FROM STDIN".format(
+            copy_to, "" if columns is None else
+            " ({})".format(", ".join(columns)))
+
+        self.stats = collections.Counter()
+
+    def run(self, pool=None):
+        """Run the pipeline to completion, processing batches on POOL
+           (a multiprocessing.Pool or a concurrent.futures.Executor;
+           by default, a single thread).  Returns the stats Counter."""
+        if pool is None:
+            with concurrent.futures.ThreadPoolExecutor(1) as pool:
+                return self.run(pool)
+
+        self._start       = time.monotonic()
+        self._last_report = self._start
+        self._stop        = threading.Event()
+        self._failure     = None
+        self._total       = None
+        self._lock        = threading.Lock()
+        self._committed   = set()
+        self._resume_seq  = 0
+        self._resume_id   = self.start_after
+        self._last_ids    = {}
+        self.stats.clear()
+
+        todo = queue.Queue(self.max_in_flight)
+        done = queue.Queue(self.max_in_flight)
+        reader = threading.Thread(target=self._read, args=(todo,),
+                                  name="Pipeline reader", daemon=True)
+        writer = threading.Thread(target=self._write, args=(done,),
+                                  name="Pipeline writer", daemon=True)
+        reader.start()
+        writer.start()
+        try:
+            self._dispatch(pool, todo, done)
+        except BaseException as e:
+            self._fail(e)
+        finally:
+            self._put(done, _DONE)
+            reader.join()
+            writer.join()
+
+        if self._failure is not None:
+            raise self._failure
+        self._report(final=True)
+        return self.stats
+
+    # Internal: stage bodies.
+
+    def _open(self):
+        db = self.connect()
+        with db.cursor() as cur:
+            for stmt in self.session_setup:
+                cur.execute(stmt)
+        db.commit()
+        return db
+
+    def _read(self, todo):
+        try:
+            db = self._open()
+            try:
+                cur = db.cursor()
+                if self.count is not None:
+                    cur.execute(self.count)
+                    self._total = cur.fetchone()[0]
+                    db.commit()
+                    self._write_log("{} rows to process".format(self._total))
+
+                after = self.start_after
+                seq = 0
+                while not self._stop.is_set():
+                    start = time.monotonic()
+                    cur.execute(self.select,
+                                { "after": after, "limit": self.batch_size })
+                    rows = cur.fetchall()
+                    # Don't hold a snapshot open while waiting for the
+                    # downstream stages.
+                    db.commit()
+                    if not rows:
+                        break
+                    after = rows[-1][0]
+                    n = len(rows)
+                    if self.prepare is not None:
+                        rows = self.prepare(rows)
+                    with self._lock:
+                        self._last_ids[seq] = after
+                        self.stats["rows_read"] += n
+                        self.stats["read_time"] += time.monotonic() - start
+                    if not self._put(todo, (seq, rows)):
+                        break
+                    seq += 1
+            finally:
+                db.close()
+        except BaseException as e:
+            self._fail(e)
+        finally:
+            self._put(todo, _DONE)
+
+    def _dispatch(self, pool, todo, done):
+        pending = set()
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < self.max_in_flight:
+                try:
+                    # Only wait for the reader if the pool has nothing
+                    # to do.
+                    if pending:
+                        item = todo.get_nowait()
+                    else:
+                        item = todo.get(timeout=_POLL)
+                except queue.Empty:
+                    if pending or self._stop.is_set():
+                        break
+                    continue
+                if item is _DONE:
+                    exhausted = True
+                    break
+                seq, rows = item
+                pending.add(_as_future(pool, (self.process, seq, rows)))
+
+            if self._stop.is_set():
+                return
+            if not pending:
+                if exhausted:
+                    return
+                continue
+
+            finished, pending = concurrent.futures.wait(
+                pending, timeout=_POLL,
+                return_when=concurrent.futures.FIRST_COMPLETED)
+            for fut in finished:
+                seq, results, elapsed = fut.result()
+                with self._lock:
+                    self.stats["process_time"] += elapsed
+                if not self._put(done, (seq, results)):
+                    return
+
+    def _write(self, done):
+        try:
+            db = self._open()
+            try:
+                cur = db.cursor()
+                for stmt in self.writer_setup:
+                    cur.execute(stmt)
+                db.commit()
+
+                while True:
+                    item = self._get(done)
+                    if item is _DONE:
+                        break
+                    seq, results = item
+                    start = time.monotonic()
+                    written = self._write_batch(db, cur, results)
+                    self._committed_batch(seq, len(results), written,
+                                          time.monotonic() - start)
+            finally:
+                db.close()
+        except BaseException as e:
+            self._fail(e)
+
+    def _copy(self, cur, rows):
+        cur.copy_expert(self._copy_sql,
+                        io.StringIO("".join(_copy_line(r) for r in rows)))
+        for stmt in self.finish:
+            cur.execute(stmt)
+
+    def _write_batch(self, db, cur, results):
+        """Write and commit RESULTS.  Returns the number of rows written."""
+        if not results:
+            return 0
+        try:
+            self._copy(cur, results)
+            db.commit()
+            return len(results)
+        except psycopg2.Error as e:
+            db.rollback()
+            self._write_log("*** batch of {} rows failed ({}); retrying"
+                            " one row at a time"
+                            .format(len(results), str(e).strip()))
+
+        written = 0
+        for row in results:
+            cur.execute("SAVEPOINT pipeline_row")
+            try:
+                self._copy(cur, (row,))
+                written += 1
+            except psycopg2.Error as e:
+                cur.execute("ROLLBACK TO SAVEPOINT pipeline_row")
+                self._write_log("*** id {} not written: {}"
+                                .format(row[0], str(e).strip()))
+            cur.execute("RELEASE SAVEPOINT pipeline_row")
+        db.commit()
+        return written
+
+    # Internal: bookkeeping.
+
+    def _committed_batch(self, seq, n_results, n_written, elapsed):
+        with self._lock:
+            self.stats["batches"] += 1
+            self.stats["rows_written"] += n_written
+            self.stats["rows_failed"] += n_results - n_written
+            self.stats["write_time"] += elapsed
+
+            # Batches finish out of order; the resume point only
+            # advances past a batch when all earlier ones are done.
+            self._committed.add(seq)
+            while self._resume_seq in self._committed:
+                self._committed.remove(self._resume_seq)
+                self._resume_id = self._last_ids.pop(self._resume_seq)
+                self._resume_seq += 1
+
+        if time.monotonic() - self._last_report >= self.report_interval:
+            self._report()
+
+    def _report(self, final=False):
+        now = time.monotonic()
+        self._last_report = now
+        elapsed = now - self._start
+        with self._lock:
+            s = dict(self.stats)
+            resume_id = self._resume_id
+
+        done = s.get("rows_written", 0) + s.get("rows_failed", 0)
+        rate = done / elapsed if elapsed > 0 else 0
+        if self._total and rate and not final:
+            remain = " remaining {}".format(
+                fmt_interval(max(0, self._total - done) / rate))
+        else:
+            remain = ""
+        msg = ("{}{} rows ({:.1f}/s){}; {} failed; resume after {};"
+               " read {:.1f}s, process {:.1f}s, write {:.1f}s"
+               .format(done,
+                       "/{}".format(self._total) if self._total else "",
+                       rate, remain, s.get("rows_failed", 0), resume_id,
+                       s.get("read_time", 0), s.get("process_time", 0),
+                       s.get("write_time", 0)))
+        if self.stage_report is not None:
+            msg += "; " + self.stage_report()
+        self._write_log(msg)
+
+    def _write_log(self, message):
+        self.log.write("{}: {}\n".format(
+            fmt_interval(time.monotonic() - self._start), message))
+        self.log.flush()
+
+    def _fail(self, exc):
+        with self._lock:
+            if self._failure is None:
+                self._failure = exc
+        self._stop.set()
+
+    def _put(self, q, item):
+        """Put ITEM on Q, unless the pipeline is stopped first.
+           Returns True if the item was queued."""
+        while True:
+            try:
+                q.put(item, timeout=_POLL)
+                return True
+            except queue.Full:
+                if self._stop.is_set():
+                    return False
+
+    def _get(self, q):
+        """Get an item from Q; returns _DONE if the pipeline is stopped."""
+        while True:
+            try:
+                return q.get(timeout=_POLL)
+            except queue.Empty:
+                if self._stop.is_set():
+                    return _DONE
@@ -5,28 +5,158 @@ import configparser
 import os
 import regex as re
 
+try:
+    import re._parser as sre_parse
+    import re._constants as sre_constants
+except ImportError:
+    import sre_parse
+    import sre_constants
+
 __all__ = ('ParkingClassifier', 'ParkingClassification')
 
 MODE_FILE = os.path.join(os.path.dirname(__file__), "modes.cf")
 RULE_FILE = os.path.join(os.path.dirname(__file__), "rules.cf")
 
+# Literals shorter than this are not worth prefiltering on.
+MIN_PREFILTER_LEN = 4
+
+# When a rule begins with a literal, try to match it at no more than
+# this many occurrences of the literal before falling back to an
+# ordinary search (starting from the last one tried).
+MAX_LITERAL_PROBES = 8
+
+def fold_case(text):
+    """Case-fold TEXT for comparison against prefilter literals.  This
+       must map every character that one of the rules' literals matches
+       case-insensitively to that literal's own folded form.  The one
+       exception str.casefold() makes is U+0130 (capital I with dot
+       above), which regex matches against 'i' but which folds to
+       'i' + U+0307; deleting all U+0307 covers that, and can only
+       produce extra prefilter hits, never lose one."""
+    return text.casefold().replace("\u0307", "")
+
+def _literal(seq):
+    """If the parsed subpattern SEQ matches only a fixed string,
+       return that string; otherwise None."""
+    chars = []
+    for op, av in seq:
+        if op is not sre_constants.LITERAL:
+            return None
+        chars.append(chr(av))
+    return "".join(chars)
+
+def required_literals(rule):
+    """Analyze the regular expression RULE and return a 2-tuple
+       (literals, leading), where LITERALS is a tuple of (case-folded)
+       strings at least one of which must occur in any text that RULE
+       matches, and LEADING is true if every match must begin with one
+       of them.  Returns None if no usable set of literals is found.
+
+       Only the top level of the pattern is examined.  Runs of literal
+       characters are candidates, as are groups whose alternatives are
+       all literal strings, like (buy|purchase); of the candidates, the
+       one whose shortest member is longest is chosen.  The rules are
+       written for 'regex', but in practice use only the syntax that
+       're' also understands, so its parser serves for this; any rule
+       it cannot parse just doesn't get a prefilter."""
+    try:
+        parsed = sre_parse.parse(rule, sre_constants.SRE_FLAG_VERBOSE)
+    except Exception:
+        return None
+
+    candidates = []
+    run = []
+    run_start = 0
+    def end_run():
+        if run:
+            candidates.append((("".join(run),), run_start == 0))
+            del run[:]
+
+    for i, (op, av) in enumerate(parsed):
+        if op is sre_constants.LITERAL:
+            if not run:
+                run_start = i
+            run.append(chr(av))
+            continue
+        end_run()
+        if op is sre_constants.SUBPATTERN:
+            body = av[-1]
+            if len(body) == 1 and body[0][0] is sre_constants.BRANCH:
+                alts = [_literal(alt) for alt in body[0][1][1]]
+            else:
+                alts = [_literal(body)]
+            if all(alts):
+                candidates.append((tuple(alts), i == 0))
+    end_run()
+
+    best = max(candidates, key=lambda c: min(len(s) for s in c[0]),
+               default=None)
+    if best is None or min(len(s) for s in best[0]) < MIN_PREFILTER_LEN:
+        return None
+    return (tuple(fold_case(s) for s in best[0]), best[1])
+
 class Ruleset:
-    """A set of tagged regular expressions."""
-    def __init__(self, label, ruledict, only=None):
+    """A set of tagged regular expressions.
+
+       Each rule is paired with the output of required_literals(), if
+       PREFILTER is true.  test() skips the full regular expression
+       search for any rule none of whose required literals appear in
+       the (case-folded) text; searching a 200kB page for a handful of
+       fixed strings is far cheaper than running the regex engine over
+       it, and most rules don't match most pages.
+
+       When a rule's literals are known to begin every match, and the
+       text is pure ASCII (so offsets in the folded text are also
+       offsets in the original), the search starts at the first
+       occurrence of a literal, and for a single literal that occurs
+       only a few times, the rule is tried only at those places.
+    """
+    def __init__(self, label, ruledict, only=None, prefilter=True):
         self.label = label
         self.rules = [
-            (tag, re.compile(rule, re.VERBOSE|re.IGNORECASE))
+            (tag, re.compile(rule, re.VERBOSE|re.IGNORECASE),
+             required_literals(rule) if prefilter else None)
             for tag, rule in ruledict.items()
             if (only is None or tag in only)
         ]
 
-    def test(self, text):
+    def test(self, text, folded=None, first_only=False):
         """Match TEXT against all of the regular expressions in this
-           set, and return the tags of those that matched."""
-        return [
-            tag for tag, rule in self.rules
-            if rule.search(text)
-        ]
+           set, and return the tags of those that matched.  FOLDED
+           should be fold_case(TEXT); if it is None, no prefiltering is
+           done.  If FIRST_ONLY is true, stop after the first match."""
+        matched = []
+        ascii = folded is not None and text.isascii()
+        for tag, rule, prefilter in self.rules:
+            if folded is None or prefilter is None:
+                found = rule.search(text)
+            elif ascii and prefilter[1]:
+                found = self._search_from_literals(rule, text, folded,
+                                                   prefilter[0])
+            else:
+                found = (any(lit in folded for lit in prefilter[0]) and
+                         rule.search(text))
+            if found:
+                matched.append(tag)
+                if first_only:
+                    break
+        return matched
+
+    @staticmethod
+    def _search_from_literals(rule, text, folded, literals):
+        starts = [pos for pos in (folded.find(lit) for lit in literals)
+                  if pos >= 0]
+        if not starts:
+            return False
+        pos = min(starts)
+        if len(literals) == 1:
+            for _ in range(MAX_LITERAL_PROBES):
+                if rule.match(text, pos):
+                    return True
+                pos = folded.find(literals[0], pos + 1)
+                if pos < 0:
+                    return False
+        return rule.search(text, pos)
 
 ParkingClassification = collections.namedtuple(
     "ParkingClassification",
@@ -37,25 +167,35 @@ class ParkingClassifier:
        site.
 
        Methods:
-           isParked(html)  - returns a named 2-tuple:
+           isParked(html, all_matches=True)
+                           - returns a named 2-tuple:
                              (is_parked, rules_matched)
                              is_parked is true or false, and rules is
-                             the list of all rules that matched.
+                             the list of all rules that matched (or,
+                             if all_matches is false, enough of them
+                             to justify the verdict).
 
        Properties:
            mode            - The classification mode (see modes.cf)
            size_limit      - Pages larger than this are assumed not
                              to be parked.
+           prefilter       - Whether to skip rules whose required
+                             literal strings do not appear in the page
+                             (see Ruleset).  This never changes the
+                             result; it is only there so the unfiltered
+                             behavior can be benchmarked.
     """
 
     def __init__(self, *,
                  mode='full',
                  size_limit=200000,
                  modefile=MODE_FILE,
-                 rulefile=RULE_FILE):
+                 rulefile=RULE_FILE,
+                 prefilter=True):
 
         self.mode       = mode
         self.size_limit = size_limit
+        self.prefilter  = prefilter
 
         mode_p = configparser.ConfigParser(interpolation=None,
                                            allow_no_value=True)
@@ -79,11 +219,14 @@ class ParkingClassifier:
                 raise ValueError("ruleset {!r} missing from {!r}"
                                  .format(ruleset, rulefile))
 
-        self.strong_rules = Ruleset("strong", rule_p["strong"], only)
-        self.weak_rules_1 = Ruleset("weak1",  rule_p["weak1"],  only)
-        self.weak_rules_2 = Ruleset("weak2",  rule_p["weak2"],  only)
+        self.strong_rules = Ruleset("strong", rule_p["strong"], only,
+                                    prefilter)
+        self.weak_rules_1 = Ruleset("weak1",  rule_p["weak1"],  only,
+                                    prefilter)
+        self.weak_rules_2 = Ruleset("weak2",  rule_p["weak2"],  only,
+                                    prefilter)
 
-    def isParked(self, html):
+    def isParked(self, html, all_matches=True):
         """Test whether HTML appears to be a webpage from a parked domain.
            Returns a 2-tuple (is_parked, rules_matched) where is_parked
            is a boolean and rules_matched is the list of all rules
@@ -92,11 +235,24 @@ class ParkingClassifier:
            A page is considered to be parked if it matches at least
            one of the "strong" rules, or if it matches at least one of
            the "weak1" rules _and_ at least one of the "weak2" rules.
+
+           If ALL_MATCHES is false, testing stops as soon as the
+           verdict is known, so rules_matched will be incomplete (but
+           nonempty if is_parked is true).
         """
+        folded = fold_case(html) if self.prefilter else None
 
-        m_strong = self.strong_rules.test(html)
-        m_weak1  = self.weak_rules_1.test(html)
-        m_weak2  = self.weak_rules_2.test(html)
+        if all_matches:
+            m_strong = self.strong_rules.test(html, folded)
+            m_weak1  = self.weak_rules_1.test(html, folded)
+            m_weak2  = self.weak_rules_2.test(html, folded)
+        else:
+            m_strong = self.strong_rules.test(html, folded, True)
+            m_weak1 = m_weak2 = []
+            if not m_strong:
+                m_weak1 = self.weak_rules_1.test(html, folded, True)
+                if m_weak1:
+                    m_weak2 = self.weak_rules_2.test(html, folded, True)
 
         is_parked = bool(m_strong) or (bool(m_weak1) and bool(m_weak2))
         rules_matched = m_strong + m_weak1 + m_weak2
@@ -107,12 +263,12 @@ class ParkingClassifier:
 # Self-tests
 #
 
-def testParkedSample(content_dir, filename, classifier, outf):
+def testParkedSample(content_dir, filename, classifier, outf, results=None):
     import time, datetime
 
     ok = 0
     errors = []
-    start = time.monotonic()
+    elapsed = 0
 
     with open(filename) as f:
         for line in f:
@@ -129,7 +285,12 @@ def testParkedSample(content_dir, filename, classifier, outf):
             with open(content_file, encoding='utf-8') as cf:
                 content = cf.read()
 
+            start = time.monotonic()
             result = classifier.isParked(content)
+            elapsed += time.monotonic() - start
+            if results is not None:
+                results[(filename, id)] = result
+
             if(result.is_parked == cls):
                 ok += 1
             else:
@@ -137,28 +298,52 @@ def testParkedSample(content_dir, filename, classifier, outf):
                               .format(id, cls, result.is_parked,
                                       result.rules_matched))
 
-    interval = datetime.timedelta(seconds=time.monotonic() - start)
+    interval = datetime.timedelta(seconds=elapsed)
 
     errors.sort()
-    outf.write("{} (mode {!r}): {}\n"
+    outf.write("{} (mode {!r}, prefilter {}): {}\n"
                "OK: {}\n"
                "Errors:\n  {}\n\n"
-               .format(filename, classifier.mode, interval, ok,
-                       "\n   ".join(errors)))
+               .format(filename, classifier.mode, classifier.prefilter,
+                       interval, ok, "\n   ".join(errors)))
 
     return (not errors)
 
-def testRules(mode, outf, samples):
-    classifier = ParkingClassifier(mode=mode)
+def testRules(mode, outf, samples, prefilter=True, results=None):
+    classifier = ParkingClassifier(mode=mode, prefilter=prefilter)
     success = True
     for i in range(0, len(samples), 2):
         success = testParkedSample(
-            samples[i], samples[i+1], classifier, outf) and success
+            samples[i], samples[i+1], classifier, outf, results) and success
     return success
 
+def benchPrefilter(mode, outf, samples):
+    """Run the labeled samples through the classifier with and without
+       the literal prefilter, and check that every page gets exactly
+       the same classification (including the list of rules matched)
+       either way.  The timings are printed by testParkedSample."""
+    plain = {}
+    filtered = {}
+    testRules(mode, outf, samples, False, plain)
+    testRules(mode, outf, samples, True, filtered)
+
+    mismatches = sorted(k for k in plain if plain[k] != filtered.get(k))
+    for fname, id in mismatches:
+        outf.write("{}: {}: without prefilter {}, with prefilter {}\n"
+                   .format(fname, id, plain[(fname, id)],
+                           filtered.get((fname, id))))
+    outf.write("mode {!r}: {} pages, {} differences\n\n"
+               .format(mode, len(plain), len(mismatches)))
+    return not mismatches
+
 if __name__ == '__main__':
     import sys
+    args = sys.argv[1:]
+    test = testRules
+    if args and args[0] == '--bench':
+        test = benchPrefilter
+        args = args[1:]
     success = True
     for mode in ('full', 'balanced', 'min'):
-        success = testRules(mode, sys.stdout, sys.argv[1:]) and success
+        success = test(mode, sys.stdout, args) and success
     sys.exit(0 if success else 1)
@@ -0,0 +1,388 @@
+# Pre-forked worker processes for the CPU-bound half of page analysis
+# (HTML content extraction, language detection, word segmentation,
+# and domain-parking classification).
+#
+# Several scripts need to push a stream of pages through the same
+# handful of expensive libraries.  Each used to set up its own process
+# pool, and each worker in each pool paid for the expensive parts of
+# initialization (the Stanford segmenters start a JVM;
+# ParkingClassifier compiles several hundred regexes) on its first
+# task, in the middle of the run.  ExtractionService does all of that
+# up front, before a worker is handed any work, and replaces workers
+# whose memory usage grows too large (the JVMs and the HTML parser
+# both tend to hold on to memory).
+#
+# ExtractionService is a concurrent.futures.Executor, so it can be
+# used with loop.run_in_executor() as well as directly.  Requests and
+# responses travel over a pipe per worker, as pickled tuples; the
+# function to run must therefore be picklable (i.e. defined at the
+# top level of some module).
+#
+# Task functions can attribute their running time to named stages
+# with the stage() context manager; the totals are accumulated by the
+# service and reported by stage_report().
+
+import collections
+import concurrent.futures
+import contextlib
+import multiprocessing
+import multiprocessing.connection
+import os
+import sys
+import threading
+import time
+import traceback
+
+__all__ = ['ExtractionService', 'stage', 'parking_classifier',
+           'DEFAULT_WARM_LANGS']
+
+# Languages whose segmenters are started in every worker by default.
+# These are the ones that involve an external library or process.
+DEFAULT_WARM_LANGS = ('zh', 'ar', 'ja', 'th', 'vi')
+
+# A scrap of text to push through each segmenter during warm-up.
+# It does not need to be in the right language, only to reach the
+# language-specific segmenter after presegmentation.
+_WARMUP_TEXT = "warm up 预热 تسخين"
+
+#
+# Worker-side state.
+#
+
+_stage_times  = collections.Counter()
+_parking_cfr  = None
+
+@contextlib.contextmanager
+def stage(name):
+    """Attribute the time spent in the body of the 'with' statement
+       to the stage NAME.  Outside a worker process this is harmless,
+       but the times go nowhere."""
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        _stage_times[name] += time.monotonic() - start
+
+def parking_classifier():
+    """Return this process's domain-parking classifier, creating it
+       if necessary."""
+    global _parking_cfr
+    if _parking_cfr is None:
+        import domainparking
+        _parking_cfr = domainparking.ParkingClassifier()
+    return _parking_cfr
+
+def _warm_up(warm_langs, want_parking):
+    import cld2
+    import html_extractor
+    import word_seg
+
+    with stage("warmup"):
+        # The first call to any of the word_seg entry points
+        # constructs the shared Segmenter.
+        word_seg.is_nonword("")
+        html_extractor.ExtractedContent("http://example.com/",
+                                        b"<html><body><p>warm up</p>")
+        cld2.detect(_WARMUP_TEXT)
+
+        for lang in warm_langs:
+            try:
+                list(word_seg.segment(lang, _WARMUP_TEXT))
+            except Exception as e:
+                # Leave it to fail, with a proper traceback, if a real
+                # task ever needs this segmenter.
+                sys.stderr.write("extraction_service: warming up {!r}: {}\n"
+                                 .format(lang, e))
+
+        if want_parking:
+            parking_classifier()
+
+def _current_rss():
+    """Resident set size of this process, in bytes."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        import resource
+        # ru_maxrss is in kilobytes on Linux; this is a high-water
+        # mark rather than a current value, but close enough.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def _worker_main(conn, warm_langs, want_parking, max_rss):
+    try:
+        _warm_up(warm_langs, want_parking)
+    except BaseException:
+        conn.send(("failed", traceback.format_exc()))
+        return
+    conn.send(("ready", dict(_stage_times), _current_rss()))
+
+    while True:
+        try:
+            msg = conn.recv()
+        except EOFError:
+            return
+        if msg is None:
+            return
+
+        fn, args, kwargs = msg
+        _stage_times.clear()
+        try:
+            result = (True, fn(*args, **kwargs))
+        except BaseException as e:
+            e.__traceback_text__ = traceback.format_exc()
+            result = (False, e)
+
+        rss = _current_rss()
+        retire = bool(max_rss) and rss > max_rss
+        try:
+            conn.send(("done", result, dict(_stage_times), rss, retire))
+        except Exception as e:
+            # Most likely the result or the exception could not be
+            # pickled.
+            conn.send(("done",
+                       (False, RuntimeError("could not send result: {!r}"
+                                            .format(e))),
+                       dict(_stage_times), rss, retire))
+        if retire:
+            return
+
+#
+# Parent side.
+#
+
+class WorkerCrashed(RuntimeError):
+    """A worker process exited while it was working on a task."""
+
+class _Worker:
+    def __init__(self, ctx, args):
+        self.conn, child_conn = ctx.Pipe()
+        self.proc = ctx.Process(target=_worker_main,
+                                args=(child_conn,) + args,
+                                daemon=True)
+        self.proc.start()
+        child_conn.close()
+        self.ready   = False
+        self.task    = None
+        self.started = time.monotonic()
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.conn.close()
+
+class ExtractionService(concurrent.futures.Executor):
+    """Pool of pre-forked, pre-warmed worker processes.
+
+       Constructor arguments:
+           n_workers    - Number of worker processes (default: one per CPU).
+           warm_langs   - Languages whose word segmenters should be
+                          started in each worker before it takes any work.
+           want_parking - Whether to construct a ParkingClassifier in
+                          each worker.
+           max_rss      - If a worker's resident set size exceeds this
+                          many bytes after completing a task, it is
+                          replaced with a fresh one.  None to disable.
+           mp_context   - multiprocessing context to use for the
+                          workers (default: the global one).
+
+       Besides the Executor interface (submit, map, shutdown), this
+       provides imap_unordered() with the same semantics as
+       multiprocessing.Pool's, and these statistics:
+           tasks_done       - Number of tasks completed.
+           workers_recycled - Number of workers replaced due to
+                              memory growth or crashes.
+           stage_times      - Counter mapping stage names to total
+                              seconds spent in that stage, across
+                              all workers.
+    """
+
+    def __init__(self, n_workers=None, *,
+                 warm_langs=DEFAULT_WARM_LANGS,
+                 want_parking=True,
+                 max_rss=4 * 1024**3,
+                 mp_context=None):
+
+        if n_workers is None:
+            n_workers = os.cpu_count() or 1
+        if mp_context is None:
+            mp_context = multiprocessing.get_context()
+
+        self._ctx         = mp_context
+        self._worker_args = (tuple(warm_langs), want_parking, max_rss)
+        self._n_workers   = n_workers
+
+        self.tasks_done       = 0
+        self.workers_recycled = 0
+        self.stage_times      = collections.Counter()
+
+        self._lock     = threading.Lock()
+        self._pending  = collections.deque()
+        self._shutdown = False
+        self._broken   = None
+        self._wake_r, self._wake_w = mp_context.Pipe(duplex=False)
+        self._workers  = [_Worker(mp_context, self._worker_args)
+                          for _ in range(n_workers)]
+
+        self._dispatcher = threading.Thread(
+            target=self._dispatch, name="ExtractionService", daemon=True)
+        self._dispatcher.start()
+
+    def submit(self, fn, *args, **kwargs):
+        with self._lock:
+            if self._broken is not None:
+                raise RuntimeError("extraction service failed: {!r}"
+                                   .format(self._broken))
+            if self._shutdown:
+                raise RuntimeError("cannot submit after shutdown")
+            fut = concurrent.futures.Future()
+            self._pending.append((fut, fn, args, kwargs))
+        self._wake()
+        return fut
+
+    def imap_unordered(self, fn, iterable):
+        """Apply FN to each item of ITERABLE in a worker, and yield the
+           results in order of completion."""
+        futs = [self.submit(fn, item) for item in iterable]
+        for fut in concurrent.futures.as_completed(futs):
+            yield fut.result()
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            self._shutdown = True
+        self._wake()
+        if wait:
+            self._dispatcher.join()
+
+    def stage_report(self):
+        """Return a one-line summary of the time spent per stage."""
+        total = sum(self.stage_times.values()) or 1
+        return "{} tasks, {} recycled; ".format(
+            self.tasks_done, self.workers_recycled) + ", ".join(
+            "{}: {:.1f}s ({:.0%})".format(name, secs, secs/total)
+            for name, secs in self.stage_times.most_common())
+
+    # Internal:
+    def _wake(self):
+        try:
+            self._wake_w.send(None)
+        except OSError:
+            pass
+
+    def _replace(self, worker):
+        worker.conn.close()
+        worker.proc.join()
+        self.workers_recycled += 1
+        i = self._workers.index(worker)
+        self._workers[i] = _Worker(self._ctx, self._worker_args)
+
+    def _handle(self, worker):
+        try:
+            msg = worker.conn.recv()
+        except (EOFError, OSError):
+            if worker.task is not None:
+                worker.task[0].set_exception(WorkerCrashed(
+                    "worker {} exited with code {}".format(
+                        worker.proc.pid, worker.proc.exitcode)))
+            self._replace(worker)
+            return
+
+        if msg[0] == "ready":
+            worker.ready = True
+            self.stage_times.update(msg[1])
+            return
+
+        if msg[0] == "failed":
+            # Warm-up failed; there is no point retrying that.
+            sys.stderr.write("extraction_service: worker startup failed:\n"
+                             + msg[1])
+            worker.conn.close()
+            worker.proc.join()
+            self._workers.remove(worker)
+            if not self._workers:
+                self._fail_all(RuntimeError("all workers failed to start"))
+            return
+
+        _, (ok, value), times, rss, retire = msg
+        fut = worker.task[0]
+        worker.task = None
+        self.tasks_done += 1
+        self.stage_times.update(times)
+        if ok:
+            fut.set_result(value)
+        else:
+            fut.set_exception(value)
+        if retire:
+            self._replace(worker)
+
+    def _fail_all(self, exc):
+        with self._lock:
+            pending = list(self._pending)
+            self._pending.clear()
+            self._shutdown = True
+        for fut, *_ in pending:
+            if fut.set_running_or_notify_cancel():
+                fut.set_exception(exc)
+
+    def _assign(self):
+        for worker in self._workers:
+            while worker.ready and worker.task is None:
+                while True:
+                    with self._lock:
+                        if not self._pending:
+                            return
+                        task = self._pending.popleft()
+                    if task[0].set_running_or_notify_cancel():
+                        break
+                worker.task = task
+                try:
+                    worker.conn.send(task[1:])
+                except Exception as e:
+                    # Either the task could not be pickled, in which
+                    # case nothing was sent and the worker can take
+                    # the next one, or the pipe is broken, in which
+                    # case the worker has exited and _handle will
+                    # replace it.
+                    worker.task = None
+                    task[0].set_exception(e)
+                    if isinstance(e, OSError):
+                        worker.ready = False
+
+    def _dispatch(self):
+        try:
+            self._dispatch_loop()
+        except BaseException as e:
+            # Without the dispatcher, nothing would ever complete;
+            # fail everything, rather than leaving callers waiting.
+            with self._lock:
+                self._broken = e
+            self._fail_all(e)
+            for w in self._workers:
+                if w.task is not None:
+                    w.task[0].set_exception(e)
+                    w.task = None
+            raise
+        finally:
+            for w in self._workers:
+                w.stop()
+            for w in self._workers:
+                w.proc.join()
+
+    def _dispatch_loop(self):
+        while True:
+            conns = { w.conn: w for w in self._workers }
+            for c in multiprocessing.connection.wait(
+                    list(conns.keys()) + [self._wake_r]):
+                if c is self._wake_r:
+                    c.recv()
+                else:
+                    self._handle(conns[c])
+
+            self._assign()
+
+            with self._lock:
+                done = (self._shutdown and not self._pending and
+                        all(w.task is None for w in self._workers))
+            if done:
+                break
@@ -1,89 +1,50 @@
 #! /usr/bin/env python3
 
-import re
+# Filter a list of URLs down to those that a robot is allowed to
+# crawl, according to each site's robots.txt.
+#
+# usage: filter_robot_exclusion.py [options] [user-agent...] < urls
+#
+# URLs are grouped by origin.  All of the robots.txt files are fetched
+# concurrently (at most --concurrency at once, each subject to
+# --timeout), and recorded in a persistent cache (--cache), so that a
+# rerun over the same sites needs no network access, apart from
+# retrying sites that could not be reached the first time.  Then
+# the rules are applied to each site's URLs in a pool of worker
+# processes.  With --fixtures DIR, robots.txt files are read from DIR
+# instead of the network (see DirectoryFetcher), and no cache is used
+# unless --cache is given explicitly.
+
+import argparse
+import asyncio
+import collections
+import multiprocessing
+import os
+import sqlite3
 import sys
+import time
 import urllib.parse
 
-from reppy.robots import Robots
-from collections import defaultdict
+from reppy.robots import Robots, AllowAll, AllowNone
 
-def _urlsplit_forced_encoding(url):
-    try:
-        return urllib.parse.urlsplit(url)
-    except UnicodeDecodeError:
-        return urllib.parse.urlsplit(url.decode("utf-8", "surrogateescape"))
-
-_enap_re = re.compile(br'[\x00-\x20\x7F-\xFF]|'
-                      br'%(?!(?:[0-9A-Fa-f]{2}|u[0-9A-Fa-f]{4}))')
-def _encode_nonascii_and_percents(segment):
-    segment = segment.encode("utf-8", "surrogateescape")
-    return _enap_re.sub(
-        lambda m: "%{:02X}".format(ord(m.group(0))).encode("ascii"),
-        segment).decode("ascii")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "collector", "lib"))
+from shared import url_canon
 
 def canon_url_syntax(url):
-    """Syntactically canonicalize a URL.  This makes the following
-       transformations:
-         - scheme and hostname are lowercased
-         - hostname is punycoded if necessary
-         - vacuous user, password, and port fields are stripped
-         - ports redundant to the scheme are also stripped
-         - path becomes '/' if empty
-         - characters outside the printable ASCII range in path,
-           query, fragment, user, and password are %-encoded, as are
-           improperly used % signs
-    """
-
-    exploded = _urlsplit_forced_encoding(url.strip())
-    if not exploded.hostname:
-        # Remove extra slashes after the scheme and retry.
-        corrected = re.sub(r'(?i)^([a-z]+):///+', r'\1://', url)
-        exploded = _urlsplit_forced_encoding(corrected)
-
-    if not exploded.hostname:
-        raise ValueError("url with no host - " + repr(url))
-
-    scheme = exploded.scheme
-    if scheme != "http" and scheme != "https":
-        raise ValueError("url with non-http(s) scheme - " + repr(url))
-
-    host   = exploded.hostname
-    user   = _encode_nonascii_and_percents(exploded.username or "")
-    passwd = _encode_nonascii_and_percents(exploded.password or "")
-    port   = exploded.port
-    path   = _encode_nonascii_and_percents(exploded.path)
-    query  = _encode_nonascii_and_percents(exploded.query)
-    frag   = _encode_nonascii_and_percents(exploded.fragment)
-
-    if path == "":
-        path = "/"
-
-    # We do this even if there are no non-ASCII characters, because it
-    # has the side-effect of throwing a UnicodeError if the hostname
-    # is syntactically invalid (e.g. "foo..com").
-    host = host.encode("idna").decode("ascii")
-
-    if port is None:
-        port = ""
-    elif ((port == 80  and scheme == "http") or
-          (port == 443 and scheme == "https")):
-        port = ""
-    else:
-        port = ":{}".format(port)
-
-    # We don't have to worry about ':' or '@' in the user and password
-    # strings, because urllib.parse does not do %-decoding on them.
-    if user == "" and passwd == "":
-        auth = ""
-    elif passwd == "":
-        auth = "{}@".format(user)
-    else:
-        auth = "{}:{}@".format(user, passwd)
-    netloc = auth + host + port
+    return url_canon.canon_url_syntax(url.strip())
 
-    result = urllib.parse.SplitResult(scheme, netloc, path, query, frag)
-    return result.geturl()
+# Defaults for the fetch stage.
+CONCURRENCY  = 100
+TIMEOUT      = 30          # seconds, per robots.txt
+MAX_SIZE     = 1048576     # bytes; the rest of a robots.txt is ignored
+DEFAULT_CACHE = "robots-cache.sqlite"
 
+# The outcome of fetching one robots.txt.  STATUS is the HTTP status
+# code, or 0 if no response was received at all (CONTENT is then the
+# error message).  FETCHED is a Unix timestamp.
+RobotsFile = collections.namedtuple("RobotsFile",
+                                    ("status", "content", "etag", "fetched"))
 
 class DummyAgent:
     """Pseudo-REP ruleset which allows everything, with a crawl delay of
@@ -93,57 +54,240 @@ class DummyAgent:
     def allowed(self, url):
         return True
 
+def robots_rules(robots_url, robots_file, ua):
+    """Return the rules in ROBOTS_FILE that apply to UA.  Statuses
+       are interpreted the same way as by reppy's Robots.fetch."""
+    status = robots_file.status
+    try:
+        if status == 200:
+            return Robots.parse(robots_url, robots_file.content).agent(ua)
+        elif status in (401, 403):
+            return AllowNone(robots_url).agent(ua)
+        elif 400 <= status < 500:
+            return AllowAll(robots_url).agent(ua)
+        elif status == 0:
+            msg = robots_file.content
+        else:
+            msg = "HTTP status {}".format(status)
+    except Exception as e:
+        msg = str(e)
+    sys.stderr.write("warning: failed to fetch and parse {}: {}\n"
+                     .format(robots_url, msg))
+    return DummyAgent()
+
+#
+# Fetching.
+#
+
+async def read_limited(stream, max_size):
+    """Read from STREAM (an aiohttp or asyncio StreamReader) until EOF,
+       or until MAX_SIZE bytes have been read.  A single read() only
+       returns what has arrived so far, which may be much less."""
+    chunks = []
+    size = 0
+    while size < max_size:
+        chunk = await stream.read(max_size - size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size += len(chunk)
+    return b"".join(chunks)
+
+class HTTPFetcher:
+    """Fetch robots.txt files over the network."""
+
+    def __init__(self, ua, timeout=TIMEOUT, max_size=MAX_SIZE):
+        import aiohttp
+        self._aiohttp  = aiohttp
+        self.ua        = ua
+        self.timeout   = aiohttp.ClientTimeout(total=timeout)
+        self.max_size  = max_size
+        self._session  = None
+
+    async def __aenter__(self):
+        self._session = self._aiohttp.ClientSession(
+            headers={ 'User-Agent': self.ua }, timeout=self.timeout)
+        return self
+
+    async def __aexit__(self, *dontcare):
+        await self._session.close()
+        return False
+
+    async def fetch(self, robots_url, etag=None):
+        headers = {}
+        if etag is not None:
+            headers['If-None-Match'] = etag
+        try:
+            async with self._session.get(robots_url,
+                                         headers=headers) as resp:
+                content = await read_limited(resp.content, self.max_size)
+                return RobotsFile(resp.status, content,
+                                  resp.headers.get('ETag'), time.time())
+        except (self._aiohttp.ClientError, asyncio.TimeoutError,
+                ValueError) as e:
+            return RobotsFile(0, "{}: {}".format(type(e).__name__, e),
+                              None, time.time())
+
+class DirectoryFetcher:
+    """Read robots.txt files from a directory, for tests and
+       benchmarks.  The file for http://example.com:8080/robots.txt
+       is named http_example.com_8080.txt.  If there is no such file,
+       a file named http_example.com_8080.NNN will be used with HTTP
+       status NNN, if there is one; otherwise the status is 404.
+       DELAY seconds of simulated latency are added to each fetch."""
+
+    def __init__(self, directory, delay=0):
+        self.directory = directory
+        self.delay = delay
+        self._statuses = collections.defaultdict(list)
+        for fn in os.listdir(directory):
+            key, _, ext = fn.rpartition(".")
+            if ext.isdigit():
+                self._statuses[key].append(int(ext))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *dontcare):
+        return False
+
+    @staticmethod
+    def fixture_name(robots_url):
+        u = urllib.parse.urlsplit(robots_url)
+        return "{}_{}".format(u.scheme, u.netloc.replace(":", "_"))
+
+    async def fetch(self, robots_url, etag=None):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        key = self.fixture_name(robots_url)
+        candidates = [(200, key + ".txt")]
+        candidates.extend((status, "{}.{}".format(key, status))
+                          for status in self._statuses.get(key, ()))
+        for status, fn in candidates:
+            try:
+                with open(os.path.join(self.directory, fn), "rb") as f:
+                    return RobotsFile(status, f.read(), None, time.time())
+            except FileNotFoundError:
+                pass
+        return RobotsFile(404, b"", None, time.time())
+
+class RobotsCache:
+    """Persistent record of fetched robots.txt files, keyed by
+       robots.txt URL (i.e. by origin)."""
+
+    # Commit after this many new entries.
+    COMMIT_INTERVAL = 1000
+
+    def __init__(self, path=DEFAULT_CACHE):
+        self._db = sqlite3.connect(path)
+        self._db.execute("PRAGMA journal_mode = WAL")
+        self._db.execute("PRAGMA synchronous = NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS robots ("
+                         "  robots_url TEXT    NOT NULL PRIMARY KEY,"
+                         "  status     INTEGER NOT NULL,"
+                         "  content    BLOB,"
+                         "  etag       TEXT,"
+                         "  fetched    REAL    NOT NULL"
+                         ")")
+        self._pending = 0
+
+    def get(self, robots_url):
+        row = self._db.execute("SELECT status, content, etag, fetched"
+                               "  FROM robots WHERE robots_url = ?",
+                               (robots_url,)).fetchone()
+        return RobotsFile(*row) if row else None
+
+    def put(self, robots_url, robots_file):
+        self._db.execute("INSERT OR REPLACE INTO robots"
+                         " (robots_url, status, content, etag, fetched)"
+                         " VALUES (?, ?, ?, ?, ?)",
+                         (robots_url,) + tuple(robots_file))
+        self._pending += 1
+        if self._pending >= self.COMMIT_INTERVAL:
+            self.commit()
+
+    def commit(self):
+        self._db.commit()
+        self._pending = 0
+
+    def close(self):
+        self.commit()
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *dontcare):
+        self.close()
+        return False
+
+async def fetch_robots(robots_urls, fetcher, cache=None, max_age=None,
+                       concurrency=CONCURRENCY):
+    """Fetch each of ROBOTS_URLS with FETCHER, at most CONCURRENCY at
+       a time.  Returns a dictionary mapping each URL to a RobotsFile.
+       If CACHE is provided, entries found in it are used instead of
+       fetching, unless they are older than MAX_AGE seconds, in which
+       case they are revalidated using their ETag.  New results are
+       added to the cache, except for transient failures (no response,
+       or a 5xx status), which will be retried next time."""
+    limit = asyncio.Semaphore(concurrency)
+    results = {}
+    now = time.time()
+
+    async def fetch_one(robots_url):
+        cached = cache.get(robots_url) if cache is not None else None
+        if cached is not None and (max_age is None or
+                                   now - cached.fetched < max_age):
+            results[robots_url] = cached
+            return
+
+        async with limit:
+            fetched = await fetcher.fetch(
+                robots_url, etag=cached.etag if cached else None)
+        if fetched.status == 304 and cached is not None:
+            fetched = cached._replace(fetched=fetched.fetched)
+        results[robots_url] = fetched
+        if cache is not None and 0 < fetched.status < 500:
+            cache.put(robots_url, fetched)
+
+    async with fetcher:
+        await asyncio.gather(*(fetch_one(u) for u in robots_urls))
+    if cache is not None:
+        cache.commit()
+    return results
+
+#
+# Evaluation.
+#
 
 class Site:
     """One site from the input list.  Sites are defined by their origin,
     and the origin is equated with the robots.txt URL.
 
     """
-    def __init__(self):
-        self.robots_url = None
+    def __init__(self, robots_url):
+        self.robots_url = robots_url
         self.crawl_delay = None
         self.urls = set()
 
     def add(self, url):
-        if self.robots_url:
+        if self.crawl_delay is not None:
             raise RuntimeError(".add called after .filter")
         self.urls.add(url)
 
-    def filter(self, ua):
-        """Remove all of the urls in URLS that UA is not allowed to crawl,
-           and fill in the .crawl_delay and .robots_url properties."""
-
-        rules = None
-        for url in sorted(self.urls):
-            robots_url = Robots.robots_url(url)
-            if self.robots_url != robots_url:
-                if self.robots_url is None:
-                    try:
-                        rules = Robots.fetch(robots_url, headers={
-                            'User-Agent': ua
-                        }).agent(ua)
-                    except Exception as e:
-                        sys.stderr.write(
-                            "warning: failed to fetch and parse {}: {}\n"
-                            .format(robots_url, e))
-                        rules = DummyAgent()
-
-                    self.robots_url = robots_url
-                    self.crawl_delay = rules.delay or 1
-
-                else:
-                    raise ValueError(
-                        "robots.txt for {} is {}, not {}"
-                        .format(url, robots_url, self.robots_url))
-
-            if not rules.allowed(url):
-                self.urls.remove(url)
+    def filter(self, ua, robots_file):
+        """Remove all of the urls in URLS that UA is not allowed to
+           crawl, according to ROBOTS_FILE (a RobotsFile), and fill
+           in the .crawl_delay property."""
+        rules = robots_rules(self.robots_url, robots_file, ua)
+        self.crawl_delay = rules.delay or 1
+        self.urls = set(url for url in self.urls if rules.allowed(url))
 
     def write_to(self, fp):
         """Write out a sorted list of urls that we are allowed to crawl,
            with a header giving the origin and crawl delay.
            Must be called after .filter()."""
-        if not self.robots_url:
+        if self.crawl_delay is None:
             raise RuntimeError(".write_to called before .filter")
         if not self.urls:
             return
@@ -153,27 +297,89 @@ class Site:
             fp.write("  {}\n".format(url))
         fp.write("\n")
 
-def filter_urls(urls, ua):
+def filter_site(args):
+    """Worker: filter one Site and send it back."""
+    site, ua, robots_file = args
+    site.filter(ua, robots_file)
+    return site
+
+def filter_urls(urls, ua, fetcher=None, cache=None, max_age=None,
+                concurrency=CONCURRENCY, processes=None):
     """Partition URLS (an iterable) into sites, and then filter out all of
     the urls in each site that UA is not allowed to crawl.  Returns a list
-    of Site objects."""
+    of Site objects.  FETCHER defaults to an HTTPFetcher; the other
+    arguments are as for fetch_robots and multiprocessing.Pool."""
 
-    sites = defaultdict(Site)
+    sites = {}
     for url in urls:
         url = canon_url_syntax(url)
         robots_url = Robots.robots_url(url)
-        sites[robots_url].add(url)
+        site = sites.get(robots_url)
+        if site is None:
+            site = sites[robots_url] = Site(robots_url)
+        site.add(url)
 
-    for site in sites.values(): site.filter(ua)
-    return sorted(sites.values(), key = lambda s: s.robots_url)
+    if fetcher is None:
+        fetcher = HTTPFetcher(ua)
+    robots_files = asyncio.run(fetch_robots(sorted(sites), fetcher, cache,
+                                            max_age, concurrency))
 
-if __name__ == '__main__':
-    def main():
-        ua = " ".join(sys.argv[1:])
-        if not ua:
-            ua = "generic-robot/0.0"
-        sites = filter_urls(sys.stdin, ua)
-        for site in sites:
-            site.write_to(sys.stdout)
+    jobs = [(site, ua, robots_files[robots_url])
+            for robots_url, site in sites.items()]
+    with multiprocessing.Pool(processes) as pool:
+        filtered = list(pool.imap_unordered(filter_site, jobs,
+                                            chunksize=16))
+    return sorted(filtered, key = lambda s: s.robots_url)
+
+def main():
+    ap = argparse.ArgumentParser(
+        description="Filter a list of URLs (on stdin) down to those that"
+                    " USER-AGENT may crawl, according to robots.txt.")
+    ap.add_argument("ua", nargs="*", metavar="user-agent")
+    ap.add_argument("--cache", default=None,
+                    help="robots.txt cache file (default {}, or none"
+                         " with --fixtures).".format(DEFAULT_CACHE))
+    ap.add_argument("--no-cache", action="store_true",
+                    help="Don't read or update the cache.")
+    ap.add_argument("--max-age", type=float, default=None,
+                    help="Revalidate cached robots.txt files older than"
+                         " this many seconds (default: never).")
+    ap.add_argument("--concurrency", type=int, default=CONCURRENCY,
+                    help="Maximum simultaneous fetches"
+                         " (default %(default)s).")
+    ap.add_argument("--timeout", type=float, default=TIMEOUT,
+                    help="Time limit for each fetch, in seconds"
+                         " (default %(default)s).")
+    ap.add_argument("--processes", type=int, default=None,
+                    help="Worker processes for evaluating the rules"
+                         " (default: one per CPU).")
+    ap.add_argument("--fixtures", metavar="DIR",
+                    help="Read robots.txt files from DIR instead of"
+                         " the network.")
+    args = ap.parse_args()
 
+    ua = " ".join(args.ua) or "generic-robot/0.0"
+    if args.fixtures:
+        fetcher = DirectoryFetcher(args.fixtures)
+    else:
+        fetcher = HTTPFetcher(ua, timeout=args.timeout)
+
+    # Fixture runs must neither be answered from, nor pollute, the
+    # cache of real responses.
+    cache_path = args.cache
+    if cache_path is None and not args.fixtures:
+        cache_path = DEFAULT_CACHE
+    cache = None
+    if cache_path is not None and not args.no_cache:
+        cache = RobotsCache(cache_path)
+    try:
+        sites = filter_urls(sys.stdin, ua, fetcher, cache, args.max_age,
+                            args.concurrency, args.processes)
+    finally:
+        if cache is not None:
+            cache.close()
+    for site in sites:
+        site.write_to(sys.stdout)
+
+if __name__ == '__main__':
     main()
@@ -0,0 +1,147 @@
+# Tests for the fetch stage of filter_robot_exclusion: the cache, ETag
+# revalidation, and the interpretation of HTTP statuses.  robots.txt
+# files are served from a temporary fixture directory by
+# DirectoryFetcher, so no network access is needed.
+
+import asyncio
+import contextlib
+import io
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from filter_robot_exclusion import (DirectoryFetcher, RobotsCache,
+                                    RobotsFile, fetch_robots, read_limited,
+                                    robots_rules)
+
+ROBOTS_URL = "http://example.com/robots.txt"
+RULES = b"User-agent: *\nDisallow: /private\n"
+
+class RecordingFetcher(DirectoryFetcher):
+    """DirectoryFetcher that remembers the ETag sent with each fetch."""
+    def __init__(self, directory):
+        super().__init__(directory)
+        self.requests = []
+
+    async def fetch(self, robots_url, etag=None):
+        self.requests.append((robots_url, etag))
+        return await super().fetch(robots_url, etag)
+
+class TestFetchRobots(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.fixtures = os.path.join(self.dir, "fixtures")
+        os.mkdir(self.fixtures)
+        self.cache = RobotsCache(os.path.join(self.dir, "cache.sqlite"))
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.dir)
+
+    def fixture(self, robots_url, ext, content):
+        fn = DirectoryFetcher.fixture_name(robots_url) + "." + ext
+        with open(os.path.join(self.fixtures, fn), "wb") as f:
+            f.write(content)
+
+    def fetch(self, max_age=None):
+        fetcher = RecordingFetcher(self.fixtures)
+        results = asyncio.run(fetch_robots([ROBOTS_URL], fetcher,
+                                           self.cache, max_age))
+        return results[ROBOTS_URL], fetcher.requests
+
+    def test_fetch_and_cache_hit(self):
+        self.fixture(ROBOTS_URL, "txt", RULES)
+        result, requests = self.fetch()
+        self.assertEqual((result.status, result.content), (200, RULES))
+        self.assertEqual(len(requests), 1)
+        self.assertEqual(self.cache.get(ROBOTS_URL), result)
+
+        # The second time round, the fixture is gone, but the cache
+        # answers without a fetch.
+        os.unlink(os.path.join(self.fixtures, "http_example.com.txt"))
+        again, requests = self.fetch()
+        self.assertEqual(again, result)
+        self.assertEqual(requests, [])
+
+    def test_revalidate_with_etag(self):
+        old = RobotsFile(200, RULES, '"v1"', time.time() - 3600)
+        self.cache.put(ROBOTS_URL, old)
+        self.fixture(ROBOTS_URL, "304", b"")
+
+        result, requests = self.fetch(max_age=60)
+        self.assertEqual(requests, [(ROBOTS_URL, '"v1"')])
+        self.assertEqual((result.status, result.content, result.etag),
+                         (200, RULES, '"v1"'))
+        self.assertGreater(result.fetched, old.fetched)
+        self.assertEqual(self.cache.get(ROBOTS_URL), result)
+
+    def test_server_error_not_cached(self):
+        self.fixture(ROBOTS_URL, "503", b"")
+        result, _ = self.fetch()
+        self.assertEqual(result.status, 503)
+        self.assertIsNone(self.cache.get(ROBOTS_URL))
+
+        # It is retried, and this time it works.
+        self.fixture(ROBOTS_URL, "txt", RULES)
+        result, requests = self.fetch()
+        self.assertEqual(len(requests), 1)
+        self.assertEqual(result.status, 200)
+        self.assertEqual(self.cache.get(ROBOTS_URL), result)
+
+    def test_client_error_cached(self):
+        self.fixture(ROBOTS_URL, "403", b"")
+        result, _ = self.fetch()
+        self.assertEqual(result.status, 403)
+        self.assertEqual(self.cache.get(ROBOTS_URL), result)
+
+class TestReadLimited(unittest.TestCase):
+    # A robots.txt that arrives in several network chunks must be
+    # read in full, not just its first chunk.
+    def read(self, chunks, max_size):
+        async def go():
+            stream = asyncio.StreamReader()
+            async def feed():
+                for chunk in chunks:
+                    await asyncio.sleep(0.001)
+                    stream.feed_data(chunk)
+                stream.feed_eof()
+            feeder = asyncio.ensure_future(feed())
+            content = await read_limited(stream, max_size)
+            await feeder
+            return content
+        return asyncio.run(go())
+
+    def test_several_chunks(self):
+        chunks = [b"User-agent: *\n"] + [
+            "Disallow: /private{}\n".format(i).encode() for i in range(50)]
+        self.assertEqual(self.read(chunks, 1048576), b"".join(chunks))
+
+    def test_max_size(self):
+        chunks = [b"x" * 100] * 5
+        self.assertEqual(self.read(chunks, 250), b"x" * 250)
+
+class TestRobotsRules(unittest.TestCase):
+    def allowed(self, status, content=b""):
+        rules = robots_rules(ROBOTS_URL,
+                             RobotsFile(status, content, None, 0),
+                             "test-robot")
+        return (rules.allowed("http://example.com/"),
+                rules.allowed("http://example.com/private"))
+
+    def test_statuses(self):
+        self.assertEqual(self.allowed(200, RULES), (True, False))
+        self.assertEqual(self.allowed(401), (False, False))
+        self.assertEqual(self.allowed(403), (False, False))
+        self.assertEqual(self.allowed(404), (True, True))
+        self.assertEqual(self.allowed(410), (True, True))
+
+    def test_failures_allow_everything(self):
+        with contextlib.redirect_stderr(io.StringIO()) as err:
+            self.assertEqual(self.allowed(503), (True, True))
+            self.assertEqual(self.allowed(0, "timed out"), (True, True))
+        self.assertIn("HTTP status 503", err.getvalue())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -13,7 +13,6 @@ import json
 import math
 import multiprocessing
 import os
-import re
 import subprocess
 import sys
 import tempfile
@@ -28,8 +27,16 @@ import aiohttp
 import aiopg
 from werkzeug.http import parse_options_header
 
+import extraction_service
+import http_governor
+import topic_similarity
+import translation_cache
 import word_seg
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "collector", "lib"))
+from shared.url_canon import canon_url_syntax
+
 #
 # Utilities
 #
@@ -108,117 +115,6 @@ def sync_wait(coro, loop):
     loop.run_until_complete(task)
     return task.result()
 
-# This appears in the official documentation for asyncio, but is not
-# actually defined by the library!  But it _is_ defined by the
-# externally maintained backport to 3.3 (and that's where this code
-# comes from).  No, I don't understand either.
-
-try:
-    aio_timeout = asyncio.timeout
-
-except AttributeError:
-    def aio_timeout(timeout, *, loop=None):
-        """A factory which produce a context manager with timeout.
-        Useful in cases when you want to apply timeout logic around block
-        of code or in cases when asyncio.wait_for is not suitable.
-        For example:
-        >>> with asyncio.timeout(0.001):
-        ...     yield from coro()
-        timeout: timeout value in seconds
-        loop: asyncio compatible event loop
-        """
-        if loop is None:
-            loop = asyncio.get_event_loop()
-        return _Timeout(timeout, loop=loop)
-
-    class _Timeout:
-        def __init__(self, timeout, *, loop):
-            self._timeout = timeout
-            self._loop = loop
-            self._task = None
-            self._cancelled = False
-            self._cancel_handler = None
-
-        def __enter__(self):
-            self._task = asyncio.Task.current_task(loop=self._loop)
-            if self._task is None:
-                raise RuntimeError('Timeout context manager should be used '
-                                   'inside a task')
-            self._cancel_handler = self._loop.call_later(
-                self._timeout, self._cancel_task)
-            return self
-
-        def __exit__(self, exc_type, exc_val, exc_tb):
-            if exc_type is asyncio.futures.CancelledError and self._cancelled:
-                self._cancel_handler = None
-                self._task = None
-                raise asyncio.futures.TimeoutError
-            self._cancel_handler.cancel()
-            self._cancel_handler = None
-            self._task = None
-
-        def _cancel_task(self):
-            self._cancelled = self._task.cancel()
-
-class rate_limiter:
-    """Unblocks a calling coroutine RATE times per second:
-
-       rate = rate_limiter(10)
-       while work_to_do:
-           yield from rate
-           ...
-    """
-
-    def __init__(self, rate, *, loop=None):
-        self.rate     = rate
-        self.interval = 1.0/rate
-        self._loop    = loop or asyncio.get_event_loop()
-        self._waiters = asyncio.Queue(loop=self._loop)
-        self._task    = None
-
-    def __enter__(self):
-        self._task = self._loop.create_task(self._rl_task())
-        return self
-
-    def __exit__(self, *dontcare):
-        task = self._task
-        self._task = None
-        self._loop.run_until_complete(
-            asyncio.wait([
-                self._waiters.put(None), # termination sentinel
-                task
-            ]))
-        return False
-
-    @asyncio.coroutine
-    def _rl_task(self):
-        before = self._loop.time()
-        while True:
-            waiter = yield from self._waiters.get()
-
-            # None is posted to the queue as a sentinel when __exit__
-            # wants us to quit.
-            if waiter is None:
-                break
-
-            after = self._loop.time()
-            delay = self.interval - (after - before)
-            if delay > 0:
-                yield from asyncio.sleep(delay, loop=self._loop)
-                after = self._loop.time()
-
-            waiter.set_result(None) # unblock
-
-            before = after
-
-    @asyncio.coroutine
-    def __call__(self):
-        if self._task is None:
-            raise RuntimeError("rate limiter invoked when not running")
-        fut = asyncio.Future(loop=self._loop)
-        yield from self._waiters.put(fut)
-        yield from fut
-
 class work_buffer:
     """Buffer up work until there is enough of it, or till a timeout
        expires (default 5 seconds), then process it all at once.
@@ -309,6 +205,199 @@ class work_buffer:
                 if not fut.done():
                     fut.set_exception(e)
 
+class coalescing_queue:
+    """Like work_buffer, but identical requests are merged, and
+       batches are packed by size and chosen by priority.
+
+       Items are put into named GROUPs (e.g. one per language); a
+       batch never mixes groups.  Putting an item that is already
+       pending or being processed in the same group returns the same
+       future as before, and increases that item's priority (the
+       number of callers waiting for it).
+
+       A group's pending items become eligible for processing when
+       they would fill a batch, or when the oldest of them has waited
+       FLUSH_TIMEOUT seconds (adjusted downward as with work_buffer).
+       Batches are processed one at a time, in order of how many
+       callers are waiting on them.  Each batch holds at most
+       MAX_ITEMS items whose size, as reported by SIZE_OF(item), is
+       nonzero, and those sizes sum to at most MAX_SIZE; items of size
+       zero are free riders.  Within a group, the items with the most
+       waiters go first.
+
+       The worker procedure, WORKER, is called with two positional
+       arguments, GROUP and a list of items, and must return a list
+       of (item, result) pairs covering all of the items.
+    """
+
+    def __init__(self, worker, *, max_items, max_size, size_of,
+                 label="?", flush_timeout=5, loop=None):
+        self.worker    = worker
+        self.max_items = max_items
+        self.max_size  = max_size
+        self.size_of   = size_of
+        self.label     = label
+        self.ftimeout  = flush_timeout
+        self.loop      = loop or asyncio.get_event_loop()
+
+        # group -> OrderedDict: item -> [n_waiters, size]
+        self.pending   = {}
+        # group -> [total size, sized item count, total waiters]
+        self.totals    = {}
+        # group -> loop time at which it becomes eligible regardless
+        self.deadlines = {}
+        # (group, item) -> future, for everything pending or running
+        self.futures   = {}
+
+        self.wakeup     = asyncio.Event(loop=self.loop)
+        self.dispatcher = None
+
+    def __del__(self):
+        # This is a backstop; users of this class should ensure that
+        # the queue has been drained long before this point.
+        if self.pending or self.dispatcher:
+            self.loop.run_until_complete(self.drain())
+
+    def put(self, group, item):
+        """Request processing of ITEM in GROUP; return a Future which
+           will receive the result.  Does not wait for completion."""
+        key = (group, item)
+        fut = self.futures.get(key)
+        if fut is not None:
+            entry = self.pending.get(group, {}).get(item)
+            if entry is not None:
+                entry[0] += 1
+                self.totals[group][2] += 1
+            return fut
+
+        fut = asyncio.Future(loop=self.loop)
+        self.futures[key] = fut
+
+        size = self.size_of(item)
+        pgroup = self.pending.get(group)
+        if pgroup is None:
+            pgroup = self.pending[group] = collections.OrderedDict()
+            self.totals[group] = [0, 0, 0]
+            self.deadlines[group] = self.loop.time() + self.ftimeout
+        pgroup[item] = [1, size]
+        totals = self.totals[group]
+        totals[0] += size
+        totals[1] += (size > 0)
+        totals[2] += 1
+
+        if self.dispatcher is None:
+            self.dispatcher = self.loop.create_task(self._dispatch())
+        elif self._full(group):
+            self.wakeup.set()
+        return fut
+
+    def flush(self):
+        """Make everything currently pending eligible for processing
+           immediately.  Does not wait for completion."""
+        now = self.loop.time()
+        for group in self.deadlines:
+            self.deadlines[group] = now
+        self.wakeup.set()
+
+    @asyncio.coroutine
+    def drain(self):
+        """Flush, then wait until all outstanding work has been
+           completed."""
+        while self.dispatcher is not None:
+            self.flush()
+            yield from asyncio.wait([self.dispatcher], loop=self.loop)
+
+    def _full(self, group):
+        size, n_items, _ = self.totals[group]
+        return size >= self.max_size or n_items >= self.max_items
+
+    def _next_group(self):
+        """The eligible group with the most waiters, or None."""
+        now = self.loop.time()
+        best = None
+        best_waiters = -1
+        for group, deadline in self.deadlines.items():
+            if deadline <= now or self._full(group):
+                waiters = self.totals[group][2]
+                if waiters > best_waiters:
+                    best = group
+                    best_waiters = waiters
+        return best
+
+    def _pack(self, group):
+        """Remove and return the next batch of items from GROUP."""
+        pgroup = self.pending[group]
+        totals = self.totals[group]
+        by_priority = sorted(pgroup.items(), key=lambda kv: -kv[1][0])
+
+        batch = []
+        size = 0
+        n_items = 0
+        for item, (waiters, isize) in by_priority:
+            if isize > 0:
+                if n_items >= self.max_items:
+                    continue
+                # An oversized item must still go out eventually, alone.
+                if size + isize > self.max_size and n_items > 0:
+                    continue
+                size += isize
+                n_items += 1
+            batch.append(item)
+            del pgroup[item]
+            totals[0] -= isize
+            totals[1] -= (isize > 0)
+            totals[2] -= waiters
+
+        if not pgroup:
+            del self.pending[group]
+            del self.totals[group]
+            del self.deadlines[group]
+
+        # As in work_buffer: toward the end of a job, don't waste a lot
+        # of time waiting for more to come in.
+        if n_items < self.max_items/2 and size < self.max_size/2:
+            self.ftimeout = max(self.ftimeout/2, 0.1)
+
+        return batch
+
+    @asyncio.coroutine
+    def _dispatch(self):
+        try:
+            while self.pending:
+                group = self._next_group()
+                if group is None:
+                    self.wakeup.clear()
+                    timeout = min(self.deadlines.values()) - self.loop.time()
+                    try:
+                        yield from asyncio.wait_for(self.wakeup.wait(),
+                                                    max(timeout, 0),
+                                                    loop=self.loop)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+                batch = self._pack(group)
+                try:
+                    results = yield from self.worker(group, batch)
+                except Exception as e:
+                    for item in batch:
+                        fut = self.futures.pop((group, item))
+                        if not fut.done():
+                            fut.set_exception(e)
+                else:
+                    for item, result in results:
+                        fut = self.futures.pop((group, item), None)
+                        if fut is not None and not fut.done():
+                            fut.set_result(result)
+                    for item in batch:
+                        fut = self.futures.pop((group, item), None)
+                        if fut is not None and not fut.done():
+                            fut.set_exception(RuntimeError(
+                                "{}: no result for {!r}"
+                                .format(self.label, item)))
+        finally:
+            self.dispatcher = None
+
 def find_le(a, x):
     """Find the rightmost value of A which is less than or equal to X."""
     i = bisect.bisect_right(a, x)
@@ -319,97 +408,6 @@ def find_le(a, x):
 # Database utilities.
 #
 
-def _urlsplit_forced_encoding(url):
-    try:
-        return urllib.parse.urlsplit(url)
-    except UnicodeDecodeError:
-        return urllib.parse.urlsplit(url.decode("utf-8", "surrogateescape"))
-
-_enap_re = re.compile(br'[\x00-\x20\x7F-\xFF]|'
-                      br'%(?!(?:[0-9A-Fa-f]{2}|u[0-9A-Fa-f]{4}))')
-def _encode_nonascii_and_percents(segment):
-    segment = segment.encode("utf-8", "surrogateescape")
-    return _enap_re.sub(
-        lambda m: "%{:02X}".format(ord(m.group(0))).encode("ascii"),
-        segment).decode("ascii")
-
-def canon_url_syntax(url, *, want_splitresult=None):
-    """Syntactically canonicalize a URL.  This makes the following
-       transformations:
-         - scheme and hostname are lowercased
-         - hostname is punycoded if necessary
-         - vacuous user, password, and port fields are stripped
-         - ports redundant to the scheme are also stripped
-         - path becomes '/' if empty
-         - characters outside the printable ASCII range in path,
-           query, fragment, user, and password are %-encoded, as are
-           improperly used % signs
-
-       You can provide either a string or a SplitResult, and you get
-       back what you put in.  You can set the optional argument
-       want_splitresult to True or False to force a particular
-       type of output.
-    """
-
-    if isinstance(url, urllib.parse.SplitResult):
-        if want_splitresult is None: want_splitresult = True
-        exploded = url
-
-    else:
-        if want_splitresult is None: want_splitresult = False
-
-        exploded = _urlsplit_forced_encoding(url)
-        if not exploded.hostname:
-            # Remove extra slashes after the scheme and retry.
-            corrected = re.sub(r'(?i)^([a-z]+):///+', r'\1://', url)
-            exploded = _urlsplit_forced_encoding(corrected)
-
-    if not exploded.hostname:
-        raise ValueError("url with no host - " + repr(url))
-
-    scheme = exploded.scheme
-    if scheme != "http" and scheme != "https":
-        raise ValueError("url with non-http(s) scheme - " + repr(url))
-
-    host   = exploded.hostname
-    user   = _encode_nonascii_and_percents(exploded.username or "")
-    passwd = _encode_nonascii_and_percents(exploded.password or "")
-    port   = exploded.port
-    path   = _encode_nonascii_and_percents(exploded.path)
-    query  = _encode_nonascii_and_percents(exploded.query)
-    frag   = _encode_nonascii_and_percents(exploded.fragment)
-
-    if path == "":
-        path = "/"
-
-    # We do this even if there are no non-ASCII characters, because it
-    # has the side-effect of throwing a UnicodeError if the hostname
-    # is syntactically invalid (e.g. "foo..com").
-    host = host.encode("idna").decode("ascii")
-
-    if port is None:
-        port = ""
-    elif ((port == 80  and scheme == "http") or
-          (port == 443 and scheme == "https")):
-        port = ""
-    else:
-        port = ":{}".format(port)
-
-    # We don't have to worry about ':' or '@' in the user and password
-    # strings, because urllib.parse does not do %-decoding on them.
-    if user == "" and passwd == "":
-        auth = ""
-    elif passwd == "":
-        auth = "{}@".format(user)
-    else:
-        auth = "{}:{}@".format(user, passwd)
-    netloc = auth + host + port
-
-    result = urllib.parse.SplitResult(scheme, netloc, path, query, frag)
-    if want_splitresult:
-        return result
-    else:
-        return result.geturl()
 
 @asyncio.coroutine
 def add_url_string(db, url):
@@ -610,25 +608,19 @@ class Database:
     # Canned queries
     @asyncio.coroutine
     def get_translations(self):
-        with (yield from self.dblock):
-            cur = self.cur
-            yield from cur.execute("SELECT lang, word, engl FROM translations")
-
-            translations = collections.defaultdict(dict)
-            words = 0
-            while True:
-                block = yield from cur.fetchmany(10000)
-                if not block: break
-                for lang, word, engl in block:
-                    translations[lang][word] = engl
-                    words += 1
-
-                status("loading translations... {} languages {} words"
-                       .format(len(translations), words))
-
-            status("loading translations... {} languages {} words"
-                   .format(len(translations), words), done=True)
-            return translations
+        """Return a TranslationCache holding the contents of the
+           translations table.  GoogleTranslate keeps the cache up to
+           date as it records new translations; if the table has
+           changed by other means since the cache was last synced
+           with it, the cache is refreshed first."""
+        cache = translation_cache.TranslationCache(loop=self.loop)
+        try:
+            with (yield from self.dblock):
+                yield from cache.sync(self.cur, self.dbname, status)
+        except:
+            cache.close()
+            raise
+        return cache
 
     @asyncio.coroutine
     def record_translations(self, lang, translations):
@@ -642,6 +634,7 @@ class Database:
                 if len(word) < WORD_LENGTH_LIMIT)
 
             yield from cur.execute(query + values)
+            return cur.rowcount
 
     @asyncio.coroutine
     def load_date_range_for_url(self, urlid):
@@ -978,9 +971,9 @@ class Database:
 #
 
 # This chunk of the work is CPU-bound and farmed out to worker
-# processes.  We must use processes and not threads because of the
-# GIL, and unfortunately that means we have to pass all the data back
-# and forth in bare tuples.
+# processes (see extraction_service.py).  We must use processes and
+# not threads because of the GIL, and unfortunately that means we have
+# to pass all the data back and forth in bare tuples.
 
 EC = collections.namedtuple("EC",
                             ("url", "redir_url", "status", "reason",
@@ -993,36 +986,29 @@ EC = collections.namedtuple("EC",
                              "dhash", "domst",
                              "parked", "prules"))
 
-# Expensive initialization needed only in worker processes.
-extract_page_context = None
-def extract_page_context_init():
-    import cld2
-    import domainparking
-    import html_extractor
-
-    global extract_page_context
-    extract_page_context = (
-        cld2, html_extractor, domainparking.ParkingClassifier())
-
 def extract_page(url, redir_url, status, reason, ctype, data):
     """Worker-process procedure: extract content from a page retrieved
        from the Internet Archive.
     """
-    global extract_page_context
-    if extract_page_context is None:
-        extract_page_context_init()
-
-    cld2, html_extractor, parking_cfr = extract_page_context
+    # These are only needed in the workers, which have already
+    # imported and initialized them.
+    import cld2
+    import html_extractor
+    stage = extraction_service.stage
 
     if not ctype: ctype = ""
     ctype, options = parse_options_header(ctype)
     charset = options.get("charset", "")
 
-    extr = html_extractor.ExtractedContent(redir_url, data, ctype, charset)
-    lang = cld2.detect(extr.text_pruned, want_chunks=True)
-    segmented = [ { "l": c[0].code,
-                    "t": list(word_seg.segment(c[0].code, c[1])) }
-                  for c in lang.chunks ]
+    with stage("html_extractor"):
+        extr = html_extractor.ExtractedContent(redir_url, data,
+                                               ctype, charset)
+    with stage("cld2"):
+        lang = cld2.detect(extr.text_pruned, want_chunks=True)
+    with stage("word_seg"):
+        segmented = [ { "l": c[0].code,
+                        "t": list(word_seg.segment(c[0].code, c[1])) }
+                      for c in lang.chunks ]
 
     original = zlib.compress(extr.original)
     olen     = len(extr.original)
@@ -1041,7 +1027,9 @@ def extract_page(url, redir_url, status, reason, ctype, data):
     domst    = json.dumps(extr.dom_stats.to_json()).encode("utf-8")
     dhash    = hashlib.sha256(domst).digest()
 
-    parked, prules = parking_cfr.isParked(extr.original.decode("utf-8"))
+    with stage("parking"):
+        parked, prules = extraction_service.parking_classifier().isParked(
+            extr.original.decode("utf-8"))
 
     return EC(url, redir_url, status, reason,
               ohash, olen, original,
@@ -1054,16 +1042,14 @@ def extract_page(url, redir_url, status, reason, ctype, data):
               parked, prules)
 
 class WaybackMachine:
-    def __init__(self, executor, http_client, rate, loop=None):
+    def __init__(self, executor, http, loop=None):
         self.executor    = executor
-        self.http_client = http_client
-        self.rate        = rate
+        self.http        = http
         self.loop        = loop or asyncio.get_event_loop()
         self.errlog      = open("wayback-machine-errors.log", "at")
         self.n_errors    = 0
         self.n_requests  = 0
         self.session     = None
-        self.serializer  = asyncio.Lock(loop=self.loop)
 
     def __enter__(self):
         return self
@@ -1074,20 +1060,20 @@ class WaybackMachine:
     @asyncio.coroutine
     def get_unique_snapshots_of_url(self, url):
         """Retrieve a list of all available snapshots of URL."""
-        backoff = 1
+        # The governor retries 503s and the like; this loop is for
+        # when it gives up.
+        failures = 0
         while True:
-            yield from self.rate()
-            resp = None
+            self.n_requests += 1
             try:
-                self.n_requests += 1
-                resp = yield from self.http_client.get(
+                resp = yield from self.http.request(
+                    "wayback", "GET",
                     "https://web.archive.org/cdx/search/cdx",
                     params = { "url": url,
                                "collapse": "digest",
                                "fl": "original,timestamp,statuscode" })
                 if resp.status == 200:
-                    text = yield from resp.text()
-                    yield from resp.release()
+                    text = resp.text()
                     break
 
                 if resp.status == 403:
@@ -1095,7 +1081,6 @@ class WaybackMachine:
                     # show them to us because of robots.txt.
                     self.errlog.write("GET /cdx/search/cdx?{} = {} {}\n"
                                       .format(url, resp.status, resp.reason))
-                    yield from resp.release()
                     return []
 
                 if resp.status != 503:
@@ -1107,16 +1092,12 @@ class WaybackMachine:
                 traceback.print_exc(file=self.errlog)
                 self.errlog.flush()
 
-            if resp is not None:
-                try:
-                    yield from resp.release()
-                except Exception:
-                    resp.close()
-
+            failures += 1
             self.n_errors += 1
             self.session.progress()
-            yield from asyncio.sleep(backoff)
-            backoff = min(backoff * 2, 60)
+            yield from asyncio.sleep(
+                http_governor.jittered_backoff(failures, 1, 60),
+                loop=self.loop)
 
         self.session.progress()
         snapshots = []
@@ -1179,77 +1160,38 @@ class WaybackMachine:
 
     @asyncio.coroutine
     def get_page_do_http_request(self, query):
-        resp = None
-        resp_released = False
         try:
-            # Since we can use only one concurrent connection, we must also
-            # have only one task issuing queries at a time, or N-1 of the
-            # tasks are likely to time out before they even get a chance to
-            # submit their query.  The ordering here is critical: first
-            # serialization, then rate-limiting, then the timeout.
-            with (yield from self.serializer):
-                yield from self.rate()
-                with aio_timeout(600, loop=self.loop):
-                    # The Wayback Machine replays Set-Cookie headers, and
-                    # since all requests are going to the same origin, they
-                    # accumulate until we hit the request size limit.
-                    # It doesn't ever _need_ us to send cookies, AFAICT.
-                    self.http_client.cookies.clear()
-                    resp = yield from \
-                        self.http_client.get(query, allow_redirects=False)
-                    if 300 <= resp.status <= 399:
-                        location = resp.headers.get('location', '')
-                        ctype = None
-                        data = None
-                    else:
-                        location = None
-                        ctype = resp.headers.get("content-type", "")
-                        # Helpfully, the Wayback Machine returns the
-                        # page in its _original_ character encoding.
-                        # aiohttp does not implement HTML5 encoding
-                        # detection, so read the data in binary mode
-                        # to avoid problems.
-                        try:
-                            data = yield from resp.read()
-                        except (zlib.error,
-                                aiohttp.errors.ContentEncodingError,
-                                aiohttp.errors.ServerDisconnectedError):
-                            # The Wayback Machine faithfully records and
-                            # plays back malformed HTTP responses!  Treat
-                            # this as an empty document.
-                            data = b""
-
-                    try:
-                        # This can barf on a malformed HTTP response
-                        # even if read() has already succeeded.  Do not
-                        # discard the data in this case.
-                        yield from resp.release()
-                    except (zlib.error,
-                            aiohttp.errors.ContentEncodingError,
-                            aiohttp.errors.ServerDisconnectedError):
-                        resp.close()
-
-                    resp_released = True
-
-                    # It may or may not be appropriate to retry requests
-                    # that provoke HTTP errors directly from the wayback
-                    # machine, but in no case do we want to _record_ such
-                    # responses.  The exception-handling logic below
-                    # makes the final decision.
-                    if self.error_from_wayback_machine(resp.status, data):
-                        raise aiohttp.errors.HttpProcessingError(
-                            code=resp.status,
-                            message=resp.reason,
-                            headers=resp.headers)
-
-                    return (resp.status, resp.reason, location, ctype, data)
+            resp = yield from self.http.request("wayback", "GET", query,
+                                                allow_redirects=False)
+            if 300 <= resp.status <= 399:
+                location = resp.headers.get('location', '')
+                ctype = None
+                data = None
+            else:
+                location = None
+                ctype = resp.headers.get("content-type", "")
+                # Helpfully, the Wayback Machine returns the page in
+                # its _original_ character encoding.  aiohttp does not
+                # implement HTML5 encoding detection, so the transport
+                # reads the data in binary mode to avoid problems.
+                data = resp.body
+
+            # It may or may not be appropriate to retry requests
+            # that provoke HTTP errors directly from the wayback
+            # machine, but in no case do we want to _record_ such
+            # responses.  The exception-handling logic below
+            # makes the final decision.
+            if self.error_from_wayback_machine(resp.status, data):
+                raise aiohttp.errors.HttpProcessingError(
+                    code=resp.status,
+                    message=resp.reason,
+                    headers=resp.headers)
+
+            return (resp.status, resp.reason, location, ctype, data)
 
         except Exception as e:
             self.maybe_log_http_exception(e, query)
 
-            if resp is not None and not resp_released:
-                resp.close()
-
             if isinstance(e, aiohttp.errors.HttpProcessingError) and \
                400 <= e.code < 499:
                 # Do not retry 4xx-series errors, even if they came
@@ -1261,7 +1203,7 @@ class WaybackMachine:
 
     @asyncio.coroutine
     def get_page_http_request(self, query):
-        backoff = 1
+        failures = 0
         while True:
             self.n_requests += 1
             self.session.progress()
@@ -1270,10 +1212,12 @@ class WaybackMachine:
             if data is not None:
                 return data
 
+            failures += 1
             self.n_errors += 1
             self.session.progress()
-            yield from asyncio.sleep(backoff)
-            backoff = min(backoff * 2, 60)
+            yield from asyncio.sleep(
+                http_governor.jittered_backoff(failures, 1, 60),
+                loop=self.loop)
 
     def redirect_url(self, snap, redir_url, loc):
         # Redirections can happen either because the original
@@ -1380,20 +1324,121 @@ TRANSLATE_URL = \
 GET_LANGUAGES_URL = \
     "https://www.googleapis.com/language/translate/v2/languages"
 
+class GoogleTranslateService:
+    """The Google Translate API itself.  GoogleTranslate talks to the
+       translation service only through the two methods of this class,
+       so that something else (e.g. StubTranslationService) can be
+       substituted for it."""
+
+    def __init__(self, http, errlog, loop=None):
+        self.http        = http
+        self.errlog      = errlog
+        self.loop        = loop or asyncio.get_event_loop()
+
+    @asyncio.coroutine
+    def get_languages(self):
+        """Return the set of CLD2 language codes that can be translated
+           into English."""
+        resp = yield from self.http.request(
+            "gtrans", "GET", GET_LANGUAGES_URL,
+            params = { "key" : GOOGLE_API_KEY })
+        blob = resp.json()
+        # Don't bother translating English into English.
+        return frozenset(GOOGLE_TO_CLD2[x["language"]]
+                         for x in blob["data"]["languages"]
+                         if x["language"] != "en")
+
+    def log_http_error(self, lang, words, resp):
+        self.errlog.write(
+            "POST /language/translate/v2 = {} {}\n"
+            .format(resp.status, resp.reason))
+        self.errlog.write("  source: {}\n"
+                          "  target: en\n"
+                          "  q:      {!r}\n\n"
+                          .format(CLD2_TO_GOOGLE[lang], words))
+        self.errlog.write(resp.text())
+        self.errlog.write("\n\n")
+        self.errlog.flush()
+
+    @asyncio.coroutine
+    def translate(self, lang, words):
+        """Translate WORDS, a list of strings in language LANG, into
+           English.  Returns a parallel list of translations, or None
+           if the request failed (the caller will retry)."""
+        try:
+            resp = yield from self.http.request(
+                "gtrans", "POST", TRANSLATE_URL,
+                data = {
+                    "key":    GOOGLE_API_KEY,
+                    "source": CLD2_TO_GOOGLE[lang],
+                    "target": "en",
+                    "q":      words,
+                },
+                headers = {
+                    "Content-Type":
+                        "application/x-www-form-urlencoded;charset=utf-8",
+                    "X-HTTP-Method-Override": "GET",
+                })
+            if resp.status == 200:
+                return [x["translatedText"]
+                        for x in resp.json()["data"]["translations"]]
+            else:
+                self.log_http_error(lang, words, resp)
+                return None
+
+        except Exception as e:
+            if not isinstance(e, (asyncio.TimeoutError,
+                                  aiohttp.errors.ClientTimeoutError,
+                                  aiohttp.errors.ClientResponseError)):
+                traceback.print_exc(file=self.errlog)
+            return None
+
+class StubTranslationService:
+    """Stand-in for GoogleTranslateService, for benchmarks and tests.
+       Every language in LANGS is 'translatable'; each word translates
+       to itself, tagged with its language, after a simulated round
+       trip of DELAY seconds.  Counts requests and words."""
+
+    def __init__(self, langs, delay=0.1, loop=None):
+        self.langs      = frozenset(langs)
+        self.delay      = delay
+        self.loop       = loop or asyncio.get_event_loop()
+        self.n_requests = 0
+        self.n_words    = 0
+
+    @asyncio.coroutine
+    def get_languages(self):
+        return self.langs
+
+    @asyncio.coroutine
+    def translate(self, lang, words):
+        self.n_requests += 1
+        self.n_words    += len(words)
+        yield from asyncio.sleep(self.delay, loop=self.loop)
+        return ["{}:{}".format(lang, w) for w in words]
+
 class GoogleTranslate:
-    def __init__(self, db, http_client, rate, loop=None):
+    def __init__(self, db, http, loop=None, service=None):
         self.db           = db
-        self.http_client  = http_client
-        self.rate         = rate
+        self.http         = http
         self.loop         = loop or asyncio.get_event_loop()
         self.errlog       = open("google-translate-errors.log", "at")
+        self.service      = service or GoogleTranslateService(
+            http, self.errlog, self.loop)
         self.n_errors     = 0
         self.n_requests   = 0
         self.langs        = None
         self.translations = None
         self.prepare_lock = asyncio.Lock(loop=self.loop)
-        self.serializer   = asyncio.Lock(loop=self.loop)
-        self.tbufs        = {}
+        # Every word awaiting translation, across all documents, is
+        # queued here exactly once.
+        self.queue        = coalescing_queue(
+            self.get_translations_worker,
+            max_items     = WORDS_PER_POST,
+            max_size      = CHARS_PER_POST,
+            size_of       = self.request_size,
+            label         = "gtrans",
+            loop          = self.loop)
         self.session      = None
 
     def __enter__(self):
@@ -1404,6 +1449,8 @@ class GoogleTranslate:
             self.loop.create_task(
                 self.drain_translations()))
         self.errlog.close()
+        if self.translations is not None:
+            self.translations.close()
         return False
 
     @asyncio.coroutine
@@ -1418,161 +1465,84 @@ class GoogleTranslate:
             # done.
             self.translations = (yield from self.db.get_translations())
 
-            yield from self.rate()
             self.n_requests += 1
-            resp = yield from self.http_client.get(
-                GET_LANGUAGES_URL,
-                params = { "key" : GOOGLE_API_KEY })
-            blob = yield from resp.json()
-            yield from resp.release()
-            # Don't bother translating English into English.
-            self.langs = \
-                frozenset(GOOGLE_TO_CLD2[x["language"]]
-                          for x in blob["data"]["languages"]
-                          if x["language"] != "en")
-
-    @asyncio.coroutine
-    def maybe_log_http_error(self, lang, words, resp):
-        # 503 and 403 seem to be used interchangeably by
-        # google translate with the meaning "slow down a little".
-        # 500 happens on rare occasions (with meaningless details,
-        # "Backend Error") and can also safely be silently retried.
-        #if resp.status in (403, 503, 500):
-        #    return
-
-        self.errlog.write(
-            "POST /language/translate/v2 = {} {}\n"
-            .format(resp.status, resp.reason))
-        self.errlog.write("  source: {}\n"
-                          "  target: en\n"
-                          "  q:      {!r}\n\n"
-                          .format(CLD2_TO_GOOGLE[lang], words))
-        self.errlog.flush()
-        text = yield from resp.text()
-        self.errlog.write(text)
-        self.errlog.write("\n\n")
-        self.errlog.flush()
-
-    @asyncio.coroutine
-    def get_translations_http_request(self, lang, words):
-        resp = None
-        try:
-            with aio_timeout(60, loop=self.loop):
-                resp = yield from self.http_client.post(
-                    TRANSLATE_URL,
-                    data = {
-                        "key":    GOOGLE_API_KEY,
-                        "source": CLD2_TO_GOOGLE[lang],
-                        "target": "en",
-                        "q":      words,
-                    },
-                    headers = {
-                        "Content-Type":
-                            "application/x-www-form-urlencoded;charset=utf-8",
-                        "X-HTTP-Method-Override": "GET",
-                    })
-                if resp.status == 200:
-                    blob = yield from resp.json()
-                    yield from resp.release()
-                    return blob
-                else:
-                    yield from self.maybe_log_http_error(lang, words, resp)
-                    yield from resp.release()
-                    return None
-
-        except Exception as e:
-            if not isinstance(e, (asyncio.TimeoutError,
-                                  aiohttp.errors.ClientTimeoutError,
-                                  aiohttp.errors.ClientResponseError)):
-                traceback.print_exc(file=self.errlog)
-
-            if resp is not None:
-                resp.close()
-
-            return None
+            self.langs = yield from self.service.get_languages()
+
+    @staticmethod
+    def passthrough(word):
+        """If WORD should not be sent for translation, return what to
+           use as its translation instead; otherwise return None.  We
+           do not waste resources translating nonwords and URLs, and
+           overlong words are liable to be some sort of HTML spew."""
+        if len(word) > WORD_LENGTH_LIMIT:
+            return word
+        if word_seg.is_nonword(word):
+            return word
+        return word_seg.is_url(word) or None
+
+    @classmethod
+    def request_size(cls, word):
+        """The number of characters WORD will contribute to a
+           translation request: zero if it won't be sent at all."""
+        if cls.passthrough(word) is not None:
+            return 0
+        return len(word)
 
     @asyncio.coroutine
     def get_translations_internal(self, lang, words):
-        backoff = 5
-        with (yield from self.serializer):
-            while True:
-                yield from self.rate()
-                self.n_requests += 1
-                self.session.progress()
+        failures = 0
+        while True:
+            self.n_requests += 1
+            self.session.progress()
 
-                blob = yield from self.get_translations_http_request(
-                    lang, words)
-                if blob:
-                    return list(zip(
-                        words,
-                        (unicodedata.normalize(
-                            "NFKC", x["translatedText"]).casefold()
-                         for x in blob["data"]["translations"])))
+            translated = yield from self.service.translate(lang, words)
+            if translated:
+                return list(zip(
+                    words,
+                    (unicodedata.normalize("NFKC", x).casefold()
+                     for x in translated)))
 
+            failures += 1
             self.n_errors += 1
             self.session.progress()
-            yield from asyncio.sleep(backoff)
-            backoff = min(backoff * 2, 60)
+            yield from asyncio.sleep(
+                http_governor.jittered_backoff(failures, 5, 60),
+                loop=self.loop)
 
     @asyncio.coroutine
-    def get_translations_worker(self, batch, *, lang):
-        # The same word might have been requested more than once
-        # (from different documents); we must make sure to satisfy all
-        # futures waiting for each word.
-        # Re-check whether each word has been translated already, because
-        # we could've received yet more requests for a word while we were
-        # waiting for its translation to come back.
-
-        sleepers = collections.defaultdict(list)
-        for word, fut in batch:
-            engl = self.translations[lang].get(word)
-            if engl is not None:
-                fut.set_result(engl)
-            else:
-                sleepers[word].append(fut)
-
-        # Do not waste resources translating nonwords and URLs;
-        # enforce GTrans's request limits.
-        while sleepers:
-            translations = []
-            to_translate = []
-            nchars = 0
-            for word in sleepers.keys():
-                if len(to_translate) == WORDS_PER_POST: break
-                l = len(word)
-
-                if l > WORD_LENGTH_LIMIT:
-                    self.errlog.write(
-                        "{}: word too long, skipping: {}\n"
-                        .format(lang, word))
-                    translations.append((word, word))
-                    continue
-
-                elif word_seg.is_nonword(word):
-                    translations.append((word, word))
-                    continue
-
-                u = word_seg.is_url(word)
-                if u:
-                    translations.append((word, u))
-                    continue
-
-                if nchars + l > CHARS_PER_POST: break
-                to_translate.append(word)
-                nchars += l
+    def get_translations_worker(self, lang, batch):
+        # The queue has already packed BATCH to fit GTrans's request
+        # limits, and made sure that no word appears in it more than
+        # once, or in any other batch at the same time.
+        translations = []
+        to_translate = []
+        tdict = self.translations[lang]
+        for word in batch:
+            engl = tdict.get(word)
+            if engl is None:
+                engl = self.passthrough(word)
+                if engl is not None:
+                    if len(word) > WORD_LENGTH_LIMIT:
+                        self.errlog.write(
+                            "{}: word too long, skipping: {}\n"
+                            .format(lang, word))
+                    translations.append((word, engl))
+                else:
+                    to_translate.append(word)
 
-            if to_translate:
-                tbatch = yield from self.get_translations_internal(
-                    lang, to_translate)
-                translations.extend(tbatch)
+        if to_translate:
+            tbatch = yield from self.get_translations_internal(
+                lang, to_translate)
+            translations.extend(tbatch)
 
-            for word, engl in translations:
-                self.translations[lang][word] = engl
-                for fut in sleepers[word]:
-                    fut.set_result(engl)
-                del sleepers[word]
+        for word, engl in translations:
+            tdict[word] = engl
+        if translations:
+            recorded = yield from self.db.record_translations(
+                lang, translations)
+            yield from self.translations.add(lang, translations, recorded)
 
-            yield from self.db.record_translations(lang, translations)
+        return [(word, tdict[word]) for word in batch]
 
     @asyncio.coroutine
     def translate_segmented(self, url, segmented):
@@ -1610,14 +1580,10 @@ class GoogleTranslate:
                     translation.append(trans)
 
                 else:
-                    if lang not in self.tbufs:
-                        self.tbufs[lang] = work_buffer(
-                            self.get_translations_worker,
-                            WORDS_PER_POST,
-                            label="gtrans-"+lang,
-                            loop=self.loop,
-                            lang=lang)
-                    fut = self.tbufs[lang].put(word)
+                    # If some other document is already waiting for
+                    # this word, this returns the same future, and
+                    # counts one more document waiting for it.
+                    fut = self.queue.put(lang, word)
                     words_seen[key] = fut
                     sleepers.append(fut)
                     translation.append(fut)
@@ -1642,21 +1608,35 @@ class GoogleTranslate:
                 " ".join(translation))
 
     def flush_translations(self):
-        for wb in self.tbufs.values(): wb.flush()
+        self.queue.flush()
 
     @asyncio.coroutine
     def drain_translations(self):
-        sleepers = [wb.drain() for wb in self.tbufs.values()]
-        if sleepers:
-            yield from asyncio.wait(sleepers, loop=self.loop)
+        yield from self.queue.drain()
 
 #
 # The topic-analysis subprocess
 #
 
+# Number of threads for the in-process topic comparison engine.
+TOPIC_THREADS = 4
+
 class TopicAnalyzer:
+    """Decides whether two translated texts are about the same topic.
+
+       ANALYZER is either the command for an external analyzer
+       process (see gph_stub_topic_analyzer.py for the protocol), or
+       'native' to use topic_similarity.TopicSimilarity in a thread
+       pool.  'native:T' sets its similarity threshold to T.
+    """
     def __init__(self, analyzer, loop=None):
         self.analyzer   = analyzer
+        self.engine     = None
+        self.executor   = None
+        if analyzer == "native" or analyzer.startswith("native:"):
+            _, _, threshold = analyzer.partition(":")
+            self.engine = topic_similarity.TopicSimilarity(
+                **({ "threshold": float(threshold) } if threshold else {}))
         self.loop       = loop or asyncio.get_event_loop()
         self.wbuffer    = work_buffer(self._process_topic_batch, 100,
                                       label="topic", loop=self.loop)
@@ -1686,6 +1666,12 @@ class TopicAnalyzer:
 
     @asyncio.coroutine
     def start(self):
+        if self.engine is not None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                TOPIC_THREADS)
+            self.ready_evt.set()
+            return
+
         self.proc_t, self.proc_p = yield from self.loop.subprocess_exec(
             lambda: TopicAnalyzer.TAProtocol(self.exit_evt, self.ready_evt),
             self.analyzer,
@@ -1694,6 +1680,11 @@ class TopicAnalyzer:
 
     @asyncio.coroutine
     def stop(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+            self.ready_evt.clear()
+
         if self.proc_p is not None:
             self.proc_p.stop()
             yield from self.exit_evt.wait()
@@ -1754,6 +1745,14 @@ class TopicAnalyzer:
     def _process_topic_batch(self, batch):
         yield from self.ready_evt.wait()
 
+        if self.engine is not None:
+            results = yield from self.loop.run_in_executor(
+                self.executor, self.engine.same_topic_many,
+                [pair for pair, _ in batch])
+            for (_, fut), val in zip(batch, results):
+                fut.set_result(val)
+            return
+
         while True:
             try:
                 with (yield from self.batch_lock), \
@@ -2178,6 +2177,32 @@ class HistoryRetrievalSession:
 
         self.progress(".", done=True)
 
+def new_http_governor(loop):
+    http = http_governor.HTTPGovernor(
+        http_governor.AiohttpTransport(
+            loop=loop,
+            conn_timeout=5,
+            connections_per_host=4,
+            headers={
+                'User-Agent': 'tbbscraper/get_page_histories; zackw@cmu.edu'
+            }),
+        loop=loop)
+
+    # Never ask the Wayback Machine for more than ten pages a second,
+    # and back off when it says it is overloaded.  Pages can take a
+    # long time.
+    http.add_endpoint("wayback", rate=10, max_rate=10, concurrency=4,
+                      timeout=600,
+                      throttle_statuses=(429, 503))
+
+    # Google Translate uses 403 and 503 interchangeably to mean "slow
+    # down a little", and 500 ("Backend Error") can also safely be
+    # retried.
+    http.add_endpoint("gtrans", rate=20, max_rate=200, concurrency=4,
+                      timeout=60,
+                      throttle_statuses=(403, 429, 503))
+    return http
+
 @asyncio.coroutine
 def inner_main(session):
     try:
@@ -2192,32 +2217,13 @@ def main(loop, argv):
     # everything that might spin the event loop on teardown must be a context
     # manager so it'll be torn down before the loop itself is (__del__ might
     # not run early enough, even for locals)
-    # aiohttp has serious bugs if you allow it any concurrent connections
-    # (mixing up which data is supposed to be transmitted on which channel)
     with asyncio.get_child_watcher() as watcher,                          \
-         aiohttp.ClientSession(
-             connector=aiohttp.TCPConnector(
-                 loop=loop,
-                 conn_timeout=5, limit=1, use_dns_cache=True
-             ),
-             headers={
-                 'User-Agent': 'tbbscraper/get_page_histories; zackw@cmu.edu'
-             }) as http_client_wb,                                         \
-         aiohttp.ClientSession(
-             connector=aiohttp.TCPConnector(
-                 loop=loop,
-                 conn_timeout=5, limit=1, use_dns_cache=True
-             ),
-             headers={
-                 'User-Agent': 'tbbscraper/get_page_histories; zackw@cmu.edu'
-             }) as http_client_gt,                                        \
+         new_http_governor(loop) as http,                                 \
          TopicAnalyzer(analyzer, loop=loop) as topic_analyzer,            \
-         concurrent.futures.ProcessPoolExecutor() as executor,            \
-         rate_limiter(10, loop=loop) as wb_rate,                          \
-         rate_limiter(4096, loop=loop) as gt_rate,                        \
+         extraction_service.ExtractionService() as executor,              \
          Database(dbname, loop, timeout = 3600 * 24) as db,               \
-         WaybackMachine(executor, http_client_wb, wb_rate, loop) as wayback, \
-         GoogleTranslate(db, http_client_gt, gt_rate, loop) as gtrans,       \
+         WaybackMachine(executor, http, loop) as wayback,                 \
+         GoogleTranslate(db, http, loop) as gtrans,                       \
          HistoryRetrievalSession(
              "wayback", db, wayback,
              gtrans, topic_analyzer, loop) as session:
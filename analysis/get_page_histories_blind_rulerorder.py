@@ -14,7 +14,6 @@ import math
 import multiprocessing
 import os
 import random
-import re
 import subprocess
 import sys
 import tempfile
@@ -29,6 +28,10 @@ import aiohttp
 import aiopg
 from werkzeug.http import parse_options_header
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "collector", "lib"))
+from shared.url_canon import canon_url_syntax
+
 #
 # Utilities
 #
@@ -408,97 +411,6 @@ def select_snapshots(avail, lo, hi):
 # Database utilities.
 #
 
-def _urlsplit_forced_encoding(url):
-    try:
-        return urllib.parse.urlsplit(url)
-    except UnicodeDecodeError:
-        return urllib.parse.urlsplit(url.decode("utf-8", "surrogateescape"))
-
-_enap_re = re.compile(br'[\x00-\x20\x7F-\xFF]|'
-                      br'%(?!(?:[0-9A-Fa-f]{2}|u[0-9A-Fa-f]{4}))')
-def _encode_nonascii_and_percents(segment):
-    segment = segment.encode("utf-8", "surrogateescape")
-    return _enap_re.sub(
-        lambda m: "%{:02X}".format(ord(m.group(0))).encode("ascii"),
-        segment).decode("ascii")
-
-def canon_url_syntax(url, *, want_splitresult=None):
-    """Syntactically canonicalize a URL.  This makes the following
-       transformations:
-         - scheme and hostname are lowercased
-         - hostname is punycoded if necessary
-         - vacuous user, password, and port fields are stripped
-         - ports redundant to the scheme are also stripped
-         - path becomes '/' if empty
-         - characters outside the printable ASCII range in path,
-           query, fragment, user, and password are %-encoded, as are
-           improperly used % signs
-
-       You can provide either a string or a SplitResult, and you get
-       back what you put in.  You can set the optional argument
-       want_splitresult to True or False to force a particular
-       type of output.
-    """
-
-    if isinstance(url, urllib.parse.SplitResult):
-        if want_splitresult is None: want_splitresult = True
-        exploded = url
-
-    else:
-        if want_splitresult is None: want_splitresult = False
-
-        exploded = _urlsplit_forced_encoding(url)
-        if not exploded.hostname:
-            # Remove extra slashes after the scheme and retry.
-            corrected = re.sub(r'(?i)^([a-z]+):///+', r'\1://', url)
-            exploded = _urlsplit_forced_encoding(corrected)
-
-    if not exploded.hostname:
-        raise ValueError("url with no host - " + repr(url))
-
-    scheme = exploded.scheme
-    if scheme != "http" and scheme != "https":
-        raise ValueError("url with non-http(s) scheme - " + repr(url))
-
-    host   = exploded.hostname
-    user   = _encode_nonascii_and_percents(exploded.username or "")
-    passwd = _encode_nonascii_and_percents(exploded.password or "")
-    port   = exploded.port
-    path   = _encode_nonascii_and_percents(exploded.path)
-    query  = _encode_nonascii_and_percents(exploded.query)
-    frag   = _encode_nonascii_and_percents(exploded.fragment)
-
-    if path == "":
-        path = "/"
-
-    # We do this even if there are no non-ASCII characters, because it
-    # has the side-effect of throwing a UnicodeError if the hostname
-    # is syntactically invalid (e.g. "foo..com").
-    host = host.encode("idna").decode("ascii")
-
-    if port is None:
-        port = ""
-    elif ((port == 80  and scheme == "http") or
-          (port == 443 and scheme == "https")):
-        port = ""
-    else:
-        port = ":{}".format(port)
-
-    # We don't have to worry about ':' or '@' in the user and password
-    # strings, because urllib.parse does not do %-decoding on them.
-    if user == "" and passwd == "":
-        auth = ""
-    elif passwd == "":
-        auth = "{}@".format(user)
-    else:
-        auth = "{}:{}@".format(user, passwd)
-    netloc = auth + host + port
-
-    result = urllib.parse.SplitResult(scheme, netloc, path, query, frag)
-    if want_splitresult:
-        return result
-    else:
-        return result.geturl()
 
 @asyncio.coroutine
 def add_url_string(db, url):
@@ -1,4 +1,4 @@
-__all__ = ('urljoin', 'ExtractedContent', 'DomStatistics')
+__all__ = ('urljoin', 'ExtractedContent', 'DomStatistics', 'extract_many')
 
 from .relative_urls import urljoin
-from ._extractor import ExtractedContent, DomStatistics
+from ._extractor import ExtractedContent, DomStatistics, extract_many
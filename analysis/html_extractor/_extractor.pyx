@@ -1,6 +1,11 @@
 """Extract content from HTML pages.  This is a wrapper around the
 Gumbo HTML5 parser library; for efficiency we need to do the tree
 walking as well as the parsing in C(ython).
+
+Encoding and MIME type sniffing and the Gumbo parse itself run without
+the GIL, so several pages can be processed concurrently by threads
+(see extract_many); the tree walk and boilerplate removal construct
+Python objects and still need it.
 """
 
 from gumbo cimport *
@@ -14,6 +19,7 @@ from .relative_urls cimport urljoin, urljoin_outbound
 from re import compile as _Regexp
 from re import DOTALL  as _Re_DOTALL
 from collections import Counter as _Counter
+from concurrent.futures import ThreadPoolExecutor as _ThreadPoolExecutor
 from chardet import detect as detect_encoding_statistically
 
 # "Common" tag names are those that have GUMBO_TAG_* constants.
@@ -87,6 +93,9 @@ cdef inline bytes determine_encoding_and_convert(bytes page,
 
     """
     cdef const char *rv
+    cdef const char *label
+    cdef const char *buf = page
+    cdef size_t nbytes = min(len(page), 1024)
     cdef str encoding
 
     # Step 1 does nothing (there is no user override).
@@ -102,14 +111,16 @@ cdef inline bytes determine_encoding_and_convert(bytes page,
 
     # Step 4
     if ext_encoding:
-        rv = canonical_encoding_for_label(ext_encoding)
+        label = ext_encoding
+        with nogil:
+            rv = canonical_encoding_for_label(label)
         if rv:
             encoding = rv.decode("ascii")
             return convert_to_utf8(page, encoding)
 
     # Step 5
-    rv = prescan_a_byte_stream_to_determine_its_encoding(
-        page, min(len(page), 1024))
+    with nogil:
+        rv = prescan_a_byte_stream_to_determine_its_encoding(buf, nbytes)
     if rv:
         encoding = rv.decode('ascii')
         # This is mandated by HTML5, with the justification that
@@ -136,6 +147,19 @@ cdef inline bytes determine_encoding_and_convert(bytes page,
 
     return convert_to_utf8(page, senc)
 
+cdef bytes sniff_mimetype(bytes mimetype, bytes charset, bytes page):
+    """Compute the effective MIME type of PAGE, given the MIMETYPE and
+       CHARSET supplied by the server.  The sniffer looks only at the
+       first few hundred bytes, but we may as well not hold the GIL."""
+    cdef const char *mt = mimetype
+    cdef const char *cs = charset
+    cdef const unsigned char *buf = <const unsigned char *><const char *>page
+    cdef size_t nbytes = len(page)
+    cdef const char *rv
+    with nogil:
+        rv = get_computed_mimetype(mt, cs, buf, nbytes)
+    return rv
+
 # Main tree walker.  Since this gets compiled now, we are safe to just
 # go ahead and use recursive function calls.
 
@@ -443,6 +467,9 @@ cdef class ExtractedContent:
     original     - Bytes: the original HTML of the page, converted to UTF-8
                    if necessary.
     mimetype     - The computed MIME type of the page.
+    truncated    - True if only the first MAX_SIZE bytes of the page (after
+                   conversion to UTF-8) were analyzed.  'original' is
+                   never truncated.
     """
 
     cdef readonly unicode url, title, mimetype, text_content
@@ -451,10 +478,12 @@ cdef class ExtractedContent:
     cdef readonly double threshold # ditto
     cdef readonly object links, resources, headings, dom_stats
     cdef readonly bytes original
+    cdef readonly bint truncated
 
     def __init__(self, url, page, external_ctype='text/html',
-                 external_charset='utf-8'):
+                 external_charset='utf-8', max_size=None):
 
+        cdef Py_ssize_t cut
         cdef size_t pagelen
         cdef char *pagebuf
         cdef GumboOptions opts
@@ -470,12 +499,11 @@ cdef class ExtractedContent:
             # Without the cast, Cython doesn't realize it can use
             # PyUnicode_AsUTF8String here.
             bytestr = (<str>page).encode('utf-8')
-            mimetype = get_computed_mimetype(mimetype, charset,
-                                             bytestr, len(bytestr))
+            mimetype = sniff_mimetype(mimetype, charset, bytestr)
 
         else:
-            mimetype = get_computed_mimetype(mimetype, charset,
-                                             page, len(page))
+            page = bytes(page)
+            mimetype = sniff_mimetype(mimetype, charset, page)
             bytestr = determine_encoding_and_convert(page, charset)
 
         mimetype = mimetype.decode("ascii")
@@ -503,6 +531,16 @@ cdef class ExtractedContent:
 
         self.mimetype = mimetype
         self.original = bytestr
+
+        # Very large documents can be cut short, at a character boundary.
+        self.truncated = False
+        if max_size is not None and len(bytestr) > max_size:
+            cut = max_size
+            while cut > 0 and (bytestr[cut] & 0xC0) == 0x80:
+                cut -= 1
+            bytestr = bytestr[:cut]
+            self.truncated = True
+
         pagebuf = bytestr
         pagelen = len(bytestr)
 
@@ -510,7 +548,8 @@ cdef class ExtractedContent:
         opts.stop_on_first_error = False
         opts.max_errors = 0
 
-        output = gumbo_parse_with_options(&opts, pagebuf, pagelen)
+        with nogil:
+            output = gumbo_parse_with_options(&opts, pagebuf, pagelen)
         if not output:
             raise RuntimeError("gumbo_parse returned nothing")
 
@@ -519,7 +558,8 @@ cdef class ExtractedContent:
             walker.walk_node(output.root)
             walker.finalize()
         finally:
-            gumbo_destroy_output(&opts, output)
+            with nogil:
+                gumbo_destroy_output(&opts, output)
 
         self.url          = walker.url
         self.title        = walker.title
@@ -532,3 +572,27 @@ cdef class ExtractedContent:
         tp, thresh        = extract_content(self.blocktree)
         self.text_pruned  = tp
         self.threshold    = thresh
+
+def extract_many(pages, n_threads=None, return_exceptions=False,
+                 max_size=None):
+    """Extract content from each of PAGES, which is an iterable of
+       (url, page, external_ctype, external_charset) tuples, using a
+       pool of N_THREADS threads (default: as many as
+       concurrent.futures.ThreadPoolExecutor picks).  Returns a list
+       of ExtractedContent objects in the same order as PAGES.
+       MAX_SIZE is passed down to ExtractedContent.
+
+       If RETURN_EXCEPTIONS is true, a page that cannot be processed
+       produces its exception object in the result list; otherwise
+       the first such exception is raised.
+    """
+    def extract_one(args):
+        try:
+            return ExtractedContent(*args, max_size=max_size)
+        except Exception as e:
+            if return_exceptions:
+                return e
+            raise
+
+    with _ThreadPoolExecutor(n_threads) as pool:
+        return list(pool.map(extract_one, pages))
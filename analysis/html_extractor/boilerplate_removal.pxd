@@ -26,6 +26,12 @@ cdef class BlockTreeNode:
     cdef int  _depth
     cdef double _weight
 
+    # Maximum-density node within this subtree, and the minimum
+    # totaltextdensity on the path from this node down to it.
+    # Computed by finalize().
+    cdef BlockTreeNode _maxnode
+    cdef double _pathmin
+
     # Exposed state
     cdef readonly unicode text
     cdef readonly TagClass tagclass
@@ -47,6 +53,8 @@ cdef class BlockTreeNode:
     cdef bint add_tag(self, unicode tagname, GumboElement* tag) except False
     cdef bint add_child(self, BlockTreeNode child) except False
     cdef bint finalize(self) except False
+    cdef bint _finalize_local(self) except False
+    cdef bint _finalize_totals(self) except False
 
 cdef class BlockTreeBuilder:
     cdef int depth
@@ -30,6 +30,7 @@
 # from paper #1; the "total text density" metric and the self-tuning
 # threshold are more from paper #2.
 
+from libc.string cimport strlen
 from gumbo cimport *
 from .unicode_utils cimport n_grapheme_clusters, \
     normalize_text, not_all_whitespace
@@ -40,7 +41,8 @@ __all__ = [
     "classify_tag",
     "BlockTreeNode",
     "BlockTreeBuilder",
-    "extract_content"
+    "extract_content",
+    "reference_extract_content"
 ]
 
 TAGCLASS_LABELS = [
@@ -56,10 +58,38 @@ TAGCLASS_LABELS = [
 
 # Length of the canonicalized serialization of a tag attribute.
 # Attribute names are supposed to be ASCII, but sometimes they aren't.
+#
+# Attribute names, and short attribute values (class names, target=,
+# rel=, etc.) repeat heavily, so their lengths are memoized.  The memo
+# is bounded by simply emptying it when it gets full.
+cdef enum:
+    ATTR_MEMO_MAX_ENTRIES = 8192
+    ATTR_MEMO_MAX_KEYLEN  = 64
+
+cdef dict _attr_memo = {}
+
+cdef inline Py_ssize_t attr_text_len(const char *s) except -1:
+    cdef size_t n = strlen(s)
+    cdef Py_ssize_t rv
+    cdef bytes key
+    if n > ATTR_MEMO_MAX_KEYLEN:
+        return n_grapheme_clusters(normalize_text(s[:n].decode('utf-8')))
+
+    key = s[:n]
+    cached = _attr_memo.get(key)
+    if cached is not None:
+        return cached
+
+    rv = n_grapheme_clusters(normalize_text(key.decode('utf-8')))
+    if len(_attr_memo) >= ATTR_MEMO_MAX_ENTRIES:
+        _attr_memo.clear()
+    _attr_memo[key] = rv
+    return rv
+
 cdef inline Py_ssize_t attr_len(GumboAttribute* attr) except -1:
     return (4 + # space, equals sign, two quote marks
-            n_grapheme_clusters(normalize_text(attr.name.decode('utf-8'))) +
-            n_grapheme_clusters(normalize_text(attr.value.decode('utf-8'))))
+            attr_text_len(attr.name) +
+            attr_text_len(attr.value))
 
 cdef TagClass classify_tag(GumboTag tag):
     # Elements that do not display their children.
@@ -341,9 +371,33 @@ cdef class BlockTreeNode:
         return True
 
     cdef bint finalize(self) except False:
-        if self._textv is None:
-            return True
+        """Finalize this block and all of its children.  Weights
+           propagate downward and totals propagate upward, so this is
+           done in two passes over an explicit list of nodes rather
+           than by recursion, which could overflow the C stack on very
+           deeply nested documents."""
+        cdef BlockTreeNode node, c
+        cdef list pending = [self]
+        cdef list order = []
+
+        while pending:
+            node = <BlockTreeNode>pending.pop()
+            if node._textv is None:
+                continue
+            node._finalize_local()
+            order.append(node)
+            for cc in node.children:
+                c = <BlockTreeNode>cc
+                c._weight *= node._weight
+                pending.append(c)
+
+        # Every node appears in ORDER before any of its descendants.
+        for node in reversed(order):
+            node._finalize_totals()
 
+        return True
+
+    cdef bint _finalize_local(self) except False:
         self.text   = normalize_text(self._textv)
         self._textv = None
         self._depth = -1
@@ -358,18 +412,35 @@ cdef class BlockTreeNode:
         else:
             self.tagchars = 1 + log(self.tagchars)
 
+        return True
+
+    cdef bint _finalize_totals(self) except False:
+        cdef BlockTreeNode c
+        cdef BlockTreeNode maxnode = self
+        cdef double pathmin
+
         self.totaltagchars = self.tagchars
         self.totaltextchars = self.textchars
         for cc in self.children:
             c = <BlockTreeNode>cc
-            c._weight *= self._weight
-            c.finalize()
             self.totaltagchars += c.totaltagchars
             self.totaltextchars += c.totaltextchars
 
         self.textdensity = self.textchars / self.tagchars
         self.totaltextdensity = self.totaltextchars / self.totaltagchars
 
+        # Track the maximum-density block in this subtree, and the
+        # minimum density on the path down to it, for choose_threshold.
+        # Ties go to the first such block in document order.
+        pathmin = self.totaltextdensity
+        for cc in self.children:
+            c = <BlockTreeNode>cc
+            if c._maxnode.totaltextdensity > maxnode.totaltextdensity:
+                maxnode = c._maxnode
+                pathmin = min(self.totaltextdensity, c._pathmin)
+
+        self._maxnode = maxnode
+        self._pathmin = pathmin
         return True
 
 cdef class BlockTreeBuilder:
@@ -543,45 +614,12 @@ cdef class BlockTreeBuilder:
 # is and isn't content, and extracting the right bits.
 #
 
-cdef BlockTreeNode find_max_density(BlockTreeNode node,
-                                    BlockTreeNode candidate):
-    if candidate is None or node.totaltextdensity > candidate.totaltextdensity:
-        candidate = node
-
-    for cc in node.children:
-        c = <BlockTreeNode>cc
-        candidate = find_max_density(c, candidate)
-
-    return candidate
-
-cdef list find_path_to_max_density(BlockTreeNode node,
-                                   BlockTreeNode target):
-    if node is target:
-        return [node]
-
-    for cc in node.children:
-        c = <BlockTreeNode>cc
-        p = find_path_to_max_density(c, target)
-        if p is not None:
-            return [node] + p
-
-    return None
-
 cdef double choose_threshold(BlockTreeNode root) except -1:
     # paper 2, paraphrased: "...first find the _maximum_ density
     # block in the whole page; then, take the _minimum_ density
     # in the path from that block to the body as the threshold."
-
-
-    target = find_max_density(root, None)
-    path   = find_path_to_max_density(root, target)
-
-    # This isn't just min(x.totaltextdensity for x in path) because
-    # cython 0.20 doesn't support genexps in cdefs. (0.21 does.)
-    densities = []
-    for x in path:
-        densities.append((<BlockTreeNode>x).totaltextdensity)
-    return min(densities)
+    # finalize() has already worked this out for every subtree.
+    return root._pathmin
 
 #
 # Paper 2's description of how content is actually selected is very
@@ -593,14 +631,20 @@ cdef double choose_threshold(BlockTreeNode root) except -1:
 # enough for our purposes.
 #
 
-cdef bint do_extract_content(BlockTreeNode node,
+cdef bint do_extract_content(BlockTreeNode root,
                              double thresh,
                              list output) except False:
-
-    if node.totaltextdensity >= thresh:
-        output.append(node.text)
-        for c in node.children:
-            do_extract_content(<BlockTreeNode>c, thresh, output)
+    # Pre-order walk with an explicit stack; children are pushed in
+    # reverse so they come off in document order.
+    cdef BlockTreeNode node
+    cdef list pending = [root]
+
+    while pending:
+        node = <BlockTreeNode>pending.pop()
+        if node.totaltextdensity >= thresh:
+            output.append(node.text)
+            for c in reversed(node.children):
+                pending.append(c)
 
     return True
 
@@ -616,3 +660,42 @@ cpdef object extract_content(BlockTreeNode root):
     selected_blocks = []
     do_extract_content(root, thresh, selected_blocks)
     return (" ".join(selected_blocks), thresh)
+
+#
+# The original, recursive implementation of threshold selection and
+# content extraction.  Kept only as a reference for the test suite
+# (boilerplate_removal_test.py).
+#
+
+def _reference_find_max_density(BlockTreeNode node, BlockTreeNode candidate):
+    if candidate is None or node.totaltextdensity > candidate.totaltextdensity:
+        candidate = node
+    for c in node.children:
+        candidate = _reference_find_max_density(c, candidate)
+    return candidate
+
+def _reference_find_path(BlockTreeNode node, BlockTreeNode target):
+    if node is target:
+        return [node]
+    for c in node.children:
+        p = _reference_find_path(c, target)
+        if p is not None:
+            return [node] + p
+    return None
+
+def _reference_extract(BlockTreeNode node, double thresh, list output):
+    if node.totaltextdensity >= thresh:
+        output.append(node.text)
+        for c in node.children:
+            _reference_extract(c, thresh, output)
+
+def reference_extract_content(BlockTreeNode root):
+    if root.tagclass == TC_ROOT and len(root.children) == 1:
+        root = <BlockTreeNode>root.children[0]
+
+    target = _reference_find_max_density(root, None)
+    path   = _reference_find_path(root, target)
+    thresh = min(x.totaltextdensity for x in path)
+    selected_blocks = []
+    _reference_extract(root, thresh, selected_blocks)
+    return (" ".join(selected_blocks), thresh)
@@ -0,0 +1,69 @@
+# Check that the single-pass threshold selection in boilerplate_removal
+# produces the same output as the original recursive implementation
+# (kept as boilerplate_removal.reference_extract_content).
+#
+# By default only a handful of synthetic documents are tested.  To run
+# over a corpus of stored pages, set HTML_CORPUS to a directory of
+# HTML files (one page per file, any encoding).
+
+import os
+import unittest
+
+from html_extractor import ExtractedContent
+from html_extractor.boilerplate_removal import reference_extract_content
+
+SYNTHETIC = [
+    ("empty", b""),
+    ("text only", b"just some text"),
+    ("simple", b"<html><head><title>t</title></head><body>"
+               b"<div><a href='/'>home</a> <a href='/x'>x</a></div>"
+               b"<p>The quick brown fox jumps over the lazy dog.</p>"
+               b"<p>Pack my box with five dozen liquor jugs.</p>"
+               b"</body></html>"),
+    ("ties", b"<body>" + b"<div><p>same text</p></div>" * 20 + b"</body>"),
+    ("boilerplate", b"<body><nav>" + b"<a href='#'>link</a> " * 50 +
+                    b"</nav><article><h1>Headline</h1>" +
+                    b"<p>A paragraph of real content.</p>" * 30 +
+                    b"</article><footer>copyright</footer></body>"),
+    ("deep", b"<body>" + b"<div class='x'>" * 500 + b"deep text" +
+             b"</div>" * 500 + b"</body>"),
+]
+
+class TestSinglePassThreshold(unittest.TestCase):
+    def __init__(self, label="", page=b"", max_size=None):
+        unittest.TestCase.__init__(self)
+        self._label = label
+        self._page = page
+        self._max_size = max_size
+
+    def runTest(self):
+        ec = ExtractedContent("http://example.com/", self._page,
+                              max_size=self._max_size)
+        exp_text, exp_thresh = reference_extract_content(ec.blocktree)
+        self.assertEqual(ec.threshold, exp_thresh,
+                         msg="{}: threshold".format(self._label))
+        self.assertEqual(ec.text_pruned, exp_text,
+                         msg="{}: pruned text".format(self._label))
+        if self._max_size is not None:
+            self.assertEqual(ec.truncated,
+                             len(ec.original) > self._max_size)
+
+def load_tests(loader, tests, pattern):
+    suite = unittest.TestSuite()
+    for label, page in SYNTHETIC:
+        suite.addTest(TestSinglePassThreshold(label, page))
+        suite.addTest(TestSinglePassThreshold(label + " (capped)", page,
+                                              max_size=100))
+
+    corpus = os.environ.get("HTML_CORPUS")
+    if corpus:
+        for fn in sorted(os.listdir(corpus)):
+            with open(os.path.join(corpus, fn), "rb") as f:
+                page = f.read()
+            suite.addTest(TestSinglePassThreshold(fn, page))
+            suite.addTest(TestSinglePassThreshold(fn + " (capped)", page,
+                                                  max_size=64*1024))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main()
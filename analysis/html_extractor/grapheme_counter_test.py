@@ -4,8 +4,11 @@
 import unittest
 import codecs
 import re
+import sys
+import time
 
-from grapheme_counter import n_grapheme_clusters
+from unicode_utils import n_grapheme_clusters, _n_grapheme_clusters_full, \
+    normalize_text, _normalize_text_full
 
 def to_ascii_string_literal(s):
     if s == "": return "''"
@@ -24,6 +27,11 @@ class TestNGC(unittest.TestCase):
                          .format(to_ascii_string_literal(self._text),
                                  self._exp_nclusters, nclusters))
 
+        # The ASCII fast paths must agree with the general code.
+        self.assertEqual(nclusters, _n_grapheme_clusters_full(self._text))
+        self.assertEqual(normalize_text(self._text),
+                         _normalize_text_full(self._text))
+
 def load_tests(loader, tests, pattern):
 
     tests = set()
@@ -32,6 +40,12 @@ def load_tests(loader, tests, pattern):
     # The empty string contains zero clusters.
     tests.add(("", 0))
 
+    # ASCII strings take a fast path, in which CR LF is the only
+    # multi-character cluster.
+    tests.add(("a\r\nb", 3))
+    tests.add(("\r\r\n\n", 3))
+    tests.add(("  class=\"nav\"  ", 15))
+
     # Any single-character string contains one cluster, no matter
     # what class the character is.
     for singleton in ["x",          # Other
@@ -79,5 +93,47 @@ def load_tests(loader, tests, pattern):
                                         key = lambda p: (p[1], p[0])))
     return suite
 
+# Microbenchmark: characters per second through the general code and
+# through the ASCII fast paths, on text typical of attribute names and
+# values (pure ASCII) and of page text (mostly not).
+# Run with "python3 grapheme_counter_test.py bench".
+
+BENCH_SAMPLES = {
+    "ascii":     ["class", "href", "id", "_blank", "nav-item active",
+                  "https://www.example.com/some/path?query=1",
+                  "The quick brown fox jumps over the lazy dog."],
+    "non-ascii": ["Съешь же ещё этих мягких французских булок",
+                  "我能吞下玻璃而不伤身体。", "ｆｕｌｌｗｉｄｔｈ",
+                  "نص حكيم له سر قاطع وذو شأن عظيم"],
+}
+
+def bench_one(fn, texts, min_time=1.0):
+    nchars = sum(len(t) for t in texts)
+    reps = 0
+    start = time.perf_counter()
+    while True:
+        for t in texts:
+            fn(t)
+        reps += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            return reps * nchars / elapsed
+
+def benchmark():
+    for label, texts in sorted(BENCH_SAMPLES.items()):
+        for fname, before, after in [
+                ("n_grapheme_clusters",
+                 _n_grapheme_clusters_full, n_grapheme_clusters),
+                ("normalize_text",
+                 _normalize_text_full, normalize_text)]:
+            b = bench_one(before, texts)
+            a = bench_one(after, texts)
+            sys.stdout.write("{:<10} {:<20} before {:>12,.0f} chars/s"
+                             "  after {:>12,.0f} chars/s  ({:.1f}x)\n"
+                             .format(label, fname, b, a, a/b))
+
 if __name__ == '__main__':
-    unittest.main()
+    if sys.argv[1:] == ["bench"]:
+        benchmark()
+    else:
+        unittest.main()
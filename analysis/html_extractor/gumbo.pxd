@@ -1,6 +1,6 @@
 # Cython declaration glue for libgumbo.
 
-cdef extern from "gumbo.h":
+cdef extern from "gumbo.h" nogil:
     ctypedef enum GumboParseFlags:
         GUMBO_INSERTION_NORMAL,
         GUMBO_INSERTION_BY_PARSER,
@@ -1,6 +1,9 @@
 # Cython declaration glue for mimesniff.c.
 
-cdef extern from "mimesniff.h":
+# get_computed_mimetype is pure C with no global state, so it may be
+# called without the GIL.
+
+cdef extern from "mimesniff.h" nogil:
     const char *get_computed_mimetype(const char *mimetype,
                                       const char *charset,
                                       const unsigned char *buffer,
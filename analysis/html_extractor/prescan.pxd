@@ -1,6 +1,9 @@
 # Cython declaration glue for prescan.c.
 
-cdef extern from "prescan.h":
+# Both functions are pure C with no global state, so they may be
+# called without the GIL.
+
+cdef extern from "prescan.h" nogil:
     const char *canonical_encoding_for_label(const char *encoding)
 
     const char *prescan_a_byte_stream_to_determine_its_encoding(const char *b,
@@ -5,6 +5,10 @@ __all__ = ["split_ascii_space",
            "normalize_text",
            "n_grapheme_clusters"]
 
+# PEP 393 strings record whether they are pure ASCII; checking is free.
+cdef extern from "Python.h":
+    bint PyUnicode_IS_ASCII(object s)
+
 # Input normalization per http://docs.cython.org/src/tutorial/strings.html
 cdef inline unicode _ustring(s):
     if isinstance(s, unicode):
@@ -35,6 +39,8 @@ cdef inline unicode _ustringv(s):
 # leading and trailing spaces; this is even more aggressive than NFKC,
 # which, for instance, converts U+2000 through U+200A into U+0020, but
 # leaves U+0009 and U+000A alone, and doesn't collapse runs.
+#
+# NFKC does nothing to pure ASCII text, so we skip it in that case.
 
 from re import compile as _Regex
 from re import DOTALL  as _Re_DOTALL
@@ -42,6 +48,15 @@ from unicodedata import normalize as unicode_norm
 
 WSRE = _Regex("\\s+")
 cpdef unicode normalize_text(text):
+    cdef unicode utext = _ustringv(text)
+    if not PyUnicode_IS_ASCII(utext):
+        utext = unicode_norm("NFKC", utext)
+    # str.split() splits on exactly the characters that \s matches,
+    # and is much faster than WSRE.sub(" ", utext).strip().
+    return " ".join(utext.split())
+
+cpdef unicode _normalize_text_full(text):
+    """normalize_text without the ASCII fast path; for testing."""
     cdef unicode utext = _ustringv(text)
     return WSRE.sub(" ", unicode_norm("NFKC", utext)).strip()
 
@@ -87,6 +102,16 @@ from gbp_tbl cimport *
 cpdef Py_ssize_t n_grapheme_clusters(text) except -1:
     cdef unicode utext = _ustring(text)
 
+    # In ASCII, the only multi-character grapheme cluster is CR LF
+    # (rule GB3); every other character pair has a boundary between.
+    if PyUnicode_IS_ASCII(utext):
+        return len(utext) - utext.count("\r\n")
+    return _n_grapheme_clusters_full(utext)
+
+cpdef Py_ssize_t _n_grapheme_clusters_full(text) except -1:
+    """n_grapheme_clusters without the ASCII fast path."""
+    cdef unicode utext = _ustring(text)
+
     # Setting the "previous character"'s class to GBP_Control at the
     # beginning of the string implements UAX#29 rule GB1, because
     # GBP_Control invariably has a cluster break after it.
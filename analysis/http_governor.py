@@ -0,0 +1,485 @@
+# Shared HTTP client layer for get_page_histories*.py.
+#
+# Every request to a remote service goes through an HTTPGovernor,
+# which sends it to one of its Endpoints (e.g. "wayback", "gtrans").
+# Each Endpoint limits the number of requests in flight, and spaces
+# them out with a token bucket whose rate is adjusted by AIMD: it
+# creeps up while requests succeed, and is cut in half when the
+# service says to slow down (429), or trimmed when it answers with
+# another 5xx or not at all.  Each cut happens at most once per round
+# trip, so a burst of such answers to requests sent at the old rate
+# counts only once.
+# A Retry-After header pauses the endpoint altogether.  Those answers,
+# timeouts and network errors (OSError, and whatever the transport
+# lists in its transient_errors) are retried, after a randomly
+# jittered exponential backoff, up to a limit; any other exception is
+# taken to be a bug or a permanent failure, and raised at once.  Each Endpoint keeps
+# histograms of request latency and of completed requests per second,
+# and HTTPGovernor.report writes them out.
+#
+# The actual HTTP is done by a transport.  AiohttpTransport keeps a
+# pool of keep-alive sessions per host; StubTransport answers requests
+# with a function, for benchmarks (see bench_http_governor.py) and
+# tests.  Either way, request bodies are read in full, and requests
+# return Response objects.
+
+import asyncio
+import collections
+import itertools
+import json
+import math
+import random
+import sys
+import urllib.parse
+import zlib
+
+__all__ = ('HTTPGovernor', 'Endpoint', 'Response', 'Histogram',
+           'AiohttpTransport', 'StubTransport', 'jittered_backoff')
+
+class Response:
+    """A completely read HTTP response."""
+
+    def __init__(self, status, reason, headers, body):
+        self.status  = status
+        self.reason  = reason
+        self.headers = headers
+        self.body    = body
+
+    def charset(self):
+        ctype = self.headers.get("content-type", "")
+        for param in ctype.split(";")[1:]:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "charset":
+                return value.strip().strip('"') or "utf-8"
+        return "utf-8"
+
+    def text(self, encoding=None, errors="replace"):
+        return self.body.decode(encoding or self.charset(), errors)
+
+    def json(self):
+        return json.loads(self.text(errors="strict"))
+
+class Histogram:
+    """Histogram with logarithmically spaced buckets: STEPS buckets
+       per doubling, starting at LOW.  Values below LOW go in the
+       first bucket."""
+
+    def __init__(self, low, steps=4):
+        self.low    = low
+        self.steps  = steps
+        self.counts = collections.Counter()
+        self.n      = 0
+        self.total  = 0.0
+        self.max    = 0.0
+
+    def add(self, value):
+        if value <= self.low:
+            b = 0
+        else:
+            b = int(math.log2(value / self.low) * self.steps) + 1
+        self.counts[b] += 1
+        self.n     += 1
+        self.total += value
+        self.max    = max(self.max, value)
+
+    def upper(self, b):
+        """Upper bound of bucket B."""
+        return self.low * 2 ** (b / self.steps)
+
+    def quantile(self, q):
+        """Upper bound of the bucket containing the Q-th quantile."""
+        if not self.n:
+            return 0.0
+        target = q * self.n
+        seen = 0
+        for b in sorted(self.counts):
+            seen += self.counts[b]
+            if seen >= target:
+                return min(self.upper(b), self.max)
+        return self.max
+
+    def write(self, out, label, unit, width=40):
+        if not self.n:
+            out.write("  {}: no data\n".format(label))
+            return
+        out.write("  {}: n={} mean={:.3f}{u} p50={:.3f}{u} p90={:.3f}{u}"
+                  " p99={:.3f}{u} max={:.3f}{u}\n"
+                  .format(label, self.n, self.total / self.n,
+                          self.quantile(0.5), self.quantile(0.9),
+                          self.quantile(0.99), self.max, u=unit))
+        peak = max(self.counts.values())
+        for b in range(min(self.counts), max(self.counts) + 1):
+            n = self.counts.get(b, 0)
+            out.write("    <= {:>9.3f}{} {:>8} {}\n"
+                      .format(self.upper(b), unit, n,
+                              "#" * int(round(width * n / peak))))
+
+class Endpoint:
+    """Rate, concurrency and retry policy for one remote service, and
+       statistics about the requests made to it.
+
+       RATE is the initial number of requests per second; AIMD keeps
+       it between MIN_RATE and MAX_RATE, adding INCREASE (default
+       RATE/16) requests per second for each second's worth of
+       successful requests.  The rate is multiplied by DECREASE on a
+       status in THROTTLE_STATUSES, and by ERROR_DECREASE on any other
+       status in RETRY_STATUSES, a timeout or a transport error; the
+       former mean the service is overloaded, the latter may just be
+       bad luck.  All of those are retried.  BURST is the size of the
+       token bucket.  At most CONCURRENCY requests
+       are in flight at once, each for at most TIMEOUT seconds.  A
+       request is tried at most MAX_TRIES times; the delay before the
+       n-th retry is random, between zero and BACKOFF * 2**(n-1)
+       seconds, capped at MAX_BACKOFF.  Unless HONOR_RETRY_AFTER is
+       false, a Retry-After header on a response with one of those
+       statuses stops all requests for the time it gives."""
+
+    def __init__(self, name, *, rate, concurrency=1,
+                 min_rate=None, max_rate=None, burst=1,
+                 increase=None, decrease=0.5, error_decrease=0.9,
+                 throttle_statuses=(429,),
+                 retry_statuses=(500, 502, 503, 504),
+                 max_tries=8, backoff=1, max_backoff=60,
+                 honor_retry_after=True, timeout=60, loop=None):
+        self.name              = name
+        self.loop              = loop or asyncio.get_event_loop()
+        self.rate              = float(rate)
+        self.min_rate          = rate / 64 if min_rate is None else min_rate
+        self.max_rate          = rate * 4 if max_rate is None else max_rate
+        self.burst             = burst
+        self.increase          = rate / 16 if increase is None else increase
+        self.decrease          = decrease
+        self.error_decrease    = error_decrease
+        self.throttle_statuses = frozenset(throttle_statuses)
+        self.retry_statuses    = (frozenset(retry_statuses)
+                                  | self.throttle_statuses)
+        self.max_tries         = max_tries
+        self.backoff           = backoff
+        self.max_backoff       = max_backoff
+        self.honor_retry_after = honor_retry_after
+        self.timeout           = timeout
+
+        self.slots             = asyncio.Semaphore(concurrency, loop=self.loop)
+        self.bucket_lock       = asyncio.Lock(loop=self.loop)
+        self.tokens            = float(burst)
+        self.refilled          = self.loop.time()
+        self.paused_until      = 0.0
+        self.last_decrease     = -math.inf
+
+        self.started           = self.loop.time()
+        self.n_requests        = 0
+        self.n_retries         = 0
+        self.n_errors          = 0
+        self.n_bytes           = 0
+        self.statuses          = collections.Counter()
+        self.latency           = Histogram(0.001)
+        self.throughput        = Histogram(1, steps=2)
+        self.this_second       = None
+        self.n_this_second     = 0
+
+    @asyncio.coroutine
+    def acquire(self):
+        """Wait for a request slot, then for a token."""
+        yield from self.slots.acquire()
+        try:
+            with (yield from self.bucket_lock):
+                while True:
+                    now = self.loop.time()
+                    if now < self.paused_until:
+                        yield from asyncio.sleep(self.paused_until - now,
+                                                 loop=self.loop)
+                        continue
+                    self.tokens = min(self.burst, self.tokens +
+                                      (now - self.refilled) * self.rate)
+                    self.refilled = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return now
+                    yield from asyncio.sleep((1 - self.tokens) / self.rate,
+                                             loop=self.loop)
+        except:
+            self.slots.release()
+            raise
+
+    def release(self):
+        self.slots.release()
+
+    def retry_delay(self, attempt):
+        return jittered_backoff(attempt, self.backoff, self.max_backoff)
+
+    def _count_completion(self, now):
+        second = int(now - self.started)
+        if second != self.this_second:
+            if self.this_second is not None:
+                self.throughput.add(self.n_this_second)
+                # Seconds with nothing completed count too.
+                for _ in range(min(second - self.this_second - 1, 3600)):
+                    self.throughput.add(0)
+            self.this_second   = second
+            self.n_this_second = 0
+        self.n_this_second += 1
+
+    def record(self, sent, resp):
+        """Account for RESP, the response to a request sent at SENT,
+           and adjust the rate."""
+        now = self.loop.time()
+        self.n_requests += 1
+        self.statuses[resp.status] += 1
+        self.n_bytes += len(resp.body)
+        self.latency.add(now - sent)
+        self._count_completion(now)
+
+        if resp.status not in self.retry_statuses:
+            self.rate = min(self.max_rate,
+                            self.rate + self.increase / self.rate)
+            return
+
+        if resp.status in self.throttle_statuses:
+            self.slow_down(sent, now, self.decrease)
+        else:
+            self.slow_down(sent, now, self.error_decrease)
+        pause = (self.honor_retry_after and
+                 parse_retry_after(resp.headers.get("retry-after")))
+        if pause:
+            self.paused_until = max(self.paused_until, now + pause)
+
+    def record_error(self, sent):
+        """Account for a request sent at SENT that failed without a
+           response (a timeout or transport error)."""
+        now = self.loop.time()
+        self.n_requests += 1
+        self.n_errors += 1
+        self.latency.add(now - sent)
+        self.slow_down(sent, now, self.error_decrease)
+
+    def slow_down(self, sent, now, factor):
+        # Requests sent before the last decrease were sent at a rate
+        # that has already been corrected for.
+        if sent >= self.last_decrease:
+            self.rate = max(self.min_rate, self.rate * factor)
+            self.last_decrease = now
+
+    def write_report(self, out):
+        elapsed = max(self.loop.time() - self.started, 1e-9)
+        out.write("{}: {} requests ({} retries, {} errors), {:.1f} req/s,"
+                  " {:.1f} KiB/s; current rate limit {:.2f} req/s\n"
+                  .format(self.name, self.n_requests, self.n_retries,
+                          self.n_errors, self.n_requests / elapsed,
+                          self.n_bytes / 1024 / elapsed, self.rate))
+        if self.statuses:
+            out.write("  status: {}\n".format(", ".join(
+                "{} x{}".format(s, n)
+                for s, n in sorted(self.statuses.items()))))
+        self.latency.write(out, "latency", "s")
+        self.throughput.write(out, "completed per second", "")
+
+def jittered_backoff(attempt, base, cap):
+    """Delay before retry number ATTEMPT (counting from 1): random,
+       between zero and BASE * 2**(ATTEMPT-1), but no more than CAP.
+       The randomness keeps clients that failed together from
+       retrying together."""
+    return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+
+def parse_retry_after(value):
+    """Seconds to wait, from a Retry-After header; HTTP dates are not
+       supported and treated as absent."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        return None
+
+class HTTPGovernor:
+    """Routes requests to their Endpoints and a shared transport.
+
+       gov = HTTPGovernor(AiohttpTransport(headers=...))
+       gov.add_endpoint("wayback", rate=10)
+       resp = yield from gov.request("wayback", "GET", url)
+    """
+
+    def __init__(self, transport, *, loop=None):
+        self.transport = transport
+        self.retryable = ((asyncio.TimeoutError, OSError)
+                          + tuple(transport.transient_errors))
+        self.loop      = loop or asyncio.get_event_loop()
+        self.endpoints = collections.OrderedDict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *dontcare):
+        self.report(sys.stderr)
+        self.transport.close()
+        return False
+
+    def add_endpoint(self, name, **kwargs):
+        ep = Endpoint(name, loop=self.loop, **kwargs)
+        self.endpoints[name] = ep
+        return ep
+
+    @asyncio.coroutine
+    def request(self, endpoint, method, url, **kwargs):
+        """Make a request through ENDPOINT, retrying as its policy
+           says, and return the Response.  If the last try ended with
+           a status in ENDPOINT's retry_statuses, that response is
+           returned; if it ended with an exception, that is raised.
+           Exceptions other than timeouts and network errors are
+           raised immediately, without affecting ENDPOINT's rate.
+           Keyword arguments are passed to the transport."""
+        ep = self.endpoints[endpoint]
+        for attempt in itertools.count(1):
+            sent = yield from ep.acquire()
+            try:
+                resp = yield from asyncio.wait_for(
+                    self.transport.request(method, url, **kwargs),
+                    ep.timeout, loop=self.loop)
+            except self.retryable:
+                ep.record_error(sent)
+                if attempt >= ep.max_tries:
+                    raise
+            else:
+                ep.record(sent, resp)
+                if (resp.status not in ep.retry_statuses
+                    or attempt >= ep.max_tries):
+                    return resp
+            finally:
+                ep.release()
+
+            ep.n_retries += 1
+            yield from asyncio.sleep(ep.retry_delay(attempt), loop=self.loop)
+
+    def report(self, out):
+        for ep in self.endpoints.values():
+            ep.write_report(out)
+        out.flush()
+
+class AiohttpTransport:
+    """Sends requests with aiohttp, keeping up to CONNECTIONS_PER_HOST
+       keep-alive sessions for each host.  Each session has a
+       connector limited to a single connection, because aiohttp has
+       serious bugs if you allow it any concurrent connections (mixing
+       up which data is supposed to be transmitted on which channel).
+       HEADERS are sent with every request."""
+
+    def __init__(self, *, headers=None, conn_timeout=5,
+                 connections_per_host=1, loop=None):
+        self.headers      = headers
+        self.conn_timeout = conn_timeout
+        self.per_host     = connections_per_host
+        self.loop         = loop or asyncio.get_event_loop()
+        self.idle         = collections.defaultdict(list)
+        self.n_sessions   = collections.Counter()
+        self.available    = {}
+
+    @property
+    def transient_errors(self):
+        import aiohttp
+        return (aiohttp.errors.ClientError,
+                aiohttp.errors.DisconnectedError,
+                aiohttp.errors.HttpProcessingError)
+
+    def new_session(self):
+        import aiohttp
+        return aiohttp.ClientSession(
+            headers   = self.headers,
+            connector = aiohttp.TCPConnector(
+                loop          = self.loop,
+                conn_timeout  = self.conn_timeout,
+                limit         = 1,
+                use_dns_cache = True))
+
+    @asyncio.coroutine
+    def get_session(self, host):
+        avail = self.available.get(host)
+        if avail is None:
+            avail = self.available[host] = \
+                asyncio.Semaphore(self.per_host, loop=self.loop)
+        yield from avail.acquire()
+        if self.idle[host]:
+            return self.idle[host].pop()
+        self.n_sessions[host] += 1
+        return self.new_session()
+
+    def put_session(self, host, session, broken):
+        if broken:
+            session.close()
+        else:
+            self.idle[host].append(session)
+        self.available[host].release()
+
+    @asyncio.coroutine
+    def request(self, method, url, *, headers=None, params=None,
+                data=None, allow_redirects=True):
+        import aiohttp
+        malformed = (zlib.error,
+                     aiohttp.errors.ContentEncodingError,
+                     aiohttp.errors.ServerDisconnectedError)
+
+        host = urllib.parse.urlsplit(url).netloc
+        session = yield from self.get_session(host)
+        resp = None
+        broken = True
+        try:
+            # The Wayback Machine replays Set-Cookie headers, and
+            # since all requests are going to the same origin, they
+            # accumulate until we hit the request size limit.  None
+            # of the services we talk to ever _need_ us to send
+            # cookies.
+            session.cookies.clear()
+            resp = yield from session.request(
+                method, url, headers=headers, params=params, data=data,
+                allow_redirects=allow_redirects)
+            try:
+                body = yield from resp.read()
+            except malformed:
+                # The Wayback Machine faithfully records and plays
+                # back malformed HTTP responses!  Treat this as an
+                # empty body.
+                body = b""
+            try:
+                # This can barf on a malformed HTTP response even if
+                # read() has already succeeded.  Do not discard the
+                # body in this case.
+                yield from resp.release()
+                broken = False
+            except malformed:
+                resp.close()
+            return Response(resp.status, resp.reason, resp.headers, body)
+
+        except:
+            if resp is not None:
+                resp.close()
+            raise
+
+        finally:
+            self.put_session(host, session, broken)
+
+    def close(self):
+        for sessions in self.idle.values():
+            for s in sessions:
+                s.close()
+        self.idle.clear()
+
+class StubTransport:
+    """Answers requests by calling HANDLER(method, url, kwargs), which
+       returns a Response, or a coroutine that does.  Counts requests
+       by method.  Exceptions of the types in TRANSIENT_ERRORS raised
+       by HANDLER are retried, like network errors."""
+
+    def __init__(self, handler, *, transient_errors=(), loop=None):
+        self.handler          = handler
+        self.transient_errors = tuple(transient_errors)
+        self.loop             = loop or asyncio.get_event_loop()
+        self.requests         = collections.Counter()
+
+    @asyncio.coroutine
+    def request(self, method, url, **kwargs):
+        self.requests[method] += 1
+        resp = self.handler(method, url, kwargs)
+        if not isinstance(resp, Response):
+            resp = yield from resp
+        return resp
+
+    def close(self):
+        pass
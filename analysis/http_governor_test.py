@@ -0,0 +1,164 @@
+# Tests for http_governor: which failures are retried, and how the
+# endpoint's rate responds to them.  Requests go to a StubTransport,
+# so no network access is needed.
+
+import asyncio
+import unittest
+
+import http_governor
+from http_governor import HTTPGovernor, Response, StubTransport
+
+def ok(status=200, headers={}):
+    return Response(status, "", headers, b"")
+
+class GovernorTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.calls = 0
+
+    def tearDown(self):
+        self.loop.close()
+
+    def governor(self, handler, transient_errors=(), **kwargs):
+        def counting(method, url, kw):
+            self.calls += 1
+            return handler(self.calls)
+        gov = HTTPGovernor(StubTransport(counting,
+                                         transient_errors=transient_errors,
+                                         loop=self.loop),
+                           loop=self.loop)
+        params = dict(rate=100, increase=0, max_tries=4, backoff=0,
+                      timeout=0.05)
+        params.update(kwargs)
+        return gov, gov.add_endpoint("ep", **params)
+
+    def request(self, gov):
+        return self.loop.run_until_complete(
+            gov.request("ep", "GET", "http://example.com/"))
+
+class TestRetries(GovernorTest):
+    def test_client_error_not_retried(self):
+        gov, ep = self.governor(lambda n: ok(404))
+        self.assertEqual(self.request(gov).status, 404)
+        self.assertEqual((self.calls, ep.n_retries), (1, 0))
+        self.assertEqual(ep.rate, 100)
+
+    def test_unlisted_server_error_not_retried(self):
+        gov, ep = self.governor(lambda n: ok(501))
+        self.assertEqual(self.request(gov).status, 501)
+        self.assertEqual((self.calls, ep.n_retries), (1, 0))
+
+    def test_retry_status_retried(self):
+        gov, ep = self.governor(lambda n: ok(503 if n < 3 else 200))
+        self.assertEqual(self.request(gov).status, 200)
+        self.assertEqual((self.calls, ep.n_retries), (3, 2))
+
+    def test_gives_up_with_last_response(self):
+        gov, ep = self.governor(lambda n: ok(503))
+        self.assertEqual(self.request(gov).status, 503)
+        self.assertEqual(self.calls, ep.max_tries)
+
+    def test_parse_error_not_retried(self):
+        def handler(n):
+            raise ValueError("malformed response")
+        gov, ep = self.governor(handler)
+        with self.assertRaises(ValueError):
+            self.request(gov)
+        self.assertEqual((self.calls, ep.n_retries, ep.n_errors), (1, 0, 0))
+        self.assertEqual(ep.rate, 100)
+        # The request slot was given back.
+        self.assertFalse(ep.slots.locked())
+
+    def test_network_error_retried(self):
+        def handler(n):
+            if n == 1:
+                raise ConnectionResetError("reset")
+            return ok()
+        gov, ep = self.governor(handler)
+        self.assertEqual(self.request(gov).status, 200)
+        self.assertEqual((self.calls, ep.n_retries, ep.n_errors), (2, 1, 1))
+
+    def test_transport_transient_errors(self):
+        class Flaky(Exception):
+            pass
+        def handler(n):
+            if n == 1:
+                raise Flaky()
+            return ok()
+        gov, ep = self.governor(handler, transient_errors=(Flaky,))
+        self.assertEqual(self.request(gov).status, 200)
+        self.assertEqual((self.calls, ep.n_errors), (2, 1))
+
+class TestRate(GovernorTest):
+    def test_timeout_retried_and_slows_down(self):
+        @asyncio.coroutine
+        def slow():
+            yield from asyncio.sleep(1, loop=self.loop)
+            return ok()
+        def handler(n):
+            return slow() if n == 1 else ok()
+        gov, ep = self.governor(handler, error_decrease=0.75)
+        self.assertEqual(self.request(gov).status, 200)
+        self.assertEqual((self.calls, ep.n_retries, ep.n_errors), (2, 1, 1))
+        self.assertAlmostEqual(ep.rate, 75)
+
+    def test_timeout_exhausts_tries(self):
+        @asyncio.coroutine
+        def slow():
+            yield from asyncio.sleep(1, loop=self.loop)
+            return ok()
+        gov, ep = self.governor(lambda n: slow(), max_tries=2)
+        with self.assertRaises(asyncio.TimeoutError):
+            self.request(gov)
+        self.assertEqual(self.calls, 2)
+        self.assertFalse(ep.slots.locked())
+
+    def test_throttle_halves_once_per_round_trip(self):
+        gov, ep = self.governor(lambda n: ok(429), max_tries=1,
+                                concurrency=8, burst=8)
+        self.loop.run_until_complete(asyncio.wait(
+            [self.loop.create_task(
+                gov.request("ep", "GET", "http://example.com/"))
+             for _ in range(8)], loop=self.loop))
+        self.assertEqual(self.calls, 8)
+        self.assertAlmostEqual(ep.rate, 50)
+
+        # A request sent after that cut is answered by another.
+        self.request(gov)
+        self.assertAlmostEqual(ep.rate, 25)
+
+    def test_additive_increase(self):
+        gov, ep = self.governor(lambda n: ok(), increase=10)
+        self.request(gov)
+        self.assertAlmostEqual(ep.rate, 100 + 10 / 100)
+
+    def test_rate_limits(self):
+        gov, ep = self.governor(lambda n: ok(429), max_tries=1,
+                                min_rate=60)
+        for _ in range(3):
+            self.request(gov)
+        self.assertEqual(ep.rate, 60)
+
+    def test_retry_after_pauses(self):
+        gov, ep = self.governor(
+            lambda n: ok(429, { "retry-after": "0.2" }) if n == 1 else ok())
+        start = self.loop.time()
+        self.assertEqual(self.request(gov).status, 200)
+        self.assertGreaterEqual(self.loop.time() - start, 0.2)
+
+class TestBackoff(unittest.TestCase):
+    def test_jittered_backoff(self):
+        for attempt in range(1, 10):
+            for _ in range(100):
+                d = http_governor.jittered_backoff(attempt, 1, 60)
+                self.assertGreaterEqual(d, 0)
+                self.assertLessEqual(d, min(60, 2 ** (attempt - 1)))
+
+    def test_parse_retry_after(self):
+        self.assertEqual(http_governor.parse_retry_after("5"), 5.0)
+        self.assertIsNone(http_governor.parse_retry_after(None))
+        self.assertIsNone(http_governor.parse_retry_after(
+            "Wed, 21 Oct 2015 07:28:00 GMT"))
+
+if __name__ == '__main__':
+    unittest.main()
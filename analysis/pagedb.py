@@ -4,11 +4,14 @@
 
 import os
 import psycopg2
-import zlib
-import json
+import psycopg2.extras
 import random
 from collections import defaultdict
 
+import numpy as np
+
+import termstats
+
 __all__ = ['PageText', 'PageObservation', 'DOMStatistics', 'PageDB']
 
 class PageText:
@@ -82,13 +85,13 @@ class PageText:
     @property
     def tfidf(self):
         if self._tfidf is None:
-            self._tfidf = self._db.get_text_statistic('tfidf', self.eid)
+            self._tfidf = self._db.get_text_statistic('tfidf', self)
         return self._tfidf
 
     @property
     def nfidf(self):
         if self._nfidf is None:
-            self._nfidf = self._db.get_text_statistic('nfidf', self.eid)
+            self._nfidf = self._db.get_text_statistic('nfidf', self)
         return self._nfidf
 
     @property
@@ -213,6 +216,7 @@ class PageDB:
         """If 'only_runs' is a list, only those runs will be examined."""
 
         self._locales    = None
+        self._vocabs     = {}
         self._runs       = [int(x) for x in only_runs]
         self._cursor_tag = "pagedb_qtmp_{}_{}".format(os.getpid(), id(self))
         self._cursor_ctr = 0
@@ -282,6 +286,7 @@ class PageDB:
 
         def up_iden(x):  return x
         def up_dstat(x): return DOMStatistics(x if x else {})
+        def up_tstat(x): return termstats.decode(x)
 
         no_join    = []
         tfidf_join = ["LEFT JOIN analysis.pruned_content_stats st"
@@ -297,8 +302,8 @@ class PageDB:
             "contents":     ("p.pruned_text",    up_iden,  no_join),
             "raw_contents": ("p.raw_text",       up_iden,  no_join),
             "segmented":    ("p.segmented_text", up_iden,  no_join),
-            "tfidf":        ("st.data",          up_iden,  tfidf_join),
-            "nfidf":        ("sn.data",          up_iden,  nfidf_join),
+            "tfidf":        ("st.data",          up_tstat, tfidf_join),
+            "nfidf":        ("sn.data",          up_tstat, nfidf_join),
             "headings":     ("p.headings",       up_iden,  no_join),
             "links":        ("p.links",          up_iden,  no_join),
             "resources":    ("p.resources",      up_iden,  no_join),
@@ -361,7 +366,7 @@ class PageDB:
         gaps = set(x[0] for x in cur.fetchall())
 
         rng = random.Random(seed)
-       sample = set()
+        sample = set()
         while len(sample) < count:
             block = set(rng.sample(range(lo, hi+1),
                                    count - len(sample))) - gaps
@@ -540,56 +545,209 @@ class PageDB:
     #
     # Corpus-wide and per-document statistics.
     #
+    # These are word -> score maps, stored in the binary encoding
+    # defined in termstats.py.  Blobs written by older versions of
+    # this code (zlib-compressed JSON) can still be read.
+    #
+    def get_vocabulary(self, lang):
+        """Retrieve the term-id vocabulary for LANG.  This is memoized;
+           it is shared by all of the corpus statistics for LANG.  If
+           a blob refers to words added since (by another process),
+           they are loaded then."""
+        vocab = self._vocabs.get(lang)
+        if vocab is None:
+            vocab = termstats.Vocabulary(
+                lang, self._load_vocabulary(lang, 0),
+                loader=self._load_vocabulary)
+            self._vocabs[lang] = vocab
+        return vocab
+
+    def _load_vocabulary(self, lang, first_id):
+        cur = self._db.cursor()
+        cur.execute("SELECT word FROM analysis.corpus_vocab"
+                    " WHERE lang = %s AND id >= %s ORDER BY id",
+                    (lang, first_id))
+        return [row[0] for row in cur]
+
+    def _extend_vocabulary(self, cur, lang, words):
+        """Assign term ids to every word in WORDS that doesn't have one
+           yet.  Must be called with analysis.corpus_vocab locked."""
+
+        # Someone else may have added words since we last looked.
+        self._vocabs.pop(lang, None)
+        vocab = self.get_vocabulary(lang)
+        added = vocab.intern(words)
+        if added:
+            # One statement per page of words, not per word: the
+            # tables are locked against every other writer meanwhile.
+            psycopg2.extras.execute_values(
+                cur, "INSERT INTO analysis.corpus_vocab"
+                     " (lang, id, word) VALUES %s",
+                ((lang, i, w) for i, w in added), page_size=10000)
+        return vocab
+
     def get_corpus_statistic(self, stat, lang):
         cur = self._db.cursor()
         cur.execute("SELECT n_documents, data FROM analysis.corpus_stats"
                     " WHERE stat = %s AND lang = %s AND runs = %s",
                     (stat, lang, self._runs))
         row = cur.fetchone()
-        if row:
-            return (row[0], json.loads(zlib.decompress(row[1]).decode('utf-8')))
-        else:
+        if not row:
             return (0, {})
 
-    def update_corpus_statistics(self, lang, n_documents,
-                                 statistics):
-        cur = self._db.cursor()
+        blob = row[1]
+        if termstats.is_legacy_blob(blob):
+            return (row[0], termstats.decode(blob))
+        return (row[0], termstats.decode(blob, self.get_vocabulary(lang)))
+
+    def _store_corpus_statistic(self, cur, stat, lang, n_documents, blob,
+                                watermark=None):
+        # try UPDATE first, if it affects zero rows, then INSERT
+        if watermark is None:
+            cur.execute("UPDATE analysis.corpus_stats"
+                        "   SET n_documents = %s, data = %s"
+                        " WHERE stat=%s AND lang=%s AND runs=%s",
+                        (n_documents, blob, stat, lang, self._runs))
+        else:
+            cur.execute("UPDATE analysis.corpus_stats"
+                        "   SET n_documents = %s, data = %s, watermark = %s"
+                        " WHERE stat=%s AND lang=%s AND runs=%s",
+                        (n_documents, blob, watermark,
+                         stat, lang, self._runs))
 
+        if cur.rowcount == 0:
+            cur.execute("INSERT INTO analysis.corpus_stats"
+                        " (stat, lang, runs, "
+                        "  n_documents, data, watermark)"
+                        " VALUES (%s, %s, %s, %s, %s, %s)",
+                        (stat, lang, self._runs,
+                         n_documents, blob, watermark))
+
+    def _lock_corpus_statistics(self, cur):
         # This is the big-hammer exclusive-lockout approach to upsert.
         # It's possible that SHARE ROW EXCLUSIVE would be good enough,
         # but I don't really understand the difference between
         # EXCLUSIVE and SHARE ROW EXCLUSIVE, so I'm being conservative.
+        cur.execute("BEGIN")
+        cur.execute("LOCK analysis.corpus_vocab IN EXCLUSIVE MODE")
+        cur.execute("LOCK analysis.corpus_stats IN EXCLUSIVE MODE")
+
+    def update_corpus_statistics(self, lang, n_documents,
+                                 statistics):
+        cur = self._db.cursor()
+        try:
+            self._lock_corpus_statistics(cur)
+
+            statistics = list(statistics)
+            vocab = self._extend_vocabulary(
+                cur, lang, (w for _, data in statistics for w in data))
+
+            for stat, data in statistics:
+                self._store_corpus_statistic(
+                    cur, stat, lang, n_documents,
+                    termstats.encode_ids(data, vocab))
+
+            self._db.commit()
+
+        except:
+            self._db.rollback()
+            self._vocabs.pop(lang, None)
+            raise
+
+    def update_corpus_statistics_arrays(self, lang, n_documents,
+                                        words, statistics, watermark=None):
+        """Like update_corpus_statistics, but instead of dictionaries,
+           each entry of STATISTICS is a (stat, values) pair where
+           VALUES is a numpy array parallel to the list WORDS.  The
+           words need not be in the same order as the vocabulary.
+           If WATERMARK is not None, it is recorded as the highest
+           text id included in these statistics."""
+        cur = self._db.cursor()
+        try:
+            self._lock_corpus_statistics(cur)
+            self._store_corpus_statistics_arrays(
+                cur, lang, n_documents, words, statistics, watermark)
+            self._db.commit()
+
+        except:
+            self._db.rollback()
+            self._vocabs.pop(lang, None)
+            raise
+
+    def _store_corpus_statistics_arrays(self, cur, lang, n_documents,
+                                        words, statistics, watermark):
+        vocab = self._extend_vocabulary(cur, lang, words)
+        ids = np.fromiter((vocab.ids[w] for w in words),
+                          termstats.ID_DTYPE, len(words))
+
+        for stat, values in statistics:
+            self._store_corpus_statistic(
+                cur, stat, lang, n_documents,
+                termstats.encode_id_arrays(ids, values), watermark)
+
+    def add_counted_texts(self, text_stats, text_ids, corpus_stats,
+                          watermark):
+        """Record, in a single transaction, that the texts in TEXT_IDS
+           have been added to the corpus statistics: give each of them
+           a row for each stat in TEXT_STATS in pruned_content_stats
+           (as prepare_text_statistic does), store CORPUS_STATS, a
+           list of (lang, n_documents, words, statistics) tuples (as
+           for update_corpus_statistics_arrays), and set the watermark
+           on all of the corpus statistics to WATERMARK."""
+        cur = self._db.cursor()
+        langs = [entry[0] for entry in corpus_stats]
         try:
             cur.execute("BEGIN")
+            cur.execute("LOCK analysis.pruned_content_stats IN EXCLUSIVE MODE")
+            cur.execute("LOCK analysis.corpus_vocab IN EXCLUSIVE MODE")
             cur.execute("LOCK analysis.corpus_stats IN EXCLUSIVE MODE")
 
-            for stat, data in statistics:
-                blob = zlib.compress(json.dumps(data, separators=(',',':'))
-                                     .encode("utf-8"))
-
-                # try UPDATE first, if it affects zero rows, then INSERT
-                cur.execute("UPDATE analysis.corpus_stats"
-                            "   SET n_documents = %s, data = %s"
-                            " WHERE stat=%s AND lang=%s AND runs=%s",
-                            (n_documents, blob, stat, lang, self._runs))
-
-                if cur.rowcount == 0:
-                    cur.execute("INSERT INTO analysis.corpus_stats"
-                                " (stat, lang, runs, "
-                                "  n_documents, data)"
-                                " VALUES (%s, %s, %s, %s, %s)",
-                                (stat, lang, self._runs,
-                                 n_documents, blob))
+            for stat in text_stats:
+                self._insert_text_statistic_rows(cur, stat, "", text_ids)
+            for lang, n_documents, words, statistics in corpus_stats:
+                self._store_corpus_statistics_arrays(
+                    cur, lang, n_documents, words, statistics, None)
+            cur.execute("UPDATE analysis.corpus_stats SET watermark = %s"
+                        " WHERE runs = %s", (watermark, self._runs))
 
             self._db.commit()
 
         except:
             self._db.rollback()
+            for lang in langs:
+                self._vocabs.pop(lang, None)
             raise
 
     def update_corpus_statistic(self, stat, lang, n_documents, data):
         self.update_corpus_statistics(lang, n_documents, [(stat, data)])
 
+    def get_corpus_languages(self):
+        """List all the languages with corpus statistics."""
+        cur = self._db.cursor()
+        cur.execute("SELECT DISTINCT lang FROM analysis.corpus_stats"
+                    " WHERE runs = %s ORDER BY lang", (self._runs,))
+        return [row[0] for row in cur]
+
+    def get_corpus_watermark(self):
+        """Return the highest text id known to be included in all of
+           the corpus statistics, or None if there are no statistics
+           or any of them lacks a watermark."""
+        cur = self._db.cursor()
+        cur.execute("SELECT count(*), count(watermark), min(watermark)"
+                    "  FROM analysis.corpus_stats WHERE runs = %s",
+                    (self._runs,))
+        n_rows, n_marked, watermark = cur.fetchone()
+        if n_rows == 0 or n_marked < n_rows:
+            return None
+        return watermark
+
+    def set_corpus_watermark(self, watermark):
+        """Record WATERMARK on all of the corpus statistics at once."""
+        with self._db:
+            cur = self._db.cursor()
+            cur.execute("UPDATE analysis.corpus_stats SET watermark = %s"
+                        " WHERE runs = %s", (watermark, self._runs))
+
     def get_text_statistic(self, stat, text):
         cur = self._db.cursor()
         cur.execute("SELECT data FROM analysis.pruned_content_stats"
@@ -597,10 +755,16 @@ class PageDB:
                     (stat, text.eid, self._runs))
         row = cur.fetchone()
         if row and row[0]:
-            return json.loads(zlib.decompress(row[0]).decode('utf-8'))
+            return termstats.decode(row[0])
         return {}
 
-    def prepare_text_statistic(self, stat):
+    def prepare_text_statistic(self, stat, where_clause="", text_ids=None):
+        """Ensure that every segmented text has a row for STAT in
+           pruned_content_stats.  If WHERE_CLAUSE is not empty, only
+           texts matching it are considered; as with get_page_texts,
+           it may refer to analysis.extracted_content as 'p'.  If
+           TEXT_IDS is not None, only the texts with those ids are
+           considered."""
         cur = self._db.cursor()
 
         # For document statistics, we take a two-phase approach to the
@@ -613,21 +777,53 @@ class PageDB:
         with self._db:
             cur.execute("BEGIN")
             cur.execute("LOCK analysis.pruned_content_stats IN EXCLUSIVE MODE")
-            cur.execute("INSERT INTO analysis.pruned_content_stats"
-                        "  (stat, text_id, runs)"
-                        "SELECT %s AS stat, p.id AS text_id, %s AS runs"
-                        "  FROM analysis.extracted_content p"
-                        " WHERE p.segmented_text IS NOT NULL"
-                        " AND NOT EXISTS ("
-                        "  SELECT 1 FROM analysis.pruned_content_stats ps"
-                        "   WHERE ps.stat = %s AND ps.text_id = p.id"
-                        "     AND runs = %s)",
-                        (stat, self._runs, stat, self._runs))
+            self._insert_text_statistic_rows(cur, stat, where_clause,
+                                             text_ids)
+
+    def _insert_text_statistic_rows(self, cur, stat, where_clause, text_ids):
+        # Must be called with analysis.pruned_content_stats locked.
+        if where_clause:
+            where_clause = " AND ({})".format(where_clause)
+        if text_ids is not None:
+            where_clause += cur.mogrify(" AND p.id = ANY(%s::bigint[])",
+                                        (list(text_ids),)).decode()
+
+        cur.execute("INSERT INTO analysis.pruned_content_stats"
+                    "  (stat, text_id, runs)"
+                    "SELECT %s AS stat, p.id AS text_id, %s AS runs"
+                    "  FROM analysis.extracted_content p"
+                    " WHERE p.segmented_text IS NOT NULL" + where_clause +
+                    " AND NOT EXISTS ("
+                    "  SELECT 1 FROM analysis.pruned_content_stats ps"
+                    "   WHERE ps.stat = %s AND ps.text_id = p.id"
+                    "     AND runs = %s)",
+                    (stat, self._runs, stat, self._runs))
+
+    def text_statistic_clause(self, stat, state):
+        """Return an SQL condition on analysis.extracted_content (as
+           'p'), suitable for get_page_texts' where_clause, selecting
+           texts according to the STATE of their row for STAT in
+           pruned_content_stats:
+
+               'missing' - there is no row
+               'null'    - there is a row, but its data is null
+               'scored'  - there is a row with non-null data
+        """
+        conditions = {
+            'missing': ("NOT EXISTS", ""),
+            'null':    ("EXISTS",     " AND s.data IS NULL"),
+            'scored':  ("EXISTS",     " AND s.data IS NOT NULL"),
+        }
+        exists, extra = conditions[state]
+        cur = self._db.cursor()
+        return cur.mogrify(
+            exists + " (SELECT 1 FROM analysis.pruned_content_stats s"
+            " WHERE s.stat = %s AND s.text_id = p.id AND s.runs = %s"
+            + extra + ")", (stat, self._runs)).decode()
 
     def update_text_statistic(self, stat, text, data):
         cur = self._db.cursor()
-        blob = zlib.compress(json.dumps(data, separators=(',',':'))
-                             .encode("utf-8"))
+        blob = termstats.encode_terms(data)
         cur.execute("UPDATE analysis.pruned_content_stats"
                     "   SET data = %s"
                     " WHERE stat = %s AND text_id = %s AND runs = %s",
@@ -636,6 +832,29 @@ class PageDB:
             raise RuntimeError("%s/%s/%r: no row in pruned_content_stats"
                                % (stat, text.eid, self._runs))
 
+    def update_text_statistics_bulk(self, stat, blobs):
+        """Store many already-encoded text statistics at once.  BLOBS
+           is a sequence of (text_id, blob) pairs, where each blob is
+           the output of termstats.encode_terms or encode_term_arrays.
+           As with update_text_statistic, every row must already exist
+           (see prepare_text_statistic)."""
+        if not blobs:
+            return
+        cur = self._db.cursor()
+        query = cur.mogrify(
+            "UPDATE analysis.pruned_content_stats s"
+            "   SET data = v.data"
+            "  FROM (VALUES %%s) AS v(text_id, data)"
+            " WHERE s.stat = %s AND s.text_id = v.text_id AND s.runs = %s",
+            (stat, self._runs))
+        psycopg2.extras.execute_values(cur, query, blobs,
+                                       page_size=len(blobs))
+        if cur.rowcount < len(blobs):
+            raise RuntimeError("%s/%r: %d of %d rows missing from"
+                               " pruned_content_stats"
+                               % (stat, self._runs,
+                                  len(blobs) - cur.rowcount, len(blobs)))
+
     # Transaction manager issues a regular database transaction,
     # committed on normal exit and rolled back on exception.
     def __enter__(self):
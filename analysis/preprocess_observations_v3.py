@@ -7,12 +7,12 @@ import time
 
 import collections
 import itertools
-import multiprocessing
 import json
 import zlib
 import hashlib
 
 import cld2
+import extraction_service
 import html_extractor
 import word_seg
 
@@ -63,9 +63,10 @@ def intern_pruned_segmented(cur, hash, pruned, segmented):
 
 
 # This chunk of the work doesn't touch the database at all, and so
-# can be farmed out to worker processes.  We must use processes and
-# not threads because of the GIL, and unfortunately that means we
-# have to pass all the data back and forth in bare tuples.
+# can be farmed out to worker processes (see extraction_service.py).
+# We must use processes and not threads because of the GIL, and
+# unfortunately that means we have to pass all the data back and
+# forth in bare tuples.
 
 def do_content_extraction(args):
     docid, page, baseurl = args
@@ -73,12 +74,14 @@ def do_content_extraction(args):
         page = zlib.decompress(page)
     except:
         page = ''
-    extr = html_extractor.ExtractedContent(baseurl, page)
-    lang = cld2.detect(extr.text_pruned, want_chunks=True)
-
-    segmented = [ { "l": c[0].code,
-                    "t": list(word_seg.segment(c[0].code, c[1])) }
-                  for c in lang.chunks ]
+    with extraction_service.stage("html_extractor"):
+        extr = html_extractor.ExtractedContent(baseurl, page)
+    with extraction_service.stage("cld2"):
+        lang = cld2.detect(extr.text_pruned, want_chunks=True)
+    with extraction_service.stage("word_seg"):
+        segmented = [ { "l": c[0].code,
+                        "t": list(word_seg.segment(c[0].code, c[1])) }
+                      for c in lang.chunks ]
 
     pagelen = len(page)
     content = extr.text_content.encode("utf-8")
@@ -201,9 +204,10 @@ def preprocess_pages(db, cur, pool, start, end):
                          .format(processed, total_pages,
                                  fmt_interval(elapsed),
                                  fmt_interval(remain)))
+        sys.stdout.write("  {}\n".format(pool.stage_report()))
 
 def main():
-    with multiprocessing.Pool() as pool:
+    with extraction_service.ExtractionService(want_parking=False) as pool:
         db = psycopg2.connect("dbname="+sys.argv[1])
         start_time = sys.argv[2]
         end_time = sys.argv[3]
@@ -3,92 +3,59 @@
 import sys
 import os
 import psycopg2
-import time
-
-import collections
-import itertools
-from concurrent import futures
+import functools
 import json
 import zlib
 import hashlib
 
 import cld2
 
-def fmt_interval(interval):
-    m, s = divmod(interval, 60)
-    h, m = divmod(m, 60)
-    return "{}:{:>02}:{:>05.2f}".format(int(h), int(m), s)
-
-# This chunk of the work doesn't touch the database at all, and so can
-# be farmed out to worker threads.  Decompression and cld2.detect both
-# drop the GIL enough that threads should be OK.
-
-def do_redetect(args):
-    id, text = args
-    try:
-        text = zlib.decompress(text)
-    except:
-        text = ''
-    langs = cld2.detect(text)
-
-    return (id, json.dumps([{"l":l.code, "s":l.score} for l in langs.scores]))
-
-def redetect_pages(db, cur, pool):
-
-    # This is not in itertools, for no good reason.
-    def chunked(iterable, n):
-        it = iter(iterable)
-        while True:
-           chunk = tuple(itertools.islice(it, n))
-           if not chunk:
-               return
-           yield chunk
-
-    # There is no good way to hold a cursor open on a read query while
-    # simultaneously making commits to one of the tables involved.  We
-    # work around this by maintaining a local list of rows to process.
-    # We don't just pull out all of the page contents in advance
-    # because that would blow out the RAM.
-
-    sys.stdout.write("Determining job size...\n")
-    sys.stdout.flush()
-
-    cur.execute("SELECT id FROM analysis.capture_pruned_content"
-                " WHERE lang_scores IS NULL")
-    pages = cur.fetchall()
-    total_pages = len(pages)
-    if not total_pages:
-        return
-
-    processed = 0
-    start = time.monotonic()
-    sys.stdout.write("Processing 0/{}...\n".format(total_pages))
-    for chunk in chunked(pages, 1000):
-        with db:
-            cur.execute(" SELECT id, content FROM analysis.capture_pruned_content"
-                        "  WHERE id = ANY(%s)",
-                        ([c[0] for c in chunk],))
-
-            for result in pool.map(do_redetect, cur):
-                cur.execute("UPDATE analysis.capture_pruned_content"
-                            "   SET lang_scores = %s"
-                            " WHERE id = %s",
-                            (result[1], result[0]))
-                processed += 1
-
-        stop = time.monotonic()
-        elapsed = stop - start
-        remain  = (total_pages - processed)*(elapsed/processed)
-        sys.stdout.write("Processed {}/{} in {} remaining {}\n"
-                         .format(processed, total_pages,
-                                 fmt_interval(elapsed),
-                                 fmt_interval(remain)))
+from db_pipeline import Pipeline
+
+# This chunk of the work doesn't touch the database at all.
+# cld2.detect_many runs the detections on several threads, without
+# the GIL.
+
+def do_redetect(rows):
+    ids   = []
+    texts = []
+    for id, text in rows:
+        try:
+            text = zlib.decompress(text).decode("utf-8")
+        except:
+            text = ''
+        ids.append(id)
+        texts.append(text)
+
+    return [
+        (id, json.dumps([{"l":l.code, "s":l.score} for l in langs.scores]))
+        for id, langs in zip(ids, cld2.detect_many(texts))
+    ]
+
+def redetect_pages(dbname, start_after=0):
+    # No process pool: cld2.detect_many does its own parallelism, and
+    # the pipeline overlaps it with the database reads and writes.
+    Pipeline(
+        connect = functools.partial(psycopg2.connect, dbname=dbname),
+        session_setup = ("SET search_path TO public",),
+        count = ("SELECT count(*) FROM analysis.capture_pruned_content"
+                 " WHERE lang_scores IS NULL"),
+        select = ("SELECT id, content FROM analysis.capture_pruned_content"
+                  " WHERE lang_scores IS NULL AND id > %(after)s"
+                  " ORDER BY id LIMIT %(limit)s"),
+        process = do_redetect,
+        writer_setup = ("CREATE TEMPORARY TABLE lang_scores_new ("
+                        "  id INTEGER NOT NULL PRIMARY KEY,"
+                        "  lang_scores JSONB NOT NULL)",),
+        copy_to = "lang_scores_new",
+        finish = ("UPDATE analysis.capture_pruned_content c"
+                  "   SET lang_scores = n.lang_scores"
+                  "  FROM lang_scores_new n WHERE c.id = n.id",
+                  "TRUNCATE lang_scores_new"),
+        start_after = start_after,
+    ).run()
 
 def main():
-    db = psycopg2.connect("dbname="+sys.argv[1])
-    cur = db.cursor()
-    cur.execute("SET search_path TO public")
-    with futures.ThreadPoolExecutor(max_workers=6) as pool:
-        redetect_pages(db, cur, pool)
+    redetect_pages(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 0)
 
 main()
@@ -3,19 +3,14 @@
 import sys
 import os
 import psycopg2
-import time
-import collections
-import itertools
+import functools
 import multiprocessing
 import json
 
 import cld2
 import word_seg
 
-def fmt_interval(interval):
-    m, s = divmod(interval, 60)
-    h, m = divmod(m, 60)
-    return "{}:{:>02}:{:>05.2f}".format(int(h), int(m), s)
+from db_pipeline import Pipeline
 
 def do_resegment(args):
     docid, text_pruned = args
@@ -25,66 +20,35 @@ def do_resegment(args):
                   for c in lang.chunks ]
     return (docid, json.dumps(segmented))
 
-def resegment_pages(db, cur, pool):
-    # This is not in itertools, for no good reason.
-    def chunked(iterable, n):
-        it = iter(iterable)
-        while True:
-           chunk = tuple(itertools.islice(it, n))
-           if not chunk:
-               return
-           yield chunk
-
-    # There is no good way to hold a cursor open on a read query while
-    # simultaneously making commits to one of the tables involved.  We
-    # work around this by maintaining a local list of rows to process.
-    # We don't just pull out all of the page contents in advance
-    # because that would blow out the RAM.
-
-    sys.stdout.write("Determining job size...\n")
-    sys.stdout.flush()
-
-    cur.execute("    SELECT p.id"
-                "      FROM extracted_plaintext p"
-                " LEFT JOIN extracted_pt_resegment q ON p.id = q.id"
-                "     WHERE p.segmented IS NOT NULL"
-                "       AND q.id IS NULL")
-    pages = cur.fetchall()
-    total_pages = len(pages)
-    if not total_pages:
-        return
-
-    processed = 0
-    start = time.monotonic()
-    sys.stdout.write("Processing 0/{}...\n".format(total_pages))
-    for chunk in chunked(pages, 1000):
-        with db:
-            cur.execute(" SELECT id, plaintext"
-                        "   FROM extracted_plaintext p"
-                        "  WHERE id = ANY(%s)",
-                        ([c[0] for c in chunk],))
-
-            for result in pool.imap_unordered(do_resegment, cur.fetchall()):
-                cur.execute("INSERT INTO extracted_pt_resegment "
-                            "VALUES (%s,%s::jsonb)",
-                            result)
-                processed += 1
-
-        stop = time.monotonic()
-        elapsed = stop - start
-        remain  = (total_pages - processed)*(elapsed/processed)
-        sys.stdout.write("Processed {}/{} in {} remaining {}\n"
-                         .format(processed, total_pages,
-                                 fmt_interval(elapsed),
-                                 fmt_interval(remain)))
+def resegment_batch(rows):
+    return [do_resegment(row) for row in rows]
+
+def resegment_pages(dbname, pool, start_after=0):
+    Pipeline(
+        connect = functools.partial(psycopg2.connect, dbname=dbname),
+        session_setup = ("SET search_path TO analysis, public",
+                         "SET standard_conforming_strings TO on"),
+        count = ("    SELECT count(*)"
+                 "      FROM extracted_plaintext p"
+                 " LEFT JOIN extracted_pt_resegment q ON p.id = q.id"
+                 "     WHERE p.segmented IS NOT NULL"
+                 "       AND q.id IS NULL"),
+        select = ("    SELECT p.id, p.plaintext"
+                  "      FROM extracted_plaintext p"
+                  " LEFT JOIN extracted_pt_resegment q ON p.id = q.id"
+                  "     WHERE p.segmented IS NOT NULL"
+                  "       AND q.id IS NULL"
+                  "       AND p.id > %(after)s"
+                  "  ORDER BY p.id"
+                  "     LIMIT %(limit)s"),
+        process = resegment_batch,
+        copy_to = "extracted_pt_resegment",
+        start_after = start_after,
+    ).run(pool)
 
 def main():
+    start_after = int(sys.argv[2]) if len(sys.argv) > 2 else 0
     with multiprocessing.Pool() as pool:
-        db = psycopg2.connect("dbname="+sys.argv[1])
-        cur = db.cursor()
-        cur.execute("SET search_path TO analysis, public")
-        cur.execute("SET standard_conforming_strings TO on")
-        resegment_pages(db, cur, pool)
+        resegment_pages(sys.argv[1], pool, start_after)
 
 main()
-
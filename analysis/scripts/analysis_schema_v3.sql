@@ -138,6 +138,9 @@ CREATE TABLE corpus_stats (
     runs            INTEGER[] NOT NULL,
     n_documents     INTEGER NOT NULL CHECK (n_documents >= 1),
     data            BYTEA   NOT NULL,
+    -- Highest extracted_content id included in these statistics;
+    -- see tfidf_v3.py --incremental.
+    watermark       INTEGER,
     PRIMARY KEY (stat, lang, runs)
 );
 ALTER TABLE corpus_stats
@@ -145,4 +148,15 @@ ALTER TABLE corpus_stats
   ALTER COLUMN lang SET STORAGE PLAIN,
   ALTER COLUMN data SET STORAGE EXTERNAL;
 
+-- Term ids for the binary encoding of corpus_stats.data (see
+-- termstats.py).  Ids are per language, dense, and append-only; all
+-- of the statistics for one language share the same vocabulary.
+CREATE TABLE corpus_vocab (
+    lang            TEXT    NOT NULL CHECK (lang <> ''),
+    id              INTEGER NOT NULL CHECK (id >= 0),
+    word            TEXT    NOT NULL,
+    PRIMARY KEY (lang, id),
+    UNIQUE (lang, word)
+);
+
 COMMIT;
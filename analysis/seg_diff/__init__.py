@@ -0,0 +1,5 @@
+__all__ = ('matching_blocks', 'DocComparison', 'LangStats',
+           'flatten_segmented', 'merge_stats')
+
+from .myers import matching_blocks
+from .compare import DocComparison, LangStats, flatten_segmented, merge_stats
@@ -0,0 +1,158 @@
+# Compiled fast path for seg_diff.myers.  See myers.py for the
+# specification; this module must produce exactly the same results
+# (myers_test.py checks this).
+#
+# Both sequences are copied into C arrays of token ids up front, and
+# the whole comparison then runs without the GIL.
+
+from cpython.mem cimport PyMem_Malloc, PyMem_Free
+
+cdef struct Runs:
+    Py_ssize_t *buf     # triples (i, j, n)
+    Py_ssize_t  len     # number of triples
+
+cdef inline void _emit(Runs *out, Py_ssize_t i, Py_ssize_t j,
+                       Py_ssize_t n) nogil:
+    cdef Py_ssize_t *last
+    if n == 0:
+        return
+    if out.len:
+        last = out.buf + 3 * (out.len - 1)
+        if last[0] + last[2] == i and last[1] + last[2] == j:
+            last[2] += n
+            return
+    out.buf[3 * out.len]     = i
+    out.buf[3 * out.len + 1] = j
+    out.buf[3 * out.len + 2] = n
+    out.len += 1
+
+cdef void _middle_snake(const long *a, Py_ssize_t alo, Py_ssize_t ahi,
+                        const long *b, Py_ssize_t blo, Py_ssize_t bhi,
+                        Py_ssize_t *vf, Py_ssize_t *vb,
+                        Py_ssize_t *snake) nogil:
+    cdef Py_ssize_t N = ahi - alo, M = bhi - blo
+    cdef Py_ssize_t delta = N - M
+    cdef bint odd = delta & 1
+    cdef Py_ssize_t maxd = (N + M + 1) // 2
+    cdef Py_ssize_t off = maxd + 1
+    cdef Py_ssize_t d, k, x, y, x0, y0
+
+    vf[off + 1] = 0
+    vb[off + 1] = 0
+    for d in range(maxd + 1):
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and vf[off + k - 1] < vf[off + k + 1]):
+                x = vf[off + k + 1]
+            else:
+                x = vf[off + k - 1] + 1
+            y = x - k
+            x0 = x
+            y0 = y
+            while x < N and y < M and a[alo + x] == b[blo + y]:
+                x += 1
+                y += 1
+            vf[off + k] = x
+            if (odd and delta - (d - 1) <= k <= delta + (d - 1)
+                and x + vb[off + delta - k] >= N):
+                snake[0] = alo + x0
+                snake[1] = blo + y0
+                snake[2] = alo + x
+                snake[3] = blo + y
+                return
+
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and vb[off + k - 1] < vb[off + k + 1]):
+                x = vb[off + k + 1]
+            else:
+                x = vb[off + k - 1] + 1
+            y = x - k
+            x0 = x
+            y0 = y
+            while x < N and y < M and a[ahi - 1 - x] == b[bhi - 1 - y]:
+                x += 1
+                y += 1
+            vb[off + k] = x
+            if (not odd and -d <= delta - k <= d
+                and x + vf[off + delta - k] >= N):
+                snake[0] = ahi - x
+                snake[1] = bhi - y
+                snake[2] = ahi - x0
+                snake[3] = bhi - y0
+                return
+
+cdef void _compare(const long *a, Py_ssize_t alo, Py_ssize_t ahi,
+                   const long *b, Py_ssize_t blo, Py_ssize_t bhi,
+                   Py_ssize_t *vf, Py_ssize_t *vb, Runs *out) nogil:
+    cdef Py_ssize_t n, sfx = 0
+    cdef Py_ssize_t snake[4]
+
+    n = 0
+    while alo + n < ahi and blo + n < bhi and a[alo + n] == b[blo + n]:
+        n += 1
+    _emit(out, alo, blo, n)
+    alo += n
+    blo += n
+    while alo < ahi - sfx and blo < bhi - sfx and \
+          a[ahi - 1 - sfx] == b[bhi - 1 - sfx]:
+        sfx += 1
+
+    if alo < ahi - sfx and blo < bhi - sfx:
+        _middle_snake(a, alo, ahi - sfx, b, blo, bhi - sfx, vf, vb, snake)
+        _compare(a, alo, snake[0], b, blo, snake[1], vf, vb, out)
+        _emit(out, snake[0], snake[1], snake[2] - snake[0])
+        _compare(a, snake[2], ahi - sfx, b, snake[3], bhi - sfx,
+                 vf, vb, out)
+
+    _emit(out, ahi - sfx, bhi - sfx, sfx)
+
+cdef long *_to_c(seq, Py_ssize_t n) except NULL:
+    cdef long *arr = <long *>PyMem_Malloc((n + 1) * sizeof(long))
+    cdef Py_ssize_t i
+    if arr == NULL:
+        raise MemoryError
+    try:
+        for i in range(n):
+            arr[i] = seq[i]
+    except:
+        PyMem_Free(arr)
+        raise
+    return arr
+
+def matching_blocks(a, b):
+    """Return the matching blocks of a longest common subsequence of
+       A and B, which must be sequences of integers."""
+    cdef Py_ssize_t N = len(a), M = len(b)
+    cdef Py_ssize_t vsize = N + M + 5
+    cdef long *ca = NULL
+    cdef long *cb = NULL
+    cdef Py_ssize_t *vf = NULL
+    cdef Py_ssize_t *vb = NULL
+    cdef Runs out
+    cdef Py_ssize_t i
+    out.buf = NULL
+    out.len = 0
+
+    try:
+        ca = _to_c(a, N)
+        cb = _to_c(b, M)
+        vf = <Py_ssize_t *>PyMem_Malloc(vsize * sizeof(Py_ssize_t))
+        vb = <Py_ssize_t *>PyMem_Malloc(vsize * sizeof(Py_ssize_t))
+        out.buf = <Py_ssize_t *>PyMem_Malloc(
+            3 * (min(N, M) + 1) * sizeof(Py_ssize_t))
+        if vf == NULL or vb == NULL or out.buf == NULL:
+            raise MemoryError
+
+        with nogil:
+            _compare(ca, 0, N, cb, 0, M, vf, vb, &out)
+
+        result = [(out.buf[3*i], out.buf[3*i + 1], out.buf[3*i + 2])
+                  for i in range(out.len)]
+        result.append((N, M, 0))
+        return result
+
+    finally:
+        PyMem_Free(ca)
+        PyMem_Free(cb)
+        PyMem_Free(vf)
+        PyMem_Free(vb)
+        PyMem_Free(out.buf)
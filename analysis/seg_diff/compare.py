@@ -0,0 +1,262 @@
+# Comparison of two word segmentations of the same document, as
+# stored in extracted_plaintext.segmented and
+# extracted_pt_resegment.segmented: a list of chunks, each
+# { "l": language code, "t": [token, ...] }.
+#
+# The two token sequences are aligned with Myers' algorithm (see
+# myers.py); a token is identified by its language and its text, so a
+# chunk whose language changed counts as a difference even if its
+# tokens did not.  Everything between two aligned tokens is a "hunk".
+#
+# Statistics are accumulated per language, treating P (the first
+# segmentation) as the reference and Q as the candidate:
+#
+#   tokens     - tokens in P and in Q, and how many of them align
+#   boundaries - token boundaries in P and in Q, and how many of them
+#                are in the same place in both.  Each token contributes
+#                the boundary at its end.  The boundaries of aligned
+#                tokens always agree; within a hunk, they are compared
+#                by character offset if both sides have the same text,
+#                and otherwise only the boundary at the end of the hunk
+#                is taken to agree.
+#   divergent  - how often each hunk occurred, keyed by the text of its
+#                two sides.
+#
+# Hunks are attributed to the language of their first token in P (or
+# in Q, if the P side is empty).
+
+import collections
+
+from .myers import matching_blocks
+
+__all__ = ('LangStats', 'DocComparison', 'flatten_segmented',
+           'merge_stats')
+
+# Each side of a 'divergent' key is cut off after this many tokens.
+HUNK_KEY_TOKENS = 8
+
+def flatten_segmented(s):
+    """Return the tokens of the segmented document S as a list of
+       (language, token) pairs."""
+    return [(chunk['l'], w) for chunk in s for w in chunk['t']]
+
+class LangStats:
+    """Comparison statistics for one language; see above."""
+
+    __slots__ = ('docs', 'docs_affected',
+                 'p_tokens', 'q_tokens', 'matched_tokens',
+                 'p_bounds', 'q_bounds', 'matched_bounds',
+                 'divergent')
+
+    def __init__(self):
+        self.docs           = 0
+        self.docs_affected  = 0
+        self.p_tokens       = 0
+        self.q_tokens       = 0
+        self.matched_tokens = 0
+        self.p_bounds       = 0
+        self.q_bounds       = 0
+        self.matched_bounds = 0
+        self.divergent      = collections.Counter()
+
+    def merge(self, other):
+        for attr in self.__slots__[:-1]:
+            setattr(self, attr, getattr(self, attr) + getattr(other, attr))
+        self.divergent.update(other.divergent)
+
+    def trim(self, limit):
+        """Discard all but the LIMIT most common divergent hunks.
+           Keeps memory bounded over a large corpus, at the cost of
+           making the counts for rare hunks approximate."""
+        if len(self.divergent) > limit:
+            self.divergent = collections.Counter(
+                dict(self.divergent.most_common(limit)))
+
+    @staticmethod
+    def _ratio(n, d):
+        return n / d if d else float('nan')
+
+    @property
+    def token_precision(self):
+        return self._ratio(self.matched_tokens, self.q_tokens)
+
+    @property
+    def token_recall(self):
+        return self._ratio(self.matched_tokens, self.p_tokens)
+
+    @property
+    def boundary_precision(self):
+        return self._ratio(self.matched_bounds, self.q_bounds)
+
+    @property
+    def boundary_recall(self):
+        return self._ratio(self.matched_bounds, self.p_bounds)
+
+def merge_stats(into, stats):
+    """Merge the dictionary STATS (language: LangStats) into INTO."""
+    for lang, s in stats.items():
+        t = into.get(lang)
+        if t is None:
+            into[lang] = s
+        else:
+            t.merge(s)
+    return into
+
+def _hunk_key(tokens):
+    words = [w for _, w in tokens[:HUNK_KEY_TOKENS]]
+    if len(tokens) > HUNK_KEY_TOKENS:
+        words.append("…")
+    return " ".join(words)
+
+def _end_offsets(tokens):
+    offsets = set()
+    pos = 0
+    for _, w in tokens:
+        pos += len(w)
+        offsets.add(pos)
+    return offsets
+
+class DocComparison:
+    """Alignment of two segmentations, P and Q, of one document."""
+
+    def __init__(self, p, q):
+        self.p = flatten_segmented(p)
+        self.q = flatten_segmented(q)
+
+        ids = {}
+        pa = [ids.setdefault(t, len(ids)) for t in self.p]
+        qa = [ids.setdefault(t, len(ids)) for t in self.q]
+        self.blocks = matching_blocks(pa, qa)
+
+    def opcodes(self):
+        """As difflib.SequenceMatcher.get_opcodes."""
+        i = j = 0
+        codes = []
+        for ai, bj, size in self.blocks:
+            if i < ai and j < bj:
+                codes.append(('replace', i, ai, j, bj))
+            elif i < ai:
+                codes.append(('delete', i, ai, j, bj))
+            elif j < bj:
+                codes.append(('insert', i, ai, j, bj))
+            if size:
+                codes.append(('equal', ai, ai + size, bj, bj + size))
+            i = ai + size
+            j = bj + size
+        return codes
+
+    def languages(self):
+        return set(l for l, _ in self.p) | set(l for l, _ in self.q)
+
+    def add_to(self, stats):
+        """Accumulate statistics for this document into STATS, a
+           dictionary mapping language codes to LangStats."""
+        def get(lang):
+            s = stats.get(lang)
+            if s is None:
+                s = stats[lang] = LangStats()
+            return s
+
+        for lang in self.languages():
+            get(lang).docs += 1
+
+        affected = set()
+        for tag, i1, i2, j1, j2 in self.opcodes():
+            ph = self.p[i1:i2]
+            qh = self.q[j1:j2]
+            if tag == 'equal':
+                for lang, _ in ph:
+                    s = get(lang)
+                    s.p_tokens += 1
+                    s.q_tokens += 1
+                    s.matched_tokens += 1
+                    s.p_bounds += 1
+                    s.q_bounds += 1
+                    s.matched_bounds += 1
+                continue
+
+            for lang, _ in ph:
+                s = get(lang)
+                s.p_tokens += 1
+                s.p_bounds += 1
+            for lang, _ in qh:
+                s = get(lang)
+                s.q_tokens += 1
+                s.q_bounds += 1
+
+            lang = (ph or qh)[0][0]
+            s = get(lang)
+            affected.add(lang)
+            s.divergent[(_hunk_key(ph), _hunk_key(qh))] += 1
+            if ph and qh:
+                if "".join(w for _, w in ph) == "".join(w for _, w in qh):
+                    s.matched_bounds += len(_end_offsets(ph) &
+                                            _end_offsets(qh))
+                else:
+                    s.matched_bounds += 1
+
+        for lang in affected:
+            stats[lang].docs_affected += 1
+        return stats
+
+    def unified_diff(self, fromfile, tofile, n=3):
+        """Generate a diff of the two token lists, one token per line,
+           in the same format as difflib.unified_diff."""
+        def line(tok):
+            return "{}  {}\n".format(*tok)
+
+        started = False
+        for group in _grouped_opcodes(self.opcodes(), n):
+            if not started:
+                started = True
+                yield '--- {}\n'.format(fromfile)
+                yield '+++ {}\n'.format(tofile)
+
+            first, last = group[0], group[-1]
+            yield '@@ -{} +{} @@\n'.format(
+                _format_range_unified(first[1], last[2]),
+                _format_range_unified(first[3], last[4]))
+
+            for tag, i1, i2, j1, j2 in group:
+                if tag == 'equal':
+                    for tok in self.p[i1:i2]:
+                        yield ' ' + line(tok)
+                    continue
+                for tok in self.p[i1:i2]:
+                    yield '-' + line(tok)
+                for tok in self.q[j1:j2]:
+                    yield '+' + line(tok)
+
+# These two are adapted from difflib, which only provides them for
+# its own SequenceMatcher.
+
+def _grouped_opcodes(codes, n):
+    if not codes:
+        codes = [('equal', 0, 1, 0, 1)]
+    if codes[0][0] == 'equal':
+        tag, i1, i2, j1, j2 = codes[0]
+        codes[0] = tag, max(i1, i2 - n), i2, max(j1, j2 - n), j2
+    if codes[-1][0] == 'equal':
+        tag, i1, i2, j1, j2 = codes[-1]
+        codes[-1] = tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)
+
+    nn = n + n
+    group = []
+    for tag, i1, i2, j1, j2 in codes:
+        if tag == 'equal' and i2 - i1 > nn:
+            group.append((tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)))
+            yield group
+            group = []
+            i1, j1 = max(i1, i2 - n), max(j1, j2 - n)
+        group.append((tag, i1, i2, j1, j2))
+    if group and not (len(group) == 1 and group[0][0] == 'equal'):
+        yield group
+
+def _format_range_unified(start, stop):
+    beginning = start + 1
+    length = stop - start
+    if length == 1:
+        return '{}'.format(beginning)
+    if not length:
+        beginning -= 1
+    return '{},{}'.format(beginning, length)
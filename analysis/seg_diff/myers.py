@@ -0,0 +1,107 @@
+# Myers' O(ND) difference algorithm, in its linear-space form: find a
+# longest common subsequence of two sequences by recursively locating
+# the "middle snake" of an optimal edit path.  (E. W. Myers, "An O(ND)
+# Difference Algorithm and Its Variations", Algorithmica 1(2), 1986.)
+#
+# Running time is proportional to the total length of the sequences
+# times the number of differences between them, which for two
+# segmentations of the same text is close to linear; difflib's
+# SequenceMatcher can be quadratic on the same inputs.  Memory use is
+# linear either way.
+#
+# If the _myers extension module has been built ("make" in this
+# directory), the compiled version is used.  It takes the same
+# arguments and produces exactly the same results, but requires the
+# sequences to contain integers (e.g. interned token ids).
+
+__all__ = ('matching_blocks',)
+
+def _middle_snake(a, alo, ahi, b, blo, bhi):
+    N = ahi - alo
+    M = bhi - blo
+    delta = N - M
+    odd = delta & 1
+    maxd = (N + M + 1) // 2
+    off = maxd + 1
+    vf = [0] * (2 * maxd + 3)
+    vb = [0] * (2 * maxd + 3)
+
+    for d in range(maxd + 1):
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and vf[off + k - 1] < vf[off + k + 1]):
+                x = vf[off + k + 1]
+            else:
+                x = vf[off + k - 1] + 1
+            y = x - k
+            x0, y0 = x, y
+            while x < N and y < M and a[alo + x] == b[blo + y]:
+                x += 1
+                y += 1
+            vf[off + k] = x
+            if (odd and delta - (d - 1) <= k <= delta + (d - 1)
+                and x + vb[off + delta - k] >= N):
+                return alo + x0, blo + y0, alo + x, blo + y
+
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and vb[off + k - 1] < vb[off + k + 1]):
+                x = vb[off + k + 1]
+            else:
+                x = vb[off + k - 1] + 1
+            y = x - k
+            x0, y0 = x, y
+            while x < N and y < M and a[ahi - 1 - x] == b[bhi - 1 - y]:
+                x += 1
+                y += 1
+            vb[off + k] = x
+            if (not odd and -d <= delta - k <= d
+                and x + vf[off + delta - k] >= N):
+                return ahi - x, bhi - y, ahi - x0, bhi - y0
+
+    raise AssertionError("no middle snake")
+
+def _emit(out, i, j, n):
+    if n == 0:
+        return
+    if out:
+        li, lj, ln = out[-1]
+        if li + ln == i and lj + ln == j:
+            out[-1] = (li, lj, ln + n)
+            return
+    out.append((i, j, n))
+
+def _compare(a, alo, ahi, b, blo, bhi, out):
+    n = 0
+    while alo + n < ahi and blo + n < bhi and a[alo + n] == b[blo + n]:
+        n += 1
+    _emit(out, alo, blo, n)
+    alo += n
+    blo += n
+    sfx = 0
+    while (alo < ahi - sfx and blo < bhi - sfx and
+           a[ahi - 1 - sfx] == b[bhi - 1 - sfx]):
+        sfx += 1
+
+    if alo < ahi - sfx and blo < bhi - sfx:
+        x, y, u, v = _middle_snake(a, alo, ahi - sfx, b, blo, bhi - sfx)
+        _compare(a, alo, x, b, blo, y, out)
+        _emit(out, x, y, u - x)
+        _compare(a, u, ahi - sfx, b, v, bhi - sfx, out)
+
+    _emit(out, ahi - sfx, bhi - sfx, sfx)
+
+def _py_matching_blocks(a, b):
+    """Return a list of triples (i, j, n) describing a longest common
+       subsequence of A and B: each triple means that a[i:i+n] ==
+       b[j:j+n].  The triples are in increasing order of i and j,
+       adjacent triples are merged, and the last one is always
+       (len(a), len(b), 0), as with difflib's get_matching_blocks."""
+    out = []
+    _compare(a, 0, len(a), b, 0, len(b), out)
+    out.append((len(a), len(b), 0))
+    return out
+
+try:
+    from ._myers import matching_blocks
+except ImportError:
+    matching_blocks = _py_matching_blocks
+
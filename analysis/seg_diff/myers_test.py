@@ -0,0 +1,151 @@
+# Check that matching_blocks finds a longest common subsequence, that
+# the compiled and pure-Python implementations agree exactly, and that
+# DocComparison's diffs and statistics are consistent with it.  Run
+# from the analysis directory:
+#
+#     python3 -m unittest seg_diff.myers_test
+#
+# SEG_DIFF_TEST_N sets the number of random sequence pairs.
+
+import os
+import random
+import unittest
+
+from seg_diff import myers, DocComparison, LangStats
+
+N_PAIRS = int(os.environ.get("SEG_DIFF_TEST_N", 2000))
+
+def lcs_length(a, b):
+    """Quadratic dynamic-programming LCS, for reference."""
+    prev = [0] * (len(b) + 1)
+    for x in a:
+        cur = [0]
+        for j, y in enumerate(b):
+            cur.append(prev[j] + 1 if x == y else max(prev[j + 1], cur[j]))
+        prev = cur
+    return prev[-1]
+
+def random_pair(rng):
+    alphabet = rng.randrange(1, 12)
+    a = [rng.randrange(alphabet) for _ in range(rng.randrange(60))]
+    if rng.random() < 0.5:
+        # Mostly similar sequences, as real segmentations are.
+        b = list(a)
+        for _ in range(rng.randrange(6)):
+            op = rng.randrange(3)
+            i = rng.randrange(len(b) + 1)
+            if op == 0:
+                b.insert(i, rng.randrange(alphabet))
+            elif b and i < len(b):
+                if op == 1:
+                    del b[i]
+                else:
+                    b[i] = rng.randrange(alphabet)
+    else:
+        b = [rng.randrange(alphabet) for _ in range(rng.randrange(60))]
+    return a, b
+
+class TestMatchingBlocks(unittest.TestCase):
+    def check(self, fn, a, b):
+        blocks = fn(a, b)
+        self.assertEqual(blocks[-1], (len(a), len(b), 0))
+        i = j = 0
+        total = 0
+        for k, (ai, bj, n) in enumerate(blocks[:-1]):
+            self.assertGreater(n, 0)
+            self.assertGreaterEqual(ai, i)
+            self.assertGreaterEqual(bj, j)
+            if k:
+                # Adjacent blocks are merged.
+                self.assertFalse(ai == i and bj == j)
+            self.assertEqual(a[ai:ai+n], b[bj:bj+n])
+            i, j = ai + n, bj + n
+            total += n
+        self.assertEqual(total, lcs_length(a, b), msg=repr((a, b)))
+        return blocks
+
+    def test_random(self):
+        rng = random.Random(20180101)
+        compiled = myers.matching_blocks
+        have_compiled = compiled is not myers._py_matching_blocks
+        for _ in range(N_PAIRS):
+            a, b = random_pair(rng)
+            py = self.check(myers._py_matching_blocks, a, b)
+            if have_compiled:
+                self.assertEqual(py, compiled(a, b), msg=repr((a, b)))
+
+    def test_edge_cases(self):
+        for a, b in [([], []), ([1], []), ([], [1]), ([1], [1]),
+                     ([1, 2, 3], [3, 2, 1]), ([1] * 50, [1] * 49),
+                     (list(range(100)), list(range(100, 200)))]:
+            self.check(myers.matching_blocks, a, b)
+            self.check(myers._py_matching_blocks, a, b)
+
+    def test_large(self):
+        rng = random.Random(7)
+        a = [rng.randrange(1000) for _ in range(100000)]
+        b = list(a)
+        for _ in range(100):
+            b[rng.randrange(len(b))] = rng.randrange(1000)
+        blocks = myers.matching_blocks(a, b)
+        self.assertGreaterEqual(sum(n for _, _, n in blocks),
+                                len(a) - 100)
+
+def seg(*chunks):
+    return [{"l": l, "t": t.split()} for l, t in chunks]
+
+class TestDocComparison(unittest.TestCase):
+    def test_identical(self):
+        p = seg(("en", "the cat sat"), ("zh", "我 们"))
+        dc = DocComparison(p, p)
+        self.assertEqual(list(dc.unified_diff("1", "1")), [])
+        stats = dc.add_to({})
+        self.assertEqual(set(stats), {"en", "zh"})
+        for s in stats.values():
+            self.assertEqual(s.docs_affected, 0)
+            self.assertEqual(s.boundary_precision, 1.0)
+            self.assertEqual(s.boundary_recall, 1.0)
+
+    def test_resegmented(self):
+        p = seg(("en", "a b"), ("zh", "我们 是 学生"), ("en", "c"))
+        q = seg(("en", "a b"), ("zh", "我 们 是 学 生"), ("en", "c"))
+        dc = DocComparison(p, q)
+        stats = dc.add_to({})
+        zh = stats["zh"]
+        self.assertEqual((zh.p_tokens, zh.q_tokens, zh.matched_tokens),
+                         (3, 5, 1))
+        # Boundaries after 我们, 是, 学生 in P; all of them are also in Q.
+        self.assertEqual(zh.matched_bounds, 3)
+        self.assertEqual(zh.boundary_recall, 1.0)
+        self.assertEqual(zh.boundary_precision, 3 / 5)
+        self.assertEqual(zh.docs_affected, 1)
+        self.assertEqual(stats["en"].docs_affected, 0)
+        self.assertEqual(zh.divergent[("我们", "我 们")], 1)
+
+        # Applying the edits to P gives Q.
+        rebuilt = []
+        for tag, i1, i2, j1, j2 in dc.opcodes():
+            rebuilt.extend(dc.p[i1:i2] if tag == 'equal' else dc.q[j1:j2])
+        self.assertEqual(rebuilt, dc.q)
+
+    def test_diff_format(self):
+        p = seg(("en", "one two three four five six seven eight nine"))
+        q = seg(("en", "one two three four fiveX six seven eight nine"))
+        lines = list(DocComparison(p, q).unified_diff("7", "7"))
+        self.assertEqual(lines, [
+            "--- 7\n", "+++ 7\n", "@@ -2,7 +2,7 @@\n",
+            " en  two\n", " en  three\n", " en  four\n",
+            "-en  five\n", "+en  fiveX\n",
+            " en  six\n", " en  seven\n", " en  eight\n"])
+
+    def test_merge(self):
+        a, b = LangStats(), LangStats()
+        a.docs, b.docs = 1, 2
+        a.divergent["x"] = 1
+        b.divergent["x"] = 2
+        a.merge(b)
+        self.assertEqual(a.docs, 3)
+        self.assertEqual(a.divergent["x"], 3)
+
+if __name__ == '__main__':
+    unittest.main()
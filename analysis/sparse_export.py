@@ -0,0 +1,266 @@
+#! /usr/bin/python3
+
+# Export per-document tf-idf or nf-idf scores (as computed by
+# tfidf_v3.py) as a sparse document-term matrix, for clustering and
+# topic modeling.
+#
+# usage: sparse_export.py [--stat tfidf|nfidf] [--where CLAUSE]
+#                         [--limit N] DBNAME OUTDIR [RUN...]
+#
+# Documents are streamed from the database and written out in chunks,
+# so the matrix never has to fit in memory.  OUTDIR receives the
+# components of a compressed sparse row (CSR) matrix, as raw
+# little-endian arrays that can be memory-mapped:
+#
+#    data.f32        nnz float32 scores
+#    indices.i32     nnz int32 column (term) numbers, ascending per row
+#    indptr.i64      n_rows+1 int64 offsets of each row in the above
+#    text_ids.i32    n_rows analysis.extracted_content ids, one per row
+#    vocabulary.txt  the term for each column, one per line
+#    meta.json       shape, nnz, statistic, and runs
+#
+# Columns are numbered in order of first appearance, and the
+# vocabulary is shared by all languages, since the per-document
+# statistics are keyed by bare words.  load_matrix() reassembles the
+# pieces as a scipy.sparse.csr_matrix over the memory-mapped arrays;
+# row slices of it can be fed to e.g. MiniBatchKMeans.partial_fit.
+
+import argparse
+import array
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+import pagedb
+
+DATA_DTYPE    = np.dtype('<f4')
+INDEX_DTYPE   = np.dtype('<i4')
+INDPTR_DTYPE  = np.dtype('<i8')
+TEXT_ID_DTYPE = np.dtype('<i4')
+
+FILES = {
+    'data':     ("data.f32",     DATA_DTYPE),
+    'indices':  ("indices.i32",  INDEX_DTYPE),
+    'indptr':   ("indptr.i64",   INDPTR_DTYPE),
+    'text_ids': ("text_ids.i32", TEXT_ID_DTYPE),
+}
+VOCABULARY = "vocabulary.txt"
+META       = "meta.json"
+
+def fmt_elapsed(start):
+    interval = time.monotonic() - start
+    m, s = divmod(interval, 60)
+    h, m = divmod(m, 60)
+    return "{}:{:>02}:{:>05.2f}".format(int(h), int(m), s)
+
+class CSRWriter:
+    """Write a CSR matrix to a directory, one row at a time, holding
+       at most CHUNK_ROWS rows in memory.  Use as a context manager,
+       or call close() when done; the matrix is complete only once
+       meta.json has been written."""
+
+    CHUNK_ROWS = 10000
+
+    def __init__(self, outdir, meta={}):
+        os.makedirs(outdir, exist_ok=True)
+        self.outdir  = outdir
+        self.meta    = dict(meta)
+        self.words   = []
+        self.columns = {}
+        self.n_rows  = 0
+        self.nnz     = 0
+
+        # Remove any previous meta.json first, so that an interrupted
+        # export cannot be mistaken for a complete one.
+        try:
+            os.unlink(os.path.join(outdir, META))
+        except FileNotFoundError:
+            pass
+        self._files = { name: open(os.path.join(outdir, fname), "wb")
+                        for name, (fname, _) in FILES.items() }
+        self._vocab_file = open(os.path.join(outdir, VOCABULARY), "wt",
+                                encoding="utf-8", newline="\n")
+        self._reset_chunk()
+        self._files['indptr'].write(np.zeros(1, INDPTR_DTYPE).tobytes())
+
+    def _reset_chunk(self):
+        self._data     = array.array('f')
+        self._indices  = array.array('l')
+        self._indptr   = array.array('q')
+        self._text_ids = array.array('l')
+        self._n_words_written = len(self.words)
+
+    def add_row(self, text_id, terms, scores):
+        """Append one row, for document TEXT_ID.  TERMS is a sequence
+           of words and SCORES a parallel sequence of numbers."""
+        columns = self.columns
+        words   = self.words
+        cols = []
+        for w in terms:
+            c = columns.get(w)
+            if c is None:
+                c = columns[w] = len(words)
+                words.append(w)
+            cols.append(c)
+
+        cols   = np.array(cols, np.int64)
+        scores = np.asarray(scores, DATA_DTYPE)
+        order  = np.argsort(cols, kind="stable")
+
+        self._indices.extend(cols[order].tolist())
+        self._data.extend(scores[order].tolist())
+        self.nnz += len(cols)
+        self.n_rows += 1
+        self._indptr.append(self.nnz)
+        self._text_ids.append(text_id)
+
+        if len(self._text_ids) >= self.CHUNK_ROWS:
+            self.flush()
+
+    def flush(self):
+        files = self._files
+        files['data'].write(
+            np.frombuffer(self._data, np.float32)
+            .astype(DATA_DTYPE, copy=False).tobytes())
+        files['indices'].write(
+            np.array(self._indices, INDEX_DTYPE).tobytes())
+        files['indptr'].write(
+            np.array(self._indptr, INDPTR_DTYPE).tobytes())
+        files['text_ids'].write(
+            np.array(self._text_ids, TEXT_ID_DTYPE).tobytes())
+        for w in self.words[self._n_words_written:]:
+            self._vocab_file.write(w)
+            self._vocab_file.write("\n")
+        self._reset_chunk()
+
+    def close(self):
+        if self._files is None:
+            return
+        self.flush()
+        for f in self._files.values():
+            f.close()
+        self._vocab_file.close()
+        self._files = None
+
+        meta = dict(self.meta)
+        meta.update(shape = [self.n_rows, len(self.words)],
+                    nnz   = self.nnz)
+        tmp = os.path.join(self.outdir, META + ".tmp")
+        with open(tmp, "wt") as f:
+            json.dump(meta, f, indent=2, sort_keys=True)
+        os.replace(tmp, os.path.join(self.outdir, META))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+        else:
+            for f in self._files.values():
+                f.close()
+            self._vocab_file.close()
+            self._files = None
+
+def load_matrix(outdir, mmap=True):
+    """Load a matrix written by CSRWriter.  Returns a triple
+       (matrix, text_ids, vocabulary): a scipy.sparse.csr_matrix,
+       a numpy array of document ids, one per row, and a list of
+       terms, one per column.  If MMAP is true, the large arrays are
+       memory-mapped read-only rather than read into memory."""
+    import scipy.sparse
+
+    with open(os.path.join(outdir, META)) as f:
+        meta = json.load(f)
+    with open(os.path.join(outdir, VOCABULARY), encoding="utf-8") as f:
+        vocabulary = f.read().split("\n")[:-1]
+
+    arrays = {}
+    for name, (fname, dtype) in FILES.items():
+        path = os.path.join(outdir, fname)
+        if mmap and os.path.getsize(path) > 0:
+            arrays[name] = np.memmap(path, dtype=dtype, mode="r")
+        else:
+            arrays[name] = np.fromfile(path, dtype=dtype)
+
+    n_rows, n_cols = meta["shape"]
+    if (len(arrays['indptr']) != n_rows + 1 or
+        len(arrays['data']) != meta["nnz"] or
+        len(vocabulary) != n_cols):
+        raise ValueError("{}: inconsistent matrix components"
+                         .format(outdir))
+
+    # scipy wants indices and indptr to have the same type; converting
+    # indptr (one entry per row) is much cheaper than converting
+    # indices (one entry per nonzero), and keeps the mapping intact.
+    indptr = arrays['indptr']
+    if meta["nnz"] < 2**31:
+        indptr = indptr.astype(INDEX_DTYPE)
+
+    matrix = scipy.sparse.csr_matrix(
+        (arrays['data'], arrays['indices'], indptr),
+        shape=(n_rows, n_cols), copy=False)
+    return matrix, arrays['text_ids'], vocabulary
+
+def export(db, outdir, stat, runs, where_clause="", limit=None,
+           start=None):
+    """Stream the per-document statistic STAT ('tfidf' or 'nfidf')
+       for every document that has it from DB into OUTDIR.  Returns
+       the CSRWriter, which has been closed."""
+    if start is None:
+        start = time.monotonic()
+    alias = { 'tfidf': 'st', 'nfidf': 'sn' }[stat]
+
+    clause = "{0}.data IS NOT NULL AND {0}.runs = ARRAY[{1}]::integer[]" \
+        .format(alias, ",".join(str(int(r)) for r in runs))
+    if where_clause:
+        clause += " AND ({})".format(where_clause)
+
+    meta = { "stat": stat, "runs": [int(r) for r in runs] }
+    with CSRWriter(outdir, meta) as writer:
+        for text in db.get_page_texts(load=[stat], where_clause=clause,
+                                      limit=limit):
+            scores = getattr(text, stat)
+            if isinstance(scores, dict):
+                # legacy blob
+                writer.add_row(text.eid, list(scores.keys()),
+                               list(scores.values()))
+            else:
+                writer.add_row(text.eid, list(scores.keys()),
+                               scores.scores)
+
+            if writer.n_rows % 10000 == 0:
+                sys.stderr.write("[{}] {} docs, {} terms, {} nonzero\n"
+                                 .format(fmt_elapsed(start),
+                                         writer.n_rows, len(writer.words),
+                                         writer.nnz))
+
+    sys.stderr.write("[{}] {} docs, {} terms, {} nonzero, done\n"
+                     .format(fmt_elapsed(start), writer.n_rows,
+                             len(writer.words), writer.nnz))
+    return writer
+
+def main():
+    ap = argparse.ArgumentParser(
+        description="Export per-document term statistics as a sparse"
+                    " document-term matrix.")
+    ap.add_argument("dbname")
+    ap.add_argument("outdir")
+    ap.add_argument("runs", nargs="*", metavar="run")
+    ap.add_argument("--stat", choices=("tfidf", "nfidf"), default="tfidf",
+                    help="Which statistic to export (default %(default)s).")
+    ap.add_argument("--where", default="",
+                    help="Additional SQL condition on the documents"
+                         " (analysis.extracted_content is 'p').")
+    ap.add_argument("--limit", type=int, default=None,
+                    help="Export at most this many documents.")
+    args = ap.parse_args()
+
+    db = pagedb.PageDB(args.dbname, args.runs)
+    export(db, args.outdir, args.stat, args.runs, args.where, args.limit)
+
+if __name__ == '__main__':
+    main()
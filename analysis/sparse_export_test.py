@@ -0,0 +1,91 @@
+# Tests for sparse_export: a matrix written row by row with CSRWriter,
+# across chunk boundaries and with terms in arbitrary order, must load
+# back identically with load_matrix; and an export interrupted by an
+# exception must not look complete.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import sparse_export
+from sparse_export import CSRWriter, load_matrix
+
+ROWS = [
+    (101, ["zebra", "apple", "mango"],     [0.5, 1.0, 2.0]),
+    (102, ["apple", "東京"],                [3.0, 0.25]),
+    (103, [],                              []),
+    (104, ["mango", "zebra", "kiwi", "東京"], [1.5, 2.5, 3.5, 4.5]),
+    (105, ["kiwi"],                        [7.0]),
+    (106, ["plum", "apple"],               [0.125, 8.0]),
+    (107, ["apple"],                       [9.0]),
+]
+
+class SmallChunkWriter(CSRWriter):
+    CHUNK_ROWS = 3
+
+class TestCSRWriter(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def check_round_trip(self, writer_class, mmap):
+        outdir = os.path.join(self.dir, "out")
+        with writer_class(outdir, { "stat": "tfidf" }) as w:
+            for text_id, terms, scores in ROWS:
+                w.add_row(text_id, terms, scores)
+
+        matrix, text_ids, vocabulary = load_matrix(outdir, mmap=mmap)
+
+        # Columns are numbered in order of first appearance.
+        expected_vocab = []
+        for _, terms, _ in ROWS:
+            for t in terms:
+                if t not in expected_vocab:
+                    expected_vocab.append(t)
+        self.assertEqual(vocabulary, expected_vocab)
+        self.assertEqual(text_ids.tolist(), [r[0] for r in ROWS])
+
+        expected = np.zeros((len(ROWS), len(expected_vocab)), np.float32)
+        for i, (_, terms, scores) in enumerate(ROWS):
+            for t, s in zip(terms, scores):
+                expected[i, expected_vocab.index(t)] = s
+        self.assertEqual(matrix.shape, expected.shape)
+        self.assertTrue((matrix.toarray() == expected).all())
+        self.assertTrue(matrix.has_sorted_indices)
+        self.assertEqual(matrix.nnz, sum(len(r[1]) for r in ROWS))
+
+    def test_round_trip_one_chunk(self):
+        self.check_round_trip(CSRWriter, mmap=True)
+
+    def test_round_trip_across_chunks(self):
+        # 7 rows in chunks of 3: boundaries after rows 3 and 6, the
+        # first one right after an empty row.
+        self.check_round_trip(SmallChunkWriter, mmap=True)
+        self.check_round_trip(SmallChunkWriter, mmap=False)
+
+    def test_interrupted_write(self):
+        outdir = os.path.join(self.dir, "out")
+        with CSRWriter(outdir) as w:
+            w.add_row(1, ["a"], [1.0])
+        self.assertTrue(os.path.exists(
+            os.path.join(outdir, sparse_export.META)))
+
+        # Rewriting the same directory, and failing partway through,
+        # must leave no meta.json behind, old or new.
+        with self.assertRaises(RuntimeError):
+            with SmallChunkWriter(outdir) as w:
+                for text_id, terms, scores in ROWS:
+                    w.add_row(text_id, terms, scores)
+                raise RuntimeError("interrupted")
+        self.assertFalse(os.path.exists(
+            os.path.join(outdir, sparse_export.META)))
+        with self.assertRaises(FileNotFoundError):
+            load_matrix(outdir)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,294 @@
+# Compact binary encoding for word -> score maps, as stored in
+# analysis.corpus_stats and analysis.pruned_content_stats.
+#
+# The original encoding was zlib.compress(json.dumps(dict)).  That
+# works, but every read has to decompress and parse the whole thing
+# into a Python dictionary, which for corpus-wide statistics on a big
+# language means millions of objects.  The encoding defined here is
+# instead directly usable as a pair of numpy arrays, with no parsing:
+#
+#    offset  size  content
+#         0     4  magic number b"TBst"
+#         4     1  format version (currently 1)
+#         5     1  key kind: b'V' - keys are term ids in a vocabulary
+#                            b'T' - keys are inline UTF-8 strings
+#         6     1  value type: b'f' - float32, b'I' - uint32
+#         7     1  reserved, always zero
+#         8     4  number of entries N (uint32)
+#        12    4N  values
+#     12+4N    ..  keys:
+#                    kind V: N int32 term ids, sorted ascending
+#                    kind T: N+1 uint32 offsets into the string data
+#                            that follows, then the string data; the
+#                            strings are sorted by code point.
+#
+# All integers are little-endian.  Every section is 4-byte aligned, so
+# readers can use numpy.frombuffer on a memoryview of the blob.
+#
+# Corpus-wide statistics use kind V: term ids are assigned per language
+# by a Vocabulary, which is shared among all the statistics for that
+# language (cwf, rdf, and idf have the same keys, so this saves storing
+# every word three times).  Per-document statistics are keyed by bare
+# words drawn from all the languages in the document, and are small,
+# so they use kind T.
+#
+# decode() also understands the old zlib(JSON) blobs, which are
+# recognizable because a zlib stream never starts with b"TB".
+
+import bisect
+import json
+import struct
+import zlib
+
+import numpy as np
+
+__all__ = ['Vocabulary', 'TermScores', 'encode_ids', 'encode_terms',
+           'encode_id_arrays', 'encode_term_arrays',
+           'decode', 'is_legacy_blob']
+
+MAGIC   = b"TBst"
+VERSION = 1
+HEADER  = struct.Struct("<4sBccxI")
+
+KIND_IDS   = b'V'
+KIND_TERMS = b'T'
+
+VALUE_DTYPES = {
+    b'f': np.dtype('<f4'),
+    b'I': np.dtype('<u4'),
+}
+ID_DTYPE     = np.dtype('<i4')
+OFFSET_DTYPE = np.dtype('<u4')
+
+class Vocabulary:
+    """Bidirectional mapping between words and small integer ids, for
+       one language.  Ids are assigned in order of first appearance and
+       never change, so blobs encoded against an older state of the
+       vocabulary remain valid after more words are added.
+
+       If LOADER is provided, it is called as LOADER(lang, n) to
+       retrieve the words with ids n and up, in order, when a blob
+       refers to an id this vocabulary doesn't have yet (because
+       another process has added words since it was loaded).
+
+       Properties:
+           lang       - The language this vocabulary is for.
+           words      - List of words, indexed by id.
+           ids        - Dictionary mapping words to ids.
+    """
+    def __init__(self, lang, words=(), loader=None):
+        self.lang    = lang
+        self.words   = list(words)
+        self.ids     = { w: i for i, w in enumerate(self.words) }
+        self._loader = loader
+
+    def __len__(self):
+        return len(self.words)
+
+    def get(self, word, default=None):
+        return self.ids.get(word, default)
+
+    def ensure(self, n):
+        """Make sure this vocabulary has at least N words, loading
+           more if necessary.  Returns True if it does."""
+        if len(self.words) < n and self._loader is not None:
+            for w in self._loader(self.lang, len(self.words)):
+                self.ids[w] = len(self.words)
+                self.words.append(w)
+        return len(self.words) >= n
+
+    def intern(self, words):
+        """Assign ids to all of WORDS that don't have one already.
+           Returns a list of (id, word) pairs for the newly added words,
+           so the caller can persist them."""
+        added = []
+        for w in words:
+            if w not in self.ids:
+                i = len(self.words)
+                self.words.append(w)
+                self.ids[w] = i
+                added.append((i, w))
+        return added
+
+class TermScores:
+    """Read-only word -> score mapping backed by numpy arrays.  This
+       supports the subset of the dict interface that the analysis
+       scripts use (indexing, get, in, len, iteration, keys, values,
+       items), plus direct access to the underlying arrays:
+
+           scores   - numpy array of scores, parallel to 'keys'.
+           term_ids - numpy array of sorted term ids (kind V only).
+
+       Lookups are by binary search over the sorted keys.
+    """
+    def __init__(self, scores, *, term_ids=None, vocab=None, terms=None):
+        self.scores   = scores
+        self.term_ids = term_ids
+        self._vocab   = vocab
+        self._terms   = terms
+
+    def _index(self, word):
+        if self._terms is not None:
+            i = bisect.bisect_left(self._terms, word)
+            if i < len(self._terms) and self._terms[i] == word:
+                return i
+            return -1
+
+        tid = self._vocab.get(word)
+        if tid is None:
+            return -1
+        i = int(np.searchsorted(self.term_ids, tid))
+        if i < len(self.term_ids) and self.term_ids[i] == tid:
+            return i
+        return -1
+
+    def _word(self, i):
+        if self._terms is not None:
+            return self._terms[i]
+        return self._vocab.words[self.term_ids[i]]
+
+    def __len__(self):
+        return len(self.scores)
+
+    def __contains__(self, word):
+        return self._index(word) >= 0
+
+    def __getitem__(self, word):
+        i = self._index(word)
+        if i < 0:
+            raise KeyError(word)
+        return self.scores[i].item()
+
+    def get(self, word, default=None):
+        i = self._index(word)
+        if i < 0:
+            return default
+        return self.scores[i].item()
+
+    def __iter__(self):
+        return self.keys()
+
+    def keys(self):
+        for i in range(len(self.scores)):
+            yield self._word(i)
+
+    def values(self):
+        return iter(self.scores.tolist())
+
+    def items(self):
+        return zip(self.keys(), self.scores.tolist())
+
+    def to_dict(self):
+        return dict(self.items())
+
+def is_legacy_blob(blob):
+    return bytes(blob[:2]) != MAGIC[:2]
+
+def _value_code(values):
+    """Counts (cwf, rdf) are stored exactly as uint32; everything
+       else is float32."""
+    if all(type(v) is int and 0 <= v < 2**32 for v in values):
+        return b'I'
+    return b'f'
+
+def _header(kind, vcode, n):
+    return HEADER.pack(MAGIC, VERSION, kind, vcode, n)
+
+def _array_value_code(values):
+    """Integer arrays are stored as uint32, everything else as
+       float32, matching what _value_code does for lists."""
+    if values.dtype.kind in 'iu' and (len(values) == 0 or
+                                      (values.min() >= 0 and
+                                       values.max() < 2**32)):
+        return b'I'
+    return b'f'
+
+def encode_ids(data, vocab):
+    """Encode the word -> score mapping DATA as a kind-V blob, using
+       the term ids in VOCAB.  Every key in DATA must already have been
+       interned in VOCAB."""
+    pairs = sorted((vocab.ids[w], s) for w, s in data.items())
+    vcode = _value_code(s for _, s in pairs)
+    ids    = np.fromiter((i for i, _ in pairs), ID_DTYPE, len(pairs))
+    values = np.fromiter((s for _, s in pairs), VALUE_DTYPES[vcode],
+                         len(pairs))
+    return b"".join((_header(KIND_IDS, vcode, len(pairs)),
+                     values.tobytes(), ids.tobytes()))
+
+def encode_id_arrays(term_ids, values):
+    """Encode a kind-V blob directly from a numpy array of TERM_IDS
+       and a parallel numpy array of VALUES.  The ids need not be
+       sorted, but must be distinct."""
+    order  = np.argsort(term_ids, kind='stable')
+    vcode  = _array_value_code(values)
+    ids    = np.asarray(term_ids)[order].astype(ID_DTYPE)
+    values = np.asarray(values)[order].astype(VALUE_DTYPES[vcode])
+    return b"".join((_header(KIND_IDS, vcode, len(ids)),
+                     values.tobytes(), ids.tobytes()))
+
+def _encode_sorted_terms(terms, values, vcode):
+    encoded = [w.encode("utf-8") for w in terms]
+    offsets = np.zeros(len(encoded) + 1, OFFSET_DTYPE)
+    np.cumsum([len(e) for e in encoded], out=offsets[1:])
+
+    return b"".join((_header(KIND_TERMS, vcode, len(encoded)),
+                     values.tobytes(), offsets.tobytes(),
+                     b"".join(encoded)))
+
+def encode_terms(data):
+    """Encode the word -> score mapping DATA as a self-contained
+       kind-T blob."""
+    pairs = sorted(data.items())
+    vcode = _value_code(s for _, s in pairs)
+    values = np.fromiter((s for _, s in pairs), VALUE_DTYPES[vcode],
+                         len(pairs))
+    return _encode_sorted_terms([w for w, _ in pairs], values, vcode)
+
+def encode_term_arrays(terms, values):
+    """Encode a kind-T blob from a list of distinct TERMS and a
+       parallel numpy array of VALUES."""
+    order = sorted(range(len(terms)), key=terms.__getitem__)
+    vcode = _array_value_code(values)
+    values = np.asarray(values)[order].astype(VALUE_DTYPES[vcode])
+    return _encode_sorted_terms([terms[i] for i in order], values, vcode)
+
+def _decode_legacy(blob):
+    return json.loads(zlib.decompress(blob).decode("utf-8"))
+
+def decode(blob, vocab=None):
+    """Decode BLOB, which may be in either the binary encoding or
+       the legacy zlib(JSON) encoding.  VOCAB is required for kind-V
+       blobs.  Binary blobs decode to TermScores objects, which share
+       memory with BLOB; legacy blobs decode to plain dictionaries."""
+    if not blob:
+        return {}
+    if is_legacy_blob(blob):
+        return _decode_legacy(blob)
+
+    buf = memoryview(blob)
+    magic, version, kind, vcode, n = HEADER.unpack_from(buf)
+    if version != VERSION:
+        raise ValueError("unsupported term-statistic blob version {}"
+                         .format(version))
+    pos = HEADER.size
+    scores = np.frombuffer(buf, VALUE_DTYPES[vcode], n, pos)
+    pos += 4*n
+
+    if kind == KIND_IDS:
+        if vocab is None:
+            raise ValueError("term-id blob requires a vocabulary")
+        term_ids = np.frombuffer(buf, ID_DTYPE, n, pos)
+        if n and not vocab.ensure(int(term_ids[-1]) + 1):
+            raise ValueError("term id {} not in the {!r} vocabulary"
+                             .format(int(term_ids[-1]), vocab.lang))
+        return TermScores(scores, term_ids=term_ids, vocab=vocab)
+
+    if kind == KIND_TERMS:
+        offsets = np.frombuffer(buf, OFFSET_DTYPE, n+1, pos).tolist()
+        pos += 4*(n+1)
+        text = bytes(buf[pos:])
+        terms = [text[offsets[i]:offsets[i+1]].decode("utf-8")
+                 for i in range(n)]
+        return TermScores(scores, terms=terms)
+
+    raise ValueError("unknown term-statistic blob kind {!r}".format(kind))
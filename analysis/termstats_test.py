@@ -0,0 +1,114 @@
+# Tests for termstats: every encoder must round-trip through decode,
+# legacy zlib(JSON) blobs must still decode, and a kind-V blob that
+# refers to words added to the vocabulary after it was loaded must
+# cause the missing words to be loaded.
+
+import json
+import unittest
+import zlib
+
+import numpy as np
+
+import termstats
+
+WORDS = ["zebra", "apple", "東京", "mañana", "apple pie", ""]
+
+class TestRoundTrip(unittest.TestCase):
+    def check(self, decoded, expected):
+        self.assertIsInstance(decoded, termstats.TermScores)
+        self.assertEqual(len(decoded), len(expected))
+        got = decoded.to_dict()
+        self.assertEqual(set(got), set(expected))
+        for w, v in expected.items():
+            self.assertAlmostEqual(got[w], v, places=5)
+            self.assertIn(w, decoded)
+            self.assertAlmostEqual(decoded[w], v, places=5)
+        self.assertNotIn("not a word", decoded)
+        self.assertIsNone(decoded.get("not a word"))
+        with self.assertRaises(KeyError):
+            decoded["not a word"]
+
+    def test_terms_float(self):
+        data = { w: 0.25 * i for i, w in enumerate(WORDS) }
+        self.check(termstats.decode(termstats.encode_terms(data)), data)
+
+    def test_terms_counts_exact(self):
+        data = { w: 2**31 + i for i, w in enumerate(WORDS) }
+        decoded = termstats.decode(termstats.encode_terms(data))
+        self.assertEqual(decoded.scores.dtype, np.dtype('<u4'))
+        self.assertEqual(decoded.to_dict(), data)
+
+    def test_term_arrays(self):
+        values = np.arange(len(WORDS), dtype=np.float64) / 3
+        data = dict(zip(WORDS, values.tolist()))
+        self.check(termstats.decode(
+            termstats.encode_term_arrays(WORDS, values)), data)
+
+    def test_ids(self):
+        vocab = termstats.Vocabulary("xx")
+        vocab.intern(reversed(WORDS))
+        data = { w: 1.5 * i for i, w in enumerate(WORDS) }
+        decoded = termstats.decode(termstats.encode_ids(data, vocab), vocab)
+        self.check(decoded, data)
+        self.assertTrue((np.diff(decoded.term_ids) > 0).all())
+
+    def test_id_arrays_unsorted(self):
+        vocab = termstats.Vocabulary("xx", WORDS)
+        ids = np.array([vocab.ids[w] for w in reversed(WORDS)])
+        values = np.arange(len(WORDS), dtype=np.int64) * 7
+        data = dict(zip(reversed(WORDS), values.tolist()))
+        decoded = termstats.decode(
+            termstats.encode_id_arrays(ids, values), vocab)
+        self.assertEqual(decoded.to_dict(), data)
+
+    def test_empty(self):
+        self.assertEqual(len(termstats.decode(termstats.encode_terms({}))),
+                         0)
+        self.assertEqual(termstats.decode(b""), {})
+
+class TestLegacy(unittest.TestCase):
+    def test_legacy_blob(self):
+        data = { "apple": 3, "東京": 0.5 }
+        blob = zlib.compress(json.dumps(data).encode("utf-8"))
+        self.assertTrue(termstats.is_legacy_blob(blob))
+        self.assertFalse(termstats.is_legacy_blob(
+            termstats.encode_terms(data)))
+        self.assertEqual(termstats.decode(blob), data)
+        # memoryview and bytearray, as psycopg2 may return.
+        self.assertEqual(termstats.decode(memoryview(blob)), data)
+        self.assertEqual(termstats.decode(bytearray(blob)), data)
+
+class TestVocabularyGrowth(unittest.TestCase):
+    def test_loads_new_words(self):
+        stored = list(WORDS)
+        calls = []
+        def loader(lang, first):
+            calls.append(first)
+            return stored[first:]
+
+        writer = termstats.Vocabulary("xx", WORDS)
+        reader = termstats.Vocabulary("xx", WORDS, loader=loader)
+
+        # Another process adds words and stores a blob using them.
+        writer.intern(["kiwi", "lime"])
+        stored = list(writer.words)
+        blob = termstats.encode_ids({ "kiwi": 1, "apple": 2 }, writer)
+
+        decoded = termstats.decode(blob, reader)
+        self.assertEqual(decoded.to_dict(), { "kiwi": 1, "apple": 2 })
+        self.assertEqual(calls, [len(WORDS)])
+        self.assertEqual(reader.ids["lime"], len(WORDS) + 1)
+
+        # Nothing more to load for a blob within the known range.
+        termstats.decode(blob, reader)
+        self.assertEqual(calls, [len(WORDS)])
+
+    def test_unknown_id(self):
+        vocab = termstats.Vocabulary("xx", WORDS)
+        blob = termstats.encode_id_arrays(np.array([len(WORDS)]),
+                                          np.array([1]))
+        with self.assertRaises(ValueError):
+            termstats.decode(blob, vocab)
+
+if __name__ == '__main__':
+    unittest.main()
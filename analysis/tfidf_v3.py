@@ -1,152 +1,507 @@
 #! /usr/bin/python3
 
+# Compute corpus-wide word statistics (corpus word frequency, raw
+# document frequency, inverse document frequency) and per-document
+# tf-idf and nf-idf scores for the segmented text in the database.
+#
+# usage: tfidf_v3.py [--incremental [--tolerance T] [--rescan]]
+#                    DBNAME [RUN...]
+#
+# Both passes are split across worker processes, each of which scans
+# its own partition of analysis.extracted_content (by id modulo the
+# number of workers).  In the corpus-wide pass, each worker interns
+# words to small integer ids in a private per-language vocabulary and
+# counts into numpy arrays; the parent merges the partial counts into
+# one vocabulary per language and computes IDF as a numpy array.  In
+# the per-document pass, the workers inherit those tables (by fork)
+# and compute each document's scores with array operations, writing
+# them back in bulk.
+#
+# With --incremental, only documents added since the last run are
+# counted: those with no row in pruned_content_stats and an id above
+# the watermark recorded in analysis.corpus_stats (--rescan drops the
+# watermark condition, to pick up documents segmented late).  Their
+# counts are added to the stored raw counts for each language, and
+# IDF is recomputed.  A term's stored IDF is replaced only if it has
+# moved by more than the tolerance (default 0.01); already-scored
+# documents are rewritten only if they contain such a term.  The new
+# documents are then given rows and scored; only the documents
+# actually counted get rows, so one segmented while the run is in
+# progress is left for the next run.  If there are no stored
+# statistics, or they lack a watermark, a full run is done instead.
+
+import argparse
+import array
 import collections
-import pagedb
+import multiprocessing
+import os
 import sys
-import math
 import time
 
+import numpy as np
+
+import pagedb
+import termstats
+
 def fmt_elapsed(start):
     interval = time.monotonic() - start
     m, s = divmod(interval, 60)
     h, m = divmod(m, 60)
     return "{}:{:>02}:{:>05.2f}".format(int(h), int(m), s)
 
+# Documents are written back in batches of this many, each batch in
+# its own transaction.
+WRITE_BATCH = 1000
+
 def compute_idf(n_documents, raw_doc_freq):
     """Compute inverse document frequencies:
            idf(t, D) = log |D|/|{d in D: t in d}|
        i.e. total number of documents over number of documents containing
        the term.  Since this is within-corpus IDF we know by construction
-       that the denominator will never be zero."""
+       that the denominator will never be zero.
 
-    log = math.log
-    return { lang: { word: log(ndocs/doc_freq)
-                     for word, doc_freq in raw_doc_freq[lang].items() }
-             for lang, ndocs in n_documents.items() }
+       RAW_DOC_FREQ is a numpy array of document counts, indexed by
+       term id; the result is a parallel array of IDF values."""
+    return np.log(n_documents / raw_doc_freq.astype(np.float64))
 
-def corpus_wide_statistics(db, start):
-    """Compute corpus-wide frequency and raw document frequency per term,
-       and count the number of documents."""
+# Default for --tolerance.
+IDF_TOLERANCE = 0.01
+
+def partition_clause(n_parts, part, extra=None):
+    clause = "p.segmented_text is not null"
+    if n_parts > 1:
+        clause += " and p.id % {} = {}".format(n_parts, part)
+    if extra:
+        clause += " and ({})".format(extra)
+    return clause
+
+class LanguageCounts:
+    """Corpus word frequency and raw document frequency for one
+       language, over some subset of the corpus.
+
+       Words are interned to ids in order of first appearance.  The
+       ids of each document's words are buffered in flat arrays and
+       periodically folded into the count arrays with np.bincount,
+       so that the per-word work in Python is just a dictionary
+       lookup and an append.
+    """
+    FLUSH_TOKENS = 1000000
+
+    def __init__(self, lang):
+        self.lang        = lang
+        self.words       = []
+        self.ids         = {}
+        self.n_documents = 0
+        self.cwf         = np.zeros(0, np.int64)
+        self.rdf         = np.zeros(0, np.int64)
+        self.idf         = np.zeros(0, np.float64)
+        # In incremental mode, a boolean array marking the terms
+        # whose IDF was changed by this run; None if there were none.
+        self.moved       = None
+        self._tokens     = array.array('q')
+        self._doc_terms  = array.array('q')
+
+    def ids_for(self, words):
+        """Return a list of ids for WORDS, assigning new ids as
+           necessary."""
+        ids   = self.ids
+        vocab = self.words
+        result = []
+        for w in words:
+            i = ids.get(w)
+            if i is None:
+                i = ids[w] = len(vocab)
+                vocab.append(w)
+            result.append(i)
+        return result
+
+    def intern(self, words):
+        """Like ids_for, but also count WORDS toward the corpus
+           frequency."""
+        result = self.ids_for(words)
+        self._tokens.extend(result)
+        return result
+
+    def add_document(self, term_ids):
+        """Record that one more document contained the set of
+           TERM_IDS."""
+        self.n_documents += 1
+        self._doc_terms.extend(term_ids)
+        if len(self._tokens) >= self.FLUSH_TOKENS:
+            self.flush()
+
+    def flush(self):
+        n = len(self.words)
+        if len(self.cwf) < n:
+            self.cwf = np.concatenate(
+                (self.cwf, np.zeros(n - len(self.cwf), np.int64)))
+            self.rdf = np.concatenate(
+                (self.rdf, np.zeros(n - len(self.rdf), np.int64)))
+        if self._tokens:
+            self.cwf += np.bincount(np.frombuffer(self._tokens, np.int64),
+                                    minlength=n)
+            self._tokens = array.array('q')
+        if self._doc_terms:
+            self.rdf += np.bincount(np.frombuffer(self._doc_terms, np.int64),
+                                    minlength=n)
+            self._doc_terms = array.array('q')
+
+    def merge(self, words, cwf, rdf, n_documents):
+        """Add in partial counts from another LanguageCounts (as
+           returned by its partial() method)."""
+        gids = np.array(self.ids_for(words), np.int64)
+        self.flush()
+        # gids are distinct, so plain fancy-index addition is safe.
+        self.cwf[gids] += cwf
+        self.rdf[gids] += rdf
+        self.n_documents += n_documents
 
-    corpus_word_freq = collections.defaultdict(collections.Counter)
-    raw_doc_freq     = collections.defaultdict(collections.Counter)
-    n_documents      = collections.Counter()
-    n_all_documents  = 0
-    langs_in_block   = set()
-    word_already_this_document = collections.defaultdict(set)
-    lang_already_this_document = set()
+    def partial(self):
+        self.flush()
+        return (self.words, self.cwf, self.rdf, self.n_documents)
 
+    @classmethod
+    def load(cls, db, lang):
+        """Load the stored corpus statistics for LANG.  Returns None if
+           they are in the legacy format or inconsistent with each
+           other, in which case they cannot be updated incrementally."""
+        n_documents, cwf = db.get_corpus_statistic('cwf', lang)
+        _, rdf = db.get_corpus_statistic('rdf', lang)
+        _, idf = db.get_corpus_statistic('idf', lang)
+        stats = (cwf, rdf, idf)
+        if not all(isinstance(st, termstats.TermScores)
+                   and st.term_ids is not None for st in stats):
+            return None
+        if not (np.array_equal(cwf.term_ids, rdf.term_ids) and
+                np.array_equal(cwf.term_ids, idf.term_ids)):
+            return None
+
+        lc = cls(lang)
+        vocab = db.get_vocabulary(lang)
+        lc.ids_for(vocab.words[i] for i in cwf.term_ids.tolist())
+        lc.n_documents = n_documents
+        lc.cwf = cwf.scores.astype(np.int64)
+        lc.rdf = rdf.scores.astype(np.int64)
+        lc.idf = idf.scores.astype(np.float64)
+        return lc
+
+    def update_idf(self, tolerance):
+        """Recompute IDF after merging in new counts.  Terms that were
+           already known keep their previous IDF unless the new value
+           differs from it by more than TOLERANCE; those that do are
+           marked in self.moved."""
+        n_old   = len(self.idf)
+        new_idf = compute_idf(self.n_documents, self.rdf)
+        moved   = np.abs(new_idf[:n_old] - self.idf) > tolerance
+        new_idf[:n_old] = np.where(moved, new_idf[:n_old], self.idf)
+        self.idf   = new_idf
+        self.moved = moved if moved.any() else None
+
+def count_document(counts, segmented):
+    """Add the words of one document, SEGMENTED, to COUNTS (a
+       dictionary of LanguageCounts objects)."""
+    doc_terms = {}
+    for run in segmented:
+        lang = run["l"]
+        lc = counts.get(lang)
+        if lc is None:
+            lc = counts[lang] = LanguageCounts(lang)
+        ids = lc.intern(run["t"])
+        terms = doc_terms.get(lc)
+        if terms is None:
+            terms = doc_terms[lc] = set()
+        terms.update(ids)
+    for lc, terms in doc_terms.items():
+        lc.add_document(terms)
+
+def count_partition(args):
+    """Worker: compute partial corpus-wide counts over one partition
+       of the corpus."""
+    dbname, runs, n_parts, part, extra, want_ids, start = args
+    db = pagedb.PageDB(dbname, runs)
+    counts = {}
+    n_docs = 0
+    max_id = 0
+    ids = array.array('q') if want_ids else None
     for text in db.get_page_texts(load = ["segmented"],
                                   where_clause =
-                                  "p.segmented_text is not null"):
-        n_all_documents += 1
-        word_already_this_document.clear()
-        lang_already_this_document.clear()
-        for run in text.segmented:
-            lang  = run["l"]
-            words = run["t"]
-            if lang not in lang_already_this_document:
-                n_documents[lang] += 1
-                langs_in_block.add(lang)
-                lang_already_this_document.add(lang)
-            for word in words:
-                corpus_word_freq[lang][word] += 1
-                if word not in word_already_this_document[lang]:
-                    raw_doc_freq[lang][word] += 1
-                    word_already_this_document[lang].add(word)
-
-        if n_all_documents % 1000 == 0:
-            sys.stderr.write("[{}] CS: {} docs - {}\n"
-                             .format(fmt_elapsed(start),
-                                     n_all_documents,
-                                     " ".join(sorted(langs_in_block))))
-            langs_in_block.clear()
+                                  partition_clause(n_parts, part, extra)):
+        count_document(counts, text.segmented)
+        n_docs += 1
+        max_id = max(max_id, text.eid)
+        if ids is not None:
+            ids.append(text.eid)
+        if n_docs % 10000 == 0:
+            sys.stderr.write("[{}] CS: worker {}: {} docs\n"
+                             .format(fmt_elapsed(start), part, n_docs))
+
+    sys.stderr.write("[{}] CS: worker {}: {} docs, done\n"
+                     .format(fmt_elapsed(start), part, n_docs))
+    return n_docs, max_id, ids, { lang: lc.partial()
+                                  for lang, lc in counts.items() }
+
+def count_documents(dbname, runs, n_workers, extra, start, want_ids=False):
+    """Count the words of all segmented documents matching EXTRA (an
+       SQL condition, or None for all of them), in parallel.  Returns
+       a dictionary mapping language codes to LanguageCounts objects,
+       the number of documents counted, the highest document id
+       counted (0 if none), and, if WANT_IDS is true, an array of the
+       ids of all the documents counted (otherwise None)."""
+    jobs = [(dbname, runs, n_workers, k, extra, want_ids, start)
+            for k in range(n_workers)]
+    counts = {}
+    n_all_documents = 0
+    max_id = 0
+    ids = array.array('q') if want_ids else None
+    ctx = multiprocessing.get_context("fork")
+    with ctx.Pool(n_workers) as pool:
+        for n_docs, part_max_id, part_ids, partial in \
+                pool.imap_unordered(count_partition, jobs):
+            n_all_documents += n_docs
+            max_id = max(max_id, part_max_id)
+            if ids is not None:
+                ids.extend(part_ids)
+            for lang, (words, cwf, rdf, ndocs) in partial.items():
+                lc = counts.get(lang)
+                if lc is None:
+                    lc = counts[lang] = LanguageCounts(lang)
+                lc.merge(words, cwf, rdf, ndocs)
 
     sys.stderr.write("[{}] CS: {} docs - {}\n"
                      .format(fmt_elapsed(start),
                              n_all_documents,
-                             " ".join(sorted(langs_in_block))))
-    idf = compute_idf(n_documents, raw_doc_freq)
+                             " ".join(sorted(counts.keys()))))
+    return counts, n_all_documents, max_id, ids
+
+def stat_arrays(lc):
+    return [('cwf', lc.cwf), ('rdf', lc.rdf), ('idf', lc.idf)]
+
+def store_corpus_statistics(db, counts, watermark):
+    for lang, lc in counts.items():
+        db.update_corpus_statistics_arrays(lang, lc.n_documents, lc.words,
+                                           stat_arrays(lc), watermark)
+
+def corpus_wide_statistics(db, dbname, runs, n_workers, start):
+    """Compute corpus-wide frequency and raw document frequency per term,
+       and count the number of documents.  Returns a dictionary
+       mapping language codes to LanguageCounts objects, with
+       their 'idf' attributes set."""
+
+    counts, _, max_id, _ = count_documents(dbname, runs, n_workers,
+                                           None, start)
+    for lc in counts.values():
+        lc.flush()
+        lc.idf = compute_idf(lc.n_documents, lc.rdf)
     sys.stderr.write("[{}] CS: IDF computed.\n"
                      .format(fmt_elapsed(start)))
-    for lang in n_documents.keys():
-        db.update_corpus_statistics(lang, n_documents[lang],
-                                    [('cwf', corpus_word_freq[lang]),
-                                     ('rdf', raw_doc_freq[lang]),
-                                     ('idf', idf[lang])])
 
+    store_corpus_statistics(db, counts, max_id)
     sys.stderr.write("[{}] CS: complete.\n"
                      .format(fmt_elapsed(start)))
-    return idf
+    return counts
+
+def incremental_corpus_statistics(db, dbname, runs, n_workers,
+                                  tolerance, rescan, start):
+    """Add the documents that have not yet been counted to the stored
+       corpus-wide statistics, and give them pruned_content_stats
+       rows.  Returns a dictionary of LanguageCounts objects as for
+       corpus_wide_statistics, and the new watermark; or (None, None)
+       if the stored statistics cannot be updated incrementally."""
 
+    watermark = db.get_corpus_watermark()
+    if watermark is None:
+        sys.stderr.write("[{}] CS: no watermark, full run required.\n"
+                         .format(fmt_elapsed(start)))
+        return None, None
 
-def compute_doc_statistics(db, text, idf, langs_in_block):
+    tables = {}
+    for lang in db.get_corpus_languages():
+        lc = LanguageCounts.load(db, lang)
+        if lc is None:
+            sys.stderr.write("[{}] CS: legacy statistics for '{}',"
+                             " full run required.\n"
+                             .format(fmt_elapsed(start), lang))
+            return None, None
+        tables[lang] = lc
+    sys.stderr.write("[{}] CS: loaded statistics up to {}.\n"
+                     .format(fmt_elapsed(start), watermark))
+
+    new_docs = db.text_statistic_clause('tfidf', 'missing')
+    if not rescan:
+        new_docs = "p.id > {} and {}".format(watermark, new_docs)
+    counts, n_new, max_id, counted = count_documents(
+        dbname, runs, n_workers, new_docs, start, want_ids=True)
+
+    changed = {}
+    for lang, partial in counts.items():
+        lc = tables.get(lang)
+        if lc is None:
+            lc = tables[lang] = LanguageCounts(lang)
+        lc.merge(*partial.partial())
+        lc.update_idf(tolerance)
+        changed[lang] = lc
+        sys.stderr.write("[{}] CS: {}: {} terms, {} IDF changes\n"
+                         .format(fmt_elapsed(start), lang, len(lc.words),
+                                 0 if lc.moved is None
+                                 else int(lc.moved.sum())))
+
+    # The new documents' pruned_content_stats rows, which mark them
+    # as counted, are created in the same transaction as the updated
+    # statistics and watermark are stored, so that an interruption
+    # cannot leave documents counted but unmarked, or vice versa.
+    watermark = max(watermark, max_id)
+    db.add_counted_texts(
+        ('tfidf', 'nfidf'), counted,
+        [(lang, lc.n_documents, lc.words, stat_arrays(lc))
+         for lang, lc in changed.items()],
+        watermark)
+    sys.stderr.write("[{}] CS: complete, watermark {}.\n"
+                     .format(fmt_elapsed(start), watermark))
+
+    return tables, watermark
+
+# Per-document pass.  _IDF_TABLES is set in the parent just before the
+# worker pool is created, so that the workers inherit it by fork
+# rather than having it pickled to each of them.
+_IDF_TABLES = None
+
+def compute_doc_statistics(text, idf_tables, langs_in_block):
     # tf: baseline tfidf - no correction for document length.
     # nf: augmented normalized tfidf - use max term frequency within
     #     each document to normalize, so long documents cannot over-
     #     influence scoring of the entire corpus.
     # both are computed _across_ all languages within the doc.
+    #
+    # A word that appears in more than one language's runs gets one
+    # score, using the IDF from the language of its last occurrence.
+
+    local     = {}   # word -> index within this document
+    positions = []   # local index of each token
+    tok_idf   = []   # IDF of each token, in its own language
 
-    allwords = collections.Counter()
     for run in text.segmented:
-        langs_in_block.add(run["l"])
-        for word in run["t"]:
-            allwords[word] += 1
+        lang  = run["l"]
+        words = run["t"]
+        langs_in_block.add(lang)
+        if not words:
+            continue
+
+        lc = idf_tables[lang]
+        try:
+            gids = [lc.ids[w] for w in words]
+        except KeyError as e:
+            sys.stderr.write("*** '{}' missing IDF in '{}'\n"
+                             .format(e.args[0], lang))
+            sys.stderr.write("*** seg dump: {!r}\n".format(text.segmented))
+            raise
+        tok_idf.append(lc.idf[gids])
+        positions.extend(local.setdefault(w, len(local)) for w in words)
 
-    tf = {}
-    nf = {}
-    if allwords:
-        max_tf = max(allwords.values())
+    if not local:
+        empty = termstats.encode_terms({})
+        return empty, empty
 
-        for run in text.segmented:
-            lang  = run["l"]
-            words = run["t"]
+    positions = np.array(positions, np.int64)
+    tok_idf   = np.concatenate(tok_idf)
 
-            for word in words:
-                w_tf  = allwords[word]
-                try:
-                    w_idf = idf[lang][word]
-                except KeyError:
-                    sys.stderr.write("*** '{}' missing IDF in '{}'\n"
-                                     .format(word, lang))
-                    sys.stderr.write("*** seg dump: {!r}\n".format(text.segmented))
-                    raise
+    counts = np.bincount(positions, minlength=len(local))
+    max_tf = counts.max()
 
-                tf[word] = w_tf * w_idf
-                nf[word] = (0.5 + (0.5 * w_tf)/max_tf) * w_idf
+    # Position of the last occurrence of each word: the first
+    # occurrence in the reversed token sequence.
+    _, rev_first = np.unique(positions[::-1], return_index=True)
+    w_idf = tok_idf[len(positions) - 1 - rev_first]
 
-    db.update_text_statistic('tfidf', text, tf)
-    db.update_text_statistic('nfidf', text, nf)
+    tf = counts * w_idf
+    nf = (0.5 + (0.5 * counts)/max_tf) * w_idf
 
-def per_document_statistics(db, idf, start):
+    words = list(local.keys())
+    return (termstats.encode_term_arrays(words, tf),
+            termstats.encode_term_arrays(words, nf))
+
+def uses_moved_terms(text, idf_tables):
+    """True if TEXT contains any term whose IDF was changed by an
+       incremental run (see LanguageCounts.update_idf)."""
+    for run in text.segmented:
+        lc = idf_tables[run["l"]]
+        if lc.moved is None:
+            continue
+        n_old = len(lc.moved)
+        ids = lc.ids
+        for w in run["t"]:
+            i = ids[w]
+            if i < n_old and lc.moved[i]:
+                return True
+    return False
+
+def score_partition(args):
+    """Worker: compute and store per-document statistics for one
+       partition of the corpus."""
+    dbname, runs, n_parts, part, extra, only_moved, start = args
 
     # Note: the entire get_page_texts() operation must be enclosed in a
     # single transaction; committing in the middle will invalidate the
-    # server-side cursor it holds.
+    # server-side cursor it holds.  So writes go through a second
+    # connection, which commits after each batch.
+    rdb = pagedb.PageDB(dbname, runs)
+    wdb = pagedb.PageDB(dbname, runs)
 
     processed = 0
+    scanned = 0
     langs_in_block = set()
-    with db:
-        for text in db.get_page_texts(load = ["segmented"],
-                                      where_clause =
-                                      "p.segmented_text is not null"):
-            compute_doc_statistics(db, text, idf, langs_in_block)
-            processed += 1
-
-            if processed % 1000 == 0:
-                sys.stderr.write("[{}] DS: {} docs - {}\n"
-                                 .format(fmt_elapsed(start),
-                                         processed,
-                                         " ".join(sorted(langs_in_block))))
-                langs_in_block.clear()
-
-        sys.stderr.write("[{}] DS: {} docs - {}\n"
-                         .format(fmt_elapsed(start),
-                                 processed,
-                                 " ".join(sorted(langs_in_block))))
-    sys.stderr.write("[{}] DS: complete.\n"
-                     .format(fmt_elapsed(start)))
+    tf_batch = []
+    nf_batch = []
 
+    def write_batch():
+        with wdb:
+            wdb.update_text_statistics_bulk('tfidf', tf_batch)
+            wdb.update_text_statistics_bulk('nfidf', nf_batch)
+        tf_batch.clear()
+        nf_batch.clear()
+
+    for text in rdb.get_page_texts(load = ["segmented"],
+                                   where_clause =
+                                   partition_clause(n_parts, part, extra)):
+        scanned += 1
+        if only_moved and not uses_moved_terms(text, _IDF_TABLES):
+            continue
+        tf, nf = compute_doc_statistics(text, _IDF_TABLES, langs_in_block)
+        tf_batch.append((text.eid, tf))
+        nf_batch.append((text.eid, nf))
+        processed += 1
+
+        if len(tf_batch) >= WRITE_BATCH:
+            write_batch()
+
+        if processed % 10000 == 0:
+            sys.stderr.write("[{}] DS: worker {}: {} docs - {}\n"
+                             .format(fmt_elapsed(start), part, processed,
+                                     " ".join(sorted(langs_in_block))))
+            langs_in_block.clear()
+
+    write_batch()
+    sys.stderr.write("[{}] DS: worker {}: {}/{} docs, done\n"
+                     .format(fmt_elapsed(start), part, processed, scanned))
+    return processed
+
+def per_document_statistics(dbname, runs, idf_tables, n_workers, start,
+                            extra=None, only_moved=False):
+    """Compute and store per-document statistics for all segmented
+       documents matching EXTRA (an SQL condition, or None for all of
+       them).  If ONLY_MOVED is true, skip documents that do not
+       contain any term whose IDF was changed by an incremental run."""
+    global _IDF_TABLES
+    _IDF_TABLES = idf_tables
+
+    jobs = [(dbname, runs, n_workers, k, extra, only_moved, start)
+            for k in range(n_workers)]
+    ctx = multiprocessing.get_context("fork")
+    with ctx.Pool(n_workers) as pool:
+        processed = sum(pool.imap_unordered(score_partition, jobs))
+
+    _IDF_TABLES = None
+    sys.stderr.write("[{}] DS: {} docs complete.\n"
+                     .format(fmt_elapsed(start), processed))
 
 def prep_database(dbname, runs, start):
     db = pagedb.PageDB(dbname, runs)
@@ -157,13 +512,59 @@ def prep_database(dbname, runs, start):
                      .format(fmt_elapsed(start)))
     return db
 
+def full_run(dbname, runs, n_workers, start):
+    db = prep_database(dbname, runs, start)
+    idf_tables = corpus_wide_statistics(db, dbname, runs, n_workers, start)
+    per_document_statistics(dbname, runs, idf_tables, n_workers, start)
+
+def incremental_run(dbname, runs, n_workers, tolerance, rescan, start):
+    db = pagedb.PageDB(dbname, runs)
+    idf_tables, watermark = incremental_corpus_statistics(
+        db, dbname, runs, n_workers, tolerance, rescan, start)
+    if idf_tables is None:
+        full_run(dbname, runs, n_workers, start)
+        return
+
+    below = "p.id <= {} and ".format(watermark)
+
+    # Rescore the documents affected by IDF changes before scoring
+    # the new documents, so the latter are not scanned twice.
+    if any(lc.moved is not None for lc in idf_tables.values()):
+        per_document_statistics(
+            dbname, runs, idf_tables, n_workers, start,
+            below + db.text_statistic_clause('tfidf', 'scored'),
+            only_moved=True)
+
+    # This also picks up documents left unscored by an interrupted run.
+    per_document_statistics(
+        dbname, runs, idf_tables, n_workers, start,
+        below + db.text_statistic_clause('tfidf', 'null'))
+
 def main():
-    dbname = sys.argv[1]
-    runs = sys.argv[2:]
-    start = time.monotonic()
+    ap = argparse.ArgumentParser(
+        description="Compute corpus-wide and per-document tf-idf"
+                    " statistics.")
+    ap.add_argument("dbname")
+    ap.add_argument("runs", nargs="*", metavar="run")
+    ap.add_argument("--incremental", action="store_true",
+                    help="Only process documents added since the"
+                         " last run.")
+    ap.add_argument("--tolerance", type=float, default=IDF_TOLERANCE,
+                    help="In incremental mode, rescore old documents"
+                         " only for IDF changes larger than this"
+                         " (default %(default)s).")
+    ap.add_argument("--rescan", action="store_true",
+                    help="In incremental mode, look for uncounted"
+                         " documents below the watermark as well.")
+    args = ap.parse_args()
 
-    db = prep_database(dbname, runs, start)
-    idf = corpus_wide_statistics(db, start)
-    per_document_statistics(db, idf, start)
+    n_workers = os.cpu_count() or 1
+    start = time.monotonic()
+    if args.incremental:
+        incremental_run(args.dbname, args.runs, n_workers,
+                        args.tolerance, args.rescan, start)
+    else:
+        full_run(args.dbname, args.runs, n_workers, start)
 
-main()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+# In-process topic comparison for get_page_histories.py.
+#
+# The history scanner needs to decide, for many pairs of snapshots of
+# the same page, whether the page is still "about the same thing".
+# Its inputs are the translated bags of words that GoogleTranslate
+# produces: a space-separated list of language codes, a comma, and a
+# space-separated list of (English) words.
+#
+# This module answers that question directly, without a subprocess:
+# each text becomes a hashed term vector (sublinear term frequency,
+# English stopwords removed, L2-normalized), and two texts are the
+# same topic if the cosine similarity of their vectors is at least a
+# threshold.  A batch of pairs is compared with a handful of numpy
+# operations over all the pairs at once.
+#
+# Term hashing uses Python's built-in string hash, which is randomized
+# per process; that is fine, since vectors are never stored or
+# compared across processes.
+
+import collections
+import functools
+import glob
+import os
+
+import numpy as np
+
+__all__ = ('TopicSimilarity', 'load_stopwords')
+
+PKGDIR = os.path.dirname(os.path.abspath(__file__))
+
+# Number of hash buckets (must be a power of two).  Collisions only
+# ever make two texts look slightly more similar.
+N_FEATURES = 1 << 20
+
+# Default cosine-similarity threshold for "same topic".
+SAME_TOPIC_THRESHOLD = 0.5
+
+# Number of recently vectorized texts to remember.  Consecutive
+# snapshots are compared pairwise, so most texts appear twice.
+VECTOR_CACHE_SIZE = 4096
+
+def load_stopwords(pattern=os.path.join(PKGDIR, "stopwords", "*.txt")):
+    """Load and merge all of the stopword lists matching PATTERN."""
+    words = set()
+    for fn in glob.glob(pattern):
+        with open(fn, encoding="utf-8-sig") as f:
+            words.update(line.strip().casefold() for line in f)
+    words.discard("")
+    return frozenset(words)
+
+class TopicSimilarity:
+    """Compare translated bag-of-words texts for topic similarity.
+       Thread-safe: same_topic_many may be called from several
+       threads at once."""
+
+    def __init__(self, threshold=SAME_TOPIC_THRESHOLD,
+                 n_features=N_FEATURES, stopwords=None):
+        if n_features & (n_features - 1):
+            raise ValueError("n_features must be a power of two")
+        self.threshold  = threshold
+        self.n_features = n_features
+        self.stopwords  = (load_stopwords() if stopwords is None
+                           else frozenset(stopwords))
+        self.vectorize  = functools.lru_cache(VECTOR_CACHE_SIZE)(
+            self._vectorize)
+
+    def _vectorize(self, text):
+        """Convert TEXT to a pair of numpy arrays (buckets, weights):
+           the sorted, distinct hash buckets of its words, and their
+           L2-normalized sublinear term frequencies."""
+        _, _, words = text.partition(",")
+        # Counting is done in C by Counter; the Python-level loop is
+        # then only over distinct words.
+        counts = collections.Counter(words.split())
+        for w in self.stopwords.intersection(counts):
+            del counts[w]
+
+        n = len(counts)
+        hashes = np.fromiter(map(hash, counts), np.int64, n)
+        hashes &= self.n_features - 1
+        tf = np.fromiter(counts.values(), np.float64, n)
+        # Words that collide share a bucket; add up their counts.
+        buckets, inverse = np.unique(hashes, return_inverse=True)
+        tf = np.bincount(inverse.reshape(-1), weights=tf,
+                         minlength=len(buckets))
+        weights = 1.0 + np.log(tf) if n else tf
+        norm = np.sqrt(np.dot(weights, weights))
+        if norm > 0:
+            weights /= norm
+        return buckets, weights
+
+    def similarity_many(self, pairs):
+        """Return a numpy array of the cosine similarities of each
+           (a, b) pair of texts in PAIRS.  A text with no words (after
+           stopword removal) has similarity 1 to another such text
+           and 0 to anything else."""
+        n = len(pairs)
+        if n == 0:
+            return np.zeros(0)
+
+        a_keys = []
+        a_wts  = []
+        b_keys = []
+        b_wts  = []
+        both_empty = np.zeros(n, bool)
+        for i, (a, b) in enumerate(pairs):
+            ka, wa = self.vectorize(a)
+            kb, wb = self.vectorize(b)
+            both_empty[i] = len(ka) == 0 and len(kb) == 0
+            # Offset each pair's buckets into its own range, so that
+            # one intersection finds the common terms of every pair.
+            a_keys.append(ka + i * self.n_features)
+            a_wts.append(wa)
+            b_keys.append(kb + i * self.n_features)
+            b_wts.append(wb)
+
+        a_keys = np.concatenate(a_keys)
+        b_keys = np.concatenate(b_keys)
+        _, ia, ib = np.intersect1d(a_keys, b_keys, assume_unique=True,
+                                   return_indices=True)
+        products = np.concatenate(a_wts)[ia] * np.concatenate(b_wts)[ib]
+        sims = np.bincount(a_keys[ia] // self.n_features,
+                           weights=products, minlength=n)
+        sims[both_empty] = 1.0
+        return sims
+
+    def same_topic_many(self, pairs):
+        """Return a list of booleans: for each (a, b) pair of texts in
+           PAIRS, whether they are about the same topic."""
+        return (self.similarity_many(pairs) >= self.threshold).tolist()
+
+    def same_topic(self, a, b):
+        return self.same_topic_many([(a, b)])[0]
@@ -0,0 +1,267 @@
+# Persistent local copy of the 'translations' table, for
+# get_page_histories*.py.
+#
+# The translations table maps (source language, word) to an English
+# translation.  It has millions of rows, and loading all of it into a
+# dictionary at the start of every session took minutes and a lot of
+# memory, per process.  Instead, the table is copied once into an
+# SQLite database on local disk (a B-tree keyed on (lang, word), which
+# SQLite memory-maps), and each session looks words up there as it
+# needs them.  Opening the cache is effectively instantaneous, and any
+# number of processes on the same machine can share it, and its pages,
+# concurrently.  New translations are appended to the cache as they
+# are recorded in the translations table.
+#
+# The cache remembers which database it was copied from, and that
+# database's count of rows ever inserted into (or updated in) the
+# translations table at the time, plus the rows appended since.  This
+# count comes from the statistics collector, so checking it costs
+# nothing, unlike counting the table.  If it has moved on by the start
+# of a later session (because translations were recorded on another
+# host, or by a session using a different cache file), the cache is
+# brought up to date before use; see TranslationCache.sync.
+#
+# All writes go through a single thread per process, with its own
+# connection, so that waiting for another process's write lock never
+# blocks the event loop.  Lookups use a separate, read-only
+# connection; in WAL mode, readers never wait for writers.
+
+import asyncio
+import concurrent.futures
+import sqlite3
+
+__all__ = ('TranslationCache',)
+
+# Default location of the cache file, relative to the current
+# directory (like google-translate-errors.log).
+DEFAULT_PATH = "translation-cache.sqlite"
+
+# How much of the cache file SQLite may map into memory.
+MMAP_SIZE = 1 << 32
+
+# Rows per transaction when populating the cache.
+POPULATE_BATCH = 10000
+
+@asyncio.coroutine
+def table_changes(cur):
+    """Return the number of rows ever inserted into or updated in the
+       translations table, according to the statistics collector, or
+       its row count if statistics are not being collected."""
+    yield from cur.execute("SELECT n_tup_ins + n_tup_upd"
+                           "  FROM pg_stat_user_tables"
+                           " WHERE relid = 'translations'::regclass")
+    row = yield from cur.fetchone()
+    if row is not None and row[0]:
+        return row[0]
+    yield from cur.execute("SELECT COUNT(*) FROM translations")
+    return (yield from cur.fetchone())[0]
+
+class LanguageTranslations:
+    """The translations for one source language.  This supports the
+       subset of the dict interface that GoogleTranslate uses (get, in,
+       indexing, assignment).  The results of lookups in the cache,
+       including misses, are memoized, and assignments only affect
+       this session; use TranslationCache.add to store translations
+       persistently."""
+
+    def __init__(self, cache, lang):
+        self._cache = cache
+        self._lang  = lang
+        self._memo  = {}
+
+    def get(self, word, default=None):
+        try:
+            engl = self._memo[word]
+        except KeyError:
+            engl = self._memo[word] = self._cache._lookup(self._lang, word)
+        if engl is None:
+            return default
+        return engl
+
+    def __contains__(self, word):
+        return self.get(word) is not None
+
+    def __getitem__(self, word):
+        engl = self.get(word)
+        if engl is None:
+            raise KeyError(word)
+        return engl
+
+    def __setitem__(self, word, engl):
+        self._memo[word] = engl
+
+class TranslationCache:
+    """On-disk (lang, word) -> English translation store.  Indexing
+       by language code produces a LanguageTranslations object.
+       Call the open coroutine before anything else."""
+
+    def __init__(self, path=DEFAULT_PATH, loop=None):
+        self.path    = path
+        self.loop    = loop or asyncio.get_event_loop()
+        self._writer = concurrent.futures.ThreadPoolExecutor(1)
+        self._wdb    = None
+        self._db     = None
+        self._langs  = {}
+
+    @asyncio.coroutine
+    def open(self):
+        yield from self._write(self._open_writer)
+        self._db = sqlite3.connect("file:{}?mode=ro".format(self.path),
+                                   uri=True, isolation_level=None)
+        self._db.execute("PRAGMA mmap_size = {}".format(MMAP_SIZE))
+
+    def close(self):
+        if self._wdb is not None:
+            self._writer.submit(self._wdb.close)
+        self._writer.shutdown()
+        if self._db is not None:
+            self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *dontcare):
+        self.close()
+        return False
+
+    def __getitem__(self, lang):
+        tr = self._langs.get(lang)
+        if tr is None:
+            tr = self._langs[lang] = LanguageTranslations(self, lang)
+        return tr
+
+    def _lookup(self, lang, word):
+        row = self._db.execute("SELECT engl FROM translations"
+                               " WHERE lang = ? AND word = ?",
+                               (lang, word)).fetchone()
+        return row[0] if row else None
+
+    def _meta(self, key):
+        row = self._db.execute("SELECT value FROM meta WHERE key = ?",
+                               (key,)).fetchone()
+        return row[0] if row else None
+
+    def source(self):
+        """Return the name of the database this cache was copied from,
+           and the change count of its translations table as of the
+           last sync (see sync), or (None, None) if the cache has
+           never been synced."""
+        changes = self._meta("changes")
+        return self._meta("dbname"), (int(changes) if changes is not None
+                                      else None)
+
+    @asyncio.coroutine
+    def sync(self, cur, dbname, status=None):
+        """Open the cache, and bring it up to date with the
+           translations table of DBNAME, using CUR, an aiopg cursor
+           connected to that database.  The caller must make sure
+           nothing else uses CUR meanwhile.  STATUS, if provided, is
+           called with progress messages, and done=True for the last.
+           Refuses to use a cache copied from a different database."""
+        yield from self.open()
+        cached_dbname, synced = self.source()
+        if cached_dbname is not None and cached_dbname != dbname:
+            raise RuntimeError(
+                "{}: translation cache is for database {}, not {}"
+                .format(self.path, cached_dbname, dbname))
+
+        # Read the change count first, so that rows added during the
+        # copy can only make it too low, which means another copy
+        # next time, never a missed row.
+        changes = yield from table_changes(cur)
+        if changes == synced:
+            return
+
+        # The table has no insertion order to resume from, so copy all
+        # of it again; rows already in the cache are overwritten.
+        yield from cur.execute("SELECT lang, word, engl FROM translations")
+        words = 0
+        while True:
+            block = yield from cur.fetchmany(POPULATE_BATCH)
+            if not block: break
+            yield from self.populate_batch(block)
+            words += len(block)
+            if status is not None:
+                status("populating translation cache... {} words"
+                       .format(words))
+
+        yield from self.mark_synced(dbname, changes)
+        if status is not None:
+            status("populating translation cache... {} words"
+                   .format(words), done=True)
+
+    @asyncio.coroutine
+    def populate_batch(self, rows):
+        """Copy a batch of (lang, word, engl) rows from the
+           translations table into the cache."""
+        yield from self._write(self._insert, rows, 0)
+
+    @asyncio.coroutine
+    def mark_synced(self, dbname, changes):
+        """Record that the cache now holds all of DBNAME's translations
+           table, as of change count CHANGES (see table_changes)."""
+        yield from self._write(self._set_source, dbname, changes)
+
+    @asyncio.coroutine
+    def add(self, lang, translations, recorded):
+        """Record TRANSLATIONS, a list of (word, engl) pairs for
+           language LANG, both persistently and in this session.
+           RECORDED is the number of them that were inserted into the
+           translations table."""
+        tr = self[lang]
+        for word, engl in translations:
+            tr[word] = engl
+        if translations:
+            yield from self._write(
+                self._insert,
+                [(lang, word, engl) for word, engl in translations],
+                recorded)
+
+    # Everything below runs on the writer thread.
+
+    @asyncio.coroutine
+    def _write(self, fn, *args):
+        return (yield from self.loop.run_in_executor(self._writer,
+                                                     fn, *args))
+
+    def _open_writer(self):
+        # isolation_level=None: transactions are managed explicitly.
+        self._wdb = sqlite3.connect(self.path, timeout=600,
+                                    isolation_level=None)
+        self._wdb.execute("PRAGMA journal_mode = WAL")
+        self._wdb.execute("PRAGMA synchronous = NORMAL")
+        self._wdb.execute("CREATE TABLE IF NOT EXISTS translations ("
+                          "  lang TEXT NOT NULL,"
+                          "  word TEXT NOT NULL,"
+                          "  engl TEXT NOT NULL,"
+                          "  PRIMARY KEY (lang, word)"
+                          ") WITHOUT ROWID")
+        self._wdb.execute("CREATE TABLE IF NOT EXISTS meta ("
+                          "  key   TEXT NOT NULL PRIMARY KEY,"
+                          "  value TEXT NOT NULL)")
+
+    def _insert(self, rows, recorded):
+        self._wdb.execute("BEGIN IMMEDIATE")
+        try:
+            self._wdb.executemany("INSERT OR REPLACE INTO translations"
+                                  " (lang, word, engl) VALUES (?, ?, ?)",
+                                  rows)
+            if recorded:
+                self._wdb.execute("UPDATE meta SET value = value + ?"
+                                  " WHERE key = 'changes'", (recorded,))
+            self._wdb.execute("COMMIT")
+        except:
+            self._wdb.execute("ROLLBACK")
+            raise
+
+    def _set_source(self, dbname, changes):
+        self._wdb.execute("BEGIN IMMEDIATE")
+        try:
+            self._wdb.executemany("INSERT OR REPLACE INTO meta (key, value)"
+                                  " VALUES (?, ?)",
+                                  [("dbname", dbname),
+                                   ("changes", changes)])
+            self._wdb.execute("COMMIT")
+        except:
+            self._wdb.execute("ROLLBACK")
+            raise
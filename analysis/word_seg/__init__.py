@@ -2,6 +2,8 @@ from collections import defaultdict
 import regex as re
 import unicodedata
 
+from . import charclasses
+
 __all__ = ('segment', 'presegment', 'is_nonword', 'is_url')
 
 def get_url_re():
@@ -169,6 +171,11 @@ def get_url_re():
     """
     return re.compile(url_re, re.VERBOSE|re.IGNORECASE)
 
+# Maximum number of Stanford segmenter processes (each one a JVM) to
+# run per language, per process.  Extra processes are started only for
+# large documents.
+STANFORD_POOL_SIZE = 2
+
 class Segmenter:
     """Segmenter is a singleton object which does lazy initialization of
        the various external segmenters, some of which are quite
@@ -178,38 +185,10 @@ class Segmenter:
     """
 
     def __init__(self):
-        symbols_s = []
-        symbols_t = []
-        digits    = []
-        white     = []
-        for c in range(0x10FFFF):
-            x = chr(c)
-            cat = unicodedata.category(x)
-            if cat[0] in ('P', 'S'): # Punctuation, Symbols
-                # These symbol characters may appear inside a word without
-                # breaking it in two.  FIXME: Any others?
-                split = (x not in ('-', '‐', '\'', '’', '.'))
-
-                # These characters need to be escaped inside a character class.
-                if (x in '\\', '[', ']', '-'):
-                    x = '\\' + x
-
-                symbols_t.append(x)
-                if split:
-                    symbols_s.append(x)
-
-            elif cat[0] == 'N':
-                digits.append(x)
-
-            # Treat all C0 and C1 controls the same as whitespace.
-            # (\t\r\n\v\f are *not* in class Z.)
-            elif cat[0] == 'Z' or cat in ('Cc', 'Cf'):
-                white.append(x)
-
-        symbols_s = "".join(symbols_s)
-        symbols_t = "".join(symbols_t)
-        digits    = "".join(digits)
-        white     = "".join(white)
+        symbols_s = charclasses.char_class('symbols_s')
+        symbols_t = charclasses.char_class('symbols_t')
+        digits    = charclasses.char_class('digits')
+        white     = charclasses.char_class('white')
 
         self.white      = re.compile("["  +             white +          "]+")
         self.split      = re.compile("["  + symbols_s + white +          "]+")
@@ -286,6 +265,35 @@ class Segmenter:
                         for lw in language_seg(w):
                             yield unicodedata.normalize('NFKC', lw).casefold()
 
+    def _presegment_batched(self, text, language_seg_many):
+        """Like _presegment_internal, but LANGUAGE_SEG_MANY is called
+           just once, with a list of all the words that survive
+           presegmentation, and must return a list of lists of
+           segmented words, one for each.  This is for segmenters
+           where each call involves a round trip to another process.
+        """
+        urls  = {}
+        words = []
+        for word in self.white.split(text):
+            u = self.is_url(word)
+            if u:
+                urls[len(words)] = u
+                words.append(None)
+            else:
+                for w in self.split.split(word):
+                    w = self.left_trim.sub("", w)
+                    if w:
+                        words.append(self.right_trim.sub("", w))
+
+        segmented = iter(language_seg_many([w for w in words
+                                            if w is not None]))
+        for i, w in enumerate(words):
+            if w is None:
+                yield urls[i]
+            else:
+                for lw in next(segmented):
+                    yield unicodedata.normalize('NFKC', lw).casefold()
+
     def _lang_segment_default(self, text):
         """The default behavior is just to do presegmentation."""
         return self._presegment_internal(text, lambda word: (word,))
@@ -312,17 +320,17 @@ class Segmenter:
     def _lang_segment_zh(self, text):
         if self.s_chinese is None:
             from . import stanford
-            self.s_chinese = stanford.ChineseSegmenter()
-        return self._presegment_internal(
-            text, lambda word: self.s_chinese.segment(word))
+            self.s_chinese = stanford.SegmenterPool(
+                stanford.ChineseSegmenter, STANFORD_POOL_SIZE)
+        return self._presegment_batched(text, self.s_chinese.segment_many)
 
     # Arabic and related languages: SNLP + heuristics
     def _lang_segment_ar(self, text):
         if self.s_arabic is None:
             from . import stanford
-            self.s_arabic = stanford.ArabicSegmenter()
-        return self._presegment_internal(
-            text, lambda word: self.s_arabic.segment(word))
+            self.s_arabic = stanford.SegmenterPool(
+                stanford.ArabicSegmenter, STANFORD_POOL_SIZE)
+        return self._presegment_batched(text, self.s_arabic.segment_many)
 
     # Vietnamese: dongdu
     # In Vietnamese, spaces appear _within_ every multisyllabic word.
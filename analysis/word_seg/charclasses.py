@@ -0,0 +1,211 @@
+# Character classes for the word segmenters, as compact lists of
+# code point ranges, cached on disk.
+#
+# Several of the segmenters need regular-expression character classes
+# defined by Unicode properties that neither 're' nor 'regex' can
+# express directly in the way we want (e.g. "punctuation and symbols,
+# except for these five", or "word characters in the Arabic blocks").
+# Computing them means scanning all of Unicode, which takes seconds;
+# that used to happen in every process that did any segmentation.
+#
+# Instead, each class is computed once per version of the Unicode
+# database and saved, as a list of [first, last] code point ranges, in
+# charclasses-<unidata_version>.json in this directory (or in
+# $WORD_SEG_CACHE_DIR, if set).  A class with thousands of members
+# typically collapses to a few hundred ranges, which also makes the
+# compiled regexes much smaller.
+#
+# Running this module as a script precomputes all the classes.
+
+import json
+import os
+import re
+import unicodedata
+
+__all__ = ('get_classes', 'char_class', 'clear_cache')
+
+PKGDIR = os.path.dirname(os.path.abspath(__file__))
+
+# One past the largest code point scanned.  (The original scans used
+# range(0x10FFFF); U+10FFFF is a noncharacter, so it makes no
+# difference to any of the classes.)
+_LIMIT = 0x10FFFF
+
+def _cache_path():
+    return os.path.join(os.environ.get("WORD_SEG_CACHE_DIR", PKGDIR),
+                        "charclasses-{}.json"
+                        .format(unicodedata.unidata_version))
+
+def _compress(codepoints):
+    """Convert an ascending iterable of code points to a list of
+       [first, last] ranges."""
+    ranges = []
+    for c in codepoints:
+        if ranges and ranges[-1][1] == c - 1:
+            ranges[-1][1] = c
+        else:
+            ranges.append([c, c])
+    return ranges
+
+def _word_chars():
+    """All code points matched by \\w in the standard 're' module,
+       in ascending order.  Scanning one big string with finditer is
+       much faster than matching each character separately."""
+    everything = "".join(map(chr, range(_LIMIT)))
+    for m in re.finditer(r"\w+", everything):
+        yield from range(m.start(), m.end())
+
+# Code point blocks that the Stanford segmenters' presegmentation
+# heuristics treat specially.  Incoming text is already NFKC so we
+# shouldn't have to worry about combining marks outside these ranges
+# (and maybe not the presentation forms either, but let's be cautious).
+_ARABIC_BLOCKS = (
+    (0x000600, 0x0006FF),
+    (0x000750, 0x00077F),
+    (0x0008A0, 0x0008FF),
+    (0x00FB50, 0x00FDFF),
+    (0x00FE70, 0x00FEFF),
+    (0x010E60, 0x010E7F),
+    (0x01EE00, 0x01EEFF),
+)
+_CHINESE_BLOCKS = (
+    (0x002E80, 0x002EFF), # CJK Radicals Suppl.
+    (0x002F00, 0x002FDF), # Kangxi Radicals
+    (0x003000, 0x00303F), # CJK Symbols and Punct.
+    (0x003200, 0x004DBF), # CJK Compat/ExtA
+    (0x004E00, 0x009FFF), # CJK Unified
+    (0x00F900, 0x00FAFF), # CJK Compat
+    (0x020000, 0x02FFFF), # SIP
+)
+
+def _in_blocks(c, blocks):
+    return any(lo <= c <= hi for lo, hi in blocks)
+
+def _compute():
+    symbols_s = []
+    symbols_t = []
+    digits    = []
+    white     = []
+    for c in range(_LIMIT):
+        cat = unicodedata.category(chr(c))
+        if cat[0] in ('P', 'S'): # Punctuation, Symbols
+            symbols_t.append(c)
+            # These symbol characters may appear inside a word without
+            # breaking it in two.  FIXME: Any others?
+            if chr(c) not in ('-', '‐', '\'', '’', '.'):
+                symbols_s.append(c)
+
+        elif cat[0] == 'N':
+            digits.append(c)
+
+        # Treat all C0 and C1 controls the same as whitespace.
+        # (\t\r\n\v\f are *not* in class Z.)
+        elif cat[0] == 'Z' or cat in ('Cc', 'Cf'):
+            white.append(c)
+
+    arabic      = []
+    not_arabic  = []
+    chinese     = []
+    not_chinese = []
+    for c in _word_chars():
+        (arabic if _in_blocks(c, _ARABIC_BLOCKS) else not_arabic).append(c)
+        (chinese if _in_blocks(c, _CHINESE_BLOCKS) else not_chinese).append(c)
+
+    return {
+        'symbols_s':   _compress(symbols_s),
+        'symbols_t':   _compress(symbols_t),
+        'digits':      _compress(digits),
+        'white':       _compress(white),
+        'arabic':      _compress(arabic),
+        'not_arabic':  _compress(not_arabic),
+        'chinese':     _compress(chinese),
+        'not_chinese': _compress(not_chinese),
+    }
+
+_classes = None
+
+def get_classes():
+    """Return a dictionary mapping class names to lists of [first, last]
+       code point ranges.  The classes are:
+
+           symbols_t   - punctuation and symbols (categories P*, S*)
+           symbols_s   - symbols_t, less the characters that may
+                         appear inside a word (hyphens, apostrophes,
+                         and the full stop)
+           digits      - numbers (categories N*)
+           white       - separators and control characters
+                         (categories Z*, Cc, Cf)
+           arabic      - \\w characters in the Arabic blocks
+           not_arabic  - all other \\w characters
+           chinese     - \\w characters in the CJK blocks
+           not_chinese - all other \\w characters
+
+       The result is loaded from the on-disk cache if possible;
+       otherwise it is computed and the cache is written (failure to
+       write the cache is not an error).
+    """
+    global _classes
+    if _classes is not None:
+        return _classes
+
+    path = _cache_path()
+    try:
+        with open(path) as f:
+            data = json.load(f)
+        if data.get("unidata_version") == unicodedata.unidata_version:
+            _classes = data["classes"]
+            return _classes
+    except (OSError, ValueError, KeyError):
+        pass
+
+    _classes = _compute()
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    try:
+        with open(tmp, "w") as f:
+            json.dump({ "unidata_version": unicodedata.unidata_version,
+                        "classes": _classes }, f, separators=(',', ':'))
+        os.replace(tmp, path)
+    except OSError:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+
+    return _classes
+
+def clear_cache():
+    """Forget the classes loaded by this process and remove the on-disk
+       cache for the current Unicode version."""
+    global _classes
+    _classes = None
+    try:
+        os.unlink(_cache_path())
+    except FileNotFoundError:
+        pass
+
+def _escape(c):
+    if c <= 0xFFFF:
+        return "\\u{:04X}".format(c)
+    return "\\U{:08X}".format(c)
+
+def char_class(*names):
+    """Return the union of the named classes, as a string suitable for
+       use inside square brackets in a 're' or 'regex' pattern.  All
+       characters are written as escapes, so the result is safe to use
+       in verbose-mode patterns."""
+    classes = get_classes()
+    parts = []
+    for name in names:
+        for lo, hi in classes[name]:
+            if lo == hi:
+                parts.append(_escape(lo))
+            else:
+                parts.append(_escape(lo) + "-" + _escape(hi))
+    return "".join(parts)
+
+if __name__ == '__main__':
+    clear_cache()
+    for name, ranges in sorted(get_classes().items()):
+        print("{:<12} {:>6} ranges {:>8} code points".format(
+            name, len(ranges), sum(hi - lo + 1 for lo, hi in ranges)))
+    print("written to", _cache_path())
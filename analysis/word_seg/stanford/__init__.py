@@ -1,5 +1,6 @@
 # Arabic (and Farsi) segmentation based on Stanford NLP.
 
+import codecs
 import fcntl
 import os
 import re
@@ -8,6 +9,8 @@ import subprocess
 import unicodedata
 from collections import deque
 
+from .. import charclasses
+
 PKGDIR        = os.path.dirname(__file__)
 SEGMENTER_JAR = os.path.join(PKGDIR, "stanford-segmenter-3.5.2.jar")
 ARABIC_DATA   = os.path.join(PKGDIR, "arabic-segmenter-atb+bn+arztrain.ser.gz")
@@ -32,38 +35,6 @@ def _set_nonblocking(f):
     flags = fcntl.fcntl(f, fcntl.F_GETFL)
     fcntl.fcntl(f, fcntl.F_SETFL, (flags | os.O_NONBLOCK))
 
-def _read_all_available(f):
-    """Read all data currently available from F, which is a nonblocking
-       file descriptor (or a filelike object with a .fileno method).
-       If _no_ data is currently available, blocks until some is.
-       Only returns the empty string upon hitting EOF.
-    """
-    if not isinstance(f, int):
-        f = f.fileno()
-
-    poll = select.poll()
-    poll.register(f, select.POLLIN|select.POLLHUP)
-    events = poll.poll()
-    assert len(events) == 1
-    assert events[0][0] == f
-    if events[0][1] == select.POLLHUP:
-        raise subprocess.CalledProcessError("Stanford NLP segmenter has exited")
-
-    chunks = []
-    while True:
-        try:
-            c = os.read(f, PIPE_BUF)
-        except BlockingIOError:
-            break
-        if not c:
-            break
-        chunks.append(c)
-
-    if not chunks:
-        raise subprocess.CalledProcessError("Stanford NLP segmenter has exited")
-
-    return b"".join(chunks).decode("utf-8")
-
 def _write_many_chunks(f, q):
     """F is a nonblocking file descriptor for a pipe (or a filelike with a
        .fileno method, ditto).  Q is a deque.  Write as many items as
@@ -90,6 +61,99 @@ def _write_many_chunks(f, q):
     except BlockingIOError:
         return
 
+# Sentinel values used to frame requests.  These have to pass through
+# the segmenter proper unmolested, and also have to be something
+# extraordinarily unlikely to appear in the text itself.  U+FDD0 and
+# U+FDD1 are official permanent noncharacters.
+END_OF_REQUEST = "\uFDD0"
+END_OF_ITEM    = "\uFDD1"
+
+class _Exchange:
+    """One framed request in flight to one segmenter process.  The
+       request is a list of items; each item is a list of tokens,
+       which are written one per line and followed by END_OF_ITEM.
+       The whole request is followed by END_OF_REQUEST.  The response
+       is demultiplexed back into one list of words per item.
+    """
+    def __init__(self, proc, items):
+        self.wfd = proc.stdin.fileno()
+        self.rfd = proc.stdout.fileno()
+        self.to_write = deque()
+        for tokens in items:
+            self.to_write.extend(tokens)
+            self.to_write.append(END_OF_ITEM)
+        self.to_write.append(END_OF_REQUEST)
+
+        self.decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        self.partial = ""
+        self.current = []
+        self.results = []
+        self.done    = False
+
+    def write(self):
+        _write_many_chunks(self.wfd, self.to_write)
+
+    def read(self):
+        chunks = []
+        while True:
+            try:
+                c = os.read(self.rfd, PIPE_BUF)
+            except BlockingIOError:
+                break
+            if not c:
+                if not chunks:
+                    raise subprocess.SubprocessError(
+                        "Stanford NLP segmenter has exited")
+                break
+            chunks.append(c)
+
+        # Only complete lines can be processed; a read may end in the
+        # middle of a word, or even of a character.
+        text = self.partial + self.decoder.decode(b"".join(chunks))
+        lines = text.split("\n")
+        self.partial = lines.pop()
+        for line in lines:
+            for word in line.split():
+                if word == END_OF_ITEM:
+                    self.results.append(self.current)
+                    self.current = []
+                elif word == END_OF_REQUEST:
+                    self.done = True
+                    return
+                else:
+                    self.current.append(word)
+
+def _run_exchanges(exchanges):
+    """Drive all of EXCHANGES to completion concurrently, writing to
+       each process whenever it can accept input and reading from each
+       whenever it has output, so that no process has to wait for a
+       round trip before receiving its next token."""
+    poll = select.poll()
+    by_fd = {}
+    for x in exchanges:
+        by_fd[x.wfd] = x
+        by_fd[x.rfd] = x
+        poll.register(x.wfd, select.POLLOUT)
+        poll.register(x.rfd, select.POLLIN)
+
+    remaining = len(exchanges)
+    while remaining:
+        for fd, event in poll.poll():
+            x = by_fd[fd]
+            if fd == x.wfd:
+                if event & (select.POLLERR|select.POLLHUP):
+                    raise subprocess.SubprocessError(
+                        "Stanford NLP segmenter has exited")
+                x.write()
+                if not x.to_write:
+                    poll.unregister(fd)
+            else:
+                if event & (select.POLLIN|select.POLLHUP):
+                    x.read()
+                if x.done:
+                    poll.unregister(fd)
+                    remaining -= 1
+
 class Segmenter:
     def __init__(self):
         self._presegment_re = self._get_presegment_re()
@@ -108,34 +172,62 @@ class Segmenter:
         self._proc.terminate()
         self._proc.wait()
 
+    def _presegment(self, text):
+        return [piece
+                for token in self._presegment_re.finditer(text)
+                for piece in token.group(0).split()]
+
+    def segment_many(self, words):
+        """Segment each of WORDS (a list of strings).  Returns a list of
+           lists of words, one for each of WORDS.  This is done in a
+           single request to the segmenter process."""
+        x = _Exchange(self._proc, [self._presegment(w) for w in words])
+        _run_exchanges([x])
+        return x.results
+
     def segment(self, text):
-        presegmented = deque()
         if isinstance(text, str):
             text = [text]
-        for block in text:
-            for token in self._presegment_re.finditer(block):
-                presegmented.extend(token.group(0).split())
-
-        # Sentinel value to tell us when we're done with this block of
-        # text.  This has to pass through the segmenter proper
-        # unmolested, and also has to be something extraordinarily
-        # unlikely to appear in the text itself.  U+FDD0 is an
-        # official permanent noncharacter.
-        presegmented.append("\uFDD0")
-        while presegmented:
-            _write_many_chunks(self._proc.stdin, presegmented)
-            result = _read_all_available(self._proc.stdout)
-            for word in result.split():
-                if word == "\uFDD0":
-                    return
-                yield word
+        for words in self.segment_many(text):
+            yield from words
+
+class SegmenterPool:
+    """A small pool of segmenter processes of one type.  segment_many
+       splits large requests among the processes and runs them all at
+       once.  The processes are started lazily."""
+
+    # Don't bother splitting requests smaller than this.
+    MIN_SHARD = 256
+
+    def __init__(self, segmenter_class, size=2):
+        self._class = segmenter_class
+        self._size  = size
+        self._segmenters = []
+
+    def segment_many(self, words):
+        nshards = max(1, min(self._size, len(words) // self.MIN_SHARD))
+        while len(self._segmenters) < nshards:
+            self._segmenters.append(self._class())
+
+        shard_len = -(-len(words) // nshards)
+        exchanges = []
+        for i in range(nshards):
+            seg = self._segmenters[i]
+            shard = words[i*shard_len : (i+1)*shard_len]
+            exchanges.append(_Exchange(seg._proc,
+                                       [seg._presegment(w) for w in shard]))
+        _run_exchanges(exchanges)
+
+        results = []
+        for x in exchanges:
+            results.extend(x.results)
+        return results
 
-        while True:
-            result = _read_all_available(self._proc.stdout)
-            for word in result.split():
-                if word == "\uFDD0":
-                    return
-                yield word
+    def segment(self, text):
+        if isinstance(text, str):
+            text = [text]
+        for words in self.segment_many(text):
+            yield from words
 
 class ArabicSegmenter(Segmenter):
     SEGMENTER_INVOCATION = [
@@ -159,29 +251,8 @@ class ArabicSegmenter(Segmenter):
         if cls._PRESEGMENT_RE is None:
             # Partition the set of characters matched by \w into Arabic
             # and non-Arabic.
-            w = re.compile("\A\w\Z")
-            arabic = set()
-            not_arabic = set()
-            for x in range(0, 0x10FFFF):
-                c = chr(x)
-                if w.match(c):
-                    # Arabic Unicode blocks.  Incoming text is already
-                    # NFKC so we shouldn't have to worry about combining
-                    # marks outside these ranges (and maybe not the
-                    # presentation forms either, but let's be cautious)
-                    if (0x000600 <= x <= 0x0006FF or
-                        0x000750 <= x <= 0x00077F or
-                        0x0008A0 <= x <= 0x0008FF or
-                        0x00FB50 <= x <= 0x00FDFF or
-                        0x00FE70 <= x <= 0x00FEFF or
-                        0x010E60 <= x <= 0x010E7F or
-                        0x01EE00 <= x <= 0x01EEFF):
-                        arabic.add(c)
-                    else:
-                        not_arabic.add(c)
-
-            arabic     = "[" + "".join(sorted(arabic)) +     "]"
-            not_arabic = "[" + "".join(sorted(not_arabic)) + "]"
+            arabic     = "[" + charclasses.char_class('arabic') +     "]"
+            not_arabic = "[" + charclasses.char_class('not_arabic') + "]"
 
             cls._PRESEGMENT_RE = re.compile(r"""
                   \W+      # one or more nonword characters
@@ -233,27 +304,9 @@ class ChineseSegmenter(Segmenter):
         """
         if cls._PRESEGMENT_RE is None:
             # Partition the set of characters matched by \w into Chinese
-            # and non-Chinese
-            w = re.compile("\A\w\Z")
-            chinese = set()
-            not_chinese = set()
-            for x in range(0, 0x10FFFF):
-                c = chr(x)
-                if w.match(c):
-                    # Chinese Unicode blocks (approximately)
-                    if (0x002E80 <= x <= 0x002EFF or # CJK Radicals Suppl.
-                        0x002F00 <= x <= 0x002FDF or # Kangxi Radicals
-                        0x003000 <= x <= 0x00303F or # CJK Symbols and Punct.
-                        0x003200 <= x <= 0x004DBF or # CJK Compat/ExtA
-                        0x004E00 <= x <= 0x009FFF or # CJK Unified
-                        0x00F900 <= x <= 0x00FAFF or # CJK Compat
-                        0x020000 <= x <= 0x02FFFF):  # SIP
-                        chinese.add(c)
-                    else:
-                        not_chinese.add(c)
-
-            chinese     = "[" + "".join(sorted(chinese)) +     "]"
-            not_chinese = "[" + "".join(sorted(not_chinese)) + "]"
+            # and non-Chinese.
+            chinese     = "[" + charclasses.char_class('chinese') +     "]"
+            not_chinese = "[" + charclasses.char_class('not_chinese') + "]"
 
             cls._PRESEGMENT_RE = re.compile(r"""
                   \W{{1,512}}  # up to 512 nonword characters
@@ -0,0 +1,162 @@
+# Compiled fast path for shared.url_canon.  See url_canon.py for the
+# specification; this module must produce exactly the same results
+# (url_canon_test.py checks this).
+#
+# Only str inputs are handled here.  urllib.parse still does the
+# splitting, so that all of its quirks are preserved, but the
+# percent-encoding of each component is a byte loop, and the result
+# is assembled without going through urlunsplit in the common case.
+
+from cpython.mem cimport PyMem_Malloc, PyMem_Free
+
+import re
+from urllib.parse import urlsplit, urlunsplit
+
+cdef object _strict_slashes_re  = re.compile(r'(?i)^([a-z]+):///+')
+cdef object _lenient_slashes_re = re.compile(r'(?i)^([a-z]+):/+')
+
+cdef const char *HEXDIGITS = b"0123456789ABCDEF"
+
+cdef inline bint _is_hex(unsigned int c) nogil:
+    return ((c >= 0x30 and c <= 0x39) or     # 0-9
+            (c >= 0x41 and c <= 0x46) or     # A-F
+            (c >= 0x61 and c <= 0x66))       # a-f
+
+cdef inline bint _must_escape(unsigned int c) nogil:
+    return c <= 0x20 or c >= 0x7F
+
+# A '%' is left alone if it begins %XX or %uXXXX (X = hex digit).
+
+cdef bint _str_escape_ok(str s, Py_ssize_t i, Py_ssize_t n):
+    if i + 2 < n and _is_hex(s[i+1]) and _is_hex(s[i+2]):
+        return True
+    return (i + 5 < n and s[i+1] == u'u' and
+            _is_hex(s[i+2]) and _is_hex(s[i+3]) and
+            _is_hex(s[i+4]) and _is_hex(s[i+5]))
+
+cdef inline bint _bytes_escape_ok(const unsigned char *s, Py_ssize_t i,
+                                  Py_ssize_t n) nogil:
+    if i + 2 < n and _is_hex(s[i+1]) and _is_hex(s[i+2]):
+        return True
+    return (i + 5 < n and s[i+1] == 0x75 and
+            _is_hex(s[i+2]) and _is_hex(s[i+3]) and
+            _is_hex(s[i+4]) and _is_hex(s[i+5]))
+
+cpdef str encode_nonascii_and_percents(str segment):
+    """%-encode all bytes of the UTF-8 (with surrogate escapes)
+       encoding of SEGMENT that are outside the printable ASCII
+       range, and all improperly used % signs."""
+    cdef Py_ssize_t i, j, n = len(segment)
+    cdef Py_UCS4 c
+
+    # The overwhelmingly common case is a segment that needs no
+    # changes at all; detect that without encoding anything.
+    if segment.isascii():
+        for i in range(n):
+            c = segment[i]
+            if c <= 0x20 or c == 0x7F:
+                break
+            if c == u'%' and not _str_escape_ok(segment, i, n):
+                break
+        else:
+            return segment
+
+    cdef bytes raw = segment.encode("utf-8", "surrogateescape")
+    cdef const unsigned char *src = raw
+    cdef Py_ssize_t m = len(raw)
+    cdef unsigned char b
+    cdef char *dst = <char *>PyMem_Malloc(3 * m + 1)
+    if dst == NULL:
+        raise MemoryError
+    try:
+        j = 0
+        for i in range(m):
+            b = src[i]
+            if _must_escape(b) or (b == 0x25 and
+                                   not _bytes_escape_ok(src, i, m)):
+                dst[j]   = 0x25
+                dst[j+1] = HEXDIGITS[b >> 4]
+                dst[j+2] = HEXDIGITS[b & 0x0F]
+                j += 3
+            else:
+                dst[j] = b
+                j += 1
+        return dst[:j].decode("ascii")
+    finally:
+        PyMem_Free(dst)
+
+cpdef str canon_url_string(str url, bint lenient, object encode_host):
+    """Canonicalize URL, which must be a string, and return a string.
+       ENCODE_HOST is the function that converts the hostname to its
+       ASCII form."""
+    cdef str host, user, passwd, path, query, frag, netloc, scheme
+    cdef object exploded, port
+
+    exploded = urlsplit(url)
+    if not exploded.hostname:
+        # Remove extra slashes after the scheme and retry.
+        if lenient:
+            exploded = urlsplit(_lenient_slashes_re.sub(r'\1://', url))
+        else:
+            exploded = urlsplit(_strict_slashes_re.sub(r'\1://', url))
+
+    scheme = exploded.scheme
+    if lenient:
+        host = exploded.hostname or ""
+    else:
+        host = exploded.hostname
+        if not host:
+            raise ValueError("url with no host - " + repr(url))
+        if scheme != "http" and scheme != "https":
+            raise ValueError("url with non-http(s) scheme - " + repr(url))
+
+    user   = encode_nonascii_and_percents(exploded.username or "")
+    passwd = encode_nonascii_and_percents(exploded.password or "")
+    port   = exploded.port
+    path   = encode_nonascii_and_percents(exploded.path)
+    query  = encode_nonascii_and_percents(exploded.query)
+    frag   = encode_nonascii_and_percents(exploded.fragment)
+
+    if not path:
+        path = "/"
+
+    host = encode_host(host)
+
+    if port is None:
+        netloc = host
+    elif ((port == 80  and scheme == "http") or
+          (port == 443 and scheme == "https")):
+        netloc = host
+    else:
+        netloc = host + ":" + str(port)
+
+    if passwd:
+        netloc = user + ":" + passwd + "@" + netloc
+    elif user:
+        netloc = user + "@" + netloc
+
+    if not netloc or not scheme:
+        # Only possible in lenient mode; let urllib.parse deal with it.
+        return urlunsplit((scheme, netloc, path, query, frag))
+
+    if path[0] != u'/':
+        path = "/" + path
+    if query:
+        path = path + "?" + query
+    if frag:
+        path = path + "#" + frag
+    return scheme + "://" + netloc + path
+
+def canon_many(urls, bint lenient, object encode_host, object fallback):
+    """Canonicalize each of URLS; see url_canon.canon_many.  Items
+       that are not strings are passed to FALLBACK."""
+    cdef list out = []
+    for url in urls:
+        try:
+            if type(url) is str:
+                out.append(canon_url_string(url, lenient, encode_host))
+            else:
+                out.append(fallback(url))
+        except ValueError:
+            out.append(None)
+    return out
@@ -230,6 +230,12 @@ class BaseProxyManager:
     def label(self):
         return "{} ({})".format(self.loc, self.TYPE)
 
+    def host(self):
+        """Return a name for the machine that this proxy's traffic
+           emerges from.  Proxies with the same host share that
+           machine's bandwidth."""
+        return self.loc
+
     def close(self):
         """Client should call this method when it is completely done using
            this proxy."""
@@ -279,6 +285,9 @@ class DirectProxyManager(BaseProxyManager):
     def adjust_command(self, cmd):
         return cmd
 
+    def host(self):
+        return "localhost"
+
     @asyncio.coroutine
     def start(self, ns):
         sys.stderr.write(self.label() + ": online.\n")
@@ -370,6 +379,7 @@ class OpenVPNProxyManager(BaseProxyManager):
     def __init__(self, loop, loc, cfg, *args):
         BaseProxyManager.__init__(self, loop, loc)
         self._namespace    = None
+        self._openvpn_cfg  = None
         self._openvpn_args = args
         self._exit_f       = None
         self._ready_f      = None
@@ -390,6 +400,20 @@ class OpenVPNProxyManager(BaseProxyManager):
         cmd.insert(1, "ISOL_NETNS="+self._namespace)
         return cmd
 
+    def host(self):
+        """The first 'remote' of the configuration file in use (or
+           last used), or the location if that can't be determined."""
+        if self._openvpn_cfg is not None:
+            try:
+                with open(self._openvpn_cfg) as f:
+                    for line in f:
+                        w = line.split()
+                        if len(w) >= 2 and w[0] == "remote":
+                            return w[1]
+            except OSError:
+                pass
+        return self.loc
+
     def _become_online(self, fut):
         self.starting = False
 
@@ -447,6 +471,7 @@ class OpenVPNProxyManager(BaseProxyManager):
 
         cfg = self._openvpn_cfgs[0]
         self._openvpn_cfgs.rotate(-1)
+        self._openvpn_cfg = cfg
         command = [ "openvpn-netns", self._namespace, cfg ]
         command.extend(self._openvpn_args)
 
@@ -0,0 +1,278 @@
+# Analysis of scamper "tracelb" (multipath traceroute) results.
+#
+# Copyright © 2017 Zack Weinberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# There is NO WARRANTY.
+#
+# Warts files are decoded with sc_warts2text, whose output for each
+# trace is a header line followed by one line per path through the
+# multipath graph:
+#
+#     tracelb from 10.0.0.1 to 93.184.216.34, ...
+#     * -> 192.0.2.1 -> (198.51.100.1, 198.51.100.2) -> 93.184.216.34
+#
+# decode_warts() turns that into a list of Trace objects, each with
+# its hops in topological order (origin first), computed with Kahn's
+# algorithm in time linear in the size of the graph.  Addresses are
+# interned as integers (see ORIGIN, UNKNOWN_IP, and unknown_names
+# below), so traces are cheap to send between processes.
+# CountryResolver then maps whole batches of addresses to countries
+# with a sorted table of address ranges.
+
+import bisect
+import collections
+import csv
+import socket
+import subprocess
+
+__all__ = ('Trace', 'decode_warts', 'parse_tracelb_text', 'kahn_order',
+           'CountryResolver', 'country_path', 'addr_text',
+           'ORIGIN', 'UNKNOWN_IP')
+
+# Special hop ids.  Real addresses are IPv4 addresses as unsigned
+# integers.  Hop names that are neither addresses nor '*' get ids
+# below UNKNOWN_IP, and are treated as addresses whose location is
+# unknown.
+ORIGIN     = -1     # the vantage point (a leading '*')
+UNKNOWN_IP = -2     # '*', a hop that did not respond
+
+ORIGIN_NAME           = "<origin>"
+UNKNOWN_IP_NAME       = "[unknown IP]"
+UNKNOWN_LOCATION_NAME = "[unknown location]"
+
+# SOURCE and DEST are integers; HOPS is a list of hop ids, origin first.
+Trace = collections.namedtuple("Trace", ("source", "dest", "hops"))
+
+def addr_text(addr):
+    return socket.inet_ntoa(addr.to_bytes(4, "big"))
+
+def _addr_int(text):
+    return int.from_bytes(socket.inet_aton(text), "big")
+
+def kahn_order(succs, sort_key):
+    """SUCCS maps each node of a directed graph to the set of nodes it
+       has edges to.  Return the nodes in reverse topological order:
+       first all the nodes with no outgoing edges, sorted by SORT_KEY;
+       then all the nodes whose edges all lead to those, and so on.
+       Self-edges are ignored, and nodes on (or upstream of) a cycle
+       are left out."""
+    preds = collections.defaultdict(list)
+    n_out = {}
+    for node, targets in succs.items():
+        n_out.setdefault(node, 0)
+        for t in targets:
+            if t != node:
+                n_out[node] += 1
+                n_out.setdefault(t, 0)
+                preds[t].append(node)
+
+    order = []
+    level = [node for node, n in n_out.items() if n == 0]
+    while level:
+        if len(level) > 1:
+            level.sort(key=sort_key)
+        order.extend(level)
+        next_level = []
+        for node in level:
+            for p in preds.get(node, ()):
+                n_out[p] -= 1
+                if n_out[p] == 0:
+                    next_level.append(p)
+        level = next_level
+    return order
+
+class _TraceBuilder:
+    def __init__(self, source, dest):
+        self.source = source
+        self.dest = dest
+        self.succs = collections.defaultdict(set)
+        self.first_line = True
+        self.names = {}            # non-address hop name -> id
+        self.texts = {}            # id -> hop name, for sorting
+
+    def hop_id(self, name):
+        if name == '*':
+            return UNKNOWN_IP
+        try:
+            return _addr_int(name)
+        except OSError:
+            id = self.names.get(name)
+            if id is None:
+                id = self.names[name] = UNKNOWN_IP - 1 - len(self.names)
+                self.texts[id] = name
+            return id
+
+    def sort_key(self, id):
+        # Within a level, hops are ordered by their textual form, as
+        # sc_warts2text printed them.
+        if id >= 0:
+            return addr_text(id)
+        if id == ORIGIN:
+            return ORIGIN_NAME
+        if id == UNKNOWN_IP:
+            return '*'
+        return self.texts[id]
+
+    def add_line(self, line):
+        hops = line.strip().split(" -> ")
+        assert len(hops) >= 2
+
+        groups = []
+        for i, hop in enumerate(hops):
+            if hop[0] == '(':
+                names = hop[1:-1].split(", ")
+            else:
+                names = [hop]
+            if i == 0 and self.first_line and names == ['*']:
+                groups.append([ORIGIN])
+            else:
+                groups.append([self.hop_id(n) for n in names])
+        self.first_line = False
+
+        for f, t in zip(groups, groups[1:]):
+            for ff in f:
+                self.succs[ff].update(t)
+
+    def finish(self):
+        order = kahn_order(self.succs, self.sort_key)
+        order.reverse()
+        return Trace(self.source, self.dest, order)
+
+def parse_tracelb_text(lines):
+    """Parse the output of sc_warts2text (an iterable of bytes or str
+       lines) and return a list of Traces."""
+    traces = []
+    current = None
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode("ascii")
+        if line.startswith("tracelb from "):
+            if current is not None:
+                traces.append(current.finish())
+            words = line.split(None, 5)
+            # words: tracelb from SRC to DST, ...
+            current = _TraceBuilder(_addr_int(words[2]),
+                                    _addr_int(words[4].rstrip(",")))
+        else:
+            assert current is not None
+            current.add_line(line)
+    if current is not None:
+        traces.append(current.finish())
+    return traces
+
+def decode_warts(path, decoder="sc_warts2text"):
+    """Decode the warts file PATH and return a list of its Traces.
+       Suitable for use with multiprocessing.Pool.map."""
+    with subprocess.Popen([decoder, path],
+                          stdin  = subprocess.DEVNULL,
+                          stdout = subprocess.PIPE) as proc:
+        traces = parse_tracelb_text(proc.stdout)
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, [decoder, path])
+    return traces
+
+class CountryResolver:
+    """Map IPv4 addresses (as integers) to country names, with a
+       sorted table of address ranges.  The table is either loaded in
+       full from a GeoIP country CSV file (from_csv), or filled in
+       from a GeoIP database one network block at a time, as addresses
+       in new blocks are encountered (from_geoip).  Either way, most
+       lookups are a bisection of the table, or no search at all when
+       the addresses are processed in sorted order."""
+
+    def __init__(self, geoip=None):
+        self._starts = []
+        self._ends   = []
+        self._names  = []
+        self._gi     = geoip
+
+    @classmethod
+    def from_csv(cls, path):
+        """Load the legacy GeoIP country CSV format: start address,
+           end address, start number, end number, country code,
+           country name."""
+        self = cls()
+        with open(path, newline='', encoding='utf-8') as f:
+            rows = sorted((int(row[2]), int(row[3]), row[5])
+                          for row in csv.reader(f))
+        for start, end, name in rows:
+            self._starts.append(start)
+            self._ends.append(end)
+            self._names.append(name)
+        return self
+
+    @classmethod
+    def from_geoip(cls, path):
+        import GeoIP
+        return cls(GeoIP.open(path, GeoIP.GEOIP_STANDARD))
+
+    def _query(self, addr):
+        """Look up ADDR in the GeoIP database, and record the range of
+           addresses that share its record."""
+        text = addr_text(addr)
+        name = UNKNOWN_LOCATION_NAME
+        start = end = addr
+        try:
+            gir = self._gi.record_by_addr(text)
+            if gir and gir['country_name']:
+                name = gir['country_name']
+            rng = self._gi.range_by_ip(text)
+            if rng:
+                start, end = _addr_int(rng[0]), _addr_int(rng[1])
+                if not start <= addr <= end:
+                    start = end = addr
+        except Exception:
+            pass
+
+        i = bisect.bisect_left(self._starts, start)
+        self._starts.insert(i, start)
+        self._ends.insert(i, end)
+        self._names.insert(i, name)
+        return i
+
+    def resolve_many(self, addrs):
+        """Return a dictionary mapping each of ADDRS to a country name
+           (UNKNOWN_LOCATION_NAME if it is not known)."""
+        result = {}
+        i = -1
+        for addr in sorted(set(addrs)):
+            if not (0 <= i and self._starts[i] <= addr <= self._ends[i]):
+                i = bisect.bisect_right(self._starts, addr) - 1
+                if i < 0 or addr > self._ends[i]:
+                    if self._gi is None:
+                        result[addr] = UNKNOWN_LOCATION_NAME
+                        i = -1
+                        continue
+                    i = self._query(addr)
+            result[addr] = self._names[i]
+        return result
+
+def country_path(hops, countries):
+    """Convert HOPS, a list of hop ids, to a list of countries, with
+       consecutive duplicates removed, using COUNTRIES (as returned by
+       CountryResolver.resolve_many).  A leading origin, and a leading
+       "Anonymous Proxy" after that, are dropped."""
+    rv = []
+    prev = None
+    for h in hops:
+        if h >= 0:
+            c = countries[h]
+        elif h == ORIGIN:
+            c = ORIGIN_NAME
+        elif h == UNKNOWN_IP:
+            c = UNKNOWN_IP_NAME
+        else:
+            c = UNKNOWN_LOCATION_NAME
+        if c != prev:
+            rv.append(c)
+            prev = c
+
+    if rv and rv[0] == ORIGIN_NAME:
+        del rv[0]
+    if rv and rv[0] == 'Anonymous Proxy':
+        del rv[0]
+    return rv
@@ -0,0 +1,88 @@
+# Tests for shared.tracelb.  kahn_order must give the same order as
+# the toposort2 function it replaced (reproduced below), including its
+# treatment of self-edges and cycles.  Run from collector/lib:
+#
+#     python3 -m unittest shared.tracelb_test
+
+import functools
+import os
+import random
+import tempfile
+import unittest
+
+from shared import tracelb
+
+def toposort2(data):
+    # Ignore self dependencies.
+    for k, v in data.items():
+        v.discard(k)
+    # Find all items that don't depend on anything.
+    extra_items_in_deps = functools.reduce(set.union, data.values()) - set(data.keys())
+    # Add empty dependences where needed
+    data.update({item:set() for item in extra_items_in_deps})
+    while True:
+        ordered = set(item for item, dep in data.items() if not dep)
+        if not ordered:
+            break
+        for o in sorted(ordered): yield o
+        data = {item: (dep - ordered)
+                for item, dep in data.items()
+                    if item not in ordered}
+
+class TestKahnOrder(unittest.TestCase):
+    def test_random_graphs(self):
+        rng = random.Random(1)
+        for _ in range(2000):
+            n = rng.randrange(1, 15)
+            graph = {}
+            for _ in range(rng.randrange(1, 30)):
+                graph.setdefault(rng.randrange(n), set()).add(rng.randrange(n))
+            expected = list(toposort2({k: set(v) for k, v in graph.items()}))
+            self.assertEqual(tracelb.kahn_order(graph, lambda x: x),
+                             expected, msg=repr(graph))
+
+SAMPLE = b"""\
+tracelb from 192.168.1.1 to 10.0.0.9, 4 nodes, 4 links, 20 probes, 95%
+* -> 10.0.0.1 -> (10.0.0.2, 10.1.0.3) -> 10.0.0.9
+10.0.0.1 -> * -> 10.0.0.9
+tracelb from 192.168.1.1 to 10.2.0.1, 2 nodes, 1 links, 5 probes, 95%
+* -> 10.2.0.1
+"""
+
+class TestParse(unittest.TestCase):
+    def test_sample(self):
+        a = tracelb._addr_int
+        traces = tracelb.parse_tracelb_text(SAMPLE.splitlines(True))
+        self.assertEqual(len(traces), 2)
+        t = traces[0]
+        self.assertEqual((t.source, t.dest), (a("192.168.1.1"), a("10.0.0.9")))
+        # Within each level, hops are sorted by their text, and then the
+        # whole order is reversed.
+        self.assertEqual(t.hops, [tracelb.ORIGIN, a("10.0.0.1"),
+                                  a("10.1.0.3"), a("10.0.0.2"),
+                                  tracelb.UNKNOWN_IP, a("10.0.0.9")])
+        self.assertEqual(traces[1].hops, [tracelb.ORIGIN, a("10.2.0.1")])
+
+    def test_country_path(self):
+        with tempfile.NamedTemporaryFile("wt", suffix=".csv",
+                                         delete=False) as f:
+            f.write('"10.0.0.0","10.0.255.255","167772160","167837695",'
+                    '"AA","Aland"\n'
+                    '"10.1.0.0","10.1.255.255","167837696","167903231",'
+                    '"BB","Borduria"\n')
+        try:
+            resolver = tracelb.CountryResolver.from_csv(f.name)
+        finally:
+            os.unlink(f.name)
+
+        t = tracelb.parse_tracelb_text(SAMPLE.splitlines(True))[0]
+        countries = resolver.resolve_many(h for h in t.hops if h >= 0)
+        self.assertEqual(tracelb.country_path(t.hops, countries),
+                         ["Aland", "Borduria", "Aland", "[unknown IP]",
+                          "Aland"])
+        self.assertEqual(resolver.resolve_many([tracelb._addr_int("9.9.9.9")]),
+                         { tracelb._addr_int("9.9.9.9"):
+                           tracelb.UNKNOWN_LOCATION_NAME })
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,181 @@
+# Syntactic canonicalization of URLs.
+#
+# Copyright © 2014–2017 Zack Weinberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# There is NO WARRANTY.
+#
+# This is the one implementation of canon_url_syntax; everything that
+# needs it should import it from here (or from shared.util).  If the
+# _url_canon extension module has been built ("make" in this
+# directory), string URLs are processed by compiled code; otherwise
+# the pure-Python implementation below is used.  Both produce the same
+# results.  Hostname-to-ASCII conversions are memoized, since most
+# URL lists contain many URLs on the same few hosts.
+
+import functools
+import re
+import urllib.parse
+
+__all__ = ('canon_url_syntax', 'canon_many')
+
+# Number of distinct hostnames whose ASCII forms are remembered.
+HOST_CACHE_SIZE = 1 << 16
+
+def _urlsplit_forced_encoding(url):
+    try:
+        return urllib.parse.urlsplit(url)
+    except UnicodeDecodeError:
+        return urllib.parse.urlsplit(url.decode("utf-8", "surrogateescape"))
+
+_enap_re = re.compile(br'[\x00-\x20\x7F-\xFF]|'
+                      br'%(?!(?:[0-9A-Fa-f]{2}|u[0-9A-Fa-f]{4}))')
+def _py_encode_nonascii_and_percents(segment):
+    segment = segment.encode("utf-8", "surrogateescape")
+    return _enap_re.sub(
+        lambda m: "%{:02X}".format(ord(m.group(0))).encode("ascii"),
+        segment).decode("ascii")
+
+# Exceptions are not cached by lru_cache, so an invalid hostname
+# raises UnicodeError every time it is seen, as it should.
+
+@functools.lru_cache(maxsize=HOST_CACHE_SIZE)
+def _encode_host(host):
+    # We do this even if there are no non-ASCII characters, because it
+    # has the side-effect of throwing a UnicodeError if the hostname
+    # is syntactically invalid (e.g. "foo..com").
+    return host.encode("idna").decode("ascii")
+
+@functools.lru_cache(maxsize=HOST_CACHE_SIZE)
+def _encode_host_lenient(host):
+    # The split-join is to avoid barfing on syntactically invalid
+    # hostnames (e.g. "foo..com").  encode('idna') is idempotent.
+    return ".".join((label.encode("idna").decode("ascii") if label else "")
+                    for label in host.split("."))
+
+try:
+    from shared import _url_canon
+    _encode_nonascii_and_percents = _url_canon.encode_nonascii_and_percents
+except ImportError:
+    _url_canon = None
+    _encode_nonascii_and_percents = _py_encode_nonascii_and_percents
+
+def _py_canon_url_syntax(url, want_splitresult, lenient):
+    if isinstance(url, urllib.parse.SplitResult):
+        if want_splitresult is None: want_splitresult = True
+        exploded = url
+
+    else:
+        if want_splitresult is None: want_splitresult = False
+
+        exploded = _urlsplit_forced_encoding(url)
+        if not exploded.hostname:
+            # Remove extra slashes after the scheme and retry.
+            if lenient:
+                corrected = re.sub(r'(?i)^([a-z]+):/+', r'\1://', url)
+            else:
+                corrected = re.sub(r'(?i)^([a-z]+):///+', r'\1://', url)
+            exploded = _urlsplit_forced_encoding(corrected)
+
+    scheme = exploded.scheme
+    if lenient:
+        host = exploded.hostname or ""
+    else:
+        if not exploded.hostname:
+            raise ValueError("url with no host - " + repr(url))
+        if scheme != "http" and scheme != "https":
+            raise ValueError("url with non-http(s) scheme - " + repr(url))
+        host = exploded.hostname
+
+    user   = _encode_nonascii_and_percents(exploded.username or "")
+    passwd = _encode_nonascii_and_percents(exploded.password or "")
+    port   = exploded.port
+    path   = _encode_nonascii_and_percents(exploded.path)
+    query  = _encode_nonascii_and_percents(exploded.query)
+    frag   = _encode_nonascii_and_percents(exploded.fragment)
+
+    if path == "":
+        path = "/"
+
+    if lenient:
+        host = _encode_host_lenient(host)
+    else:
+        host = _encode_host(host)
+
+    if port is None:
+        port = ""
+    elif ((port == 80  and scheme == "http") or
+          (port == 443 and scheme == "https")):
+        port = ""
+    else:
+        port = ":{}".format(port)
+
+    # We don't have to worry about ':' or '@' in the user and password
+    # strings, because urllib.parse does not do %-decoding on them.
+    if user == "" and passwd == "":
+        auth = ""
+    elif passwd == "":
+        auth = "{}@".format(user)
+    else:
+        auth = "{}:{}@".format(user, passwd)
+    netloc = auth + host + port
+
+    result = urllib.parse.SplitResult(scheme, netloc, path, query, frag)
+    if want_splitresult:
+        return result
+    else:
+        return result.geturl()
+
+def canon_url_syntax(url, *, want_splitresult=None, lenient=False):
+    """Syntactically canonicalize a URL.  This makes the following
+       transformations:
+         - scheme and hostname are lowercased
+         - hostname is punycoded if necessary
+         - vacuous user, password, and port fields are stripped
+         - ports redundant to the scheme are also stripped
+         - path becomes '/' if empty
+         - characters outside the printable ASCII range in path,
+           query, fragment, user, and password are %-encoded, as are
+           improperly used % signs
+
+       You can provide either a string or a SplitResult, and you get
+       back what you put in.  You can set the optional argument
+       want_splitresult to True or False to force a particular
+       type of output.
+
+       Normally, URLs with no hostname, or a scheme other than http
+       or https, are rejected with a ValueError, as are syntactically
+       invalid hostnames (UnicodeError).  With lenient=True, all of
+       these are tolerated, and any number of slashes after the
+       scheme is accepted (e.g. "http:/host.dom.ain", "itmss://whatever",
+       "http://foo..com/").
+    """
+    if (_url_canon is not None and type(url) is str
+        and not want_splitresult):
+        return _url_canon.canon_url_string(
+            url, lenient, _encode_host_lenient if lenient else _encode_host)
+    return _py_canon_url_syntax(url, want_splitresult, lenient)
+
+def canon_many(urls, *, lenient=False):
+    """Canonicalize each of URLS, an iterable of strings, and return
+       a list of the results, in the same order.  URLs that cannot be
+       canonicalized produce None rather than an exception; use
+       canon_url_syntax on them individually to find out why.
+       This is considerably faster than calling canon_url_syntax in
+       a loop."""
+    encode_host = _encode_host_lenient if lenient else _encode_host
+    fallback = functools.partial(_py_canon_url_syntax,
+                                 want_splitresult=False, lenient=lenient)
+    if _url_canon is not None:
+        return _url_canon.canon_many(urls, lenient, encode_host, fallback)
+
+    out = []
+    for url in urls:
+        try:
+            out.append(fallback(url))
+        except ValueError:
+            out.append(None)
+    return out
@@ -0,0 +1,292 @@
+# Differential test: shared.url_canon must produce exactly the same
+# results as the implementations of canon_url_syntax it replaced,
+# which are reproduced verbatim below.  Run from collector/lib:
+#
+#     python3 -m unittest shared.url_canon_test
+#
+# The synthetic corpus has a million URLs by default; set
+# URL_CANON_TEST_N to change that.  If the _url_canon extension has
+# been built, both it and the pure-Python fallback are tested.
+
+import os
+import random
+import re
+import unittest
+import urllib.parse
+
+from shared import url_canon
+
+CORPUS_SIZE = int(os.environ.get("URL_CANON_TEST_N", 1000000))
+
+# --- The original implementations ---
+
+def _urlsplit_forced_encoding(url):
+    try:
+        return urllib.parse.urlsplit(url)
+    except UnicodeDecodeError:
+        return urllib.parse.urlsplit(url.decode("utf-8", "surrogateescape"))
+
+_enap_re = re.compile(br'[\x00-\x20\x7F-\xFF]|'
+                      br'%(?!(?:[0-9A-Fa-f]{2}|u[0-9A-Fa-f]{4}))')
+def _encode_nonascii_and_percents(segment):
+    segment = segment.encode("utf-8", "surrogateescape")
+    return _enap_re.sub(
+        lambda m: "%{:02X}".format(ord(m.group(0))).encode("ascii"),
+        segment).decode("ascii")
+
+def reference_canon_url_syntax(url, *, want_splitresult=None):
+    if isinstance(url, urllib.parse.SplitResult):
+        if want_splitresult is None: want_splitresult = True
+        exploded = url
+
+    else:
+        if want_splitresult is None: want_splitresult = False
+
+        exploded = _urlsplit_forced_encoding(url)
+        if not exploded.hostname:
+            # Remove extra slashes after the scheme and retry.
+            corrected = re.sub(r'(?i)^([a-z]+):///+', r'\1://', url)
+            exploded = _urlsplit_forced_encoding(corrected)
+
+    if not exploded.hostname:
+        raise ValueError("url with no host - " + repr(url))
+
+    scheme = exploded.scheme
+    if scheme != "http" and scheme != "https":
+        raise ValueError("url with non-http(s) scheme - " + repr(url))
+
+    host   = exploded.hostname
+    user   = _encode_nonascii_and_percents(exploded.username or "")
+    passwd = _encode_nonascii_and_percents(exploded.password or "")
+    port   = exploded.port
+    path   = _encode_nonascii_and_percents(exploded.path)
+    query  = _encode_nonascii_and_percents(exploded.query)
+    frag   = _encode_nonascii_and_percents(exploded.fragment)
+
+    if path == "":
+        path = "/"
+
+    host = host.encode("idna").decode("ascii")
+
+    if port is None:
+        port = ""
+    elif ((port == 80  and scheme == "http") or
+          (port == 443 and scheme == "https")):
+        port = ""
+    else:
+        port = ":{}".format(port)
+
+    if user == "" and passwd == "":
+        auth = ""
+    elif passwd == "":
+        auth = "{}@".format(user)
+    else:
+        auth = "{}:{}@".format(user, passwd)
+    netloc = auth + host + port
+
+    result = urllib.parse.SplitResult(scheme, netloc, path, query, frag)
+    if want_splitresult:
+        return result
+    else:
+        return result.geturl()
+
+# The version from import-batch.py and import_common_crawl.py.
+def reference_canon_url_syntax_lenient(url, *, want_splitresult=None):
+    if isinstance(url, urllib.parse.SplitResult):
+        if want_splitresult is None: want_splitresult = True
+        exploded = url
+
+    else:
+        if want_splitresult is None: want_splitresult = False
+
+        exploded = _urlsplit_forced_encoding(url)
+        if not exploded.hostname:
+            # Canonicalize the number of slashes after the scheme and retry.
+            corrected = re.sub(r'(?i)^([a-z]+):/+', r'\1://', url)
+            exploded = _urlsplit_forced_encoding(corrected)
+
+    scheme = exploded.scheme
+
+    host   = exploded.hostname or ""
+    user   = _encode_nonascii_and_percents(exploded.username or "")
+    passwd = _encode_nonascii_and_percents(exploded.password or "")
+    port   = exploded.port
+    path   = _encode_nonascii_and_percents(exploded.path or "/")
+    query  = _encode_nonascii_and_percents(exploded.query)
+    frag   = _encode_nonascii_and_percents(exploded.fragment)
+
+    host = ".".join((label.encode("idna").decode("ascii") if label else "")
+                    for label in host.split("."))
+
+    if port is None:
+        port = ""
+    elif ((port == 80  and scheme == "http") or
+          (port == 443 and scheme == "https")):
+        port = ""
+    else:
+        port = ":{}".format(port)
+
+    if user == "" and passwd == "":
+        auth = ""
+    elif passwd == "":
+        auth = "{}@".format(user)
+    else:
+        auth = "{}:{}@".format(user, passwd)
+    netloc = auth + host + port
+
+    result = urllib.parse.SplitResult(scheme, netloc, path, query, frag)
+    if want_splitresult:
+        return result
+    else:
+        return result.geturl()
+
+# --- Synthetic corpus ---
+
+SCHEMES = ["http", "https", "HTTP", "Https", "ftp", "itmss", "mailto", ""]
+SEPARATORS = ["://", "://", "://", ":", ":/", ":///", ":////", "//"]
+USERINFO = ["", "", "", "", "user@", "user:pw@", ":pw@", "user:@",
+            "us%er@", "üser:päss@", "a b:c@"]
+HOSTS = ["example.com", "www.example.com", "WWW.Example.COM",
+         "example.com.", "bücher.de", "例え.テスト",
+         "xn--bcher-kva.de", "foo..com", ".foo.com", "", "127.0.0.1",
+         "[::1]", "[2001:db8::1]", "[bad", "a" * 63 + ".com",
+         "a" * 64 + ".com", "com." + "b" * 64, "сайт.рф",
+         "ex%41mple.com", "exa mple.com", "ｅxample.com"]
+PORTS = ["", "", "", ":80", ":443", ":8080", ":", ":0", ":65535",
+         ":65536", ":abc", ":-1"]
+PLAIN_CHARS = list("abcdefxyzABCXYZ0123456789-._~/=&;+,!$'()*@:")
+SEGMENT_CHARS = (PLAIN_CHARS
+                 + ["%", "%4", "%41", "%4g", "%u12", "%u12AB", "%uabcz",
+                    "%%", " ", "\t", "\n", "\x00", "\x1f", "\x7f", "\x80",
+                    "é", "☃", "\U0001F600", "\udc80", "\udcff",
+                    "#", "?", "[", "]", "\\", "^"])
+
+def random_segment(rng, maxlen):
+    n = rng.randrange(maxlen + 1)
+    if rng.random() < 0.7:
+        return "".join(rng.choice(PLAIN_CHARS) for _ in range(n))
+    return "".join(rng.choice(SEGMENT_CHARS) for _ in range(n))
+
+def random_host(rng, p_listed):
+    if rng.random() < p_listed:
+        return rng.choice(HOSTS)
+    labels = []
+    for _ in range(rng.randrange(1, 4)):
+        labels.append("".join(rng.choice("abcdexyz0189-é")
+                              for _ in range(rng.randrange(1, 12))))
+    labels.append(rng.choice(("com", "org", "de", "рф")))
+    return ".".join(labels)
+
+def random_url(rng):
+    if rng.random() < 0.7:
+        # Most URLs in real lists are unremarkable.
+        url = (rng.choice(("http", "https")) + "://" +
+               random_host(rng, 0.1) + rng.choice(("", "", "", ":8080")))
+    else:
+        url = (rng.choice(SCHEMES) + rng.choice(SEPARATORS) +
+               rng.choice(USERINFO) + random_host(rng, 0.8) +
+               rng.choice(PORTS))
+    r = rng.random()
+    if r < 0.8:
+        url += "/" + random_segment(rng, 30)
+    elif r < 0.9:
+        url += random_segment(rng, 10)
+    if rng.random() < 0.3:
+        url += "?" + random_segment(rng, 20)
+    if rng.random() < 0.1:
+        url += "#" + random_segment(rng, 10)
+    if rng.random() < 0.05:
+        url = " " + url + "\r\n"
+    return url
+
+def synthetic_corpus(n, seed=20171018):
+    rng = random.Random(seed)
+    return [random_url(rng) for _ in range(n)]
+
+def outcome(fn, url, **kwargs):
+    try:
+        return fn(url, **kwargs)
+    except Exception as e:
+        return (type(e), str(e))
+
+# --- Tests ---
+
+class CanonTestBase:
+    # Shared by all the test classes, since they are expensive to
+    # compute: the corpus, and the reference results for it.
+    corpus = None
+    expected = {}
+
+    @classmethod
+    def setUpClass(cls):
+        if CanonTestBase.corpus is None:
+            CanonTestBase.corpus = synthetic_corpus(CORPUS_SIZE)
+
+    def check_corpus(self, reference, lenient):
+        expected = self.expected.get(lenient)
+        if expected is None:
+            expected = self.expected[lenient] = \
+                [outcome(reference, url) for url in self.corpus]
+        got = [outcome(url_canon.canon_url_syntax, url, lenient=lenient)
+               for url in self.corpus]
+        for url, e, g in zip(self.corpus, expected, got):
+            if e != g:
+                self.assertEqual(e, g, msg=repr(url))
+
+        many = url_canon.canon_many(self.corpus, lenient=lenient)
+        self.assertEqual(len(many), len(self.corpus))
+        for url, e, m in zip(self.corpus, expected, many):
+            if isinstance(e, tuple):
+                e = None
+            if e != m:
+                self.assertEqual(e, m, msg=repr(url))
+
+    def test_strict(self):
+        self.check_corpus(reference_canon_url_syntax, False)
+
+    def test_lenient(self):
+        self.check_corpus(reference_canon_url_syntax_lenient, True)
+
+    def test_splitresult(self):
+        for url in self.corpus[:10000]:
+            for reference, lenient in (
+                    (reference_canon_url_syntax, False),
+                    (reference_canon_url_syntax_lenient, True)):
+                e = outcome(reference, url, want_splitresult=True)
+                g = outcome(url_canon.canon_url_syntax, url,
+                            want_splitresult=True, lenient=lenient)
+                self.assertEqual(e, g, msg=repr(url))
+                if isinstance(e, tuple):
+                    continue
+                self.assertEqual(
+                    outcome(reference, e),
+                    outcome(url_canon.canon_url_syntax, e, lenient=lenient))
+
+    def test_bytes(self):
+        urls = [u.encode("utf-8", "surrogateescape")
+                for u in self.corpus[:1000]]
+        for url in urls:
+            self.assertEqual(
+                outcome(reference_canon_url_syntax, url, want_splitresult=True),
+                outcome(url_canon.canon_url_syntax, url,
+                        want_splitresult=True))
+
+class TestCompiled(CanonTestBase, unittest.TestCase):
+    def setUp(self):
+        if url_canon._url_canon is None:
+            self.skipTest("_url_canon extension not built")
+
+class TestPurePython(CanonTestBase, unittest.TestCase):
+    def setUp(self):
+        self._saved = (url_canon._url_canon,
+                       url_canon._encode_nonascii_and_percents)
+        url_canon._url_canon = None
+        url_canon._encode_nonascii_and_percents = \
+            url_canon._py_encode_nonascii_and_percents
+
+    def tearDown(self):
+        (url_canon._url_canon,
+         url_canon._encode_nonascii_and_percents) = self._saved
+
+if __name__ == '__main__':
+    unittest.main()
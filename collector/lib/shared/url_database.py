@@ -9,12 +9,18 @@
 # http://www.apache.org/licenses/LICENSE-2.0
 # There is NO WARRANTY.
 
+import csv
+import io
+import itertools
 import psycopg2
 import psycopg2.extras
 import re
 import urllib.parse
 
-from shared.util import canon_url_syntax
+from shared.util import canon_url_syntax, canon_many
+
+# Number of input lines that the bulk importers process at a time.
+BULK_CHUNK_SIZE = 10000
 
 def ensure_database(args):
     """Ensure that the database specified by args.database exists and has
@@ -83,6 +89,102 @@ def add_url_string(db, url):
     finally:
         cur.execute("RELEASE SAVEPOINT url_string_insertion")
 
+def chunked(iterable, size=BULK_CHUNK_SIZE):
+    """Yield successive lists of SIZE items from ITERABLE (the last
+       list may be shorter)."""
+    it = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+def _bulk_failure(errors, url, exc):
+    if errors is None:
+        raise exc
+    errors[url] = exc
+
+def add_url_strings_bulk(cur, urls, errors=None):
+    """Add many URLs to the url_strings table at once.  CUR must be a
+       cursor.  Returns a dictionary mapping each of URLS to the pair
+       (id, url) that add_url_string would have returned for it.
+
+       The URLs are canonicalized in Python, COPYed into a temporary
+       table, and added to url_strings with a single statement that
+       also retrieves the ids of the ones that were already there.
+
+       If ERRORS is None, the first URL that cannot be canonicalized
+       or added raises an exception, as with add_url_string.
+       Otherwise, ERRORS should be a dictionary; each such URL is
+       recorded in it, mapped to the exception, and left out of the
+       result.  The outer transaction is never ruined.
+    """
+    urls = list(dict.fromkeys(urls))
+    canon = {}
+    for url, curl in zip(urls, canon_many(urls)):
+        if curl is not None:
+            canon[url] = curl
+        else:
+            # canon_many doesn't say why; ask canon_url_syntax.
+            try:
+                canon_url_syntax(url)
+            except Exception as e:
+                _bulk_failure(errors, url, e)
+
+    to_add = sorted(set(canon.values()))
+    if not to_add:
+        return {}
+
+    buf = io.StringIO()
+    csv.writer(buf, lineterminator="\n").writerows((u,) for u in to_add)
+    buf.seek(0)
+
+    ids = {}
+    cur.execute("SAVEPOINT url_strings_bulk")
+    try:
+        cur.execute("CREATE TEMPORARY TABLE IF NOT EXISTS url_strings_bulk"
+                    " (url TEXT NOT NULL) ON COMMIT DELETE ROWS")
+        cur.execute("TRUNCATE url_strings_bulk")
+        cur.copy_expert("COPY url_strings_bulk (url)"
+                        " FROM STDIN WITH (FORMAT csv)", buf)
+        # The outer SELECT does not see the rows inserted by the WITH
+        # clause, so this produces each URL exactly once.
+        cur.execute("WITH ins AS ("
+                    "  INSERT INTO url_strings (url)"
+                    "  SELECT url FROM url_strings_bulk"
+                    "  ON CONFLICT (url) DO NOTHING"
+                    "  RETURNING id, url)"
+                    " SELECT id, url FROM ins"
+                    " UNION ALL"
+                    " SELECT s.id, s.url FROM url_strings s"
+                    "   JOIN url_strings_bulk b ON s.url = b.url")
+        for id, url in cur:
+            ids[url] = id
+
+    except psycopg2.Error:
+        # Most likely, one of the URLs is too long to be indexed.
+        # Fall back to adding them one at a time, below.
+        cur.execute("ROLLBACK TO SAVEPOINT url_strings_bulk")
+        ids.clear()
+
+    finally:
+        cur.execute("RELEASE SAVEPOINT url_strings_bulk")
+
+    result = {}
+    for url, curl in canon.items():
+        id = ids.get(curl)
+        if id is None:
+            # Either the bulk insertion failed, or another process
+            # added this URL concurrently.
+            try:
+                id, _ = add_url_string(cur, curl)
+                ids[curl] = id
+            except Exception as e:
+                _bulk_failure(errors, url, e)
+                continue
+        result[url] = (id, curl)
+    return result
+
 # Subroutines and REs for add_site:
 
 def to_https(spliturl):
@@ -117,7 +219,14 @@ no_www_re = re.compile(r"^(?:\d+\.\d+\.\d+\.\d+$|\[[\dA-Fa-f:]+\]$|www\.)")
 def add_site(db, site, http_only=False, www_only=False):
     """Add a site to the url_strings table for DB, if it is not already
        there.  Returns a list of pairs [(id1, url1), (id2, url2), ...]
-       comprising all URLs chosen to represent the site.
+       comprising all URLs chosen to represent the site, which are
+       those that site_urls() returns.
+    """
+    return [ add_url_string(db, url)
+             for url in site_urls(site, http_only, www_only) ]
+
+def site_urls(site, http_only=False, www_only=False):
+    """Return a list of all the URLs chosen to represent SITE.
 
        A "site" is a partial URL, from which the scheme and possibly a
        leading "www." have been stripped.  There may or may not be a
@@ -188,4 +297,4 @@ def add_site(db, site, http_only=False, www_only=False):
             if not http_only:
                 urls.append(to_https(with_path).geturl())
 
-    return [ add_url_string(db, url) for url in urls ]
+    return urls
@@ -18,6 +18,8 @@ import subprocess
 import sys
 import time
 
+import psycopg2.extras
+
 from shared import url_database
 
 class CitizenLabExtractor:
@@ -131,23 +133,20 @@ class CitizenLabExtractor:
     def process_one_import(self, cur, datestamp, country_code, reader):
         sys.stderr.write("Importing {}...".format(country_code))
         sys.stderr.flush()
-        values = []
-        for row in reader:
-            category_code = row['category_code']
-            uid, url = url_database.add_url_string(cur, row['url'])
-            values.append(cur.mogrify("(%s,%s,%s,%s)",
-                                      (uid, country_code, category_code,
-                                       datestamp)))
-
-        if not values:
-            return
-
-        sys.stderr.write(" (insert)")
-        sys.stderr.flush()
-        cur.execute(b"INSERT INTO urls_citizenlab "
-                    b"(url, country, category, retrieval_date) "
-                    b"VALUES "
-                    + b",".join(values))
+        for chunk in url_database.chunked(reader):
+            ids = url_database.add_url_strings_bulk(
+                cur, (row['url'] for row in chunk))
+            values = [(ids[row['url']][0], country_code,
+                       row['category_code'], datestamp)
+                      for row in chunk]
+
+            sys.stderr.write(" (insert {})".format(len(values)))
+            sys.stderr.flush()
+            psycopg2.extras.execute_values(
+                cur,
+                "INSERT INTO urls_citizenlab"
+                " (url, country, category, retrieval_date) VALUES %s",
+                values, page_size=len(values))
 
         sys.stderr.write(" (commit)")
         sys.stderr.flush()
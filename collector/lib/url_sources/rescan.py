@@ -9,6 +9,7 @@
 
 from shared import url_database
 import csv
+import psycopg2.extras
 
 def rescan(args):
     db = url_database.ensure_database(args)
@@ -19,14 +20,13 @@ def rescan(args):
         process_urls(db, rd)
 
 def process_urls(db, rd):
-    batch = []
-    for row in rd:
-        (uid, _) = url_database.add_url_string(db, row['url'])
-        batch.append( (uid, row['result'], row['locales']) )
-
     with db, db.cursor() as cur:
-        batch_str = b",".join(cur.mogrify("(%s,%s,%s)", row)
-                              for row in batch)
-        cur.execute(b"INSERT INTO urls_rescan (url, result, locales)"
-                    b"VALUES " + batch_str)
-        db.commit()
+        for chunk in url_database.chunked(rd):
+            ids = url_database.add_url_strings_bulk(
+                cur, (row['url'] for row in chunk))
+            batch = [(ids[row['url']][0], row['result'], row['locales'])
+                     for row in chunk]
+            psycopg2.extras.execute_values(
+                cur,
+                "INSERT INTO urls_rescan (url, result, locales) VALUES %s",
+                batch, page_size=len(batch))
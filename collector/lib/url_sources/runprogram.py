@@ -8,69 +8,291 @@
 """Run a program under a specified set of proxies --- implementation."""
 
 import asyncio
+import collections
+import concurrent.futures
 import datetime
+import json
 import os
 import subprocess
 import sys
 import tempfile
+import time
 
 from shared.aioproxies import ProxySet
 
-@asyncio.coroutine
-def run_program_for_location(proxy, program, log_dir):
-    try:
-        label = proxy.label()
-        progname = os.path.splitext(os.path.basename(program[0]))[0]
+# Delay before rerunning the program for a location whose proxy went
+# away mid-run: doubles with each interruption, up to the maximum.
+RETRY_BACKOFF     = 60
+RETRY_BACKOFF_MAX = 3600
 
-        fd, logfile = tempfile.mkstemp(
-            dir=log_dir,
-            prefix="{}-{}-".format(progname, proxy.loc),
-            suffix=".log"
-        )
-        os.fchmod(fd, 0o0644)
-
-        start = datetime.datetime.now()
-        sys.stderr.write("{}: {}: running {}...\n".format(
-            start.isoformat(sep=' '), label, progname))
-
-        cmd = ["isolate", "ISOL_RL_WALL=28800", "ISOL_RL_CPU=3600"]
-        cmd.extend(arg.replace("$LOCATION", proxy.loc)
-                   for arg in program)
-        cmd = proxy.adjust_command(cmd)
-
-        proc = yield from asyncio.create_subprocess_exec(
-                *cmd,
-                stdin  = subprocess.DEVNULL,
-                stdout = fd,
-                stderr = fd)
-        os.close(fd)
-        rc = yield from proc.wait()
-        stop = datetime.datetime.now()
+class JobState:
+    """Persistent record of the outcome of running the program for
+       each location, kept as a JSON file.  Each location's entry is a
+       dictionary with these keys:
+
+         status      - "done" (the program exited successfully),
+                       "failed" (it didn't), "interrupted" (the proxy
+                       went away while it was running), or "abandoned"
+                       (interrupted too many times);
+         attempts    - number of times the program has been started,
+                       over all runs;
+         exit        - exit code of the last attempt (negative for a
+                       signal), or null if it was interrupted;
+         started     - when the last attempt started;
+         elapsed     - wall-clock duration of the last attempt, seconds;
+         user_cpu, sys_cpu, max_rss_kb
+                     - resource usage of the last attempt;
+         log         - log file of the last attempt.
+
+       Locations whose status is "done" are skipped on later runs.
+    """
+
+    def __init__(self, fname, program):
+        self.fname     = fname
+        self.program   = list(program)
+        self.locations = {}
+        try:
+            with open(fname) as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            return
+        if saved["program"] != self.program:
+            raise RuntimeError(
+                "{}: state file is for a different command: {}"
+                .format(fname, " ".join(saved["program"])))
+        self.locations = saved["locations"]
+
+    def is_done(self, loc):
+        return self.locations.get(loc, {}).get("status") == "done"
 
-        sys.stderr.write("{}: {}: exit {}, {} elapsed\n".format(
-            stop.isoformat(' '), label, rc, stop - start))
+    def pending(self):
+        """Return an object suitable for ProxySet's INCLUDE_LOCATIONS,
+           which includes all the locations that are not yet done."""
+        return PendingLocations(self)
 
-        if rc:
-            raise subprocess.CalledProcessError(rc, cmd)
+    def record(self, loc, **fields):
+        entry = self.locations.setdefault(loc, { "attempts": 0 })
+        entry.update(fields)
+        self.save()
 
+    def save(self):
+        # Write to a temporary file and rename it into place, so a
+        # crash cannot leave a truncated state file behind.
+        fd, tmpname = tempfile.mkstemp(
+            dir=os.path.dirname(self.fname) or ".",
+            prefix=os.path.basename(self.fname) + ".")
+        try:
+            with open(fd, "wt") as f:
+                json.dump({ "program": self.program,
+                            "locations": self.locations },
+                          f, indent=1, sort_keys=True)
+                f.write("\n")
+            os.replace(tmpname, self.fname)
+        except:
+            os.unlink(tmpname)
+            raise
+
+    def summary(self):
+        counts = collections.Counter(entry.get("status", "unfinished")
+                                     for entry in self.locations.values())
+        return ", ".join("{} {}".format(n, status)
+                         for status, n in sorted(counts.items()))
+
+class PendingLocations:
+    def __init__(self, state):
+        self.state = state
+
+    def __contains__(self, loc):
+        return not self.state.is_done(loc)
+
+@asyncio.coroutine
+def run_isolated(cmd, logfd, waiter, loop):
+    """Run CMD, an 'isolate' command line, with its output going to
+       LOGFD.  Return its exit code (negative for a signal) and its
+       resource usage.
+
+       The process is reaped with os.wait4, on a thread from WAITER,
+       because asyncio's child watcher throws the resource usage
+       away.  isolate reaps the program it runs, so the usage includes
+       the program's.  If cancelled, terminate the process (isolate
+       passes that on to the program's entire process group) and wait
+       for it to exit before re-raising the cancellation."""
+
+    proc = subprocess.Popen(cmd,
+                            stdin  = subprocess.DEVNULL,
+                            stdout = logfd,
+                            stderr = logfd)
+    reaped = loop.run_in_executor(waiter, os.wait4, proc.pid, 0)
+    try:
+        _, status, usage = yield from asyncio.shield(reaped, loop=loop)
+    except asyncio.CancelledError:
+        if not reaped.done():
+            try:
+                proc.terminate()
+            except ProcessLookupError:
+                pass
+        yield from asyncio.wait([reaped], loop=loop)
+        raise
     finally:
-        proxy.close()
+        # Keep Popen from trying to reap it again.
+        proc.returncode = 0
+
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status), usage
+    return os.WEXITSTATUS(status), usage
 
 class RunProgramClient:
     def __init__(self, args, loop=None):
         if loop is None: loop = asyncio.get_event_loop()
         self.args       = args
         self.loop       = loop
-        self.proxies    = ProxySet(args, loop=loop, nstag=args.prefix)
+        self.log_dir    = args.log_dir or "."
+        self.progname   = os.path.splitext(os.path.basename(args.program[0]))[0]
+        os.makedirs(self.log_dir, exist_ok=True)
+
+        self.state      = JobState(
+            args.state_file or os.path.join(self.log_dir,
+                                            self.progname + ".state.json"),
+            args.program)
+        self.proxies    = ProxySet(args, loop=loop, nstag=args.prefix,
+                                   include_locations=self.state.pending())
         self.jobs       = {}
-        if self.args.log_dir:
-            os.makedirs(self.args.log_dir, exist_ok=True)
+        self.tries      = collections.Counter()
+        self.retry_at   = {}
+
+        max_jobs        = args.max_jobs or os.cpu_count() or 1
+        self.job_slots  = asyncio.Semaphore(max_jobs, loop=loop)
+        self.host_slots = {}
+        self.waiter     = concurrent.futures.ThreadPoolExecutor(max_jobs)
+
+    def host_slot(self, proxy):
+        if not self.args.max_jobs_per_host:
+            return None
+        host = proxy.host()
+        slot = self.host_slots.get(host)
+        if slot is None:
+            slot = self.host_slots[host] = \
+                asyncio.Semaphore(self.args.max_jobs_per_host, loop=self.loop)
+        return slot
+
+    @asyncio.coroutine
+    def run_program_for_location(self, proxy):
+        label = proxy.label()
+        loc   = proxy.loc
+
+        fd, logfile = tempfile.mkstemp(
+            dir=self.log_dir,
+            prefix="{}-{}-".format(self.progname, loc),
+            suffix=".log"
+        )
+        try:
+            os.fchmod(fd, 0o0644)
+
+            cmd = ["isolate", "ISOL_RL_WALL=28800", "ISOL_RL_CPU=3600"]
+            cmd.extend(arg.replace("$LOCATION", loc)
+                       for arg in self.args.program)
+            cmd = proxy.adjust_command(cmd)
+
+            self.tries[loc] += 1
+            attempts = self.state.locations.get(loc, {}).get("attempts", 0)
+            self.state.record(loc, attempts=attempts + 1, log=logfile)
+
+            start = datetime.datetime.now()
+            t0 = time.monotonic()
+            sys.stderr.write("{}: {}: running {} (attempt {})...\n".format(
+                start.isoformat(sep=' '), label, self.progname,
+                self.tries[loc]))
+
+            try:
+                rc, usage = yield from run_isolated(cmd, fd, self.waiter,
+                                                    self.loop)
+            except asyncio.CancelledError:
+                self.interrupted(proxy, start, time.monotonic() - t0)
+                raise
+        finally:
+            os.close(fd)
+
+        elapsed = time.monotonic() - t0
+        stop = datetime.datetime.now()
+        sys.stderr.write("{}: {}: exit {}, {} elapsed, "
+                         "cpu {:.1f}s user {:.1f}s sys, max RSS {} MiB\n"
+                         .format(stop.isoformat(' '), label, rc,
+                                 stop - start, usage.ru_utime,
+                                 usage.ru_stime, usage.ru_maxrss // 1024))
+
+        if rc and not proxy.online:
+            # The program probably failed because the proxy went away.
+            self.interrupted(proxy, start, elapsed)
+            return False
+
+        self.state.record(loc,
+                          status     = "failed" if rc else "done",
+                          exit       = rc,
+                          started    = start.isoformat(' '),
+                          elapsed    = round(elapsed, 3),
+                          user_cpu   = round(usage.ru_utime, 3),
+                          sys_cpu    = round(usage.ru_stime, 3),
+                          max_rss_kb = usage.ru_maxrss)
+        return True
+
+    def interrupted(self, proxy, start, elapsed):
+        """Record that the program for PROXY's location was interrupted,
+           and schedule a retry for when the proxy comes back, unless
+           it has been tried too many times already."""
+        loc = proxy.loc
+        n = self.tries[loc]
+        status = "interrupted"
+        if n >= self.args.max_attempts:
+            status = "abandoned"
+            sys.stderr.write("{}: interrupted {} times, giving up\n"
+                             .format(proxy.label(), n))
+            proxy.close()
+        else:
+            self.retry_at[loc] = self.loop.time() + \
+                min(RETRY_BACKOFF << (n - 1), RETRY_BACKOFF_MAX)
+
+        self.state.record(loc,
+                          status  = status,
+                          exit    = None,
+                          started = start.isoformat(' '),
+                          elapsed = round(elapsed, 3))
+
+    @asyncio.coroutine
+    def job_for_location(self, proxy):
+        finished = False
+        try:
+            delay = self.retry_at.get(proxy.loc, 0) - self.loop.time()
+            if delay > 0:
+                sys.stderr.write("{}: retrying in {:.0f}s\n"
+                                 .format(proxy.label(), delay))
+                yield from asyncio.sleep(delay, loop=self.loop)
+
+            # Take the per-host slot first, so that a job waiting for
+            # its host doesn't hold up jobs for other hosts.
+            host_slot = self.host_slot(proxy)
+            if host_slot is not None:
+                yield from host_slot.acquire()
+            try:
+                yield from self.job_slots.acquire()
+                try:
+                    finished = yield from \
+                        self.run_program_for_location(proxy)
+                finally:
+                    self.job_slots.release()
+            finally:
+                if host_slot is not None:
+                    host_slot.release()
+
+        finally:
+            # If the program didn't finish, leave the proxy open so
+            # that ProxySet will restart it and we will try again.
+            if finished:
+                proxy.close()
 
     @asyncio.coroutine
     def proxy_online(self, proxy):
         self.jobs[proxy.loc] = \
-            self.loop.create_task(run_program_for_location(
-                proxy, self.args.program, self.args.log_dir or "."))
+            self.loop.create_task(self.job_for_location(proxy))
 
     @asyncio.coroutine
     def proxy_offline(self, proxy):
@@ -79,11 +301,23 @@ class RunProgramClient:
             del self.jobs[proxy.loc]
             job.cancel()
             # swallow cancellation exception
-            try: yield from asyncio.wait_for(job)
+            try: yield from asyncio.wait([job], loop=self.loop)
             except: pass
 
     @asyncio.coroutine
     def run(self):
-        yield from self.proxies.run(self)
-        if self.jobs:
-            yield from asyncio.wait(self.jobs, loop=self.loop)
+        n_done = sum(1 for loc in self.state.locations
+                     if self.state.is_done(loc))
+        if n_done:
+            sys.stderr.write("{}: skipping {} locations already done\n"
+                             .format(self.progname, n_done))
+        try:
+            if self.proxies.locations:
+                yield from self.proxies.run(self)
+            if self.jobs:
+                yield from asyncio.wait(list(self.jobs.values()),
+                                        loop=self.loop)
+        finally:
+            self.waiter.shutdown()
+            sys.stderr.write("{}: {}\n".format(self.progname,
+                                               self.state.summary()))
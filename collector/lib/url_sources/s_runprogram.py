@@ -11,6 +11,15 @@
    program to run; all subsequent arguments are passed to the program.
    Stdout/stderr of the program are written to log files named
    <PROGRAM_BASENAME>-<PROXY>-<SERIAL>.log.
+
+   At most --max-jobs copies of the program run at once, and at most
+   --max-jobs-per-host through proxies that lead to the same machine.
+   If a proxy goes away while the program is running, the program is
+   killed and rerun (after a delay) once the proxy comes back.  The
+   outcome for each location, with its duration and CPU and memory
+   usage, is recorded in a state file (by default
+   <PROGRAM_BASENAME>.state.json in the log directory); locations
+   that the state file says are done are skipped.
 """
 
 def setup_argp(ap):
@@ -28,6 +37,21 @@ def setup_argp(ap):
     ap.add_argument("-P", "--prefix",
                     action="store", default="t",
                     help="Network namespace prefix to use.")
+    ap.add_argument("-j", "--max-jobs",
+                    action="store", type=int, default=None,
+                    help="Maximum number of copies of the program to run"
+                    " simultaneously (default: number of CPUs).")
+    ap.add_argument("-H", "--max-jobs-per-host",
+                    action="store", type=int, default=0,
+                    help="Maximum number of copies of the program to run"
+                    " simultaneously through each proxy host"
+                    " (default: no limit).")
+    ap.add_argument("-r", "--max-attempts",
+                    action="store", type=int, default=5,
+                    help="Give up on a location after the program has been"
+                    " interrupted this many times.")
+    ap.add_argument("-s", "--state-file", action="store",
+                    help="File recording which locations are done.")
 
 def run(args):
     import asyncio
@@ -11,6 +11,8 @@
 import sys
 import re
 
+import psycopg2.extras
+
 from shared import url_database
 
 class StaticListExtractor:
@@ -79,66 +81,75 @@ class StaticListExtractor:
 
     _has_scheme = re.compile(r"(?i)^[a-z]+://")
 
-    def load_urls(self, db, fp):
-        to_insert = set()
+    def error(self, lineno, msg):
+        sys.stderr.write("{}:{}: {}\n".format(self.args.file, lineno, msg))
+        self.delayed_failure = True
 
-        sys.stderr.write("Importing {}...".format(self.source_label))
-        sys.stderr.flush()
+    def read_entries(self, fp):
+        """Yield a triple (lineno, line, urls) for each URL or site
+           listed in FP, where URLS is the list of URLs to be recorded
+           for that line."""
+        for line in fp:
+            line = line.strip()
+            self.lineno += 1
 
-        with db, db.cursor() as cur:
-            for line in fp:
-                line = line.strip()
-                self.lineno += 1
+            if line == "" or line[0] == "#":
+                continue
 
-                if line == "" or line[0] == "#":
+            if self._has_scheme.match(line):
+                if (not line.startswith("http://") and
+                    not line.startswith("https://")):
+                    self.error(self.lineno,
+                               "non-HTTP(S) URL: {!r}".format(line))
                     continue
+                yield (self.lineno, line, [line])
 
-                if self._has_scheme.match(line):
-                    if (not line.startswith("http://") and
-                        not line.startswith("https://")):
-                        sys.stderr.write("{}:{}: non-HTTP(S) URL: {!r}\n"
-                                         .format(self.args.file,
-                                                 self.lineno, line))
-                        self.delayed_failure = True
-                        continue
-
-                    try:
-                        (url_id, _) = url_database.add_url_string(cur, line)
-
-                    except Exception as e:
-                        sys.stderr.write("{}:{}: {}\n"
-                                         .format(self.args.file, self.lineno,
-                                                 str(e)))
-                        self.delayed_failure = True
-                        continue
-
-                    to_insert.add(cur.mogrify("(%s, %s)",
-                                              (url_id, self.import_id)))
-
-                else:
-                    try:
-                        urls = url_database.add_site(cur, line)
-
-                    except Exception as e:
-                        sys.stderr.write("{}:{}: {}\n"
-                                         .format(self.args.file, self.lineno,
-                                                 str(e)))
-                        self.delayed_failure = True
-                        continue
-
-                    for pair in urls:
-                        to_insert.add(cur.mogrify("(%s, %s)",
-                                                  (pair[0], self.import_id)))
+            else:
+                try:
+                    urls = url_database.site_urls(line)
+                except Exception as e:
+                    self.error(self.lineno, str(e))
+                    continue
+                yield (self.lineno, line, urls)
+
+    def load_urls(self, db, fp):
+        sys.stderr.write("Importing {}...".format(self.source_label))
+        sys.stderr.flush()
+
+        with db, db.cursor() as cur:
+            for chunk in url_database.chunked(self.read_entries(fp)):
+                self.load_chunk(cur, chunk)
 
             if self.delayed_failure:
                 raise SystemExit(1)
 
-            sys.stderr.write(" (insert)")
-            sys.stderr.flush()
-            cur.execute(b"INSERT INTO urls_staticlist "
-                        b"(url, listid) VALUES "
-                        + b",".join(sorted(to_insert)))
-
             sys.stderr.write(" (commit)")
             sys.stderr.flush()
         sys.stderr.write("\n")
+
+    def load_chunk(self, cur, chunk):
+        errors = {}
+        ids = url_database.add_url_strings_bulk(
+            cur, (url for _, _, urls in chunk for url in urls), errors)
+
+        to_insert = set()
+        for lineno, line, urls in chunk:
+            failed = [url for url in urls if url in errors]
+            if failed:
+                self.error(lineno, str(errors[failed[0]]))
+                continue
+            for url in urls:
+                to_insert.add((ids[url][0], self.import_id))
+
+        # Nothing will be committed if there were any errors, so
+        # don't bother inserting anything.
+        if self.delayed_failure or not to_insert:
+            return
+
+        sys.stderr.write(" (insert {})".format(len(to_insert)))
+        sys.stderr.flush()
+        psycopg2.extras.execute_values(
+            cur,
+            "INSERT INTO urls_staticlist (url, listid) VALUES %s"
+            " ON CONFLICT DO NOTHING",
+            sorted(to_insert), page_size=len(to_insert))
@@ -1,123 +1,234 @@
-import re
-import urllib.parse
-import psycopg2
-import sys
+#! /usr/bin/python3
+
+# Audit url_strings for URLs that are not in canonical form.
+#
+# usage: audit_url_strings.py [--fix] [--workers N] [--batch-size N] DBNAME
+#
+# Writes a CSV report to stdout, one row per non-canonical URL:
+# bad_id, good_id, bad_url, good_url.  good_url is the canonical form
+# of bad_url (empty if it cannot be canonicalized at all), and good_id
+# is the id of the canonical url_strings row with that URL, if there
+# is one.
+#
+# url_strings is scanned in id order through a server-side cursor, in
+# batches that are canonicalized by a pool of worker processes, so
+# the table never has to fit in memory.  The non-canonical URLs are
+# COPYed into a temporary table, and matched up with their canonical
+# counterparts by a single join at the end.
+#
+# With --fix, references to each non-canonical URL from urls and
+# captured_pages are then changed to refer to its canonical
+# counterpart instead (where there is one), a batch at a time.  The
+# non-canonical url_strings rows themselves are left alone.
+
+import argparse
 import csv
+import io
+import multiprocessing
+import os
+import sys
+import time
 
-def _urlsplit_forced_encoding(url):
-    try:
-        return urllib.parse.urlsplit(url)
-    except UnicodeDecodeError:
-        return urllib.parse.urlsplit(url.decode("utf-8", "surrogateescape"))
-
-_enap_re = re.compile(br'[\x00-\x20\x7F-\xFF]|'
-                      br'%(?!(?:[0-9A-Fa-f]{2}|u[0-9A-Fa-f]{4}))')
-def _encode_nonascii_and_percents(segment):
-    segment = segment.encode("utf-8", "surrogateescape")
-    return _enap_re.sub(
-        lambda m: "%{:02X}".format(ord(m.group(0))).encode("ascii"),
-        segment).decode("ascii")
-
-def canon_url_syntax(url, *, want_splitresult=None):
-    """Syntactically canonicalize a URL.  This makes the following
-       transformations:
-         - scheme and hostname are lowercased
-         - hostname is punycoded if necessary
-         - vacuous user, password, and port fields are stripped
-         - ports redundant to the scheme are also stripped
-         - path becomes '/' if empty
-         - characters outside the printable ASCII range in path,
-           query, fragment, user, and password are %-encoded, as are
-           improperly used % signs
-
-       You can provide either a string or a SplitResult, and you get
-       back what you put in.  You can set the optional argument
-       want_splitresult to True or False to force a particular
-       type of output.
-    """
-
-    if isinstance(url, urllib.parse.SplitResult):
-        if want_splitresult is None: want_splitresult = True
-        exploded = url
-
-    else:
-        if want_splitresult is None: want_splitresult = False
-
-        exploded = _urlsplit_forced_encoding(url)
-        if not exploded.hostname:
-            # Remove extra slashes after the scheme and retry.
-            corrected = re.sub(r'(?i)^([a-z]+):///+', r'\1://', url)
-            exploded = _urlsplit_forced_encoding(corrected)
-
-    if not exploded.hostname:
-        raise ValueError("url with no host - " + repr(url))
-
-    scheme = exploded.scheme
-    if scheme != "http" and scheme != "https":
-        raise ValueError("url with non-http(s) scheme - " + repr(url))
-
-    host   = exploded.hostname
-    user   = _encode_nonascii_and_percents(exploded.username or "")
-    passwd = _encode_nonascii_and_percents(exploded.password or "")
-    port   = exploded.port
-    path   = _encode_nonascii_and_percents(exploded.path)
-    query  = _encode_nonascii_and_percents(exploded.query)
-    frag   = _encode_nonascii_and_percents(exploded.fragment)
-
-    if path == "":
-        path = "/"
-
-    # We do this even if there are no non-ASCII characters, because it
-    # has the side-effect of throwing a UnicodeError if the hostname
-    # is syntactically invalid (e.g. "foo..com").
-    host = host.encode("idna").decode("ascii")
-
-    if port is None:
-        port = ""
-    elif ((port == 80  and scheme == "http") or
-          (port == 443 and scheme == "https")):
-        port = ""
-    else:
-        port = ":{}".format(port)
-
-    # We don't have to worry about ':' or '@' in the user and password
-    # strings, because urllib.parse does not do %-decoding on them.
-    if user == "" and passwd == "":
-        auth = ""
-    elif passwd == "":
-        auth = "{}@".format(user)
-    else:
-        auth = "{}:{}@".format(user, passwd)
-    netloc = auth + host + port
-
-    result = urllib.parse.SplitResult(scheme, netloc, path, query, frag)
-    if want_splitresult:
-        return result
-    else:
-        return result.geturl()
+import psycopg2
 
-def main():
-    db = psycopg2.connect(dbname=sys.argv[1])
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "lib"))
+from shared.url_canon import canon_many
+
+def fmt_elapsed(start):
+    interval = time.monotonic() - start
+    m, s = divmod(interval, 60)
+    h, m = divmod(m, 60)
+    return "{}:{:>02}:{:>05.2f}".format(int(h), int(m), s)
+
+def progress(start, msg, *args):
+    sys.stderr.write("[{}] {}\n".format(fmt_elapsed(start),
+                                         msg.format(*args)))
+
+def audit_batch(rows):
+    """Worker: ROWS is a list of (id, url) pairs.  Return the
+       (id, url, canonical url) triples for the urls that are not
+       canonical; the canonical url is None if there isn't one."""
+    canon = canon_many(url for _, url in rows)
+    return [(id, url, good)
+            for (id, url), good in zip(rows, canon)
+            if url != good]
+
+def copy_bad_urls(cur, bad):
+    buf = io.StringIO()
+    wr = csv.writer(buf, lineterminator="\n")
+    # In CSV format, an unquoted empty field is NULL, and the csv
+    # module writes None as an unquoted empty field.  url_strings.url
+    # cannot be empty, so no real URL is mistaken for NULL.
+    wr.writerows(bad)
+    buf.seek(0)
+    cur.copy_expert("COPY audit_bad_urls (bad_id, bad_url, good_url)"
+                    " FROM STDIN WITH (FORMAT csv)", buf)
+
+def scan(db, pool, workers, batch_size, start):
+    """Find all the non-canonical URLs and load them into the
+       temporary table audit_bad_urls.  Returns the number of
+       url_strings scanned and the number of non-canonical URLs."""
     cur = db.cursor()
-
-    good_urls = {}
-    bad_urls  = {}
-
-    cur.execute("SELECT id, url FROM url_strings")
-    for id, url in cur:
-        try:
-            canon_url = canon_url_syntax(url)
-        except Exception:
-            canon_url = None
-        if url == canon_url:
-            good_urls[url] = id
-        else:
-            bad_urls[url] = (id, canon_url)
-
-    wr = csv.writer(sys.stdout, dialect='unix', quoting=csv.QUOTE_NONNUMERIC)
+    cur.execute("CREATE TEMPORARY TABLE audit_bad_urls ("
+                "  bad_id   INTEGER NOT NULL PRIMARY KEY,"
+                "  bad_url  TEXT    NOT NULL,"
+                "  good_url TEXT,"
+                "  good_id  INTEGER"
+                ")")
+
+    scan_cur = db.cursor("audit_url_strings_scan")
+    scan_cur.itersize = batch_size
+    scan_cur.execute("SELECT id, url FROM url_strings ORDER BY id")
+
+    n_scanned = 0
+    n_bad = 0
+    while True:
+        # Keep every worker busy, but never hold more than a few
+        # batches per worker in memory.
+        block = []
+        for _ in range(workers * 4):
+            rows = scan_cur.fetchmany(batch_size)
+            if not rows:
+                break
+            block.append(rows)
+        if not block:
+            break
+
+        for bad in pool.imap_unordered(audit_batch, block):
+            if bad:
+                copy_bad_urls(cur, bad)
+                n_bad += len(bad)
+        n_scanned += sum(len(rows) for rows in block)
+        progress(start, "{} scanned, {} not canonical (last id {})",
+                 n_scanned, n_bad, block[-1][-1][0])
+
+    scan_cur.close()
+    return n_scanned, n_bad
+
+def resolve(db, start):
+    """Fill in audit_bad_urls.good_id.  Only canonical url_strings
+       rows are eligible, i.e. those not in audit_bad_urls themselves."""
+    cur = db.cursor()
+    cur.execute("ANALYZE audit_bad_urls")
+    cur.execute("UPDATE audit_bad_urls b SET good_id = g.id"
+                "  FROM url_strings g"
+                " WHERE g.url = b.good_url"
+                "   AND NOT EXISTS (SELECT 1 FROM audit_bad_urls x"
+                "                    WHERE x.bad_id = g.id)")
+    progress(start, "{} non-canonical URLs have a canonical counterpart",
+             cur.rowcount)
+
+def report(db, outf, batch_size):
+    cur = db.cursor("audit_url_strings_report")
+    cur.itersize = batch_size
+    cur.execute("SELECT bad_id, good_id, bad_url, good_url"
+                "  FROM audit_bad_urls ORDER BY bad_id")
+
+    wr = csv.writer(outf, dialect='unix', quoting=csv.QUOTE_NONNUMERIC)
     wr.writerow(("bad_id", "good_id", "bad_url", "good_url"))
-    for bad_url, (bad_id, good_url) in bad_urls.items():
-        good_id = good_urls.get(good_url)
-        wr.writerow((bad_id, good_id, bad_url, good_url))
+    for row in cur:
+        wr.writerow(row)
+    cur.close()
+
+# Each of these statements changes references to non-canonical URLs
+# with bad_id in a range [%(lo)s, %(hi)s) to refer to the canonical
+# URL instead.  A captured_pages row is left alone if changing its url
+# would make it a duplicate of an existing capture.
+FIX_STATEMENTS = [
+    ("urls.url",
+     "UPDATE urls u SET url = b.good_id"
+     "  FROM audit_bad_urls b"
+     " WHERE u.url = b.bad_id AND b.good_id IS NOT NULL"
+     "   AND b.bad_id >= %(lo)s AND b.bad_id < %(hi)s"),
+    ("captured_pages.url",
+     "UPDATE captured_pages c SET url = b.good_id"
+     "  FROM audit_bad_urls b"
+     " WHERE c.url = b.bad_id AND b.good_id IS NOT NULL"
+     "   AND b.bad_id >= %(lo)s AND b.bad_id < %(hi)s"
+     "   AND NOT EXISTS (SELECT 1 FROM captured_pages d"
+     "                    WHERE d.url = b.good_id"
+     "                      AND d.country = c.country"
+     "                      AND d.vantage = c.vantage"
+     "                      AND d.access_time = c.access_time)"),
+    ("captured_pages.redir_url",
+     "UPDATE captured_pages c SET redir_url = b.good_id"
+     "  FROM audit_bad_urls b"
+     " WHERE c.redir_url = b.bad_id AND b.good_id IS NOT NULL"
+     "   AND b.bad_id >= %(lo)s AND b.bad_id < %(hi)s"),
+]
+
+def fix(db, batch_size, start):
+    """Remap references to non-canonical URLs, BATCH_SIZE bad ids per
+       transaction.  A batch that fails (e.g. because two bad URLs in
+       it would turn into the same capture) is rolled back and
+       reported, and the fix carries on with the next batch."""
+    cur = db.cursor()
+    cur.execute("SELECT bad_id FROM audit_bad_urls"
+                " WHERE good_id IS NOT NULL ORDER BY bad_id")
+    ids = [r[0] for r in cur]
+    db.commit()
+
+    totals = { name: 0 for name, _ in FIX_STATEMENTS }
+    failed = []
+    for i in range(0, len(ids), batch_size):
+        lo = ids[i]
+        hi = ids[min(i + batch_size, len(ids)) - 1] + 1
+        try:
+            with db:
+                counts = []
+                for name, stmt in FIX_STATEMENTS:
+                    cur.execute(stmt, { "lo": lo, "hi": hi })
+                    counts.append((name, cur.rowcount))
+        except psycopg2.IntegrityError as e:
+            progress(start, "batch [{}, {}) not fixed: {}",
+                     lo, hi, str(e).strip())
+            failed.append((lo, hi))
+            continue
+        for name, n in counts:
+            totals[name] += n
+        progress(start, "fixed ids < {}: {}", hi,
+                 ", ".join("{} {}".format(n, name) for name, n in counts))
+
+    progress(start, "fix complete: {}",
+             ", ".join("{} {}".format(n, name)
+                       for name, n in totals.items()))
+    if failed:
+        progress(start, "{} batches not fixed: {}", len(failed),
+                 " ".join("[{},{})".format(lo, hi) for lo, hi in failed))
 
-main()
+def main():
+    ap = argparse.ArgumentParser(
+        description="Report, and optionally fix, non-canonical URLs"
+                    " in url_strings.")
+    ap.add_argument("dbname")
+    ap.add_argument("--fix", action="store_true",
+                    help="Remap references from urls and captured_pages"
+                         " to the canonical form of each URL.")
+    ap.add_argument("--workers", type=int, default=os.cpu_count(),
+                    help="Number of canonicalization processes"
+                         " (default: one per CPU).")
+    ap.add_argument("--batch-size", type=int, default=10000,
+                    help="URLs per batch, both for scanning and for"
+                         " --fix (default %(default)s).")
+    args = ap.parse_args()
+
+    start = time.monotonic()
+    # Start the workers before connecting, so they don't inherit the
+    # database connection.
+    with multiprocessing.Pool(args.workers) as pool:
+        db = psycopg2.connect(dbname=args.dbname)
+        n_scanned, n_bad = scan(db, pool, args.workers, args.batch_size,
+                                start)
+    progress(start, "scan complete: {} scanned, {} not canonical",
+             n_scanned, n_bad)
+
+    resolve(db, start)
+    report(db, sys.stdout, args.batch_size)
+    db.commit()
+
+    if args.fix:
+        fix(db, args.batch_size, start)
+
+if __name__ == '__main__':
+    main()
@@ -1,129 +1,161 @@
 #! /usr/bin/python3
 
-import subprocess
-import sys
+# For each warts file of tracelb results, convert every trace to the
+# sequence of countries it passes through, and report the distinct
+# common prefixes of those country paths (one line per prefix, tagged
+# with the file's basename).
+#
+# usage: country-trace-prefix.py [options] WARTS-FILE...
+#
+# The warts files are decoded in parallel worker processes; see
+# shared/tracelb.py.  With --out DIR, every per-destination country
+# path is also written to DIR, as raw little-endian arrays that can be
+# memory-mapped (e.g. with numpy.memmap) for aggregation:
+#
+#    file.i32        n_paths  index into files.txt of each path's file
+#    source.u32      n_paths  IPv4 address of the vantage point
+#    dest.u32        n_paths  IPv4 address of the destination
+#    path_ptr.i64    n_paths+1 offsets of each path in hops.i32
+#    hops.i32        countries along each path, as indices into
+#                    countries.txt
+#    files.txt       warts file basenames, one per line
+#    countries.txt   country names, one per line
+#    meta.json       number of paths and hops
+
+import argparse
+import array
+import json
+import multiprocessing
 import os
-import re
-import functools
-from collections import defaultdict
-
-def toposort2(data):
-    # Ignore self dependencies.
-    for k, v in data.items():
-        v.discard(k)
-    # Find all items that don't depend on anything.
-    extra_items_in_deps = functools.reduce(set.union, data.values()) - set(data.keys())
-    # Add empty dependences where needed
-    data.update({item:set() for item in extra_items_in_deps})
-    while True:
-        ordered = set(item for item, dep in data.items() if not dep)
-        if not ordered:
-            break
-        for o in sorted(ordered): yield o
-        data = {item: (dep - ordered)
-                for item, dep in data.items()
-                    if item not in ordered}
-
-def squeeze_repeats(seq):
-    rv = []
-    prev = None
-    for s in seq:
-        if s != prev:
-            rv.append(s)
-            prev = s
-    rv.reverse()
-    return rv
-
-import GeoIP
-GI = GeoIP.open("/usr/share/GeoIP/GeoIPCity.dat", GeoIP.GEOIP_STANDARD)
-@functools.lru_cache(maxsize=1024)
-def get_country(ipaddr):
-    if ipaddr == "<origin>":
-        return "<origin>"
-    if ipaddr == "*":
-        return "[unknown IP]"
-    try:
-        gir = GI.record_by_addr(ipaddr)
-        if gir: return gir['country_name']
-    except:
-        pass
-    return "[unknown location]"
-
-new_trace_re = re.compile(r"^tracelb from ([0-9.]+) to ([0-9.]+),")
-
-def process_decoded(inf, infname):
-    destinations = {}
-    current_trace = None
-    current_dest = None
-    me = None
-    for line in inf:
-        line = line.decode("ascii")
-        m = new_trace_re.match(line)
-        if m:
-            if current_trace is not None:
-                assert current_dest is not None
-                destinations[current_dest] = squeeze_repeats(get_country(x) for x in toposort2(current_trace))
-            me = m.group(1)
-            current_dest = m.group(2)
-            current_trace = defaultdict(set)
-        else:
-            hops = line.strip().split(" -> ")
-            assert len(hops) >= 2
-
-            if me:
-                if hops[0] == '*':
-                    hops[0] = '<origin>'
-                me = None
-
-            for i in range(len(hops)-1):
-                f, t = hops[i], hops[i+1]
-                if f[0] == '(':
-                    f = f[1:-1].split(", ")
-                else:
-                    f = [f]
-                if t[0] == '(':
-                    t = t[1:-1].split(", ")
-                else:
-                    t = [t]
-
-                for ff in f:
-                    for tt in t:
-                        current_trace[ff].add(tt)
-
-    if current_trace is not None:
-        assert current_dest is not None
-        destinations[current_dest] = squeeze_repeats(get_country(x) for x in toposort2(current_trace))
-
-    junk = set()
-    for tag, trace in destinations.items():
-        if trace and trace[0] == '<origin>':
-            del trace[0]
-        if trace and trace[0] == 'Anonymous Proxy':
-            del trace[0]
-        if not trace:
-            junk.add(tag)
-
-    for tag in junk:
-        del destinations[tag]
+import sys
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "lib"))
+from shared.tracelb import decode_warts, country_path, CountryResolver
+
+class PathWriter:
+    """Accumulates country paths in columnar form; see above."""
+
+    def __init__(self, outdir):
+        os.makedirs(outdir, exist_ok=True)
+        self.outdir    = outdir
+        self.countries = {}
+        self.n_paths   = 0
+        self.n_hops    = 0
+        self._files = {
+            name: open(os.path.join(outdir, name), "wb")
+            for name in ("file.i32", "source.u32", "dest.u32",
+                         "path_ptr.i64", "hops.i32", "files.txt")
+        }
+        self._write("path_ptr.i64", array.array('q', [0]))
+
+    def _write(self, name, arr):
+        if sys.byteorder != 'little':
+            arr.byteswap()
+        arr.tofile(self._files[name])
+
+    def add_file(self, file_idx, fname, paths):
+        """PATHS is a list of (source, dest, country list) triples."""
+        self._files["files.txt"].write((fname + "\n").encode("utf-8"))
+        file_col   = array.array('i', [file_idx] * len(paths))
+        source_col = array.array('I')
+        dest_col   = array.array('I')
+        ptrs       = array.array('q')
+        hops       = array.array('i')
+        for source, dest, countries in paths:
+            source_col.append(source)
+            dest_col.append(dest)
+            for c in countries:
+                hops.append(self.countries.setdefault(c, len(self.countries)))
+            ptrs.append(self.n_hops + len(hops))
+
+        self.n_paths += len(paths)
+        self.n_hops  += len(hops)
+        self._write("file.i32", file_col)
+        self._write("source.u32", source_col)
+        self._write("dest.u32", dest_col)
+        self._write("path_ptr.i64", ptrs)
+        self._write("hops.i32", hops)
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        with open(os.path.join(self.outdir, "countries.txt"), "wt",
+                  encoding="utf-8") as f:
+            for c in sorted(self.countries, key=self.countries.get):
+                f.write(c + "\n")
+        with open(os.path.join(self.outdir, "meta.json"), "wt") as f:
+            json.dump({ "n_paths": self.n_paths, "n_hops": self.n_hops },
+                      f)
+            f.write("\n")
+
+def report_prefixes(out, tag, destinations):
     prefixes = set()
     traces = sorted(destinations.values())
     for a, b in zip(traces[:-1], traces[1:]):
         p = os.path.commonprefix([a, b])
         if p: prefixes.add(tuple(p))
 
-    infname = os.path.splitext(os.path.basename(infname))[0]
     if not prefixes:
-        sys.stdout.write("{}\t[no data]\n".format(infname))
+        out.write("{}\t[no data]\n".format(tag))
     else:
         for p in sorted(prefixes):
-            sys.stdout.write("{}\t{}\n".format(infname, ", ".join(p)))
-
-def process_wf(wf):
-    with subprocess.Popen(["sc_warts2text", wf],
-                          stdin  = subprocess.DEVNULL,
-                          stdout = subprocess.PIPE) as proc:
-        process_decoded(proc.stdout, wf)
+            out.write("{}\t{}\n".format(tag, ", ".join(p)))
+
+def process_traces(resolver, traces):
+    """Return a dictionary mapping each destination to a pair
+       (source, country path).  If there is more than one trace to
+       the same destination, the last one wins."""
+    countries = resolver.resolve_many(h for t in traces for h in t.hops
+                                      if h >= 0)
+    destinations = {}
+    for t in traces:
+        path = country_path(t.hops, countries)
+        if path:
+            destinations[t.dest] = (t.source, path)
+        else:
+            destinations.pop(t.dest, None)
+    return destinations
+
+def main():
+    ap = argparse.ArgumentParser(
+        description="Report the common prefixes of the country paths"
+                    " taken by the traceroutes in each warts file.")
+    ap.add_argument("warts", nargs="+")
+    ap.add_argument("--geoip", default="/usr/share/GeoIP/GeoIPCity.dat",
+                    help="GeoIP database (default %(default)s).")
+    ap.add_argument("--country-csv", metavar="FILE",
+                    help="Use a GeoIP country CSV file instead of"
+                         " --geoip.")
+    ap.add_argument("--out", metavar="DIR",
+                    help="Also write all the country paths to DIR.")
+    ap.add_argument("--workers", type=int, default=os.cpu_count(),
+                    help="Number of decoding processes"
+                         " (default: one per CPU).")
+    args = ap.parse_args()
+
+    if args.country_csv:
+        resolver = CountryResolver.from_csv(args.country_csv)
+    else:
+        resolver = CountryResolver.from_geoip(args.geoip)
+    writer = PathWriter(args.out) if args.out else None
 
-for wf in sys.argv[1:]: 
-    process_wf(wf)
+    try:
+        with multiprocessing.Pool(args.workers) as pool:
+            for i, (wf, traces) in enumerate(zip(
+                    args.warts, pool.imap(decode_warts, args.warts))):
+                destinations = process_traces(resolver, traces)
+                tag = os.path.splitext(os.path.basename(wf))[0]
+                report_prefixes(sys.stdout, tag,
+                                { d: path
+                                  for d, (_, path) in destinations.items() })
+                if writer is not None:
+                    writer.add_file(i, tag, [
+                        (source, dest, path)
+                        for dest, (source, path)
+                        in sorted(destinations.items())])
+    finally:
+        if writer is not None:
+            writer.close()
+
+main()
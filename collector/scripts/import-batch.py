@@ -2,15 +2,18 @@
 
 import collections
 import datetime
+import functools
 import hashlib
 import os
 import psycopg2
-import re
 import sys
 import time
-import urllib.parse
 import zlib
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "lib"))
+from shared import url_canon
+
 zlib_nothing = zlib.compress(b'')
 
 class savepoint:
@@ -28,94 +31,12 @@ class savepoint:
             self._cur.execute('ROLLBACK TO SAVEPOINT "' + self._name + '"')
         return False
 
-def _urlsplit_forced_encoding(url):
-    try:
-        return urllib.parse.urlsplit(url)
-    except UnicodeDecodeError:
-        return urllib.parse.urlsplit(url.decode("utf-8", "surrogateescape"))
-
-_enap_re = re.compile(br'[\x00-\x20\x7F-\xFF]|'
-                      br'%(?!(?:[0-9A-Fa-f]{2}|u[0-9A-Fa-f]{4}))')
-def _encode_nonascii_and_percents(segment):
-    segment = segment.encode("utf-8", "surrogateescape")
-    return _enap_re.sub(
-        lambda m: "%{:02X}".format(ord(m.group(0))).encode("ascii"),
-        segment).decode("ascii")
-
-def canon_url_syntax(url, *, want_splitresult=None):
-    """Syntactically canonicalize a URL.  This makes the following
-       transformations:
-         - scheme and hostname are lowercased
-         - hostname is punycoded if necessary
-         - vacuous user, password, and port fields are stripped
-         - ports redundant to the scheme are also stripped
-         - path becomes '/' if empty
-         - characters outside the printable ASCII range in path,
-           query, fragment, user, and password are %-encoded, as are
-           improperly used % signs
-
-       You can provide either a string or a SplitResult, and you get
-       back what you put in.  You can set the optional argument
-       want_splitresult to True or False to force a particular
-       type of output.
-
-       This version of this function tolerates a number of syntactic
-       problems that other versions reject, e.g. "http:/host.dom.ain"
-       and "itmss://whatever".
-    """
-
-    if isinstance(url, urllib.parse.SplitResult):
-        if want_splitresult is None: want_splitresult = True
-        exploded = url
-
-    else:
-        if want_splitresult is None: want_splitresult = False
-
-        exploded = _urlsplit_forced_encoding(url)
-        if not exploded.hostname:
-            # Canonicalize the number of slashes after the scheme and retry.
-            corrected = re.sub(r'(?i)^([a-z]+):/+', r'\1://', url)
-            exploded = _urlsplit_forced_encoding(corrected)
-
-    scheme = exploded.scheme
-    host   = exploded.hostname or ""
-    user   = _encode_nonascii_and_percents(exploded.username or "")
-    passwd = _encode_nonascii_and_percents(exploded.password or "")
-    port   = exploded.port
-    path   = _encode_nonascii_and_percents(exploded.path or "/")
-    query  = _encode_nonascii_and_percents(exploded.query)
-    frag   = _encode_nonascii_and_percents(exploded.fragment)
-
-    # It is easier to do this unconditionally than to try to detect
-    # non-ASCII characters.  The split-join is to avoid barfing on
-    # syntactically invalid hostnames (e.g. "foo..com").
-    # encode('idna') is idempotent.
-    host = ".".join((label.encode("idna").decode("ascii") if label else "")
-                    for label in host.split("."))
-
-    if port is None:
-        port = ""
-    elif ((port == 80  and scheme == "http") or
-          (port == 443 and scheme == "https")):
-        port = ""
-    else:
-        port = ":{}".format(port)
-
-    # We don't have to worry about ':' or '@' in the user and password
-    # strings, because urllib.parse does not do %-decoding on them.
-    if user == "" and passwd == "":
-        auth = ""
-    elif passwd == "":
-        auth = "{}@".format(user)
-    else:
-        auth = "{}:{}@".format(user, passwd)
-    netloc = auth + host + port
-
-    result = urllib.parse.SplitResult(scheme, netloc, path, query, frag)
-    if want_splitresult:
-        return result
-    else:
-        return result.geturl()
+# This script needs the version of canon_url_syntax that tolerates
+# syntactic problems the other users reject, e.g. "http:/host.dom.ain"
+# and "itmss://whatever".
+canon_url_syntax = functools.partial(url_canon.canon_url_syntax,
+                                     lenient=True)
+
 
 def add_url_string(cur, url):
     """Add an URL to the url_strings table for DB, if it is not already there.